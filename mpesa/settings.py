@@ -1,6 +1,8 @@
 
 from pathlib import Path
 
+from decouple import config
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -37,6 +39,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'stkpush.log.RequestContextMiddleware',
 ]
 
 ROOT_URLCONF = 'mpesa.urls'
@@ -63,14 +66,102 @@ WSGI_APPLICATION = 'mpesa.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.1/ref/settings/#databases
 
-DATABASES = {
+# SQLite by default; MPESA_DB_ENGINE=postgresql with the MPESA_DB_* settings for Postgres.
+# SQLite connections get WAL mode and a busy timeout when opened (stkpush.db).
+DB_ENGINE = config('MPESA_DB_ENGINE', default='sqlite3')
+
+if DB_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': config('MPESA_DB_NAME', default='mpesa'),
+            'USER': config('MPESA_DB_USER', default='mpesa'),
+            'PASSWORD': config('MPESA_DB_PASSWORD', default=''),
+            'HOST': config('MPESA_DB_HOST', default='localhost'),
+            'PORT': config('MPESA_DB_PORT', default='5432'),
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': config('MPESA_DB_NAME', default=str(BASE_DIR / 'db.sqlite3')),
+        }
+    }
+
+# Keep connections open between requests (seconds; 0 closes after each request),
+# checking on reuse that the server has not dropped them
+DATABASES['default']['CONN_MAX_AGE'] = config('MPESA_DB_CONN_MAX_AGE', default=60, cast=int)
+DATABASES['default']['CONN_HEALTH_CHECKS'] = True
+
+# Optional read replica for status checks, payment listings and exports. Set its
+# host (Postgres) or file (a replicated SQLite copy); the other settings are shared.
+DB_REPLICA_HOST = config('MPESA_DB_REPLICA_HOST', default='')
+DB_REPLICA_NAME = config('MPESA_DB_REPLICA_NAME', default='')
+if DB_REPLICA_HOST or DB_REPLICA_NAME:
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'HOST': DB_REPLICA_HOST or DATABASES['default'].get('HOST', ''),
+        'PORT': config('MPESA_DB_REPLICA_PORT', default=DATABASES['default'].get('PORT', '')),
+        'NAME': DB_REPLICA_NAME or DATABASES['default']['NAME'],
+        'TEST': {'MIRROR': 'default'},
+    }
+
+DATABASE_ROUTERS = ['stkpush.db.PrimaryReplicaRouter']
+
+# Settled transactions moved out of the database by `archive_transactions` are
+# written here, as compressed JSON Lines files partitioned by day
+ARCHIVE_DIR = config('MPESA_ARCHIVE_DIR', default=str(BASE_DIR / 'archive'))
+
+
+# Cache
+# https://docs.djangoproject.com/en/3.1/topics/cache/
+# The M-Pesa access token is shared through this cache. Use a cross-process backend
+# (file-based, Redis, Memcached) when running several workers so only one fetches it.
+
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
     }
 }
 
 
+# Logging
+# The stkpush loggers only enqueue records; a background listener thread formats
+# them as redacted JSON lines and writes them, keeping disk I/O out of requests.
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'filters': {
+        'context': {'()': 'stkpush.log.ContextFilter'},
+    },
+    'formatters': {
+        'json': {'()': 'stkpush.log.JsonFormatter'},
+    },
+    'handlers': {
+        'mpesa_file': {
+            'class': 'logging.FileHandler',
+            'filename': config('MPESA_LOG_FILE', default=str(BASE_DIR / 'mpesa_debug.log')),
+            'formatter': 'json',
+            'delay': True,
+        },
+        'mpesa_queue': {
+            '()': 'stkpush.log.QueueHandler',
+            'handlers': ['mpesa_file'],
+            'filters': ['context'],
+        },
+    },
+    'loggers': {
+        'stkpush': {
+            'handlers': ['mpesa_queue'],
+            'level': config('MPESA_LOG_LEVEL', default='INFO'),
+            'propagate': False,
+        },
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
 
@@ -1,3 +1,267 @@
-from django.contrib import admin
+from datetime import timedelta
 
-# Register your models here.
+from django import forms
+from django.contrib import admin, messages
+from django.db.models import Count, Q
+from django.utils.html import format_html, format_html_join
+
+from . import archive, rollups
+from .models import (
+    ArchiveBatch, ArchivedKey, C2BPayment, PaybillAccount, RollupPeriod, Tenant, Transaction, TransactionRollup,
+    WebhookDelivery, WebhookEndpoint,
+)
+
+
+class TenantForm(forms.ModelForm):
+    """
+    Tenant form whose secrets are write-only: they are never sent back to the
+    browser, and left blank on an existing tenant they keep their value.
+    """
+    class Meta:
+        model = Tenant
+        fields = "__all__"
+        widgets = {name: forms.PasswordInput(render_value=False) for name in Tenant.SECRET_FIELDS}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.instance.pk:
+            for name in Tenant.SECRET_FIELDS:
+                self.fields[name].required = False
+                self.fields[name].help_text = "Leave blank to keep the current value."
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if self.instance.pk:
+            for name in Tenant.SECRET_FIELDS:
+                if not cleaned_data.get(name):
+                    cleaned_data[name] = getattr(self.instance, name)
+        return cleaned_data
+
+
+@admin.register(Tenant)
+class TenantAdmin(admin.ModelAdmin):
+    """
+    Paybills and tills served by this deployment; edits reach running workers without a restart.
+    """
+    form = TenantForm
+    list_display = ("slug", "name", "shortcode", "transaction_type", "stk_rate", "is_active", "updated_at")
+    list_filter = ("is_active", "transaction_type")
+    search_fields = ("slug", "name", "shortcode")
+
+    def get_exclude(self, request, obj=None):
+        # Staff who may only view tenants would get the secrets as plain text
+        if obj is not None and not self.has_change_permission(request, obj):
+            return Tenant.SECRET_FIELDS
+        return super().get_exclude(request, obj)
+
+
+@admin.register(PaybillAccount)
+class PaybillAccountAdmin(admin.ModelAdmin):
+    """
+    Account numbers accepted by C2B validation; running workers pick up edits within MPESA_C2B_ACCOUNT_REFRESH seconds.
+    """
+    list_display = ("number", "name", "is_active", "updated_at")
+    list_filter = ("is_active",)
+    search_fields = ("number", "name")
+
+
+@admin.register(C2BPayment)
+class C2BPaymentAdmin(admin.ModelAdmin):
+    """
+    Payments made from the SIM menu, as confirmed by Safaricom (read-only).
+    """
+    list_display = ("trans_id", "amount", "bill_ref_number", "business_short_code", "trans_time", "received_at")
+    search_fields = ("trans_id", "bill_ref_number")
+    date_hierarchy = "received_at"
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(TransactionRollup)
+class TransactionRollupAdmin(admin.ModelAdmin):
+    """
+    Dashboard of hourly and daily totals, read from the rollups only.
+
+    The page charts the filtered buckets of one period (daily unless filtered by
+    period), with their totals and the top-spending phones over the same days.
+    """
+    list_display = ("start", "period", "tenant", "pushes", "succeeded", "failed", "success_rate", "amount")
+    list_filter = ("period", "tenant")
+    date_hierarchy = "start"
+    ordering = ("-start",)
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+    @admin.display(description="Success rate")
+    def success_rate(self, obj):
+        rate = obj.success_rate
+        return "-" if rate is None else f"{rate:.1%}"
+
+    def changelist_view(self, request, extra_context=None):
+        response = super().changelist_view(request, extra_context)
+        try:
+            queryset = response.context_data["cl"].queryset
+        except (AttributeError, KeyError):
+            # Redirect for invalid filters
+            return response
+
+        period = request.GET.get("period__exact", RollupPeriod.DAY)
+        buckets = queryset.filter(period=period).order_by()
+        bounds = buckets.values_list("start", flat=True)
+        first, last = bounds.order_by("start").first(), bounds.order_by("-start").first()
+        rows, totals = [], None
+        phones = []
+        if first is not None:
+            step = timedelta(hours=1) if period == RollupPeriod.HOUR else timedelta(days=1)
+            tenant = request.GET.get("tenant__exact")
+            rows, totals = rollups.summary(period, first, last + step, tenant)
+            top = max(row["amount"] for row in rows) or 1
+            for row in rows:
+                row["width"] = int(row["amount"] * 100 / top)
+            phones = rollups.top_phones(first, last + step)
+        response.context_data.update(
+            dashboard_period=RollupPeriod(period).label if period in RollupPeriod.values else period,
+            dashboard_rows=rows,
+            dashboard_totals=totals,
+            dashboard_phones=phones,
+        )
+        return response
+
+
+
+@admin.register(ArchiveBatch)
+class ArchiveBatchAdmin(admin.ModelAdmin):
+    """
+    Batches of transactions moved to the archive files.
+
+    Searching for a receipt number, checkout_request_id or reference finds the
+    batch holding it through the archive keys; opening a batch reads its
+    transactions back from the file.
+    """
+    list_display = ("day", "rows", "path", "archived_at")
+    date_hierarchy = "day"
+    ordering = ("-day", "-pk")
+    search_fields = ("path",)
+    search_help_text = "Receipt number, checkout_request_id or reference of an archived transaction"
+    fields = ("day", "rows", "path", "offset", "archived_at", "transactions")
+    readonly_fields = fields
+    actions = ["restore"]
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        # Deleting a batch would orphan its transactions; restore them instead
+        return False
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        keys = []
+        for field in archive.KEY_FIELDS:
+            try:
+                keys.append(archive.key(field, term))
+            except ValueError:
+                # Not a UUID, so not a reference
+                pass
+        batches = ArchivedKey.objects.filter(pk__in=keys).values("batch")
+        return queryset.filter(pk__in=batches), False
+
+    @admin.display(description="Transactions")
+    def transactions(self, obj):
+        try:
+            rows = archive.indexed_rows(obj)
+        except archive.ArchiveError as e:
+            return str(e)
+        labels = dict(Transaction.Status.choices)
+        values = [
+            (row["mpesa_receipt_number"] or "-", row["checkout_request_id"] or "-", row["reference"],
+             row["phone_number"], row["amount"], labels.get(row["status"], row["status"]), row["transaction_date"])
+            for row in rows
+        ]
+        return format_html(
+            "<table><tr><th>Receipt</th><th>Checkout request</th><th>Reference</th><th>Phone</th>"
+            "<th>Amount</th><th>Status</th><th>Started</th></tr>{}</table>",
+            format_html_join("", "<tr>" + "<td>{}</td>" * 7 + "</tr>", values),
+        )
+
+    def has_restore_permission(self, request):
+        return request.user.has_perm("stkpush.add_transaction")
+
+    @admin.action(description="Restore the transactions of the selected batches", permissions=["restore"])
+    def restore(self, request, queryset):
+        try:
+            restored = archive.restore(queryset)
+        except archive.ArchiveError as e:
+            self.message_user(request, str(e), messages.ERROR)
+            return
+        self.message_user(request, f"Restored {restored} transactions.", messages.SUCCESS)
+
+
+@admin.register(WebhookEndpoint)
+class WebhookEndpointAdmin(admin.ModelAdmin):
+    """
+    Merchant URLs sent payment status changes by `webhook_worker`, with their delivery state.
+    """
+    list_display = ("name", "url", "tenant", "is_active", "pending", "dead", "failures", "next_attempt_at",
+                    "last_error", "last_delivered_at")
+    list_filter = ("is_active",)
+    search_fields = ("name", "url", "tenant")
+    readonly_fields = ("failures", "next_attempt_at", "last_error", "last_delivered_at", "locked_until")
+    actions = ["retry_now"]
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(
+            pending_count=Count("deliveries", filter=Q(deliveries__dead_at=None)),
+            dead_count=Count("deliveries", filter=Q(deliveries__dead_at__isnull=False)),
+        )
+
+    @admin.display(description="Pending events", ordering="pending_count")
+    def pending(self, obj):
+        return obj.pending_count
+
+    @admin.display(description="Dead-lettered events", ordering="dead_count")
+    def dead(self, obj):
+        return obj.dead_count
+
+    @admin.action(description="Retry the selected endpoints now")
+    def retry_now(self, request, queryset):
+        retried = WebhookEndpoint.objects.filter(pk__in=queryset.values("pk")).update(next_attempt_at=None)
+        self.message_user(request, f"{retried} endpoints will be retried on the next poll.", messages.SUCCESS)
+
+
+@admin.register(WebhookDelivery)
+class WebhookDeliveryAdmin(admin.ModelAdmin):
+    """
+    Events still to be sent to an endpoint, and those dead-lettered after failing too often.
+    """
+    list_display = ("event", "endpoint", "attempts", "last_error", "dead_at")
+    list_filter = (("dead_at", admin.EmptyFieldListFilter), "endpoint")
+    list_select_related = ("event", "endpoint")
+    readonly_fields = ("endpoint", "event", "attempts", "last_error", "dead_at")
+    actions = ["requeue"]
+
+    def has_add_permission(self, request):
+        return False
+
+    @admin.action(description="Send the selected events again")
+    def requeue(self, request, queryset):
+        requeued = WebhookDelivery.objects.filter(pk__in=queryset.values("pk")).update(
+            attempts=0, last_error="", dead_at=None,
+        )
+        self.message_user(request, f"{requeued} events will be sent again.", messages.SUCCESS)
@@ -0,0 +1,305 @@
+"""
+JSON API for STK Push, for the mobile backend and other non-browser clients.
+
+The endpoints render no templates and never touch the session or the messages
+framework (Django loads both lazily, so they cost nothing here). Clients
+authenticate with a bearer token instead of a CSRF cookie, and responses are
+compact JSON. Idempotency, the per-phone cooldown and the Daraja rate limits and
+circuit breaker apply exactly as for the form view.
+"""
+import base64
+import hmac
+import json
+import logging
+import uuid
+from datetime import datetime, timedelta
+from functools import wraps
+
+import requests
+from decouple import config
+from django.db.models import Q
+from django.http import JsonResponse
+from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
+
+from . import archive, db, idempotency, log, metrics, rollups, statements
+from .breaker import DarajaUnavailable
+from .jobs import ASYNC_STK_PUSH, enqueue_stk_push
+from .models import RollupPeriod, Transaction
+from .status_cache import status_cache
+from .stk import (
+    StkPushError, build_payload, clean_payment, clean_phone, clean_reference, save_accepted, send_stk_push,
+)
+from .tenants import registry
+from .throttle import Throttled, claim_phone, release_phone
+from .views import IN_PROGRESS_MESSAGE, archive_unavailable, phone_throttled_message, retry_later, status_response
+
+logger = logging.getLogger(__name__)
+
+# Bearer token API clients must send; while it is empty the API refuses every request
+API_TOKEN = config("MPESA_API_TOKEN", default="")
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+COMPACT = {"separators": (",", ":")}
+
+# Range returned by the stats endpoint when no `since` is given, per period
+STATS_DEFAULT_RANGE = {RollupPeriod.HOUR: timedelta(hours=24), RollupPeriod.DAY: timedelta(days=30)}
+MAX_TOP_PHONES = 100
+
+# (output name, model field) of each listed transaction
+LIST_COLUMNS = (
+    ("reference", "reference"),
+    ("checkout_request_id", "checkout_request_id"),
+    ("phone_number", "phone_number"),
+    ("amount", "amount"),
+    ("status", "status"),
+    ("result_code", "result_code"),
+    ("receipt_number", "mpesa_receipt_number"),
+    ("transaction_date", "transaction_date"),
+)
+
+
+def api_response(body, status=200):
+    return JsonResponse(body, status=status, json_dumps_params=COMPACT)
+
+
+def api_error(message, status):
+    return api_response({"error": message}, status)
+
+
+def api_view(name, methods):
+    """
+    Wraps an API view: bearer token check, allowed methods, no CSRF, metrics under `name`.
+
+    Without MPESA_API_TOKEN the API is closed (503) rather than open to anyone.
+    """
+    def decorator(view):
+        @csrf_exempt
+        @metrics.instrument_view(name)
+        @require_http_methods(methods)
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if not API_TOKEN:
+                logger.error("Refused an API request: MPESA_API_TOKEN is not set")
+                return api_error("The API is not configured", 503)
+            if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {API_TOKEN}"):
+                return api_error("Unauthorized", 401)
+            return view(request, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@api_view("api_payments", ["GET", "POST"])
+def payments(request):
+    """
+    POST starts a payment; GET lists payments.
+    """
+    if request.method == "POST":
+        return create_payment(request)
+    with db.replica_reads():
+        return list_payments(request)
+
+
+def create_payment(request):
+    """
+    Sends (or queues) an STK Push for a JSON body `{"phone", "amount", "reference", "tenant"}`.
+
+    Answers 201 with the checkout_request_id once Safaricom accepted the push, or
+    202 with the local reference when MPESA_ASYNC_STK_PUSH queues it. A repeated
+    request replays the first answer with `Idempotent-Replayed: true`.
+    """
+    try:
+        body = json.loads(request.body or b"{}")
+    except ValueError:
+        body = None
+    if not isinstance(body, dict):
+        return api_error("Request body must be a JSON object", 400)
+    try:
+        phone, amount = clean_payment(str(body.get("phone") or ""), body.get("amount"))
+        account_reference = clean_reference(body.get("reference"))
+        tenant = registry.get(body.get("tenant"))
+    except ValueError as e:
+        return api_error(str(e), 400)
+
+    try:
+        claim = idempotency.claim(request, phone, amount, account_reference or "", tenant.slug)
+    except idempotency.InProgress:
+        return api_error(IN_PROGRESS_MESSAGE, 409)
+    if claim.replay is not None:
+        response = api_response(claim.replay, 201 if claim.replay.get("checkout_request_id") else 202)
+        response["Idempotent-Replayed"] = "true"
+        return response
+
+    wait = claim_phone(phone)
+    if wait:
+        claim.release()
+        return retry_later(api_error(phone_throttled_message(wait), 429), wait)
+
+    sent = False
+    try:
+        if ASYNC_STK_PUSH:
+            transaction = enqueue_stk_push(phone, amount, account_reference, tenant.slug)
+            result = {"reference": str(transaction.reference), "status": transaction.get_status_display()}
+            claim.complete(**result)
+            sent = True
+            return api_response(result, 202)
+
+        try:
+            res_data = send_stk_push(build_payload(phone, amount, account_reference, tenant.builder), tenant)
+        except DarajaUnavailable as e:
+            logger.warning("STK Push not sent: %s", e)
+            return retry_later(api_error(e.user_message, 429 if isinstance(e, Throttled) else 503), e.retry_after)
+        except StkPushError as e:
+            logger.error("STK Push failed: %s", e)
+            return api_error(f"STK Push failed: {e}", 502)
+        except requests.Timeout:
+            logger.error("STK Push timed out")
+            return api_error("M-Pesa did not respond in time", 504)
+        except (requests.RequestException, ValueError) as e:
+            logger.error("STK Push failed: %s", e)
+            return api_error("M-Pesa could not be reached", 502)
+
+        checkout_request_id = res_data.get("CheckoutRequestID")
+        log.bind(checkout_request_id=checkout_request_id)
+        reference = uuid.uuid4()
+        result = {
+            "checkout_request_id": checkout_request_id,
+            "reference": str(reference),
+            "status": Transaction.Status.PENDING.label,
+        }
+        claim.complete(**result)
+        sent = True
+        transaction = save_accepted(
+            reference=reference,
+            checkout_request_id=checkout_request_id,
+            merchant_request_id=res_data.get("MerchantRequestID"),
+            phone_number=phone,
+            amount=amount,
+            account_reference=account_reference,
+            tenant_id=tenant.slug,
+        )
+        status_cache.store(transaction)
+        return api_response(result, 201)
+    finally:
+        if not sent:
+            # Nothing reached the phone, so a retry may go ahead straight away
+            claim.release()
+            release_phone(phone)
+
+
+@api_view("api_payment_status", ["GET"])
+@db.reads_from_replica
+def payment_status(request, key):
+    """
+    Returns the status of a payment by checkout_request_id or reference, with ETag support.
+    """
+    entry = status_cache.get(key)
+    if entry is None:
+        try:
+            lookup = {"reference": uuid.UUID(key)}
+        except ValueError:
+            lookup = {"checkout_request_id": key}
+        try:
+            transaction = archive.get(Transaction.objects, **lookup)
+        except Transaction.DoesNotExist:
+            return api_error("Transaction not found", 404)
+        except archive.ArchiveError as e:
+            return archive_unavailable(e)
+        entry = status_cache.store(transaction)
+    return status_response(request, entry)
+
+
+def encode_cursor(transaction_date, pk):
+    return base64.urlsafe_b64encode(f"{transaction_date.isoformat()}|{pk}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """
+    Raises:
+        ValueError: If the cursor was not produced by `encode_cursor`.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        transaction_date, pk = raw.split("|")
+        return datetime.fromisoformat(transaction_date), int(pk)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+
+
+def list_payments(request):
+    """
+    Lists payments, newest first, optionally filtered by `phone`, `status`, `tenant`, `since` and `until`.
+
+    Pages are keyset-paginated: pass the `next` cursor of a page as `cursor` to get
+    the following one. Each page is a single index range scan, however deep.
+    """
+    transactions = Transaction.objects.all()
+    try:
+        if request.GET.get("phone"):
+            transactions = transactions.filter(phone_number=clean_phone(request.GET["phone"]))
+        if request.GET.get("status"):
+            transactions = transactions.filter(status=statements.parse_status(request.GET["status"]))
+        if request.GET.get("tenant"):
+            transactions = transactions.filter(tenant_id=request.GET["tenant"])
+        if request.GET.get("since"):
+            transactions = transactions.filter(transaction_date__gte=statements.parse_time(request.GET["since"]))
+        if request.GET.get("until"):
+            transactions = transactions.filter(transaction_date__lt=statements.parse_time(request.GET["until"]))
+        if request.GET.get("cursor"):
+            transaction_date, pk = decode_cursor(request.GET["cursor"])
+            # The redundant <= bound lets the index range scan start at the cursor
+            transactions = transactions.filter(transaction_date__lte=transaction_date).filter(
+                Q(transaction_date__lt=transaction_date) | Q(transaction_date=transaction_date, id__lt=pk)
+            )
+        limit = min(int(request.GET.get("limit", PAGE_SIZE)), MAX_PAGE_SIZE)
+        if limit < 1:
+            raise ValueError("limit must be positive")
+    except ValueError as e:
+        return api_error(str(e), 400)
+
+    fields = [field for _, field in LIST_COLUMNS]
+    rows = list(transactions.order_by("-transaction_date", "-id").values_list("id", *fields)[:limit + 1])
+    labels = dict(Transaction.Status.choices)
+    results = []
+    for pk, *values in rows[:limit]:
+        row = dict(zip((name for name, _ in LIST_COLUMNS), values))
+        row["status"] = labels.get(row["status"], row["status"])
+        results.append(row)
+
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = encode_cursor(last[fields.index("transaction_date") + 1], last[0])
+    return api_response({"results": results, "next": next_cursor})
+
+
+@api_view("api_stats", ["GET"])
+@db.reads_from_replica
+def stats(request):
+    """
+    Transaction totals per hour or day, read from the rollups.
+
+    Query parameters: `period` (hour or day), `since` and `until` (ISO, `until`
+    exclusive; by default the last 24 hours or 30 days), `tenant` (a slug, empty
+    for the default shortcode; all tenants if absent) and `phones` (include that
+    many top-spending phone numbers). The cost grows with the number of buckets,
+    not of transactions.
+    """
+    period = request.GET.get("period", RollupPeriod.HOUR)
+    if period not in RollupPeriod.values:
+        return api_error("period must be hour or day", 400)
+    try:
+        until = statements.parse_time(request.GET["until"]) if request.GET.get("until") else timezone.now()
+        since = (statements.parse_time(request.GET["since"]) if request.GET.get("since")
+                 else until - STATS_DEFAULT_RANGE[period])
+        phones = min(int(request.GET.get("phones", 0)), MAX_TOP_PHONES)
+    except ValueError as e:
+        return api_error(str(e), 400)
+
+    buckets, totals = rollups.summary(period, rollups.bucket_start(since, period), until, request.GET.get("tenant"))
+    body = {"period": period, "since": since, "until": until, "buckets": buckets, "totals": totals}
+    if phones > 0:
+        body["top_phones"] = rollups.top_phones(since, until, phones)
+    return api_response(body)
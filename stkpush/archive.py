@@ -0,0 +1,388 @@
+"""
+Archival of settled transactions to compressed JSON Lines files.
+
+Successful and failed transactions older than MPESA_ARCHIVE_AFTER_DAYS are moved
+out of the Transaction table in batches, each in its own short database
+transaction. A batch is appended, as one gzip member per day of
+`transaction_date`, to that day's file:
+
+    <MPESA_ARCHIVE_DIR>/2024/01/2024-01-15.<run>.jsonl.gz
+
+Each member is recorded as an `ArchiveBatch` (file, byte offset, day), and
+the rows are replaced by `ArchivedKey` entries: a 64-bit hash of each of their
+reference, checkout_request_id and receipt number, pointing at the batch. A
+lookup reads one key and decompresses one member, not the whole file.
+
+Every run writes its own files and never rewrites them, so concurrent runs
+cannot corrupt each other. The file is synced before the rows are deleted; a
+batch whose commit fails only leaves behind lines that no key points to.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import uuid
+import zlib
+from collections import defaultdict
+from datetime import timedelta
+from itertools import groupby
+from operator import attrgetter
+
+from asgiref.sync import sync_to_async
+from decouple import config
+from django.conf import settings
+from django.db import transaction as db_transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import db
+from .models import ArchiveBatch, ArchivedKey, ResultDescription, Transaction
+
+logger = logging.getLogger(__name__)
+
+# Settled transactions older than this are archived
+ARCHIVE_AFTER_DAYS = config("MPESA_ARCHIVE_AFTER_DAYS", default=90, cast=int)
+# Rows moved per batch (one file append and one short database transaction)
+BATCH_SIZE = config("MPESA_ARCHIVE_BATCH_SIZE", default=1000, cast=int)
+COMPRESS_LEVEL = config("MPESA_ARCHIVE_COMPRESS_LEVEL", default=6, cast=int)
+
+# Every column of the Transaction table, by attribute name (tenant_id, not tenant)
+FIELDS = {field.attname: field for field in Transaction._meta.concrete_fields}
+# Fields an archived transaction can be found by
+KEY_FIELDS = ("reference", "checkout_request_id", "mpesa_receipt_number")
+
+
+class ArchiveError(Exception):
+    """
+    An archive file is missing, or does not hold a row its keys point to.
+    """
+
+
+def canonical(field, value):
+    # UUID objects and strings in any accepted spelling match alike
+    return str(uuid.UUID(str(value))) if field == "reference" else str(value)
+
+
+def key(field, value):
+    """
+    Returns the ArchivedKey of a lookup value: a signed 64-bit hash of the field and value.
+
+    Raises:
+        ValueError: If a reference is not a UUID.
+    """
+    digest = hashlib.blake2b(f"{field}:{canonical(field, value)}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+def row_keys(row):
+    return [key(field, row[field]) for field in KEY_FIELDS if row.get(field) is not None]
+
+
+def encode(value):
+    # Full precision, unlike DjangoJSONEncoder, which drops microseconds
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value)
+
+
+def write_batch(rows, run):
+    """
+    Appends `rows` to their day files as one gzip member per file, synced to disk.
+
+    Returns:
+        list[tuple]: (unsaved ArchiveBatch, its rows) per member written.
+    """
+    by_day = defaultdict(list)
+    for row in rows:
+        by_day[timezone.localdate(row["transaction_date"])].append(row)
+
+    written = []
+    for day, day_rows in by_day.items():
+        path = f"{day:%Y}/{day:%m}/{day:%Y-%m-%d}.{run}.jsonl.gz"
+        full_path = os.path.join(settings.ARCHIVE_DIR, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        lines = b"".join(
+            json.dumps(row, default=encode, separators=(",", ":")).encode() + b"\n" for row in day_rows
+        )
+        with open(full_path, "ab") as archive_file:
+            offset = archive_file.tell()
+            archive_file.write(gzip.compress(lines, COMPRESS_LEVEL))
+            archive_file.flush()
+            os.fsync(archive_file.fileno())
+        written.append((ArchiveBatch(path=path, offset=offset, day=day, rows=len(day_rows)), day_rows))
+    return written
+
+
+def archive(before=None, batch_size=BATCH_SIZE):
+    """
+    Moves the successful and failed transactions started before `before` to the archive.
+
+    Args:
+        before (datetime): Cut-off; defaults to MPESA_ARCHIVE_AFTER_DAYS ago.
+        batch_size (int): Rows moved per batch.
+
+    Returns:
+        int: Number of transactions archived.
+    """
+    if before is None:
+        before = timezone.now() - timedelta(days=ARCHIVE_AFTER_DAYS)
+    run = f"{timezone.now():%Y%m%dT%H%M%S}-{os.getpid()}"
+    settled = row_values(
+        Transaction.objects.filter(status__in=Transaction.TERMINAL_STATUSES, transaction_date__lt=before)
+        .order_by("transaction_date", "id")
+    )
+
+    archived = 0
+    while True:
+        rows = list(settled[:batch_size])
+        if not rows:
+            break
+        written = write_batch(rows, run)
+        with db_transaction.atomic():
+            for batch, _batch_rows in written:
+                batch.save()
+            # Rows changed since they were read, e.g. given their receipt by a late
+            # callback, stay in the table for the next batch; their stale lines are
+            # never indexed. The rows are locked, or on SQLite the insert above
+            # already holds the database's write lock.
+            current = {
+                row["id"]: row for row in row_values(
+                    Transaction.objects.select_for_update(of=("self",)).filter(pk__in=[row["id"] for row in rows])
+                )
+            }
+            moved = []
+            for batch, batch_rows in written:
+                unchanged = [row for row in batch_rows if current.get(row["id"]) == row]
+                if not unchanged:
+                    batch.delete()
+                    continue
+                # A key already taken belongs to a row another run archived first (or,
+                # once in billions, to a hash collision, and the row stays findable by
+                # its other keys)
+                ArchivedKey.objects.bulk_create(
+                    [ArchivedKey(key=value, batch=batch) for row in unchanged for value in row_keys(row)],
+                    ignore_conflicts=True,
+                )
+                moved.extend(unchanged)
+            Transaction.objects.filter(pk__in=[row["id"] for row in moved]).delete()
+        archived += len(moved)
+        logger.info("Archived %s transactions up to %s", archived, rows[-1]["transaction_date"])
+    return archived
+
+
+def row_values(queryset):
+    """
+    Reads the archived form of transactions: every column, plus the result description text.
+    """
+    return queryset.values(*FIELDS, result_desc=F("result_description__text"))
+
+
+def read_lines(batch):
+    """
+    Returns the JSON lines of an archived batch, undecoded.
+
+    Raises:
+        ArchiveError: If the file is missing, truncated or corrupt.
+    """
+    decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+    chunks = []
+    try:
+        with open(os.path.join(settings.ARCHIVE_DIR, batch.path), "rb") as archive_file:
+            archive_file.seek(batch.offset)
+            # Stop at the end of this member; the file goes on with later batches
+            while not decompressor.eof:
+                block = archive_file.read(64 * 1024)
+                if not block:
+                    raise ArchiveError(f"{batch.path} is truncated at offset {batch.offset}")
+                chunks.append(decompressor.decompress(block))
+    except OSError as e:
+        raise ArchiveError(f"Cannot read {batch.path}: {e}") from e
+    except zlib.error as e:
+        raise ArchiveError(f"{batch.path} is corrupt at offset {batch.offset}: {e}") from e
+    return b"".join(chunks).splitlines()
+
+
+def indexed_rows(batch):
+    """
+    Returns the rows of `batch` that its keys still point to, skipping those
+    restored since and those another run archived first.
+    """
+    rows = [json.loads(line) for line in read_lines(batch)]
+    keys = {row["id"]: row_keys(row) for row in rows}
+    owned = set(
+        ArchivedKey.objects.filter(pk__in=[value for values in keys.values() for value in values], batch=batch)
+        .values_list("pk", flat=True)
+    )
+    return [row for row in rows if owned.intersection(keys[row["id"]])]
+
+
+def to_transaction(row):
+    """
+    Builds an unsaved Transaction, primary key included, from an archived row.
+    """
+    transaction = Transaction(**{
+        name: None if value is None else FIELDS[name].to_python(value)
+        for name, value in row.items() if name in FIELDS
+    })
+    if transaction.result_description_id is not None:
+        # The row carries the text; caching it spares a query (not allowed in async views)
+        transaction.result_description = ResultDescription(pk=transaction.result_description_id, text=row["result_desc"])
+    return transaction
+
+
+def locate(**lookup):
+    """
+    Finds an archived row by one of reference, checkout_request_id or mpesa_receipt_number.
+
+    Returns:
+        tuple: (ArchiveBatch, row dict)
+
+    Raises:
+        Transaction.DoesNotExist: If no archived transaction matches.
+        ArchiveError: If its archive file cannot be read.
+    """
+    (field, value), = lookup.items()
+    try:
+        value = canonical(field, value)
+        entry = db.get_fresh(ArchivedKey.objects.select_related("batch"), pk=key(field, value))
+    except (ArchivedKey.DoesNotExist, ValueError):
+        raise Transaction.DoesNotExist(f"No transaction matches {lookup}")
+    # Only decode the line that mentions the value
+    needle = json.dumps(value).encode()
+    for line in read_lines(entry.batch):
+        if needle in line:
+            row = json.loads(line)
+            if row[field] == value:
+                return entry.batch, row
+    # The key was a hash collision with another value
+    raise Transaction.DoesNotExist(f"No transaction matches {lookup}")
+
+
+def locate_many(field, values):
+    """
+    Finds the archived rows whose `field` is one of `values`, reading each batch once.
+
+    Returns:
+        dict: Row dict by value, for the values that are archived.
+
+    Raises:
+        ArchiveError: If an archive file cannot be read.
+    """
+    wanted = {}
+    for value in values:
+        try:
+            wanted[key(field, value)] = canonical(field, value)
+        except ValueError:
+            continue
+    by_batch = defaultdict(set)
+    batches = {}
+    for entry in ArchivedKey.objects.filter(pk__in=wanted).select_related("batch"):
+        by_batch[entry.batch_id].add(wanted[entry.pk])
+        batches[entry.batch_id] = entry.batch
+
+    found = {}
+    for batch_id, batch_values in by_batch.items():
+        for line in read_lines(batches[batch_id]):
+            row = json.loads(line)
+            if row[field] in batch_values:
+                found[row[field]] = row
+    return found
+
+
+def archived_transactions(since=None, until=None):
+    """
+    Yields the archived transactions started in [since, until), as unsaved
+    Transactions in (transaction_date, id) order.
+
+    Batches are read a day at a time, so memory is bounded by the largest day.
+
+    Raises:
+        ArchiveError: If an archive file cannot be read.
+    """
+    batches = ArchiveBatch.objects.order_by("day", "pk")
+    if since is not None:
+        batches = batches.filter(day__gte=timezone.localdate(since))
+    if until is not None:
+        batches = batches.filter(day__lte=timezone.localdate(until))
+    for _day, day_batches in groupby(list(batches), key=attrgetter("day")):
+        transactions = [to_transaction(row) for batch in day_batches for row in indexed_rows(batch)]
+        transactions.sort(key=attrgetter("transaction_date", "pk"))
+        for transaction in transactions:
+            if since is not None and transaction.transaction_date < since:
+                continue
+            if until is not None and transaction.transaction_date >= until:
+                continue
+            yield transaction
+
+
+def find(**lookup):
+    """
+    Returns an archived transaction, looked up like `locate`, as an unsaved Transaction.
+
+    Raises:
+        Transaction.DoesNotExist: If no archived transaction matches.
+        ArchiveError: If its archive file cannot be read.
+    """
+    return to_transaction(locate(**lookup)[1])
+
+
+def get(queryset, **lookup):
+    """
+    `db.get_fresh`, falling back to the archive for transactions moved there.
+    """
+    try:
+        return db.get_fresh(queryset, **lookup)
+    except Transaction.DoesNotExist:
+        return find(**lookup)
+
+
+async def aget(queryset, **lookup):
+    """
+    Async version of `get`.
+    """
+    try:
+        return await db.aget_fresh(queryset, **lookup)
+    except Transaction.DoesNotExist:
+        return await sync_to_async(find)(**lookup)
+
+
+def put_back(batch, rows):
+    with db_transaction.atomic():
+        for row in rows:
+            # Raw, as loaddata does, so transaction_date keeps its value instead of auto_now_add
+            to_transaction(row).save_base(raw=True, force_insert=True)
+        ArchivedKey.objects.filter(pk__in=[value for row in rows for value in row_keys(row)], batch=batch).delete()
+
+
+def restore(batches):
+    """
+    Moves the transactions of archived batches back into the Transaction table,
+    with their original primary keys. The archive files are left as they are.
+
+    Returns:
+        int: Number of transactions restored.
+
+    Raises:
+        ArchiveError: If a batch's file cannot be read.
+    """
+    restored = 0
+    for batch in batches.order_by("pk"):
+        rows = indexed_rows(batch)
+        with db_transaction.atomic():
+            put_back(batch, rows)
+            batch.delete()
+        restored += len(rows)
+    return restored
+
+
+def restore_one(**lookup):
+    """
+    Moves one archived transaction, looked up like `locate`, back into the Transaction table.
+
+    Returns:
+        Transaction: The restored transaction.
+    """
+    batch, row = locate(**lookup)
+    put_back(batch, [row])
+    return Transaction.objects.get(pk=row["id"])
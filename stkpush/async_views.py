@@ -0,0 +1,234 @@
+"""
+Native async versions of the payment views for the ASGI deployment (`mpesa/asgi.py`).
+
+Outbound Daraja calls go through the pooled httpx client and database access uses
+the async ORM, so a single process can keep thousands of STK Pushes in flight
+instead of blocking one worker per request. Enabled with MPESA_ASGI_VIEWS=True.
+"""
+import json
+import logging
+
+from asgiref.sync import sync_to_async
+from django.contrib import messages
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.http import JsonResponse
+from django.shortcuts import render
+from django.views.decorators.csrf import csrf_exempt
+
+from .breaker import DarajaUnavailable
+from .daraja import httpx
+from .jobs import ASYNC_STK_PUSH, aenqueue_stk_push
+from . import archive, db, idempotency, inbox, log, metrics
+from .models import Transaction
+from .notify import notifier
+from .stk import (
+    StkPushError, TokenUnavailable, asave_accepted, asend_stk_push, build_payload, clean_payment, status_payload,
+)
+from .status_cache import status_cache
+from .tenants import UnknownTenant, registry
+from .throttle import Throttled, aclaim_phone, arelease_phone
+from .views import (
+    IN_PROGRESS_MESSAGE, PAY_TENANT, REPLAYED_MESSAGE, archive_unavailable, pay_context, phone_throttled_message,
+    replayed, retry_later, status_response, wait_timeout,
+)
+
+if httpx is None:
+    raise ImproperlyConfigured("The async views require httpx: pip install httpx")
+
+logger = logging.getLogger(__name__)
+
+# Template rendering reads the session (messages), which is sync-only
+arender = sync_to_async(render)
+
+
+@metrics.instrument_view("pay")
+async def pay(request):
+    """
+    Async version of `views.pay`.
+
+    The view awaits Safaricom instead of blocking, and stores the transaction with
+    the async ORM. With MPESA_ASYNC_STK_PUSH enabled the push is queued as in the
+    sync view. Repeated submissions replay the first outcome, as in the sync view.
+    """
+    debug_info = {}
+    checkout_request_id = None
+
+    if request.method != "POST":
+        return await arender(request, 'pay.html', pay_context())
+
+    try:
+        phone, amount = clean_payment(request.POST.get('phone'), request.POST.get('amount'))
+        tenant = await registry.aget(PAY_TENANT)
+    except ValueError as e:
+        messages.error(request, str(e))
+        logger.warning(str(e))
+        return await arender(request, 'pay.html', pay_context(debug=debug_info))
+
+    try:
+        claim = await idempotency.aclaim(request, phone, amount, tenant=tenant.slug)
+    except idempotency.InProgress:
+        messages.error(request, IN_PROGRESS_MESSAGE)
+        return await arender(request, 'pay.html', pay_context(debug=debug_info), status=409)
+    if claim.replay is not None:
+        logger.info("Replaying the outcome of a repeated payment request")
+        messages.success(request, claim.replay.get('message', REPLAYED_MESSAGE))
+        context = pay_context(checkout_request_id=claim.replay.get('checkout_request_id'),
+                              reference=claim.replay.get('reference'))
+        return replayed(await arender(request, 'pay.html', context))
+
+    wait = await aclaim_phone(phone)
+    if wait:
+        await claim.arelease()
+        messages.error(request, phone_throttled_message(wait))
+        logger.warning("STK Push to %s refused: one was sent moments ago", phone)
+        return retry_later(await arender(request, 'pay.html', pay_context(debug=debug_info), status=429), wait)
+
+    if ASYNC_STK_PUSH:
+        transaction = await aenqueue_stk_push(phone, amount, tenant=tenant.slug)
+        msg = "Payment request queued. Check your phone shortly."
+        await claim.acomplete(message=msg, reference=str(transaction.reference))
+        messages.success(request, msg)
+        logger.info("STK Push queued as %s", transaction.reference)
+        return await arender(request, 'pay.html', pay_context(debug=debug_info, reference=transaction.reference))
+
+    payload = build_payload(phone, amount, builder=tenant.builder)
+    debug_info['request_payload'] = payload
+
+    try:
+        res_data = await asend_stk_push(payload, tenant)
+        debug_info['response_json'] = res_data
+        log.bind(checkout_request_id=res_data.get("CheckoutRequestID"))
+        logger.info("STK Push response: %s", res_data)
+
+        checkout_request_id = res_data.get("CheckoutRequestID")
+        msg = "STK Push sent successfully. Check your phone."
+        await claim.acomplete(message=msg, checkout_request_id=checkout_request_id)
+        transaction = await asave_accepted(
+            checkout_request_id=checkout_request_id,
+            merchant_request_id=res_data.get("MerchantRequestID"),
+            phone_number=phone,
+            amount=amount,
+            tenant_id=tenant.slug,
+        )
+        await status_cache.astore(transaction)
+        messages.success(request, msg)
+    except (StkPushError, TokenUnavailable) as e:
+        messages.error(request, f"STK Push failed: {e}")
+        logger.error("STK Push failed: %s", e)
+    except DarajaUnavailable as e:
+        messages.error(request, e.user_message)
+        logger.warning("STK Push not sent: %s", e)
+        await claim.arelease()
+        await arelease_phone(phone)
+        status = 429 if isinstance(e, Throttled) else 503
+        return retry_later(await arender(request, 'pay.html', pay_context(debug=debug_info), status=status), e.retry_after)
+    except httpx.TimeoutException:
+        messages.error(request, "Request timed out")
+        logger.error("Request timed out")
+    except httpx.HTTPError as e:
+        msg = f"HTTP error: {str(e)}"
+        messages.error(request, msg)
+        logger.error(msg)
+    except json.JSONDecodeError:
+        messages.error(request, "Failed to parse response JSON")
+        logger.error("Failed to parse response JSON")
+    except Exception as e:
+        msg = f"Unexpected error: {e}"
+        messages.error(request, msg)
+        logger.exception(msg)
+
+    if checkout_request_id is None:
+        await claim.arelease()
+        await arelease_phone(phone)
+    return await arender(request, 'pay.html', pay_context(debug=debug_info, checkout_request_id=checkout_request_id))
+
+
+@csrf_exempt
+@metrics.instrument_view("callback")
+async def callback(request, tenant=None):
+    """
+    Async version of `views.callback`.
+    """
+    if request.method != "POST":
+        return JsonResponse({"ResultCode": 1, "ResultDesc": "Invalid request"}, status=400)
+    if tenant:
+        try:
+            await registry.aget(tenant)
+        except UnknownTenant:
+            logger.warning("Callback for unknown tenant %s", tenant)
+            return JsonResponse({"ResultCode": 1, "ResultDesc": "Unknown tenant"}, status=404)
+        log.bind(tenant=tenant)
+    try:
+        entry = await inbox.aappend(request.body)
+    except json.JSONDecodeError:
+        logger.error("Failed to parse callback JSON")
+        return JsonResponse({"ResultCode": 1, "ResultDesc": "Invalid JSON"}, status=400)
+
+    log.bind(checkout_request_id=entry.checkout_request_id)
+    if not inbox.QUEUED_CALLBACKS:
+        try:
+            await sync_to_async(inbox.process)(entry)
+        except Exception:
+            # Stored, so acknowledge it anyway; `process_callbacks` applies it later
+            logger.exception("Failed to apply callback %s, left in the inbox", entry.pk)
+    logger.info("Callback received for %s", entry.checkout_request_id)
+
+    return JsonResponse({"ResultCode": 0, "ResultDesc": "Success"})
+
+
+@metrics.instrument_view("check_status")
+@db.reads_from_replica
+async def check_status(request):
+    """
+    Async version of `views.check_status`.
+    """
+    checkout_request_id = request.GET.get('checkout_request_id')
+    reference = request.GET.get('reference')
+    if not checkout_request_id and not reference:
+        return JsonResponse({"error": "Missing checkout_request_id"}, status=400)
+
+    entry = await status_cache.aget(checkout_request_id or reference)
+    if entry is None:
+        transactions = Transaction.objects.select_related('result_description')
+        try:
+            if checkout_request_id:
+                transaction = await archive.aget(transactions, checkout_request_id=checkout_request_id)
+            else:
+                transaction = await archive.aget(transactions, reference=reference)
+        except (Transaction.DoesNotExist, ValidationError):
+            return JsonResponse({"error": "Transaction not found"}, status=404)
+        except archive.ArchiveError as e:
+            return archive_unavailable(e)
+        entry = await status_cache.astore(transaction)
+    return status_response(request, entry)
+
+
+@metrics.instrument_view("wait_status")
+async def wait_status(request):
+    """
+    Async version of `views.wait_status`; a waiting client holds no thread.
+    """
+    checkout_request_id = request.GET.get('checkout_request_id')
+    reference = request.GET.get('reference')
+    if not checkout_request_id and not reference:
+        return JsonResponse({"error": "Missing checkout_request_id"}, status=400)
+    timeout = wait_timeout(request)
+    if timeout is None:
+        return JsonResponse({"error": "Invalid timeout"}, status=400)
+
+    lookup = {'checkout_request_id': checkout_request_id} if checkout_request_id else {'reference': reference}
+    # Load the description with the row; the lazy lookup would be a sync query
+    transactions = Transaction.objects.select_related('result_description')
+    try:
+        transaction = await archive.aget(transactions, **lookup)
+    except (Transaction.DoesNotExist, ValidationError):
+        return JsonResponse({"error": "Transaction not found"}, status=404)
+    except archive.ArchiveError as e:
+        return archive_unavailable(e)
+
+    known_status = request.GET.get('status') or transaction.get_status_display()
+    if transaction.get_status_display() == known_status and transaction.status not in Transaction.TERMINAL_STATUSES:
+        keys = (transaction.checkout_request_id, transaction.reference)
+        if await notifier.await_change(keys, known_status, timeout):
+            transaction = await transactions.aget(pk=transaction.pk)
+    return JsonResponse(status_payload(transaction))
@@ -0,0 +1,350 @@
+import logging
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+import requests
+from decouple import config
+from django.core.cache import caches
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class DarajaUnavailable(requests.ConnectionError):
+    """
+    Raised instead of calling Daraja while its circuit is open or too many calls are outstanding.
+
+    It is a `requests.ConnectionError`, so callers that already handle transport
+    errors treat a shed call like one, just without waiting for a timeout.
+    `retry_after` is a hint, in seconds, for when to try again.
+    """
+    user_message = "M-Pesa is temporarily unavailable. Please try again shortly."
+
+    def __init__(self, *args, retry_after=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Stops calling a Daraja endpoint that is failing or slow, with state shared through the cache.
+
+    Calls are counted per `window` seconds in the cache, so every worker sees the
+    same rates. Once a window has at least `min_calls` calls and the share of
+    failures (transport errors and `failure_statuses`) or of calls slower than
+    `slow_call` seconds reaches its threshold, the circuit opens: for
+    `open_seconds` calls fail at once with DarajaUnavailable. After that, one call
+    across all workers is let through as a probe (half-open); it closes the
+    circuit if it succeeds and opens it again if it does not.
+    """
+    alias = config("MPESA_BREAKER_CACHE", default="default")
+    window = config("MPESA_BREAKER_WINDOW", default=30, cast=int)
+    min_calls = config("MPESA_BREAKER_MIN_CALLS", default=10, cast=int)
+    failure_rate = config("MPESA_BREAKER_FAILURE_RATE", default=0.5, cast=float)
+    slow_call = config("MPESA_BREAKER_SLOW_CALL", default=5.0, cast=float)
+    slow_rate = config("MPESA_BREAKER_SLOW_RATE", default=0.5, cast=float)
+    open_seconds = config("MPESA_BREAKER_OPEN_SECONDS", default=15, cast=float)
+
+    def __init__(self, name, failure_statuses=(500, 502, 503, 504), probe_timeout=60):
+        self.name = name
+        self.failure_statuses = frozenset(failure_statuses)
+        # Longest a probe may take before another worker is allowed to probe
+        self.probe_timeout = probe_timeout
+        self.prefix = f"mpesa:breaker:{name}"
+        # Memo of the shared open deadline, so an open circuit sheds without a cache read
+        self.open_until = 0.0
+
+    def cache(self):
+        return caches[self.alias]
+
+    def state(self):
+        """
+        Returns "closed", "open" or "half-open".
+        """
+        open_until = self.cache().get(f"{self.prefix}:open")
+        if open_until is None:
+            return "closed"
+        return "open" if time.time() < open_until else "half-open"
+
+    def allow(self):
+        """
+        Checks whether a call may go ahead.
+
+        Returns:
+            bool: True if the call is the half-open probe.
+
+        Raises:
+            DarajaUnavailable: If the circuit is open, or half-open with a probe in flight.
+        """
+        now = time.time()
+        if now < self.open_until:
+            raise self.shed(self.open_until - now)
+        open_until = self.cache().get(f"{self.prefix}:open")
+        if open_until is None:
+            return False
+        if now < open_until:
+            self.open_until = open_until
+            raise self.shed(open_until - now)
+        if self.cache().add(f"{self.prefix}:probe", 1, self.probe_timeout):
+            return True
+        raise self.shed(self.open_seconds)
+
+    async def aallow(self):
+        """
+        Async version of `allow`, reading the shared state through the async cache API.
+        """
+        now = time.time()
+        if now < self.open_until:
+            raise self.shed(self.open_until - now)
+        open_until = await self.cache().aget(f"{self.prefix}:open")
+        if open_until is None:
+            return False
+        if now < open_until:
+            self.open_until = open_until
+            raise self.shed(open_until - now)
+        if await self.cache().aadd(f"{self.prefix}:probe", 1, self.probe_timeout):
+            return True
+        raise self.shed(self.open_seconds)
+
+    def shed(self, retry_after):
+        metrics.DARAJA_SHED.inc(endpoint=self.name, reason="circuit_open")
+        return DarajaUnavailable(f"M-Pesa {self.name} is unavailable (circuit open)", retry_after=retry_after)
+
+    def record(self, failed, elapsed, probe=False):
+        """
+        Counts a finished call and opens or closes the circuit as needed.
+        """
+        slow = elapsed >= self.slow_call
+        if probe:
+            self.cache().delete(f"{self.prefix}:probe")
+            if failed or slow:
+                self.trip("probe failed", force=True)
+            else:
+                self.close()
+            return
+
+        bucket = int(time.time() // self.window)
+        calls, failures, slows = (f"{self.prefix}:{bucket}:{name}" for name in ("calls", "failures", "slow"))
+        self.incr(calls)
+        if not (failed or slow):
+            return
+        self.incr(failures if failed else slows)
+
+        counts = self.cache().get_many([calls, failures, slows])
+        total = counts.get(calls, 0)
+        if total < self.min_calls:
+            return
+        if counts.get(failures, 0) / total >= self.failure_rate:
+            self.trip(f"{counts.get(failures, 0)} of {total} calls failed")
+        elif counts.get(slows, 0) / total >= self.slow_rate:
+            self.trip(f"{counts.get(slows, 0)} of {total} calls took over {self.slow_call}s")
+
+    async def arecord(self, failed, elapsed, probe=False):
+        """
+        Async version of `record`.
+        """
+        slow = elapsed >= self.slow_call
+        if probe:
+            await self.cache().adelete(f"{self.prefix}:probe")
+            if failed or slow:
+                await self.atrip("probe failed", force=True)
+            else:
+                await self.aclose()
+            return
+
+        bucket = int(time.time() // self.window)
+        calls, failures, slows = (f"{self.prefix}:{bucket}:{name}" for name in ("calls", "failures", "slow"))
+        await self.aincr(calls)
+        if not (failed or slow):
+            return
+        await self.aincr(failures if failed else slows)
+
+        counts = await self.cache().aget_many([calls, failures, slows])
+        total = counts.get(calls, 0)
+        if total < self.min_calls:
+            return
+        if counts.get(failures, 0) / total >= self.failure_rate:
+            await self.atrip(f"{counts.get(failures, 0)} of {total} calls failed")
+        elif counts.get(slows, 0) / total >= self.slow_rate:
+            await self.atrip(f"{counts.get(slows, 0)} of {total} calls took over {self.slow_call}s")
+
+    def incr(self, key):
+        cache = self.cache()
+        cache.add(key, 0, self.window * 2)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # Expired between add() and incr()
+            cache.set(key, 1, self.window * 2)
+
+    async def aincr(self, key):
+        cache = self.cache()
+        await cache.aadd(key, 0, self.window * 2)
+        try:
+            await cache.aincr(key)
+        except ValueError:
+            await cache.aset(key, 1, self.window * 2)
+
+    def trip(self, reason, force=False):
+        open_until = time.time() + self.open_seconds
+        # Keep the key past the deadline: while it exists the circuit is half-open
+        timeout = int(self.open_seconds + self.window * 10)
+        key = f"{self.prefix}:open"
+        if force:
+            self.cache().set(key, open_until, timeout)
+        elif not self.cache().add(key, open_until, timeout):
+            return
+        self.open_until = open_until
+        metrics.BREAKER_TRIPS.inc(endpoint=self.name)
+        logger.warning("Circuit for Daraja %s opened for %ss: %s", self.name, self.open_seconds, reason)
+
+    async def atrip(self, reason, force=False):
+        open_until = time.time() + self.open_seconds
+        timeout = int(self.open_seconds + self.window * 10)
+        key = f"{self.prefix}:open"
+        if force:
+            await self.cache().aset(key, open_until, timeout)
+        elif not await self.cache().aadd(key, open_until, timeout):
+            return
+        self.open_until = open_until
+        metrics.BREAKER_TRIPS.inc(endpoint=self.name)
+        logger.warning("Circuit for Daraja %s opened for %ss: %s", self.name, self.open_seconds, reason)
+
+    def close(self):
+        bucket = int(time.time() // self.window)
+        self.cache().delete_many(
+            [f"{self.prefix}:open"] + [f"{self.prefix}:{bucket}:{name}" for name in ("calls", "failures", "slow")]
+        )
+        self.open_until = 0.0
+        logger.info("Circuit for Daraja %s closed", self.name)
+
+    async def aclose(self):
+        bucket = int(time.time() // self.window)
+        await self.cache().adelete_many(
+            [f"{self.prefix}:open"] + [f"{self.prefix}:{bucket}:{name}" for name in ("calls", "failures", "slow")]
+        )
+        self.open_until = 0.0
+        logger.info("Circuit for Daraja %s closed", self.name)
+
+
+class AdaptiveLimiter:
+    """
+    AIMD limit on the calls to one endpoint outstanding in this process.
+
+    Each call that succeeds in under `slow_call` seconds raises the limit by
+    1/limit (about +1 per round of calls); a failed or slow call multiplies it by
+    `backoff`, at most once per `cooldown` seconds, down to `minimum`. Calls over
+    the limit fail at once with DarajaUnavailable instead of queueing on a
+    degraded API.
+    """
+    initial = config("MPESA_STK_CONCURRENCY_INITIAL", default=20, cast=int)
+    minimum = config("MPESA_STK_CONCURRENCY_MIN", default=2, cast=int)
+    maximum = config("MPESA_STK_CONCURRENCY_MAX", default=200, cast=int)
+    backoff = config("MPESA_STK_CONCURRENCY_BACKOFF", default=0.5, cast=float)
+    cooldown = 1.0
+
+    def __init__(self, name):
+        self.name = name
+        self.limit = float(self.initial)
+        self.in_flight = 0
+        self.decreased_at = 0.0
+        self.lock = threading.Lock()
+        metrics.CONCURRENCY_LIMIT.set(self.limit, endpoint=name)
+
+    def acquire(self):
+        """
+        Raises:
+            DarajaUnavailable: If `limit` calls are already outstanding.
+        """
+        with self.lock:
+            if self.in_flight >= int(self.limit):
+                metrics.DARAJA_SHED.inc(endpoint=self.name, reason="concurrency_limit")
+                raise DarajaUnavailable(f"M-Pesa {self.name} is unavailable (concurrency limit)")
+            self.in_flight += 1
+
+    def release(self, failed, slow):
+        with self.lock:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if failed or slow:
+                if now - self.decreased_at >= self.cooldown:
+                    self.limit = max(self.minimum, self.limit * self.backoff)
+                    self.decreased_at = now
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            limit = self.limit
+        metrics.CONCURRENCY_LIMIT.set(limit, endpoint=self.name)
+
+
+class Call:
+    """
+    Outcome of a guarded call; the caller sets `status` to the HTTP status received.
+    """
+    status = None
+
+
+@contextmanager
+def guard(breaker, limiter=None):
+    """
+    Runs one Daraja call under a circuit breaker and an optional concurrency limiter.
+
+    Raises DarajaUnavailable before the call if either sheds it. The call counts as
+    failed if the block raises or `Call.status` is one of the breaker's failure statuses.
+    """
+    if breaker is None:
+        yield Call()
+        return
+
+    probe = breaker.allow()
+    if limiter is not None:
+        try:
+            limiter.acquire()
+        except DarajaUnavailable:
+            if probe:
+                breaker.cache().delete(f"{breaker.prefix}:probe")
+            raise
+
+    call = Call()
+    failed = True
+    started = time.monotonic()
+    try:
+        yield call
+        failed = call.status in breaker.failure_statuses
+    finally:
+        elapsed = time.monotonic() - started
+        breaker.record(failed, elapsed, probe)
+        if limiter is not None:
+            limiter.release(failed, elapsed >= breaker.slow_call)
+
+
+@asynccontextmanager
+async def aguard(breaker, limiter=None):
+    """
+    Async version of `guard`; the breaker's cache reads and writes do not block the event loop.
+    """
+    if breaker is None:
+        yield Call()
+        return
+
+    probe = await breaker.aallow()
+    if limiter is not None:
+        try:
+            limiter.acquire()
+        except DarajaUnavailable:
+            if probe:
+                await breaker.cache().adelete(f"{breaker.prefix}:probe")
+            raise
+
+    call = Call()
+    failed = True
+    started = time.monotonic()
+    try:
+        yield call
+        failed = call.status in breaker.failure_statuses
+    finally:
+        elapsed = time.monotonic() - started
+        await breaker.arecord(failed, elapsed, probe)
+        if limiter is not None:
+            limiter.release(failed, elapsed >= breaker.slow_call)
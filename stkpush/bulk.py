@@ -0,0 +1,159 @@
+import csv
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db.models import Count
+
+from .daraja import DarajaClient
+from .jobs import claim_jobs, process_job, requeued
+from .models import Transaction
+from .stk import clean_payment
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """
+    In-process token bucket allowing `rate` calls per second with bursts of `burst`.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a call is allowed.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def read_rows(stream, fmt):
+    """
+    Yields (line_number, row dict) from a CSV or JSON Lines stream, one row at a time.
+    """
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+        return
+
+    for line_number, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError:
+            row = None
+        yield line_number, row if isinstance(row, dict) else None
+
+
+def import_rows(rows, batch, batch_size=1000, tenant=None):
+    """
+    Validates rows and stores them as queued transactions of campaign `batch`,
+    to be sent for tenant `tenant` (a slug; default: the environment's shortcode).
+
+    Rows are written with `bulk_create` every `batch_size` rows; conflicts on
+    (batch, reference) are ignored, so re-running an interrupted import only
+    adds the rows that are missing.
+
+    Returns:
+        tuple: (number of valid rows, list of (line_number, error) for invalid rows)
+    """
+    pending, errors, valid, seen = [], [], 0, set()
+
+    for line_number, row in rows:
+        if row is None:
+            errors.append((line_number, "Malformed row"))
+            continue
+        reference = str(row.get("reference") or "").strip()
+        if not reference or len(reference) > 20:
+            errors.append((line_number, "Reference is required and must be at most 20 characters."))
+            continue
+        if reference in seen:
+            errors.append((line_number, f"Duplicate reference {reference}"))
+            continue
+        try:
+            phone, amount = clean_payment(str(row.get("phone") or "").strip(), row.get("amount"))
+        except ValueError as e:
+            errors.append((line_number, str(e)))
+            continue
+
+        seen.add(reference)
+        pending.append(Transaction(
+            phone_number=phone, amount=amount, status=Transaction.Status.INITIATING,
+            batch=batch, account_reference=reference, tenant_id=tenant,
+        ))
+        valid += 1
+        if len(pending) >= batch_size:
+            Transaction.objects.bulk_create(pending, ignore_conflicts=True)
+            pending = []
+
+    if pending:
+        Transaction.objects.bulk_create(pending, ignore_conflicts=True)
+    return valid, errors
+
+
+def send_batch(batch, concurrency=10, rate=10, on_progress=None, progress_interval=5):
+    """
+    Sends every queued push of campaign `batch`.
+
+    At most `concurrency` pushes are in flight and at most `rate` are started per
+    second. Rows are claimed through the job queue, so a crashed run can simply be
+    started again; rows it had claimed are not sent twice but settled with an
+    unknown outcome (see `jobs.settle_abandoned`). A push that raises is logged and
+    the campaign goes on. While the STK Push circuit is open the run waits
+    instead of claiming rows.
+    `on_progress` receives `batch_progress()` every `progress_interval` seconds.
+    """
+    limiter = RateLimiter(rate)
+    reported = time.monotonic()
+
+    def send(transaction):
+        limiter.acquire()
+        try:
+            process_job(transaction)
+        except Exception:
+            # The row stays "Sending" until settle_abandoned marks it "Pending"; it is never sent again
+            logger.exception("STK Push job %s of batch %s failed", transaction.reference, batch)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while True:
+            while not DarajaClient.available("stkpush"):
+                time.sleep(1)
+            jobs = claim_jobs(concurrency * 2, batch=batch)
+            if not jobs:
+                break
+            list(pool.map(send, jobs))
+            if requeued(jobs):
+                time.sleep(1)
+            if on_progress and time.monotonic() - reported >= progress_interval:
+                on_progress(batch_progress(batch))
+                reported = time.monotonic()
+
+    if on_progress:
+        on_progress(batch_progress(batch))
+
+
+def batch_progress(batch):
+    """
+    Returns the number of transactions per status for campaign `batch`.
+    """
+    rows = Transaction.objects.filter(batch=batch).values("status").annotate(n=Count("id"))
+    return {Transaction.Status(row["status"]).label: row["n"] for row in rows}
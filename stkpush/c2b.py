@@ -0,0 +1,387 @@
+"""
+C2B: payments customers make to the paybill or till from the SIM menu.
+
+Safaricom calls the validation URL before completing such a payment and gives up
+on it (applying the ResponseType registered with the URLs) if no answer arrives
+within a few seconds. Validation therefore never queries the database: account
+numbers are looked up in an in-memory index of the active `PaybillAccount` rows,
+refreshed in the background.
+
+Confirmations are group-committed: request threads hand their payment to one
+writer thread, which inserts everything that arrived while the previous batch
+was being written in a single statement. Each request is answered only once its
+row is committed, so batching never acknowledges a payment that could be lost.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from decouple import config
+from django.db import close_old_connections, connection, transaction as db_transaction
+from django.db.models import Count, Max
+
+from . import metrics
+from .daraja import DarajaClient
+from .inbox import MPESA_TIMEZONE
+from .models import C2BPayment, PaybillAccount
+from .tenants import registry
+
+logger = logging.getLogger(__name__)
+
+# Reject payments to account numbers that are not active PaybillAccount rows
+VALIDATE_ACCOUNTS = config("MPESA_C2B_VALIDATE_ACCOUNTS", default=True, cast=bool)
+
+# How often the account index checks for added or edited accounts, in seconds
+ACCOUNT_REFRESH_INTERVAL = config("MPESA_C2B_ACCOUNT_REFRESH", default=30, cast=float)
+
+# Group-commit confirmations; when off, each one is saved by its own request
+BATCH_CONFIRMATIONS = config("MPESA_C2B_BATCH_CONFIRMATIONS", default=True, cast=bool)
+BATCH_SIZE = config("MPESA_C2B_BATCH_SIZE", default=500, cast=int)
+
+# How long the writer waits for more confirmations before writing a batch, in seconds
+BATCH_LINGER = config("MPESA_C2B_BATCH_LINGER", default=0.005, cast=float)
+
+# Longest a confirmation request waits for its batch to be committed
+BATCH_TIMEOUT = config("MPESA_C2B_BATCH_TIMEOUT", default=10, cast=float)
+
+# Registration and callback URLs; the ResponseType decides what Safaricom does
+# with a payment when the validation URL cannot be reached (Completed or Cancelled)
+REGISTER_PATH = config("MPESA_C2B_REGISTER_PATH", default="/mpesa/c2b/v1/registerurl")
+CONFIRMATION_URL = config("MPESA_C2B_CONFIRMATION_URL", default="")
+VALIDATION_URL = config("MPESA_C2B_VALIDATION_URL", default="")
+
+ACCEPTED = {"ResultCode": "0", "ResultDesc": "Accepted"}
+CONFIRMED = {"ResultCode": 0, "ResultDesc": "Success"}
+
+# Daraja's validation rejection codes
+INVALID_MSISDN = "C2B00011"
+INVALID_ACCOUNT = "C2B00012"
+INVALID_AMOUNT = "C2B00013"
+OTHER_ERROR = "C2B00016"
+
+# C2BPayment field of each confirmation key
+CONFIRMATION_FIELDS = {
+    "TransactionType": "transaction_type",
+    "BillRefNumber": "bill_ref_number",
+    "InvoiceNumber": "invoice_number",
+    "OrgAccountBalance": "org_account_balance",
+    "ThirdPartyTransID": "third_party_trans_id",
+    "MSISDN": "msisdn",
+    "FirstName": "first_name",
+}
+
+
+class C2BError(Exception):
+    """
+    Raised when Safaricom refuses to register the C2B URLs.
+    """
+
+
+def normalize_account(number):
+    """
+    Customers type account numbers freely; compare them without case and spaces.
+    """
+    return "".join(str(number or "").split()).upper()
+
+
+def rejected(code):
+    return {"ResultCode": code, "ResultDesc": "Rejected"}
+
+
+class AccountIndex:
+    """
+    In-memory set of the active account numbers, normalised.
+
+    The first lookup loads the set. After that, a lookup finding it older than
+    ACCOUNT_REFRESH_INTERVAL starts one background refresh and carries on with the
+    current set, so a validation never waits for the database. The refresh only
+    reloads the numbers when an aggregate shows accounts were added or edited.
+    """
+
+    def __init__(self):
+        self.accounts = None
+        self.version = None
+        self.checked_at = float("-inf")
+        self.refreshing = False
+        self.lock = threading.Lock()
+
+    def __contains__(self, number):
+        if self.accounts is None:
+            with self.lock:
+                if self.accounts is None:
+                    self.refresh()
+        elif time.monotonic() - self.checked_at >= ACCOUNT_REFRESH_INTERVAL:
+            self.refresh_in_background()
+        return normalize_account(number) in self.accounts
+
+    def refresh_in_background(self):
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+            # Rate-limits refreshes even if this one fails
+            self.checked_at = time.monotonic()
+        threading.Thread(target=self.run_refresh, name="mpesa-c2b-accounts", daemon=True).start()
+
+    def run_refresh(self):
+        try:
+            self.refresh()
+        except Exception:
+            logger.exception("Failed to refresh the C2B account index")
+        finally:
+            self.refreshing = False
+            connection.close()
+
+    def refresh(self):
+        """
+        Reloads the numbers if any account was added or edited since the last load.
+        """
+        self.checked_at = time.monotonic()
+        state = PaybillAccount.objects.aggregate(count=Count("id"), updated_at=Max("updated_at"))
+        version = (state["count"], state["updated_at"])
+        if version == self.version and self.accounts is not None:
+            return
+        numbers = PaybillAccount.objects.filter(is_active=True).values_list("number", flat=True)
+        # Replaced as a whole; lookups in other threads see the old or the new set
+        self.accounts = frozenset(normalize_account(number) for number in numbers.iterator())
+        self.version = version
+        logger.info("Loaded %d C2B accounts", len(self.accounts))
+
+    def reset(self):
+        with self.lock:
+            self.accounts = None
+            self.version = None
+
+
+account_index = AccountIndex()
+
+
+def validate(data):
+    """
+    Decides whether Safaricom should complete a C2B payment.
+
+    Returns:
+        dict: The validation response body, ACCEPTED or a rejection with Daraja's code.
+    """
+    try:
+        amount = Decimal(str(data.get("TransAmount")))
+    except (InvalidOperation, ValueError):
+        amount = None
+    if amount is None or not amount.is_finite() or amount <= 0:
+        result = rejected(INVALID_AMOUNT)
+    elif not data.get("MSISDN"):
+        result = rejected(INVALID_MSISDN)
+    elif VALIDATE_ACCOUNTS and data.get("BillRefNumber") not in account_index:
+        result = rejected(INVALID_ACCOUNT)
+    else:
+        result = ACCEPTED
+    metrics.C2B_VALIDATIONS.inc(result=result["ResultCode"])
+    return result
+
+
+def payment_from(data, body):
+    """
+    Builds the (unsaved) `C2BPayment` of a decoded confirmation.
+
+    Raises:
+        ValueError: If the TransID or amount is missing or invalid.
+    """
+    trans_id = str(data.get("TransID") or "")
+    if not trans_id:
+        raise ValueError("Missing TransID")
+    try:
+        amount = Decimal(str(data.get("TransAmount")))
+    except InvalidOperation:
+        amount = None
+    # Decimal takes "NaN" and "Infinity"; validation refuses them, so must the confirmation
+    if amount is None or not amount.is_finite() or amount <= 0:
+        raise ValueError(f"Invalid TransAmount {data.get('TransAmount')!r}")
+
+    fields = {
+        field: str(data.get(key) or "")[:C2BPayment._meta.get_field(field).max_length]
+        for key, field in CONFIRMATION_FIELDS.items()
+    }
+    try:
+        trans_time = datetime.strptime(str(data.get("TransTime")), "%Y%m%d%H%M%S").replace(tzinfo=MPESA_TIMEZONE)
+    except ValueError:
+        trans_time = None
+    return C2BPayment(
+        trans_id=trans_id,
+        trans_time=trans_time,
+        amount=amount,
+        business_short_code=str(data.get("BusinessShortCode") or ""),
+        payload=body.decode() if isinstance(body, bytes) else body,
+        **fields,
+    )
+
+
+class Batch:
+    def __init__(self):
+        self.payments = []
+        self.done = threading.Event()
+        # Exceptions by position of the payment that could not be stored
+        self.errors = {}
+
+
+class ConfirmationWriter:
+    """
+    Group commit for C2B confirmations.
+
+    `submit` adds a payment to the open batch and blocks until that batch is
+    committed. One writer thread per process takes the open batch as soon as it is
+    free, lingering BATCH_LINGER seconds for more unless BATCH_SIZE is reached, and
+    inserts it with one statement. Under a storm, batches grow to whatever arrived
+    during the previous write, so the database sees a few large inserts instead of
+    one transaction per payment.
+    """
+
+    def __init__(self, batch_size=BATCH_SIZE, linger=BATCH_LINGER):
+        self.batch_size = batch_size
+        self.linger = linger
+        self.condition = threading.Condition()
+        self.open = Batch()
+        self.writer_pid = None
+
+    def submit(self, payment, timeout=BATCH_TIMEOUT):
+        """
+        Queues a payment and waits until it is stored.
+
+        Raises:
+            TimeoutError: If the batch was not committed within `timeout` seconds.
+            DatabaseError: If writing the batch failed.
+        """
+        self.start_writer()
+        with self.condition:
+            batch = self.open
+            position = len(batch.payments)
+            batch.payments.append(payment)
+            if position + 1 in (1, self.batch_size):
+                self.condition.notify()
+        if not batch.done.wait(timeout):
+            raise TimeoutError("C2B confirmation batch not committed in time")
+        if position in batch.errors:
+            raise batch.errors[position]
+
+    def start_writer(self):
+        if self.writer_pid == os.getpid():
+            return
+        with self.condition:
+            if self.writer_pid == os.getpid():
+                return
+            # A forked child inherits the batch but not the thread
+            self.open = Batch()
+            self.writer_pid = os.getpid()
+            threading.Thread(target=self.run, name="mpesa-c2b-writer", daemon=True).start()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.open.payments:
+                    self.condition.wait()
+                deadline = time.monotonic() + self.linger
+                while len(self.open.payments) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                batch, self.open = self.open, Batch()
+            try:
+                self.write_batch(batch)
+            finally:
+                batch.done.set()
+
+    def write_batch(self, batch):
+        try:
+            self.write(batch.payments)
+            return
+        except Exception as e:
+            if len(batch.payments) == 1:
+                logger.error("Failed to store C2B confirmation: %s", e)
+                batch.errors[0] = e
+                return
+            logger.warning("Failed to store %d C2B confirmations at once, storing them one by one: %s",
+                           len(batch.payments), e)
+        # Keep one bad payment from failing the rest of the batch
+        for position, payment in enumerate(batch.payments):
+            try:
+                self.write([payment])
+            except Exception as e:
+                logger.error("Failed to store C2B confirmation %s: %s", payment.trans_id, e)
+                batch.errors[position] = e
+
+    def write(self, payments):
+        # This thread never sees request_finished; retire stale connections here
+        close_old_connections()
+        with db_transaction.atomic():
+            C2BPayment.objects.bulk_create(payments, ignore_conflicts=True)
+        metrics.C2B_BATCH_SIZE.observe(len(payments))
+
+
+confirmation_writer = ConfirmationWriter()
+
+
+def confirm(body):
+    """
+    Stores a C2B confirmation, once; repeated deliveries of a TransID are ignored.
+
+    Raises:
+        json.JSONDecodeError: If the body is not valid JSON.
+        ValueError: If the TransID or amount is missing or invalid.
+    """
+    data = json.loads(body)
+    if not isinstance(data, dict):
+        raise ValueError("Confirmation body must be a JSON object")
+    payment = payment_from(data, body)
+    if BATCH_CONFIRMATIONS:
+        confirmation_writer.submit(payment)
+    else:
+        C2BPayment.objects.bulk_create([payment], ignore_conflicts=True)
+    metrics.C2B_CONFIRMATIONS.inc()
+    logger.info("C2B payment %s of %s to account %s", payment.trans_id, payment.amount, payment.bill_ref_number)
+    return payment
+
+
+def register_urls(tenant=None, response_type="Completed", confirmation_url=None, validation_url=None):
+    """
+    Registers the confirmation and validation URLs of a shortcode with Safaricom.
+
+    Args:
+        tenant: Tenant slug, or None for the shortcode configured in the environment.
+        response_type: "Completed" or "Cancelled", applied when validation cannot be reached.
+        confirmation_url: Defaults to MPESA_C2B_CONFIRMATION_URL.
+        validation_url: Defaults to MPESA_C2B_VALIDATION_URL.
+
+    Returns:
+        dict: Safaricom's response.
+
+    Raises:
+        C2BError: If a URL is missing, no access token is available or Safaricom refused.
+        UnknownTenant: If `tenant` does not exist.
+        requests.RequestException: On transport errors.
+    """
+    context = registry.get(tenant)
+    confirmation_url = confirmation_url or CONFIRMATION_URL
+    validation_url = validation_url or VALIDATION_URL
+    if not confirmation_url or not validation_url:
+        raise C2BError("Set MPESA_C2B_CONFIRMATION_URL and MPESA_C2B_VALIDATION_URL")
+    access_token = context.token.get_access_token()
+    if not access_token:
+        raise C2BError("Failed to obtain access token")
+
+    response = DarajaClient.register_c2b_urls({
+        "ShortCode": context.builder.shortcode,
+        "ResponseType": response_type,
+        "ConfirmationURL": confirmation_url,
+        "ValidationURL": validation_url,
+    }, access_token, REGISTER_PATH)
+    try:
+        res_data = response.json()
+    except ValueError:
+        raise C2BError(f"Unexpected response ({response.status_code}): {response.text[:200]}")
+    if response.status_code != 200 or res_data.get("ResponseCode") not in ("0", 0):
+        raise C2BError(res_data.get("errorMessage") or res_data.get("ResponseDescription") or "Registration failed")
+    return res_data
@@ -1,9 +1,15 @@
-import base64
+import asyncio
+import hashlib
 import logging
+import time
+import uuid
 import requests
-from requests.auth import HTTPBasicAuth
-from datetime import datetime, timedelta
 from decouple import config
+from django.core.cache import caches
+from . import metrics
+from .breaker import DarajaUnavailable
+from .daraja import AsyncDarajaClient, DarajaClient, httpx
+from .payloads import default_builder
 
 logger = logging.getLogger(__name__)
 
@@ -21,60 +27,345 @@ class MpesaC2bCredential:
 class MpesaAccessToken:
     """
     Handles generation and caching of M-Pesa OAuth access tokens.
-    
-    Implements a singleton-like pattern to cache the token until it expires,
-    reducing unnecessary calls to the Safaricom API.
+
+    Tokens are shared by every worker through Django's cache framework (locmem, file,
+    Redis, ...) and memoised per process, so the hot path normally does no I/O at all.
+    A cache-based single-flight lock ensures only one worker calls the OAuth endpoint
+    at a time; the token is refreshed proactively before `expires_in` runs out, and
+    the previous token keeps being served while the refresh is in flight or if it fails.
     """
     validated_mpesa_access_token = None
     token_expiry = None
+    refresh_at = None
+
+    # Daraja app the token is for, and the rate limit of its OAuth calls (None: the shared one)
+    credential = MpesaC2bCredential
+    oauth_bucket = None
+
+    cache_alias = config("MPESA_TOKEN_CACHE", default="default")
+    cache_key = "mpesa:access_token"
+    lock_key = "mpesa:access_token:lock"
+    # Seconds before expiry at which the token is refreshed
+    refresh_margin = config("MPESA_TOKEN_REFRESH_MARGIN", default=300, cast=int)
+    # Upper bound for a single refresh, also the lifetime of the refresh lock
+    lock_timeout = config("MPESA_TOKEN_LOCK_TIMEOUT", default=15, cast=int)
+    # How long a worker without the lock waits for another worker's refresh
+    wait_timeout = config("MPESA_TOKEN_WAIT_TIMEOUT", default=10, cast=float)
+
+    @classmethod
+    def for_credential(cls, name, credential, oauth_bucket=None):
+        """
+        Returns a token class for another Daraja app.
+
+        The class has its own memo, and its cache and lock keys are derived from the
+        consumer key, so every app's token is cached and refreshed independently.
+        """
+        digest = hashlib.sha256(credential.consumer_key.encode()).hexdigest()[:16]
+        return type(f"{cls.__name__}[{name}]", (cls,), {
+            "credential": credential,
+            "oauth_bucket": oauth_bucket,
+            "validated_mpesa_access_token": None,
+            "token_expiry": None,
+            "refresh_at": None,
+            "cache_key": f"{MpesaAccessToken.cache_key}:{digest}",
+            "lock_key": f"{MpesaAccessToken.lock_key}:{digest}",
+        })
+
+    @classmethod
+    def cache(cls):
+        return caches[cls.cache_alias]
 
     @classmethod
+    def remember(cls, entry, source):
+        """
+        Memoises a cache entry in the class so later calls skip the cache backend.
+
+        `source` records where the entry came from (cache, fetched, stale) in the metrics.
+        """
+        metrics.TOKEN_LOOKUPS.inc(source=source)
+        cls.validated_mpesa_access_token = entry["token"]
+        cls.token_expiry = entry["expires_at"]
+        cls.refresh_at = entry["refresh_at"]
+        return entry["token"]
+
+    @classmethod
+    @metrics.timed(metrics.TOKEN_SECONDS)
     def get_access_token(cls):
         """
         Retrieves a valid access token.
-        
-        Checks if a valid, non-expired token exists in the class cache.
-        If not, it requests a new one from Safaricom using the Consumer Key and Secret.
-        
+
+        Lookup order: the per-process memo, then the shared cache, then Safaricom.
+        Once a token enters its refresh window, one worker renews it while the others
+        keep using the still-valid token. When there is no valid token at all, workers
+        that lose the lock wait for the winner instead of all calling OAuth at once.
+
         Returns:
             str: The access token string if successful.
             None: If the request fails.
+
+        Raises:
+            DarajaUnavailable: If the OAuth call was shed (circuit open, or throttled)
+                and there is no still-valid token to fall back on.
         """
-        if cls.validated_mpesa_access_token and cls.token_expiry and cls.token_expiry > datetime.now():
-            logger.info(f"Using cached access token: {cls.validated_mpesa_access_token}")
+        now = time.time()
+        if cls.validated_mpesa_access_token and cls.refresh_at and now < cls.refresh_at:
+            metrics.TOKEN_LOOKUPS.inc(source="memo")
             return cls.validated_mpesa_access_token
 
+        cache = cls.cache()
+        entry = cache.get(cls.cache_key)
+        if entry and now < entry["refresh_at"]:
+            return cls.remember(entry, "cache")
+
+        stale = entry if entry and now < entry["expires_at"] else None
+        # Each holder stores its own token, so it never releases a lock that expired and another worker took
+        lock = uuid.uuid4().hex
+        if cache.add(cls.lock_key, lock, cls.lock_timeout):
+            try:
+                # Another worker may have refreshed between our read and the lock.
+                entry = cache.get(cls.cache_key)
+                if entry and time.time() < entry["refresh_at"]:
+                    return cls.remember(entry, "cache")
+                fresh = cls.fetch_access_token()
+            except DarajaUnavailable:
+                # The OAuth call was shed; the current token, if any, is still good
+                if not stale:
+                    metrics.TOKEN_LOOKUPS.inc(source="failed")
+                    raise
+                fresh = None
+            finally:
+                cls.release_lock(lock)
+            if fresh:
+                return cls.remember(fresh, "fetched")
+            if stale:
+                logger.warning("Token refresh failed, serving the current token until it expires")
+                return cls.remember(stale, "stale")
+            metrics.TOKEN_LOOKUPS.inc(source="failed")
+            return None
+
+        if stale:
+            # Another worker is refreshing; the current token is still valid.
+            return cls.remember(stale, "stale")
+
+        deadline = now + cls.wait_timeout
+        while time.time() < deadline:
+            time.sleep(0.05)
+            entry = cache.get(cls.cache_key)
+            if entry and time.time() < entry["expires_at"]:
+                return cls.remember(entry, "cache")
+            if cache.get(cls.lock_key) is None:
+                break
+
+        logger.warning("Timed out waiting for another worker to refresh the access token")
         try:
-            response = requests.get(
-                MpesaC2bCredential.api_URL,
-                auth=HTTPBasicAuth(MpesaC2bCredential.consumer_key, MpesaC2bCredential.consumer_secret),
-                timeout=10
+            fresh = cls.fetch_access_token()
+        except DarajaUnavailable:
+            metrics.TOKEN_LOOKUPS.inc(source="failed")
+            raise
+        if not fresh:
+            metrics.TOKEN_LOOKUPS.inc(source="failed")
+            return None
+        return cls.remember(fresh, "fetched")
+
+    @classmethod
+    def release_lock(cls, lock):
+        """
+        Deletes the refresh lock if it is still the one stored as `lock`.
+
+        Read, then delete: not atomic, but the lock can only change hands in
+        between if it outlived `lock_timeout`, which a refresh should never take.
+        """
+        cache = cls.cache()
+        if cache.get(cls.lock_key) == lock:
+            cache.delete(cls.lock_key)
+
+    @classmethod
+    async def arelease_lock(cls, lock):
+        """
+        Async version of `release_lock`.
+        """
+        cache = cls.cache()
+        if await cache.aget(cls.lock_key) == lock:
+            await cache.adelete(cls.lock_key)
+
+    @classmethod
+    def fetch_access_token(cls):
+        """
+        Requests a new token from Safaricom and stores it in the shared cache.
+
+        Returns:
+            dict: The cache entry (token, expires_at, refresh_at) if successful.
+            None: If the request fails.
+
+        Raises:
+            DarajaUnavailable: If the call was shed (OAuth circuit open, or throttled).
+        """
+        try:
+            response = DarajaClient.fetch_token(
+                cls.credential.api_URL,
+                cls.credential.consumer_key,
+                cls.credential.consumer_secret,
+                bucket=cls.oauth_bucket,
             )
             response.raise_for_status()
             data = response.json()
-            access_token = data.get("access_token")
+            if not data.get("access_token"):
+                logger.error("No access token returned in response")
+                return None
+
+            entry = cls.token_entry(data)
+            expires_in = int(entry["expires_at"] - time.time())
+            cls.cache().set(cls.cache_key, entry, expires_in)
+            logger.info("New access token fetched, expires in %s seconds", expires_in)
+            return entry
+
+        except DarajaUnavailable:
+            raise
+        except (requests.RequestException, ValueError) as e:
+            logger.error("Error fetching access token: %s", e)
+            return None
+
+
+    @classmethod
+    @metrics.timed(metrics.TOKEN_SECONDS)
+    async def aget_access_token(cls):
+        """
+        Async version of `get_access_token` for the ASGI views.
+
+        Same lookup order and single-flight lock, but the cache is accessed with the
+        async cache API and the token is fetched with `AsyncDarajaClient`, so waiting
+        never blocks the event loop.
+        """
+        now = time.time()
+        if cls.validated_mpesa_access_token and cls.refresh_at and now < cls.refresh_at:
+            metrics.TOKEN_LOOKUPS.inc(source="memo")
+            return cls.validated_mpesa_access_token
+
+        cache = cls.cache()
+        entry = await cache.aget(cls.cache_key)
+        if entry and now < entry["refresh_at"]:
+            return cls.remember(entry, "cache")
+
+        stale = entry if entry and now < entry["expires_at"] else None
+        lock = uuid.uuid4().hex
+        if await cache.aadd(cls.lock_key, lock, cls.lock_timeout):
+            try:
+                entry = await cache.aget(cls.cache_key)
+                if entry and time.time() < entry["refresh_at"]:
+                    return cls.remember(entry, "cache")
+                fresh = await cls.afetch_access_token()
+            except DarajaUnavailable:
+                if not stale:
+                    metrics.TOKEN_LOOKUPS.inc(source="failed")
+                    raise
+                fresh = None
+            finally:
+                await cls.arelease_lock(lock)
+            if fresh:
+                return cls.remember(fresh, "fetched")
+            if stale:
+                logger.warning("Token refresh failed, serving the current token until it expires")
+                return cls.remember(stale, "stale")
+            metrics.TOKEN_LOOKUPS.inc(source="failed")
+            return None
+
+        if stale:
+            return cls.remember(stale, "stale")
+
+        deadline = now + cls.wait_timeout
+        while time.time() < deadline:
+            await asyncio.sleep(0.05)
+            entry = await cache.aget(cls.cache_key)
+            if entry and time.time() < entry["expires_at"]:
+                return cls.remember(entry, "cache")
+            if await cache.aget(cls.lock_key) is None:
+                break
+
+        logger.warning("Timed out waiting for another worker to refresh the access token")
+        try:
+            fresh = await cls.afetch_access_token()
+        except DarajaUnavailable:
+            metrics.TOKEN_LOOKUPS.inc(source="failed")
+            raise
+        if not fresh:
+            metrics.TOKEN_LOOKUPS.inc(source="failed")
+            return None
+        return cls.remember(fresh, "fetched")
+
+    @classmethod
+    def token_entry(cls, data):
+        """
+        Builds the cache entry for an OAuth response body.
+        """
+        # Default expiry is 3599 seconds (1 hour)
+        expires_in = int(data.get("expires_in", 3599))
+        now = time.time()
+        return {
+            "token": data["access_token"],
+            "expires_at": now + expires_in,
+            "refresh_at": now + max(expires_in - cls.refresh_margin, expires_in // 2),
+        }
 
-            if not access_token:
+    @classmethod
+    async def afetch_access_token(cls):
+        """
+        Async version of `fetch_access_token`.
+        """
+        try:
+            response = await AsyncDarajaClient.fetch_token(
+                cls.credential.api_URL,
+                cls.credential.consumer_key,
+                cls.credential.consumer_secret,
+                bucket=cls.oauth_bucket,
+            )
+            response.raise_for_status()
+            data = response.json()
+            if not data.get("access_token"):
                 logger.error("No access token returned in response")
                 return None
 
-            cls.validated_mpesa_access_token = access_token
-            # Default expiry is 3599 seconds (1 hour)
-            cls.token_expiry = datetime.now() + timedelta(seconds=int(data.get("expires_in", 3599)))
-            logger.info(f"New access token fetched successfully: {access_token}")
-            return access_token
+            entry = cls.token_entry(data)
+            expires_in = int(entry["expires_at"] - time.time())
+            await cls.cache().aset(cls.cache_key, entry, expires_in)
+            logger.info("New access token fetched, expires in %s seconds", expires_in)
+            return entry
 
-        except requests.RequestException as e:
-            logger.error(f"Error fetching access token: {str(e)}")
+        except (httpx.HTTPError, ValueError) as e:
+            logger.error("Error fetching access token: %s", e)
             return None
 
 
-class LipanaMpesaPassword:
+class PasswordAttributes(type):
+    """
+    Read-only class attributes of LipanaMpesaPassword, taken from `default_builder`.
+
+    `lipa_time` and `decode_password` are those of the latest password generated;
+    use the pair returned by `generate_password` to get both for the same second.
+    """
+
+    @property
+    def passkey(cls):
+        return default_builder.passkey
+
+    @property
+    def lipa_time(cls):
+        return default_builder.current[1]
+
+    @property
+    def decode_password(cls):
+        return default_builder.current[2]
+
+
+class LipanaMpesaPassword(metaclass=PasswordAttributes):
     """
     Utilities for generating the secure password required for STK Push requests.
+
+    Kept for existing callers; the password now comes from the shared
+    `payloads.default_builder`, which caches it per second and is thread-safe.
+    `passkey`, `lipa_time` and `decode_password` can still be read, but no
+    longer assigned.
     """
-    Business_short_code = config("MPESA_SHORT_CODE")
-    passkey = config("MPESA_PASSKEY")
+    Business_short_code = default_builder.shortcode
 
     @classmethod
     def generate_password(cls):
@@ -87,8 +378,4 @@ class LipanaMpesaPassword:
         Returns:
             tuple: (encoded_password, timestamp_string)
         """
-        cls.lipa_time = datetime.now().strftime('%Y%m%d%H%M%S')
-        data_to_encode = cls.Business_short_code + cls.passkey + cls.lipa_time
-        online_password = base64.b64encode(data_to_encode.encode())
-        cls.decode_password = online_password.decode('utf-8')
-        return cls.decode_password, cls.lipa_time
\ No newline at end of file
+        return default_builder.password()
@@ -0,0 +1,350 @@
+import asyncio
+import logging
+import random
+import threading
+import weakref
+
+import requests
+from asgiref.sync import sync_to_async
+from decouple import config
+from django.core.exceptions import ImproperlyConfigured
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from . import metrics
+from .breaker import AdaptiveLimiter, CircuitBreaker, aguard, guard
+from .payloads import dumps
+from .throttle import Throttled, TokenBucket
+
+try:
+    import httpx
+except ImportError:  # Only needed for the async views
+    httpx = None
+
+logger = logging.getLogger(__name__)
+
+
+class DarajaSettings:
+    """
+    Connection settings for the Safaricom Daraja API.
+
+    Read once from environment variables so every request reuses the same values.
+    """
+    base_url = config("MPESA_BASE_URL", default="https://api.safaricom.co.ke").rstrip("/")
+    pool_connections = config("MPESA_HTTP_POOL_CONNECTIONS", default=4, cast=int)
+    pool_maxsize = config("MPESA_HTTP_POOL_MAXSIZE", default=32, cast=int)
+    max_retries = config("MPESA_HTTP_MAX_RETRIES", default=2, cast=int)
+    backoff_factor = config("MPESA_HTTP_BACKOFF_FACTOR", default=0.2, cast=float)
+    backoff_jitter = config("MPESA_HTTP_BACKOFF_JITTER", default=0.1, cast=float)
+    backoff_max = config("MPESA_HTTP_BACKOFF_MAX", default=2.0, cast=float)
+
+    # (connect, read) timeouts in seconds, per endpoint
+    timeouts = {
+        "oauth": (
+            config("MPESA_OAUTH_CONNECT_TIMEOUT", default=3.05, cast=float),
+            config("MPESA_OAUTH_READ_TIMEOUT", default=10, cast=float),
+        ),
+        "stkpush": (
+            config("MPESA_STK_CONNECT_TIMEOUT", default=3.05, cast=float),
+            config("MPESA_STK_READ_TIMEOUT", default=30, cast=float),
+        ),
+        "stkquery": (
+            config("MPESA_STK_QUERY_CONNECT_TIMEOUT", default=3.05, cast=float),
+            config("MPESA_STK_QUERY_READ_TIMEOUT", default=15, cast=float),
+        ),
+    }
+    default_timeout = (3.05, 30)
+
+
+def _breaker(endpoint, **kwargs):
+    return CircuitBreaker(endpoint, probe_timeout=int(sum(DarajaSettings.timeouts[endpoint])) + 5, **kwargs)
+
+
+# One circuit per endpoint, so e.g. an STK Push outage does not stop token refreshes
+BREAKERS = {
+    "oauth": _breaker("oauth"),
+    "stkpush": _breaker("stkpush"),
+    # The query API answers 500 while a push is still being processed
+    "stkquery": _breaker("stkquery", failure_statuses=(502, 503, 504)),
+}
+# Adaptive cap on STK Pushes outstanding in this process
+LIMITERS = {
+    "stkpush": AdaptiveLimiter("stkpush"),
+}
+# Calls per second allowed across all workers, per endpoint (Daraja's per-app TPS); 0 disables
+BUCKETS = {
+    "oauth": TokenBucket("oauth", config("MPESA_OAUTH_RATE", default=2, cast=float)),
+    "stkpush": TokenBucket("stkpush", config("MPESA_STK_RATE", default=20, cast=float),
+                           config("MPESA_STK_BURST", default=0, cast=int)),
+    "stkquery": TokenBucket("stkquery", config("MPESA_STK_QUERY_RATE", default=10, cast=float),
+                            config("MPESA_STK_QUERY_BURST", default=0, cast=int)),
+}
+
+
+class DarajaClient:
+    """
+    Pooled, keep-alive HTTP client for the Daraja API.
+
+    A single `requests.Session` is shared by every thread in the process, so the
+    TCP and TLS handshake to Safaricom is paid once per pooled connection instead
+    of once per request. Idempotent calls (the OAuth GET) are retried on connection
+    errors and 5xx responses with jittered exponential backoff. POSTs are only
+    retried when the connection could not be established, since a retried STK Push
+    would prompt the customer twice.
+    """
+    _session = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def build_session(cls):
+        """
+        Creates a `requests.Session` with a sized connection pool and bounded retries.
+        """
+        retry = Retry(
+            total=DarajaSettings.max_retries,
+            connect=DarajaSettings.max_retries,
+            read=DarajaSettings.max_retries,
+            status=DarajaSettings.max_retries,
+            other=0,
+            allowed_methods=frozenset({"GET"}),
+            status_forcelist=(500, 502, 503, 504),
+            backoff_factor=DarajaSettings.backoff_factor,
+            backoff_jitter=DarajaSettings.backoff_jitter,
+            backoff_max=DarajaSettings.backoff_max,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=DarajaSettings.pool_connections,
+            pool_maxsize=DarajaSettings.pool_maxsize,
+            max_retries=retry,
+        )
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update({"Connection": "keep-alive"})
+        return session
+
+    @classmethod
+    def session(cls):
+        """
+        Returns the process-wide session, creating it on first use.
+        """
+        if cls._session is None:
+            with cls._lock:
+                if cls._session is None:
+                    cls._session = cls.build_session()
+        return cls._session
+
+    @classmethod
+    def reset(cls):
+        """
+        Closes the pooled connections. Call after forking or when settings change.
+        """
+        with cls._lock:
+            if cls._session is not None:
+                cls._session.close()
+            cls._session = None
+
+    @staticmethod
+    def url(path):
+        """
+        Builds an absolute Daraja URL from an API path.
+        """
+        if path.startswith("http://") or path.startswith("https://"):
+            return path
+        return f"{DarajaSettings.base_url}/{path.lstrip('/')}"
+
+    @staticmethod
+    def available(endpoint):
+        """
+        Returns False while the endpoint's circuit is open, so workers can pause instead of spinning.
+        """
+        breaker = BREAKERS.get(endpoint)
+        return breaker is None or breaker.state() != "open"
+
+    @classmethod
+    def request(cls, method, path, endpoint=None, bucket=None, **kwargs):
+        """
+        Sends a request through the shared session using the endpoint's timeout.
+
+        Latency, responses and transport errors are recorded per endpoint. Calls take
+        a token from `bucket`, by default the endpoint's shared one in BUCKETS.
+
+        Raises:
+            Throttled: If the endpoint's rate budget stays exhausted for
+                MPESA_RATE_LIMIT_MAX_WAIT seconds, or Safaricom answered 429.
+            DarajaUnavailable: Without sending anything, if the endpoint's circuit
+                is open or too many STK Pushes are outstanding.
+        """
+        kwargs.setdefault("timeout", DarajaSettings.timeouts.get(endpoint, DarajaSettings.default_timeout))
+        label = endpoint or "other"
+        if bucket is None:
+            bucket = BUCKETS.get(endpoint)
+        if bucket is not None:
+            bucket.acquire()
+        with guard(BREAKERS.get(endpoint), LIMITERS.get(endpoint)) as call, \
+                metrics.DARAJA_IN_FLIGHT.track(endpoint=label), metrics.DARAJA_SECONDS.time(endpoint=label):
+            try:
+                response = cls.session().request(method, cls.url(path), **kwargs)
+            except requests.RequestException as e:
+                metrics.DARAJA_ERRORS.inc(endpoint=label, error=type(e).__name__)
+                raise
+            call.status = response.status_code
+        metrics.DARAJA_RESPONSES.inc(endpoint=label, status=response.status_code)
+        if response.status_code == 429:
+            raise cls.throttled(endpoint, response, bucket)
+        return response
+
+    @staticmethod
+    def throttled(endpoint, response, bucket=None):
+        """
+        Empties the bucket so every worker backs off, and returns the error to raise.
+        """
+        if bucket is not None:
+            bucket.drain()
+        retry_after = response.headers.get("Retry-After", "")
+        logger.warning("Daraja %s throttled the request: %s", endpoint, response.text[:200])
+        return Throttled(
+            f"M-Pesa {endpoint} rate limit reached", response=response,
+            retry_after=float(retry_after) if retry_after.isdigit() else 1,
+        )
+
+    @classmethod
+    def fetch_token(cls, url, consumer_key, consumer_secret, bucket=None):
+        """
+        Calls the OAuth endpoint and returns the raw response.
+        """
+        return cls.request(
+            "GET", url, endpoint="oauth", bucket=bucket,
+            auth=requests.auth.HTTPBasicAuth(consumer_key, consumer_secret),
+        )
+
+    @classmethod
+    def stk_push(cls, payload, access_token, bucket=None):
+        """
+        Sends an STK Push (processrequest) and returns the raw response.
+        """
+        return cls.request(
+            "POST", "/mpesa/stkpush/v1/processrequest", endpoint="stkpush", bucket=bucket,
+            data=dumps(payload),
+            headers={"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"},
+        )
+
+    @classmethod
+    def stk_query(cls, payload, access_token, bucket=None):
+        """
+        Queries the outcome of an STK Push (stkpushquery) and returns the raw response.
+        """
+        return cls.request(
+            "POST", "/mpesa/stkpushquery/v1/query", endpoint="stkquery", bucket=bucket,
+            data=dumps(payload),
+            headers={"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"},
+        )
+
+    @classmethod
+    def register_c2b_urls(cls, payload, access_token, path):
+        """
+        Registers C2B confirmation and validation URLs (registerurl) and returns the raw response.
+        """
+        return cls.request(
+            "POST", path, endpoint="c2b", data=dumps(payload),
+            headers={"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"},
+        )
+
+
+class AsyncDarajaClient:
+    """
+    Asynchronous counterpart of `DarajaClient` for the ASGI deployment, built on httpx.
+
+    One `httpx.AsyncClient` (and so one connection pool) is kept per event loop.
+    The transport retries only failed connection attempts, which is safe for POSTs;
+    the OAuth GET is additionally retried on 5xx with the same jittered backoff.
+    """
+    _clients = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def build_client(cls):
+        if httpx is None:
+            raise ImproperlyConfigured("httpx is required for the async views: pip install httpx")
+        limits = httpx.Limits(
+            max_connections=DarajaSettings.pool_maxsize,
+            max_keepalive_connections=DarajaSettings.pool_maxsize,
+        )
+        transport = httpx.AsyncHTTPTransport(limits=limits, retries=DarajaSettings.max_retries)
+        return httpx.AsyncClient(transport=transport, headers={"Connection": "keep-alive"})
+
+    @classmethod
+    def client(cls):
+        """
+        Returns the client bound to the running event loop, creating it on first use.
+        """
+        loop = asyncio.get_running_loop()
+        client = cls._clients.get(loop)
+        if client is None or client.is_closed:
+            client = cls._clients[loop] = cls.build_client()
+        return client
+
+    @classmethod
+    async def aclose(cls):
+        """
+        Closes the client of the running event loop.
+        """
+        client = cls._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+    @staticmethod
+    def timeout(endpoint):
+        connect, read = DarajaSettings.timeouts.get(endpoint, DarajaSettings.default_timeout)
+        return httpx.Timeout(read, connect=connect)
+
+    @classmethod
+    async def request(cls, method, path, endpoint=None, bucket=None, **kwargs):
+        """
+        Sends a request through the loop's pooled client using the endpoint's timeout.
+
+        Shares the circuit breakers and concurrency limits of `DarajaClient`.
+        """
+        kwargs.setdefault("timeout", cls.timeout(endpoint))
+        label = endpoint or "other"
+        if bucket is None:
+            bucket = BUCKETS.get(endpoint)
+        if bucket is not None:
+            await bucket.aacquire()
+        async with aguard(BREAKERS.get(endpoint), LIMITERS.get(endpoint)) as call:
+            with metrics.DARAJA_IN_FLIGHT.track(endpoint=label), metrics.DARAJA_SECONDS.time(endpoint=label):
+                try:
+                    response = await cls.client().request(method, DarajaClient.url(path), **kwargs)
+                except httpx.HTTPError as e:
+                    metrics.DARAJA_ERRORS.inc(endpoint=label, error=type(e).__name__)
+                    raise
+                call.status = response.status_code
+        metrics.DARAJA_RESPONSES.inc(endpoint=label, status=response.status_code)
+        if response.status_code == 429:
+            raise await sync_to_async(DarajaClient.throttled)(endpoint, response, bucket)
+        return response
+
+    @classmethod
+    async def fetch_token(cls, url, consumer_key, consumer_secret, bucket=None):
+        """
+        Calls the OAuth endpoint, retrying 5xx responses with jittered backoff.
+        """
+        for attempt in range(DarajaSettings.max_retries + 1):
+            response = await cls.request(
+                "GET", url, endpoint="oauth", bucket=bucket, auth=(consumer_key, consumer_secret),
+            )
+            if response.status_code not in (500, 502, 503, 504) or attempt == DarajaSettings.max_retries:
+                return response
+            delay = DarajaSettings.backoff_factor * (2 ** attempt) + random.uniform(0, DarajaSettings.backoff_jitter)
+            await asyncio.sleep(min(delay, DarajaSettings.backoff_max))
+
+    @classmethod
+    async def stk_push(cls, payload, access_token, bucket=None):
+        """
+        Sends an STK Push (processrequest) and returns the raw response.
+        """
+        return await cls.request(
+            "POST", "/mpesa/stkpush/v1/processrequest", endpoint="stkpush", bucket=bucket,
+            content=dumps(payload),
+            headers={"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"},
+        )
@@ -0,0 +1,160 @@
+"""
+Database connection setup and read-replica routing.
+
+SQLite connections get WAL journaling and a busy timeout as they are opened, so
+`check_status` reads no longer block behind callback writes and a write waiting
+for the lock retries instead of failing with "database is locked".
+
+When a `replica` database is configured, `PrimaryReplicaRouter` sends the reads
+of views marked with `reads_from_replica` (status checks, listings, exports)
+to it. Every other read and every write uses the primary, so code that reads
+back what it just wrote, like the callback handler, never sees replication lag.
+"""
+import contextvars
+import os
+from contextlib import contextmanager
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+from decouple import config
+from django.conf import settings
+
+PRIMARY = "default"
+REPLICA = "replica"
+
+# Journal mode, if set explicitly; see `configure_sqlite`
+SQLITE_JOURNAL_MODE = config("MPESA_SQLITE_JOURNAL_MODE", default=None)
+
+# Applied to every new SQLite connection, in order. WAL lets readers and the single
+# writer proceed at the same time; NORMAL sync is durable in WAL mode except across
+# power loss; busy_timeout (ms) makes a blocked writer wait for the lock.
+SQLITE_PRAGMAS = {
+    "journal_mode": SQLITE_JOURNAL_MODE or "WAL",
+    "synchronous": config("MPESA_SQLITE_SYNCHRONOUS", default="NORMAL"),
+    "busy_timeout": config("MPESA_SQLITE_BUSY_TIMEOUT", default=5000, cast=int),
+}
+
+_replica_reads = contextvars.ContextVar("mpesa_replica_reads", default=False)
+
+
+def configure_sqlite(sender, connection, **kwargs):
+    """
+    `connection_created` receiver that applies SQLITE_PRAGMAS to SQLite connections.
+
+    The journal mode is stored in the database file, so unless
+    MPESA_SQLITE_JOURNAL_MODE is set it is left alone for the sample db.sqlite3
+    checked into the repository: every manage.py run, tests included, would
+    otherwise rewrite the tracked file and leave -wal and -shm files beside it.
+    """
+    if connection.vendor != "sqlite":
+        return
+    pragmas = SQLITE_PRAGMAS
+    if SQLITE_JOURNAL_MODE is None and is_sample_database(connection.settings_dict["NAME"]):
+        pragmas = {name: value for name, value in pragmas.items() if name != "journal_mode"}
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+
+
+def is_sample_database(name):
+    return os.path.abspath(name) == os.path.abspath(settings.BASE_DIR / "db.sqlite3")
+
+
+def has_replica():
+    return REPLICA in settings.DATABASES
+
+
+@contextmanager
+def replica_reads():
+    """
+    Routes the reads made inside the block to the replica, if one is configured.
+    """
+    token = _replica_reads.set(True)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def _stream_from_replica(content):
+    with replica_reads():
+        yield from content
+
+
+def reads_from_replica(view):
+    """
+    Decorates a sync or async view whose reads may be served by the replica.
+
+    Streaming responses read while they are sent, after the view has returned, so
+    their content is wrapped to keep the routing.
+    """
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            with replica_reads():
+                return await view(request, *args, **kwargs)
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        with replica_reads():
+            response = view(request, *args, **kwargs)
+        if response.streaming and not response.is_async:
+            response.streaming_content = _stream_from_replica(response.streaming_content)
+        return response
+    return wrapper
+
+
+def get_fresh(queryset, **lookup):
+    """
+    `queryset.get(**lookup)`, retried on the primary if the replica has not got the row yet.
+
+    A status check can arrive before a just-created transaction has replicated; a
+    stale status is harmless (the client polls again), a 404 is not.
+
+    Raises:
+        Model.DoesNotExist: If the primary does not have the row either.
+    """
+    try:
+        return queryset.get(**lookup)
+    except queryset.model.DoesNotExist:
+        if queryset.db != REPLICA:
+            raise
+        return queryset.using(PRIMARY).get(**lookup)
+
+
+async def aget_fresh(queryset, **lookup):
+    """
+    Async version of `get_fresh`.
+    """
+    try:
+        return await queryset.aget(**lookup)
+    except queryset.model.DoesNotExist:
+        if queryset.db != REPLICA:
+            raise
+        return await queryset.using(PRIMARY).aget(**lookup)
+
+
+class PrimaryReplicaRouter:
+    """
+    Sends reads inside `replica_reads` to the replica and everything else to the primary.
+
+    Without a `replica` database every query uses the primary. The replica is kept
+    in sync by the database itself (streaming replication, or a copied SQLite
+    file), so migrations only ever run on the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        if _replica_reads.get() and has_replica():
+            return REPLICA
+        return PRIMARY
+
+    def db_for_write(self, model, **hints):
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Both aliases hold the same data
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == PRIMARY
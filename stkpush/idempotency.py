@@ -0,0 +1,125 @@
+import asyncio
+import hashlib
+import time
+
+from decouple import config
+from django.core.cache import caches
+
+from . import metrics
+
+CACHE = config("MPESA_IDEMPOTENCY_CACHE", default="default")
+# How long the outcome of a request with an explicit Idempotency-Key is replayed
+KEY_TTL = config("MPESA_IDEMPOTENCY_TTL", default=86400, cast=int)
+# Without a key, repeats of the same phone, amount and reference within this many seconds are duplicates
+DERIVED_WINDOW = config("MPESA_IDEMPOTENCY_WINDOW", default=60, cast=int)
+# How long a duplicate waits for the first request to finish; also how long a crashed request holds its key
+MAX_WAIT = config("MPESA_IDEMPOTENCY_WAIT", default=40, cast=float)
+POLL_INTERVAL = 0.05
+
+PENDING = "pending"
+
+
+class InProgress(Exception):
+    """
+    Raised when the request holding a key did not finish within MAX_WAIT.
+    """
+
+
+class Claim:
+    """
+    A request's hold on an idempotency key.
+
+    If `replay` is set, the key was already used and `replay` is the stored outcome
+    to answer with. Otherwise the caller owns the key and must either `complete` it
+    with the outcome or `release` it so that a retry can go ahead.
+    """
+
+    def __init__(self, key, ttl, replay=None):
+        self.key = key
+        self.ttl = ttl
+        self.replay = replay
+
+    def complete(self, **result):
+        caches[CACHE].set(self.key, result, self.ttl)
+
+    def release(self):
+        caches[CACHE].delete(self.key)
+
+    async def acomplete(self, **result):
+        await caches[CACHE].aset(self.key, result, self.ttl)
+
+    async def arelease(self):
+        await caches[CACHE].adelete(self.key)
+
+
+def key_for(request, phone, amount, reference=None, tenant=None):
+    """
+    Returns the cache key and TTL for a payment request.
+
+    The client's Idempotency-Key header (or `idempotency_key` form field) is used
+    when present; otherwise the key is derived from the phone number, amount and
+    account reference (default: the `reference` form field) and expires
+    DERIVED_WINDOW seconds after the first request finished. It is not bucketed
+    by clock time: a repeat straddling a bucket boundary would get a new key.
+    Keys of different tenants never collide.
+    """
+    supplied = request.headers.get("Idempotency-Key") or request.POST.get("idempotency_key")
+    if supplied:
+        source, ttl = f"key|{supplied[:255]}", KEY_TTL
+    else:
+        if reference is None:
+            reference = request.POST.get("reference", "")
+        source, ttl = f"derived|{phone}|{amount}|{reference}", DERIVED_WINDOW
+    if tenant:
+        source = f"{tenant}|{source}"
+    return f"mpesa:idempotency:{hashlib.sha256(source.encode()).hexdigest()}", ttl
+
+
+def claim(request, phone, amount, reference=None, tenant=None):
+    """
+    Claims the request's idempotency key, waiting while a duplicate is in flight.
+
+    Returns:
+        Claim: Owned by the caller, or carrying the stored outcome to replay.
+
+    Raises:
+        InProgress: If the first request is still running after MAX_WAIT seconds.
+    """
+    key, ttl = key_for(request, phone, amount, reference, tenant)
+    cache = caches[CACHE]
+    deadline = time.monotonic() + MAX_WAIT
+    while True:
+        if cache.add(key, PENDING, int(MAX_WAIT) + 1):
+            metrics.IDEMPOTENCY.inc(outcome="new")
+            return Claim(key, ttl)
+        entry = cache.get(key)
+        if entry is not None and entry != PENDING:
+            metrics.IDEMPOTENCY.inc(outcome="replayed")
+            return Claim(key, ttl, replay=entry)
+        if time.monotonic() >= deadline:
+            metrics.IDEMPOTENCY.inc(outcome="conflict")
+            raise InProgress(key)
+        if entry == PENDING:
+            time.sleep(POLL_INTERVAL)
+
+
+async def aclaim(request, phone, amount, reference=None, tenant=None):
+    """
+    Async version of `claim`.
+    """
+    key, ttl = key_for(request, phone, amount, reference, tenant)
+    cache = caches[CACHE]
+    deadline = time.monotonic() + MAX_WAIT
+    while True:
+        if await cache.aadd(key, PENDING, int(MAX_WAIT) + 1):
+            metrics.IDEMPOTENCY.inc(outcome="new")
+            return Claim(key, ttl)
+        entry = await cache.aget(key)
+        if entry is not None and entry != PENDING:
+            metrics.IDEMPOTENCY.inc(outcome="replayed")
+            return Claim(key, ttl, replay=entry)
+        if time.monotonic() >= deadline:
+            metrics.IDEMPOTENCY.inc(outcome="conflict")
+            raise InProgress(key)
+        if entry == PENDING:
+            await asyncio.sleep(POLL_INTERVAL)
@@ -0,0 +1,244 @@
+import json
+import logging
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+from decouple import config
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, OperationalError, transaction as db_transaction
+from django.utils import timezone
+
+from . import log, metrics, rollups, webhooks
+from .models import CallbackInbox, ResultDescription, Transaction
+from .notify import notifier
+from .status_cache import status_cache
+
+logger = logging.getLogger(__name__)
+
+# Only append callbacks in the view and leave applying them to `process_callbacks`
+QUEUED_CALLBACKS = config("MPESA_CALLBACK_INBOX", default=False, cast=bool)
+
+# How long callbacks for a transaction that does not exist yet keep being retried
+UNKNOWN_RETRY_WINDOW = config("MPESA_CALLBACK_RETRY_WINDOW", default=3600, cast=int)
+
+# STK callback ResultCodes documented by Daraja, counted under their own metric label;
+# any other value sent to the callback URL is counted as "other"
+KNOWN_RESULT_CODES = frozenset({0, 1, 17, 26, 1001, 1019, 1025, 1032, 1037, 2001, 9999})
+
+# M-Pesa reports TransactionDate as YYYYMMDDHHMMSS in East Africa Time
+MPESA_TIMEZONE = ZoneInfo("Africa/Nairobi")
+
+# Callback metadata items copied onto the transaction, by model field
+METADATA_FIELDS = {
+    "MpesaReceiptNumber": "mpesa_receipt_number",
+    "Amount": "amount",
+    "PhoneNumber": "phone_number",
+    "TransactionDate": "mpesa_transaction_date",
+}
+
+
+def append(body):
+    """
+    Durably stores a raw callback body and returns the inbox entry.
+
+    Raises:
+        json.JSONDecodeError: If the body is not valid JSON.
+    """
+    return CallbackInbox.objects.create(**inbox_fields(body))
+
+
+async def aappend(body):
+    """
+    Async version of `append`.
+    """
+    return await CallbackInbox.objects.acreate(**inbox_fields(body))
+
+
+def inbox_fields(body):
+    data = json.loads(body)
+    return {
+        "payload": body.decode() if isinstance(body, bytes) else body,
+        "checkout_request_id": data.get('Body', {}).get('stkCallback', {}).get('CheckoutRequestID'),
+    }
+
+
+def parse_callback(data):
+    """
+    Extracts the transaction update from a decoded callback in a single pass.
+
+    Returns:
+        tuple: (checkout_request_id, dict of Transaction fields to update)
+    """
+    stk_callback = data.get('Body', {}).get('stkCallback', {})
+    result_code = stk_callback.get('ResultCode')
+    fields = {
+        "result_code": result_code,
+        "result_description_id": ResultDescription.id_for(stk_callback.get('ResultDesc')),
+        "status": Transaction.Status.SUCCESS if result_code == 0 else Transaction.Status.FAILED,
+    }
+    if result_code == 0:
+        for item in stk_callback.get('CallbackMetadata', {}).get('Item', []):
+            field = METADATA_FIELDS.get(item.get('Name'))
+            value = item.get('Value')
+            if field is None or value is None:
+                continue
+            if field == "mpesa_transaction_date":
+                value = datetime.strptime(str(value), "%Y%m%d%H%M%S").replace(tzinfo=MPESA_TIMEZONE)
+            elif field == "phone_number":
+                value = str(value)
+            fields[field] = value
+    return stk_callback.get('CheckoutRequestID'), fields
+
+
+def apply(data):
+    """
+    Applies a decoded callback to its transaction.
+
+    The update is a single conditional UPDATE on rows still "Pending", so duplicate
+    deliveries and replays change nothing and no row is read before writing. A
+    success already resolved by the reconciler still gets its receipt details.
+
+    Returns:
+        str: "applied", "duplicate", "unknown" (no such transaction yet) or "invalid".
+    """
+    checkout_request_id, fields = parse_callback(data)
+    if not checkout_request_id:
+        return "invalid"
+
+    with db_transaction.atomic(savepoint=False):
+        resolved = Transaction.objects.filter(
+            checkout_request_id=checkout_request_id, status=Transaction.Status.PENDING,
+        ).update(**fields)
+        updated = resolved
+        if not updated and fields.get("mpesa_receipt_number"):
+            # Successes resolved by the reconciler's STK query carry no receipt; take it from the late callback
+            updated = Transaction.objects.filter(
+                checkout_request_id=checkout_request_id, status=Transaction.Status.SUCCESS,
+                mpesa_receipt_number__isnull=True,
+            ).update(**fields)
+        adopted = 0
+        if not updated:
+            if Transaction.objects.filter(checkout_request_id=checkout_request_id).exists():
+                return "duplicate"
+            resolved = updated = adopted = adopt(checkout_request_id, fields)
+        if not updated:
+            return "unknown"
+
+        transaction = Transaction.objects.get(checkout_request_id=checkout_request_id)
+        if adopted:
+            rollups.pushed([transaction])
+        if resolved:
+            rollups.resolved([transaction])
+        webhooks.publish([transaction])
+
+    def announce():
+        status_cache.store(transaction)
+        notifier.publish(transaction.get_status_display(), checkout_request_id, transaction.reference)
+
+    db_transaction.on_commit(announce)
+    logger.info("Transaction %s updated to %s", checkout_request_id, transaction.get_status_display())
+    return "applied"
+
+
+def adopt(checkout_request_id, fields):
+    """
+    Applies a successful callback to the push it answers when the worker never got
+    Safaricom's response (see `jobs.settle_abandoned`): the oldest "Pending" row
+    without a CheckoutRequestID for the same phone number and amount.
+
+    Returns:
+        int: 1 if a row was updated, otherwise 0.
+    """
+    if not fields.get("phone_number") or fields.get("amount") is None:
+        return 0
+    unanswered = Transaction.objects.filter(status=Transaction.Status.PENDING, checkout_request_id__isnull=True)
+    pk = (
+        unanswered.filter(phone_number=fields["phone_number"], amount=fields["amount"])
+        .order_by("transaction_date").values_list("pk", flat=True).first()
+    )
+    if pk is None:
+        return 0
+    logger.info("Matched callback %s to unanswered push %s", checkout_request_id, pk)
+    return unanswered.filter(pk=pk).update(checkout_request_id=checkout_request_id, locked_at=None, **fields)
+
+
+def result_code_label(result_code):
+    """
+    Returns the metric label of a callback's ResultCode: the code if Daraja documents it, otherwise "other".
+    """
+    try:
+        code = int(result_code)
+    except (TypeError, ValueError, OverflowError):
+        return "other"
+    return str(code) if code in KNOWN_RESULT_CODES else "other"
+
+
+def process(entry):
+    """
+    Applies one inbox entry and records the outcome.
+
+    Entries whose transaction does not exist yet (the callback raced the worker
+    saving the CheckoutRequestID) stay unprocessed so a later run picks them up.
+    An entry that cannot be applied (a malformed value, a receipt number already
+    taken) is rolled back to its own savepoint and recorded as an "error:" outcome,
+    so it neither stops the entries after it nor comes back on every run.
+
+    Raises:
+        OperationalError: If the database is unavailable or locked; the entry is left for a later run.
+    """
+    result_code = None
+    with log.context(checkout_request_id=entry.checkout_request_id):
+        try:
+            data = json.loads(entry.payload)
+            result_code = data.get('Body', {}).get('stkCallback', {}).get('ResultCode')
+            with db_transaction.atomic():
+                outcome = apply(data)
+        except OperationalError:
+            raise
+        except (ValueError, TypeError, AttributeError, ValidationError, DatabaseError) as e:
+            outcome = f"error: {e}"[:100]
+            logger.error("Failed to apply callback %s: %s", entry.pk, e)
+    metrics.CALLBACKS.inc(outcome=outcome.split(":")[0], result_code=result_code_label(result_code))
+
+    processed_at = None if outcome == "unknown" else timezone.now()
+    CallbackInbox.objects.filter(pk=entry.pk).update(processed_at=processed_at, outcome=outcome)
+    return outcome
+
+
+def process_pending(batch_size=500, retry_unknown=False):
+    """
+    Applies up to `batch_size` unprocessed inbox entries in one database transaction.
+
+    Grouping the writes keeps SQLite from taking the write lock once per callback.
+    New entries are taken by default; with `retry_unknown` the entries whose
+    transaction was missing are tried again instead, and given up on once they are
+    older than UNKNOWN_RETRY_WINDOW.
+
+    Returns:
+        dict: Number of entries per outcome.
+    """
+    counts = {}
+    pending = CallbackInbox.objects.filter(processed_at__isnull=True)
+    if retry_unknown:
+        cutoff = timezone.now() - timedelta(seconds=UNKNOWN_RETRY_WINDOW)
+        pending.filter(outcome="unknown", received_at__lt=cutoff).update(processed_at=timezone.now())
+        pending = pending.filter(outcome="unknown")
+    else:
+        pending = pending.filter(outcome__isnull=True)
+
+    with db_transaction.atomic():
+        entries = list(pending.order_by('id')[:batch_size])
+        for entry in entries:
+            outcome = process(entry)
+            counts[outcome] = counts.get(outcome, 0) + 1
+    return counts
+
+
+def process_waiting(checkout_request_id):
+    """
+    Applies callbacks that arrived before `checkout_request_id` was saved.
+    """
+    for entry in CallbackInbox.objects.filter(
+        checkout_request_id=checkout_request_id, processed_at__isnull=True, outcome="unknown",
+    ):
+        process(entry)
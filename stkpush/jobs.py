@@ -0,0 +1,186 @@
+import logging
+from datetime import timedelta
+
+import requests
+from asgiref.sync import sync_to_async
+from decouple import config
+from django.db import transaction as db_transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import inbox, log, rollups, webhooks
+from .breaker import DarajaUnavailable
+from .models import ResultDescription, Transaction
+from .notify import notifier
+from .status_cache import status_cache
+from .stk import StkPushError, build_payload, send_stk_push
+from .tenants import UnknownTenant, registry
+
+logger = logging.getLogger(__name__)
+
+# Initiate STK Pushes from a background worker instead of inside the request
+ASYNC_STK_PUSH = config("MPESA_ASYNC_STK_PUSH", default=False, cast=bool)
+# A claimed job whose worker has not finished after this many seconds is settled with an unknown outcome
+CLAIM_TIMEOUT = config("MPESA_JOB_CLAIM_TIMEOUT", default=120, cast=int)
+MAX_ATTEMPTS = config("MPESA_JOB_MAX_ATTEMPTS", default=3, cast=int)
+
+
+def enqueue_stk_push(phone, amount, account_reference=None, tenant=None):
+    """
+    Persists a transaction in the "Initiating" state for a worker to pick up.
+
+    `tenant` is the slug of the tenant to send the push for (default: the
+    shortcode configured in the environment).
+
+    Returns:
+        Transaction: The queued row; its `reference` is what the client polls with.
+    """
+    transaction = Transaction.objects.create(
+        phone_number=phone, amount=amount, account_reference=account_reference, tenant_id=tenant,
+        status=Transaction.Status.INITIATING,
+    )
+    status_cache.store(transaction)
+    return transaction
+
+
+async def aenqueue_stk_push(phone, amount, account_reference=None, tenant=None):
+    """
+    Async version of `enqueue_stk_push`.
+    """
+    return await sync_to_async(enqueue_stk_push)(phone, amount, account_reference, tenant)
+
+
+def claim_jobs(limit, batch=None):
+    """
+    Claims up to `limit` queued transactions for the calling worker.
+
+    Claiming is a conditional UPDATE on the row's status, so it is safe across threads
+    and processes on both SQLite and Postgres without row locks or an external broker.
+    Rows stuck in "Sending" past CLAIM_TIMEOUT are not claimed again; see `settle_abandoned`.
+    Pass `batch` to only claim rows of one bulk campaign; without it, campaign rows
+    are left to `bulk.send_batch`, which paces them and may not have been asked to
+    send them yet.
+
+    Returns:
+        list[Transaction]: The rows this worker now owns.
+    """
+    settle_abandoned()
+    now = timezone.now()
+    queued = Transaction.objects.filter(status=Transaction.Status.INITIATING, attempts__lt=MAX_ATTEMPTS)
+    queued = queued.filter(batch=batch) if batch is not None else queued.filter(batch__isnull=True)
+    candidates = (
+        queued.order_by("id")
+        .values_list("id", "status", "locked_at")[:limit]
+    )
+
+    claimed = []
+    for pk, status, locked_at in candidates:
+        won = Transaction.objects.filter(pk=pk, status=status, locked_at=locked_at).update(
+            status=Transaction.Status.SENDING, locked_at=now, attempts=F("attempts") + 1,
+        )
+        if won:
+            claimed.append(pk)
+    return list(Transaction.objects.filter(pk__in=claimed).order_by("id"))
+
+
+def settle_abandoned(limit=100):
+    """
+    Marks rows left "Sending" past CLAIM_TIMEOUT (a crashed worker, or one that
+    could not record the outcome) as "Pending" with no CheckoutRequestID.
+
+    Their push may have reached Safaricom, and sending it again would prompt the
+    customer twice. Instead the callback is matched to them by phone and amount
+    (see `inbox.adopt`), or `reconcile.settle_unanswered` fails them.
+
+    Returns:
+        int: Number of rows settled.
+    """
+    stale = timezone.now() - timedelta(seconds=CLAIM_TIMEOUT)
+    settled = 0
+    for transaction in Transaction.objects.filter(status=Transaction.Status.SENDING, locked_at__lt=stale)[:limit]:
+        logger.warning("STK Push for %s was abandoned while sending; its outcome is unknown", transaction.reference)
+        settled += finish(transaction, status=Transaction.Status.PENDING, locked_at=transaction.locked_at)
+    return settled
+
+
+def requeued(jobs):
+    """
+    Returns whether any of the processed `jobs` went back to the queue (deferred, or to be retried).
+    """
+    return Transaction.objects.filter(pk__in=[job.pk for job in jobs], status=Transaction.Status.INITIATING).exists()
+
+
+def process_job(transaction):
+    """
+    Sends the STK Push for a claimed transaction and records the outcome.
+
+    Only pushes that cannot have reached Safaricom are sent again: a connection
+    that could not be established goes back in the queue until MAX_ATTEMPTS is
+    reached, and a push shed by the circuit breaker, or whose access token could
+    not be fetched because the OAuth circuit is open, is requeued without using up
+    an attempt. Rejections by Safaricom fail the row straight away. Any other error
+    (a read timeout, an unreadable response) means Safaricom may have the push, so
+    the row becomes "Pending" with no CheckoutRequestID; see `settle_abandoned`.
+    """
+    with log.context(reference=transaction.reference):
+        try:
+            tenant = registry.get(transaction.tenant_id)
+            res_data = send_stk_push(build_payload(
+                transaction.phone_number, transaction.amount, transaction.account_reference, tenant.builder,
+            ), tenant)
+        except (StkPushError, UnknownTenant) as e:
+            logger.error("STK Push for %s failed: %s", transaction.reference, e)
+            return finish(transaction, status=Transaction.Status.FAILED, result_description_id=ResultDescription.id_for(str(e)))
+        except DarajaUnavailable as e:
+            logger.warning("STK Push for %s deferred: %s", transaction.reference, e)
+            return finish(transaction, status=Transaction.Status.INITIATING, attempts=transaction.attempts - 1)
+        except requests.ConnectionError as e:
+            # Includes ConnectTimeout and TokenUnavailable: nothing was sent
+            if transaction.attempts >= MAX_ATTEMPTS:
+                logger.error("STK Push for %s failed after %s attempts: %s", transaction.reference, transaction.attempts, e)
+                return finish(transaction, status=Transaction.Status.FAILED, result_description_id=ResultDescription.id_for(str(e)))
+            logger.warning("STK Push for %s failed, will retry: %s", transaction.reference, e)
+            return finish(transaction, status=Transaction.Status.INITIATING)
+        except (requests.RequestException, ValueError) as e:
+            logger.warning("STK Push for %s may have been sent, outcome unknown: %s", transaction.reference, e)
+            # locked_at keeps when it was sent, for `reconcile.settle_unanswered`
+            return finish(transaction, status=Transaction.Status.PENDING, locked_at=transaction.locked_at)
+
+        log.bind(checkout_request_id=res_data.get("CheckoutRequestID"))
+        logger.info("STK Push for %s accepted as %s", transaction.reference, res_data.get("CheckoutRequestID"))
+        return finish(
+            transaction,
+            status=Transaction.Status.PENDING,
+            checkout_request_id=res_data.get("CheckoutRequestID"),
+            merchant_request_id=res_data.get("MerchantRequestID"),
+        )
+
+
+def finish(transaction, **fields):
+    """
+    Releases a claimed row with the given field values.
+
+    Matching on `locked_at` makes this a no-op if the claim expired and another
+    worker took the row over.
+    """
+    released = fields.get("status") != Transaction.Status.INITIATING
+    with db_transaction.atomic():
+        updated = Transaction.objects.filter(
+            pk=transaction.pk, status=Transaction.Status.SENDING, locked_at=transaction.locked_at,
+        ).update(**{"locked_at": None, **fields})
+        if updated and released:
+            for name, value in fields.items():
+                setattr(transaction, name, value)
+            if transaction.status != Transaction.Status.PENDING:
+                rollups.resolved([transaction])
+            elif transaction.checkout_request_id:
+                # An unanswered push is counted once a callback is matched to it (see `inbox.adopt`)
+                rollups.pushed([transaction])
+            webhooks.publish([transaction])
+    if updated and released:
+        status_cache.store(transaction)
+        notifier.publish(transaction.get_status_display(), transaction.reference, fields.get("checkout_request_id"))
+        if fields.get("checkout_request_id"):
+            # The callback may have beaten us to it
+            inbox.process_waiting(fields["checkout_request_id"])
+    return bool(updated)
@@ -0,0 +1,44 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from stkpush.archive import ARCHIVE_AFTER_DAYS, BATCH_SIZE, archive
+from stkpush.models import Transaction
+
+
+class Command(BaseCommand):
+    help = ("Moves successful and failed transactions older than --older-than days out of the "
+            "database into compressed JSON Lines files under MPESA_ARCHIVE_DIR, in batches.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--older-than", type=int, default=ARCHIVE_AFTER_DAYS,
+                            help="Age in days (default MPESA_ARCHIVE_AFTER_DAYS).")
+        parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="Rows moved per batch.")
+        parser.add_argument("--dry-run", action="store_true", help="Only count the transactions that would move.")
+        parser.add_argument("--vacuum", action="store_true",
+                            help="Then VACUUM a SQLite database to shrink its file. Locks it while running.")
+
+    def handle(self, *args, **options):
+        if options["older_than"] < 1:
+            raise CommandError("--older-than must be at least 1 day")
+        before = timezone.now() - timedelta(days=options["older_than"])
+
+        if options["dry_run"]:
+            count = Transaction.objects.filter(
+                status__in=Transaction.TERMINAL_STATUSES, transaction_date__lt=before,
+            ).count()
+            self.stdout.write(f"{count} transactions started before {before:%Y-%m-%d %H:%M} would be archived")
+            return
+
+        started = time.perf_counter()
+        archived = archive(before, batch_size=options["batch_size"])
+        self.stdout.write(f"Archived {archived} transactions in {time.perf_counter() - started:.1f}s")
+
+        if options["vacuum"] and connection.vendor == "sqlite":
+            started = time.perf_counter()
+            with connection.cursor() as cursor:
+                cursor.execute("VACUUM")
+            self.stdout.write(f"Vacuumed the database in {time.perf_counter() - started:.1f}s")
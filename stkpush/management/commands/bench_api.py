@@ -0,0 +1,90 @@
+import json
+import os
+import re
+import statistics
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from stkpush import api
+from stkpush.credentials import MpesaAccessToken, MpesaC2bCredential
+from stkpush.daraja import BUCKETS, DarajaClient, DarajaSettings
+from stkpush.stub import DarajaStubServer
+
+from .bench_daraja import percentile
+
+# The page hands the checkout id to its polling script
+CHECKOUT_ID = re.compile(rb'const checkoutRequestId = "([^"]*)"')
+
+
+class Command(BaseCommand):
+    help = ("Compares the per-request cost of the JSON API with the HTML form view, "
+            "for initiating payments and for status checks, against the local Daraja stub.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=500)
+
+    def handle(self, *args, **options):
+        server = DarajaStubServer().start()
+        MpesaC2bCredential.api_URL = f"{server.base_url}/oauth/v1/generate?grant_type=client_credentials"
+        DarajaSettings.base_url = server.base_url
+        MpesaAccessToken.validated_mpesa_access_token = None
+        api.API_TOKEN = "bench-token"
+        # Measure the views, not the shared rate limit
+        for bucket in BUCKETS.values():
+            bucket.rate = 0
+
+        db_file = os.path.join(tempfile.mkdtemp(), "bench.sqlite3")
+        connection.settings_dict.setdefault("TEST", {})["NAME"] = db_file
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        client = Client(HTTP_AUTHORIZATION=f"Bearer {api.API_TOKEN}")
+        total = options["requests"]
+        try:
+            with override_settings(ALLOWED_HOSTS=["*"]):
+                form_ids = []
+                self.run("form  POST /pay/", total, lambda i: self.form_pay(client, i, form_ids))
+                api_ids = []
+                self.run("api   POST /api/v1/payments/", total, lambda i: self.api_pay(client, i, api_ids))
+                self.run("form  GET /check-status/", total, lambda i: client.get(
+                    "/check-status/", {"checkout_request_id": form_ids[i % len(form_ids)]}))
+                self.run("api   GET /api/v1/payments/<id>/", total, lambda i: client.get(
+                    f"/api/v1/payments/{api_ids[i % len(api_ids)]}/"))
+                self.run("api   GET /api/v1/payments/?limit=50", total, lambda i: client.get(
+                    "/api/v1/payments/", {"limit": 50}))
+        finally:
+            DarajaClient.reset()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            server.shutdown()
+            server.server_close()
+
+    def form_pay(self, client, i, ids):
+        response = client.post("/pay/", {"phone": f"2547{i:08d}", "amount": "1"})
+        ids.append(CHECKOUT_ID.search(response.content).group(1).decode())
+        return response
+
+    def api_pay(self, client, i, ids):
+        response = client.post(
+            "/api/v1/payments/", json.dumps({"phone": f"2541{i:08d}", "amount": 1}), content_type="application/json",
+        )
+        ids.append(response.json()["checkout_request_id"])
+        return response
+
+    def run(self, name, total, call):
+        samples, sizes, queries = [], [], []
+        for i in range(total):
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                response = call(i)
+                samples.append(time.perf_counter() - started)
+            assert response.status_code in (200, 201), (name, response.status_code)
+            sizes.append(len(response.content))
+            queries.append(len(captured))
+        self.stdout.write(
+            f"{name:<38} mean {statistics.mean(samples) * 1000:6.2f} ms  "
+            f"p50 {statistics.median(samples) * 1000:6.2f} ms  p99 {percentile(samples, 99) * 1000:6.2f} ms  "
+            f"{statistics.mean(sizes):7.0f} B  {statistics.mean(queries):4.1f} queries"
+        )
@@ -0,0 +1,78 @@
+import os
+import random
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from stkpush import archive
+from stkpush.models import Transaction
+
+from .bench_daraja import percentile
+from .bench_schema import seed_transactions
+
+
+def size_mb(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names) / 1e6
+    return os.path.getsize(path) / 1e6
+
+
+class Command(BaseCommand):
+    help = ("Archives the settled transactions of a throwaway database seeded with synthetic "
+            "rows and reports database and archive sizes and lookup latency of hot and archived rows.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=300_000)
+        parser.add_argument("--older-than", type=int, default=30, help="Archive transactions older than this (days).")
+        parser.add_argument("--batch-size", type=int, default=archive.BATCH_SIZE)
+        parser.add_argument("--lookups", type=int, default=2000, help="Status lookups timed per kind.")
+
+    def handle(self, *args, **options):
+        directory = tempfile.mkdtemp()
+        name = os.path.join(directory, "archive.sqlite3")
+        connection.settings_dict.setdefault("TEST", {})["NAME"] = name
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with override_settings(ARCHIVE_DIR=os.path.join(directory, "archive")):
+                self.run(name, options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def run(self, name, options):
+        elapsed = seed_transactions(options["rows"])
+        self.vacuum()
+        self.stdout.write(f"Seeded {options['rows']} rows in {elapsed:.1f}s, database {size_mb(name):.1f} MB")
+
+        before = timezone.now() - timedelta(days=options["older_than"])
+        cold = list(Transaction.objects.filter(status__in=Transaction.TERMINAL_STATUSES, transaction_date__lt=before)
+                    .values_list("checkout_request_id", flat=True))
+        started = time.perf_counter()
+        archived = archive.archive(before, options["batch_size"])
+        elapsed = time.perf_counter() - started
+        self.vacuum()
+        self.stdout.write(f"Archived {archived} rows in {elapsed:.1f}s ({archived / elapsed:.0f} rows/s)")
+        self.stdout.write(f"database {size_mb(name):.1f} MB, archive files {size_mb(settings.ARCHIVE_DIR):.1f} MB")
+
+        rng = random.Random(1)
+        hot = list(Transaction.objects.values_list("checkout_request_id", flat=True))
+        self.stdout.write(f"{'lookup':<10}{'p50 ms':>9}{'p99 ms':>9}")
+        for kind, keys in (("hot", hot), ("archived", cold)):
+            samples = []
+            for key in rng.choices(keys, k=options["lookups"]):
+                started = time.perf_counter()
+                archive.get(Transaction.objects, checkout_request_id=key)
+                samples.append((time.perf_counter() - started) * 1000)
+            self.stdout.write(f"{kind:<10}{percentile(samples, 50):>9.2f}{percentile(samples, 99):>9.2f}")
+
+    def vacuum(self):
+        # Deleted pages stay in the file until it is vacuumed
+        with connection.cursor() as cursor:
+            cursor.execute("VACUUM")
@@ -0,0 +1,116 @@
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import AsyncClient, Client
+from django.test.utils import override_settings
+from django.urls import include, path
+
+from stkpush import async_views, views
+from stkpush.credentials import MpesaAccessToken, MpesaC2bCredential
+from stkpush.daraja import BUCKETS, LIMITERS, AsyncDarajaClient, DarajaClient, DarajaSettings
+from stkpush.stub import DarajaStubServer
+
+from .bench_daraja import percentile
+
+
+def build_urlconf(module):
+    """
+    Builds a throwaway URLconf routing the payment endpoints to `module`.
+    """
+    patterns = [
+        path('pay/', module.pay, name='pay'),
+        path('callback/', module.callback, name='callback'),
+        path('check-status/', module.check_status, name='check_status'),
+        path('wait-status/', module.wait_status, name='wait_status'),
+        path('', views.home, name='home'),
+        path('token/', views.token, name='token'),
+        path('stk/', views.stk, name='stk'),
+    ]
+    urlconf = types.ModuleType(f"bench_urls_{module.__name__}")
+    urlconf.urlpatterns = [path('', include((patterns, 'stkpush')))]
+    return urlconf
+
+
+class Command(BaseCommand):
+    help = ("Load-tests the sync (WSGI) and async (ASGI) payment views in-process "
+            "against the local Daraja stub and compares throughput.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=400)
+        parser.add_argument("--concurrency", type=int, default=200,
+                            help="In-flight requests for ASGI; WSGI is limited to --workers threads.")
+        parser.add_argument("--workers", type=int, default=8, help="WSGI worker threads (e.g. gunicorn --threads).")
+        parser.add_argument("--latency", type=float, default=1.0, help="Simulated Daraja response time in seconds.")
+
+    def handle(self, *args, **options):
+        server = DarajaStubServer(latency=options["latency"]).start()
+        MpesaC2bCredential.api_URL = f"{server.base_url}/oauth/v1/generate?grant_type=client_credentials"
+        DarajaSettings.base_url = server.base_url
+        DarajaSettings.pool_maxsize = max(options["concurrency"], options["workers"])
+        # Measure the views, not the client-side rate and concurrency limits
+        BUCKETS["stkpush"].rate = BUCKETS["oauth"].rate = 0
+        LIMITERS["stkpush"].limit = LIMITERS["stkpush"].maximum = float(DarajaSettings.pool_maxsize)
+
+        # Run against a throwaway file database so worker threads share it
+        db_file = os.path.join(tempfile.mkdtemp(), "bench.sqlite3")
+        connection.settings_dict.setdefault("TEST", {})["NAME"] = db_file
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with override_settings(ALLOWED_HOSTS=["*"]):
+                with override_settings(ROOT_URLCONF=build_urlconf(views)):
+                    self.report("WSGI (sync)", self.run_wsgi(options))
+                with override_settings(ROOT_URLCONF=build_urlconf(async_views)):
+                    self.report("ASGI (async)", asyncio.run(self.run_asgi(options)))
+        finally:
+            DarajaClient.reset()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            server.shutdown()
+            server.server_close()
+
+    def run_wsgi(self, options):
+        MpesaAccessToken.validated_mpesa_access_token = None
+
+        def timed(i):
+            start = time.perf_counter()
+            response = Client().post("/pay/", {"phone": f"2547{i:08d}", "amount": "1"})
+            assert response.status_code == 200
+            return time.perf_counter() - start
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options["workers"]) as pool:
+            samples = list(pool.map(timed, range(options["requests"])))
+        return samples, time.perf_counter() - started
+
+    async def run_asgi(self, options):
+        MpesaAccessToken.validated_mpesa_access_token = None
+        limit = asyncio.Semaphore(options["concurrency"])
+        client = AsyncClient()
+
+        async def timed(i):
+            async with limit:
+                start = time.perf_counter()
+                response = await client.post("/pay/", {"phone": f"2548{i:08d}", "amount": "1"})
+                assert response.status_code == 200
+                return time.perf_counter() - start
+
+        started = time.perf_counter()
+        try:
+            samples = await asyncio.gather(*(timed(i) for i in range(options["requests"])))
+        finally:
+            await AsyncDarajaClient.aclose()
+        return samples, time.perf_counter() - started
+
+    def report(self, name, result):
+        samples, elapsed = result
+        self.stdout.write(
+            f"{name:<13} {len(samples) / elapsed:8.1f} req/s  "
+            f"p50 {statistics.median(samples) * 1000:8.2f} ms  "
+            f"p99 {percentile(samples, 99) * 1000:8.2f} ms"
+        )
@@ -0,0 +1,100 @@
+import threading
+import time
+from collections import Counter
+
+import requests
+from django.core.management.base import BaseCommand
+
+from stkpush.breaker import DarajaUnavailable
+from stkpush.daraja import BREAKERS, BUCKETS, LIMITERS, DarajaClient
+from stkpush.stub import DarajaStubServer
+
+from .bench_daraja import PAYLOAD, percentile
+
+# (name, stub latency in seconds, stub error rate)
+PHASES = (
+    ("healthy", 0.02, 0.0),
+    ("outage", 0.02, 1.0),
+    ("slow", 0.5, 0.0),
+    ("recovered", 0.02, 0.0),
+)
+
+
+class Command(BaseCommand):
+    help = ("Injects faults into the local Daraja stub (an outage, then slow responses) while "
+            "sending STK Pushes, and reports how the circuit breaker and concurrency limit react.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=32)
+        parser.add_argument("--phase-seconds", type=float, default=5.0)
+        parser.add_argument("--window", type=int, default=2,
+                            help="Seconds of calls the failure and slow-call rates are computed over.")
+        parser.add_argument("--open-seconds", type=float, default=1.0,
+                            help="How long the circuit stays open before probing.")
+        parser.add_argument("--slow-call", type=float, default=0.25,
+                            help="Calls slower than this many seconds count as slow.")
+
+    def handle(self, *args, **options):
+        breaker, limiter = BREAKERS["stkpush"], LIMITERS["stkpush"]
+        breaker.window = options["window"]
+        breaker.open_seconds = options["open_seconds"]
+        breaker.slow_call = options["slow_call"]
+        breaker.close()
+        BUCKETS["stkpush"].rate = 0
+
+        server = DarajaStubServer().start()
+        url = f"{server.base_url}/mpesa/stkpush/v1/processrequest"
+        headers = {"Authorization": "Bearer bench"}
+
+        def send():
+            started = time.perf_counter()
+            try:
+                response = DarajaClient.request(
+                    "POST", url, endpoint="stkpush", json=PAYLOAD, headers=headers, timeout=(1, 2),
+                )
+                outcome = "ok" if response.status_code == 200 else "failed"
+            except DarajaUnavailable:
+                outcome = "shed"
+            except requests.RequestException:
+                outcome = "failed"
+            return outcome, time.perf_counter() - started
+
+        try:
+            for name, latency, error_rate in PHASES:
+                server.latency, server.error_rate = latency, error_rate
+                self.run(name, send, options["concurrency"], options["phase_seconds"], breaker, limiter)
+        finally:
+            DarajaClient.reset()
+            breaker.close()
+            server.shutdown()
+            server.server_close()
+
+    def run(self, name, send, concurrency, seconds, breaker, limiter):
+        results = []
+        lock = threading.Lock()
+        deadline = time.monotonic() + seconds
+
+        def loop():
+            while time.monotonic() < deadline:
+                result = send()
+                with lock:
+                    results.append(result)
+                if result[0] == "shed":
+                    # A real caller would back off; keep the loop from spinning
+                    time.sleep(0.01)
+
+        threads = [threading.Thread(target=loop) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        outcomes = Counter(outcome for outcome, _ in results)
+        shed = [elapsed * 1000 for outcome, elapsed in results if outcome == "shed"]
+        sent = [elapsed * 1000 for outcome, elapsed in results if outcome != "shed"]
+        self.stdout.write(
+            f"{name:<10} ok {outcomes['ok']:6}  failed {outcomes['failed']:5}  shed {outcomes['shed']:6}  "
+            f"sent p50 {percentile(sent, 50) if sent else 0:7.1f} ms  "
+            f"shed p99 {percentile(shed, 99) if shed else 0:6.2f} ms  "
+            f"circuit {breaker.state():<9}  limit {limiter.limit:5.1f}"
+        )
@@ -0,0 +1,136 @@
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+from wsgiref.simple_server import make_server
+
+from stkpush import c2b
+from stkpush.models import C2BPayment, PaybillAccount
+
+from .bench_daraja import percentile
+from .load_test import QuietHandler, ThreadingWSGIServer
+
+# (name, group-commit confirmations)
+SCENARIOS = (
+    ("row by row", False),
+    ("batched", True),
+)
+
+
+def confirmation(number, account):
+    return {
+        "TransactionType": "Pay Bill",
+        "TransID": f"BENCH{number:07d}",
+        "TransTime": time.strftime("%Y%m%d%H%M%S"),
+        "TransAmount": str(random.randint(10, 5000)),
+        "BusinessShortCode": "174379",
+        "BillRefNumber": account,
+        "InvoiceNumber": "",
+        "OrgAccountBalance": "",
+        "ThirdPartyTransID": "",
+        "MSISDN": "2547XXXXX126",
+        "FirstName": "John",
+    }
+
+
+class Command(BaseCommand):
+    help = ("Replays a storm of C2B confirmations over HTTP, row by row and group-committed, "
+            "while validations keep arriving, and reports throughput and latency of both.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--confirmations", type=int, default=4000)
+        parser.add_argument("--concurrency", type=int, default=32, help="Confirmations in flight at once.")
+        parser.add_argument("--validators", type=int, default=2, help="Clients sending validations meanwhile.")
+        parser.add_argument("--accounts", type=int, default=50000, help="Active account numbers in the index.")
+        parser.add_argument("--duplicate-rate", type=float, default=0.05,
+                            help="Share of confirmations delivered twice, as Safaricom sometimes does.")
+        parser.add_argument("--seed", type=int, default=1)
+
+    def handle(self, *args, **options):
+        connection.settings_dict.setdefault("TEST", {})["NAME"] = os.path.join(tempfile.mkdtemp(), "c2b.sqlite3")
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        app = make_server("127.0.0.1", 0, WSGIHandler(), server_class=ThreadingWSGIServer, handler_class=QuietHandler)
+        url = f"http://127.0.0.1:{app.server_address[1]}"
+        threading.Thread(target=app.serve_forever, daemon=True).start()
+        batched = c2b.BATCH_CONFIRMATIONS
+        try:
+            accounts = [f"ACC{i:06d}" for i in range(options["accounts"])]
+            PaybillAccount.objects.bulk_create(PaybillAccount(number=number) for number in accounts)
+            c2b.account_index.reset()
+            connection.close()
+
+            self.stdout.write(f"{options['confirmations']} confirmations, {options['concurrency']} concurrent, "
+                              f"{options['validators']} validators, {options['accounts']} accounts")
+            self.stdout.write(f"{'scenario':<12}{'conf/s':>8}{'p50 ms':>9}{'p99 ms':>9}{'errors':>8}{'rows':>8}"
+                              f"{'valid/s':>9}{'p50 ms':>9}{'p99 ms':>9}")
+            with override_settings(ALLOWED_HOSTS=["*"], DEBUG=False):
+                for offset, (name, batch) in enumerate(SCENARIOS):
+                    c2b.BATCH_CONFIRMATIONS = batch
+                    random.seed(options["seed"])
+                    self.run(name, url, accounts, offset * options["confirmations"], options)
+        finally:
+            c2b.BATCH_CONFIRMATIONS = batched
+            app.shutdown()
+            app.server_close()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def run(self, name, url, accounts, first, options):
+        numbers = list(range(first, first + options["confirmations"]))
+        deliveries = numbers + random.sample(numbers, int(len(numbers) * options["duplicate_rate"]))
+        random.shuffle(deliveries)
+        bodies = [json.dumps(confirmation(number, random.choice(accounts))) for number in deliveries]
+        local = threading.local()
+
+        def session():
+            if not hasattr(local, "session"):
+                local.session = requests.Session()
+            return local.session
+
+        def confirm(body):
+            started = time.perf_counter()
+            response = session().post(f"{url}/c2b/confirmation/", data=body,
+                                      headers={"Content-Type": "application/json"})
+            return time.perf_counter() - started, response.status_code
+
+        done = threading.Event()
+        validations = []
+
+        def validate():
+            own = requests.Session()
+            samples = []
+            while not done.is_set():
+                body = json.dumps(confirmation(0, random.choice(accounts)))
+                started = time.perf_counter()
+                own.post(f"{url}/c2b/validation/", data=body, headers={"Content-Type": "application/json"})
+                samples.append(time.perf_counter() - started)
+            validations.extend(samples)
+
+        validators = [threading.Thread(target=validate) for _ in range(options["validators"])]
+        for validator in validators:
+            validator.start()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options["concurrency"]) as pool:
+            results = list(pool.map(confirm, bodies))
+        elapsed = time.perf_counter() - started
+        done.set()
+        for validator in validators:
+            validator.join()
+
+        latencies = [seconds * 1000 for seconds, _ in results]
+        valid_ms = [seconds * 1000 for seconds in validations] or [0]
+        errors = sum(1 for _, status in results if status != 200)
+        rows = C2BPayment.objects.filter(trans_id__in=[f"BENCH{number:07d}" for number in numbers]).count()
+        self.stdout.write(
+            f"{name:<12}{len(results) / elapsed:>8.0f}{percentile(latencies, 50):>9.1f}"
+            f"{percentile(latencies, 99):>9.1f}{errors:>8}{rows:>8}"
+            f"{len(validations) / elapsed:>9.0f}{percentile(valid_ms, 50):>9.1f}{percentile(valid_ms, 99):>9.1f}"
+        )
@@ -0,0 +1,80 @@
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.core.management.base import BaseCommand
+
+from stkpush.daraja import BUCKETS, DarajaClient
+from stkpush.stub import DarajaStubServer
+
+PAYLOAD = {
+    "BusinessShortCode": "174379",
+    "Password": "bench",
+    "Timestamp": "20250101000000",
+    "TransactionType": "CustomerPayBillOnline",
+    "Amount": 1,
+    "PartyA": "254700000000",
+    "PartyB": "174379",
+    "PhoneNumber": "254700000000",
+    "CallBackURL": "http://127.0.0.1/callback/",
+    "AccountReference": "bench",
+    "TransactionDesc": "bench",
+}
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class Command(BaseCommand):
+    help = "Compares per-request connections against the pooled DarajaClient using the local stub."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=500)
+        parser.add_argument("--concurrency", type=int, default=8)
+        parser.add_argument("--connect-delay", type=float, default=0.02,
+                            help="Simulated handshake cost per new connection, in seconds.")
+        parser.add_argument("--latency", type=float, default=0.0)
+
+    def handle(self, *args, **options):
+        server = DarajaStubServer(latency=options["latency"], connect_delay=options["connect_delay"]).start()
+        # Compare connection handling only, without the shared rate limit
+        BUCKETS["stkpush"].rate = 0
+        url = f"{server.base_url}/mpesa/stkpush/v1/processrequest"
+        headers = {"Authorization": "Bearer bench"}
+
+        def unpooled():
+            return requests.post(url, json=PAYLOAD, headers=headers, timeout=30)
+
+        def pooled():
+            return DarajaClient.request("POST", url, endpoint="stkpush", json=PAYLOAD, headers=headers)
+
+        try:
+            for name, call in (("requests.post", unpooled), ("DarajaClient", pooled)):
+                server.counters.update(connections=0, requests=0)
+                self.report(name, call, options["requests"], options["concurrency"], server)
+        finally:
+            DarajaClient.reset()
+            server.shutdown()
+            server.server_close()
+
+    def report(self, name, call, total, concurrency, server):
+        def timed(_):
+            start = time.perf_counter()
+            call().raise_for_status()
+            return time.perf_counter() - start
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            samples = list(pool.map(timed, range(total)))
+        elapsed = time.perf_counter() - started
+
+        self.stdout.write(
+            f"{name:<14} {total / elapsed:8.1f} req/s  "
+            f"p50 {statistics.median(samples) * 1000:7.2f} ms  "
+            f"p99 {percentile(samples, 99) * 1000:7.2f} ms  "
+            f"connections {server.counters['connections']}"
+        )
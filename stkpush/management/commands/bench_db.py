@@ -0,0 +1,162 @@
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection, transaction as db_transaction
+
+from stkpush import db, inbox
+from stkpush.models import ResultDescription, Transaction
+
+from .bench_daraja import percentile
+
+# (name, journal mode, keep the connection between requests)
+SCENARIOS = (
+    ("rollback journal, connection per request", "DELETE", False),
+    ("WAL, connection per request", "WAL", False),
+    ("WAL, persistent connection", "WAL", True),
+)
+
+
+def callback_body(checkout_request_id, number):
+    return json.dumps({"Body": {"stkCallback": {
+        "MerchantRequestID": f"bench-{number}",
+        "CheckoutRequestID": checkout_request_id,
+        "ResultCode": 0,
+        "ResultDesc": "The service request is processed successfully.",
+        "CallbackMetadata": {"Item": [
+            {"Name": "Amount", "Value": 1},
+            {"Name": "MpesaReceiptNumber", "Value": f"RCPT{number:08d}"},
+            {"Name": "PhoneNumber", "Value": 254700000000},
+        ]},
+    }}})
+
+
+class Command(BaseCommand):
+    help = ("Measures SQLite contention under a mixed load of pay inserts, callback writes and "
+            "check_status reads, with the rollback journal and WAL, with and without persistent "
+            "connections, on a throwaway database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--readers", type=int, default=8, help="Threads polling check_status.")
+        parser.add_argument("--writers", type=int, default=4, help="Threads saving payments and callbacks.")
+        parser.add_argument("--duration", type=float, default=5.0, help="Seconds per scenario.")
+        parser.add_argument("--rows", type=int, default=2000, help="Pending transactions seeded for callbacks.")
+        parser.add_argument("--busy-timeout", type=int, default=db.SQLITE_PRAGMAS["busy_timeout"],
+                            help="SQLite busy_timeout in milliseconds.")
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{options['readers']} readers, {options['writers']} writers, "
+                          f"{options['duration']:.0f} s per scenario, busy_timeout {options['busy_timeout']} ms")
+        self.stdout.write(f"{'scenario':<42}{'reads/s':>9}{'p50 ms':>8}{'p99 ms':>8}"
+                          f"{'writes/s':>10}{'p50 ms':>8}{'p99 ms':>8}{'locked':>8}")
+        pragmas = dict(db.SQLITE_PRAGMAS)
+        try:
+            for name, journal_mode, persistent in SCENARIOS:
+                db.SQLITE_PRAGMAS.update(journal_mode=journal_mode, busy_timeout=options["busy_timeout"])
+                self.run(name, persistent, options)
+        finally:
+            db.SQLITE_PRAGMAS.update(pragmas)
+
+    def run(self, name, persistent, options):
+        connection.settings_dict.setdefault("TEST", {})["NAME"] = os.path.join(tempfile.mkdtemp(), "bench.sqlite3")
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        # The memoised description ids belong to the previous scenario's database
+        ResultDescription._ids.clear()
+        ResultDescription._texts.clear()
+        try:
+            pending = self.seed(options["rows"])
+            # Every new connection must see the scenario's journal mode
+            connection.close()
+
+            reads, writes, locked = [], [], [0]
+            lock = threading.Lock()
+            stop = time.perf_counter() + options["duration"]
+            counter = iter(range(10 ** 9))
+
+            def reader(seed):
+                rng = random.Random(seed)
+                samples = []
+                while time.perf_counter() < stop:
+                    started = time.perf_counter()
+                    try:
+                        Transaction.objects.filter(checkout_request_id=rng.choice(pending)).values(
+                            "status", "mpesa_receipt_number", "result_code").first()
+                    except OperationalError:
+                        with lock:
+                            locked[0] += 1
+                        continue
+                    finally:
+                        if not persistent:
+                            connection.close()
+                    samples.append(time.perf_counter() - started)
+                connection.close()
+                with lock:
+                    reads.extend(samples)
+
+            def writer(seed):
+                rng = random.Random(seed)
+                samples = []
+                while time.perf_counter() < stop:
+                    with lock:
+                        number = next(counter)
+                    started = time.perf_counter()
+                    try:
+                        if rng.random() < 0.5:
+                            # pay: save the accepted push
+                            Transaction.objects.create(
+                                checkout_request_id=f"ws_CO_new_{number}", phone_number="254700000000",
+                                amount=Decimal(1), status=Transaction.Status.PENDING,
+                            )
+                        else:
+                            # callback: append to the inbox and apply, as the view does
+                            body = callback_body(rng.choice(pending), number)
+                            with db_transaction.atomic():
+                                inbox.process(inbox.append(body))
+                    except OperationalError:
+                        with lock:
+                            locked[0] += 1
+                        continue
+                    finally:
+                        if not persistent:
+                            connection.close()
+                    samples.append(time.perf_counter() - started)
+                connection.close()
+                with lock:
+                    writes.extend(samples)
+
+            threads = [threading.Thread(target=reader, args=(i,)) for i in range(options["readers"])]
+            threads += [threading.Thread(target=writer, args=(-i - 1,)) for i in range(options["writers"])]
+            started = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        read_ms = [s * 1000 for s in reads] or [0]
+        write_ms = [s * 1000 for s in writes] or [0]
+        self.stdout.write(
+            f"{name:<42}{len(reads) / elapsed:>9.0f}{percentile(read_ms, 50):>8.2f}{percentile(read_ms, 99):>8.2f}"
+            f"{len(writes) / elapsed:>10.0f}{percentile(write_ms, 50):>8.2f}{percentile(write_ms, 99):>8.2f}"
+            f"{locked[0]:>8}"
+        )
+
+    def seed(self, rows):
+        """
+        Inserts `rows` pending transactions and returns their CheckoutRequestIDs.
+        """
+        ids = [f"ws_CO_bench_{i}" for i in range(rows)]
+        Transaction.objects.bulk_create(
+            Transaction(reference=uuid.uuid4(), checkout_request_id=checkout_request_id,
+                        phone_number="254700000000", amount=Decimal(1), status=Transaction.Status.PENDING)
+            for checkout_request_id in ids
+        )
+        return ids
@@ -0,0 +1,87 @@
+import logging
+import os
+import statistics
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from stkpush import log
+
+from .bench_daraja import percentile
+
+# A typical hot-path record: the STK Push response logged by the pay view
+RESPONSE = {
+    "MerchantRequestID": "29115-34620561-1",
+    "CheckoutRequestID": "ws_CO_191220191020363925",
+    "ResponseCode": "0",
+    "ResponseDescription": "Success. Request accepted for processing",
+    "CustomerMessage": "Success. Request accepted for processing",
+    "PhoneNumber": "254712345678",
+}
+
+
+class FsyncFileHandler(logging.FileHandler):
+    """
+    FileHandler that waits for each record to reach the disk, like a slow or durable volume.
+    """
+
+    def flush(self):
+        super().flush()
+        if self.stream:
+            os.fsync(self.stream.fileno())
+
+
+class Command(BaseCommand):
+    help = ("Measures the per-call cost of logging on the request thread: the old synchronous "
+            "FileHandler with f-strings versus the queued JSON handler with lazy formatting.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--calls", type=int, default=20000)
+        parser.add_argument("--fsync", action="store_true", help="fsync every record, to model a slow disk.")
+
+    def handle(self, *args, **options):
+        workdir = tempfile.mkdtemp()
+        calls = options["calls"]
+        handler_class = FsyncFileHandler if options["fsync"] else logging.FileHandler
+
+        file_handler = handler_class(os.path.join(workdir, "sync.log"))
+        file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        sync_logger = self.logger("bench.sync", file_handler)
+
+        target = handler_class(os.path.join(workdir, "queued.log"))
+        target.set_name("bench_queued_file")
+        target.setFormatter(log.JsonFormatter())
+        queue_handler = log.QueueHandler(handlers=["bench_queued_file"])
+        queue_handler.addFilter(log.ContextFilter())
+        queued_logger = self.logger("bench.queued", queue_handler)
+
+        with log.context(request_id="bench", checkout_request_id=RESPONSE["CheckoutRequestID"]):
+            self.run("sync file, f-string", calls, lambda: sync_logger.info(f"STK Push response: {RESPONSE}"))
+            self.run("queued json, lazy", calls, lambda: queued_logger.info("STK Push response: %s", RESPONSE))
+            self.run("disabled, f-string", calls, lambda: queued_logger.debug(f"STK Push response: {RESPONSE}"))
+            self.run("disabled, lazy", calls, lambda: queued_logger.debug("STK Push response: %s", RESPONSE))
+
+        started = time.perf_counter()
+        queue_handler.close()
+        self.stdout.write(f"Listener drained the queue in {(time.perf_counter() - started) * 1000:.1f} ms")
+        file_handler.close()
+        target.close()
+
+    def logger(self, name, handler):
+        logger = logging.getLogger(name)
+        logger.handlers = [handler]
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        return logger
+
+    def run(self, name, calls, emit):
+        samples = []
+        for _ in range(calls):
+            started = time.perf_counter_ns()
+            emit()
+            samples.append((time.perf_counter_ns() - started) / 1000)
+        self.stdout.write(
+            f"{name:<22} mean {statistics.mean(samples):7.2f} us  "
+            f"p50 {percentile(samples, 50):7.2f} us  p99 {percentile(samples, 99):7.2f} us"
+        )
@@ -0,0 +1,86 @@
+import base64
+import json
+import threading
+import time
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+
+from stkpush import payloads
+from stkpush.payloads import default_builder
+
+
+class PerCallPassword:
+    """
+    The previous password helper: encodes on every call and keeps the result in class attributes.
+    """
+    Business_short_code = default_builder.shortcode
+    passkey = default_builder.secret[len(default_builder.shortcode):].decode()
+
+    @classmethod
+    def generate_password(cls):
+        cls.lipa_time = datetime.now().strftime('%Y%m%d%H%M%S')
+        data_to_encode = cls.Business_short_code + cls.passkey + cls.lipa_time
+        online_password = base64.b64encode(data_to_encode.encode())
+        cls.decode_password = online_password.decode('utf-8')
+        return cls.decode_password, cls.lipa_time
+
+
+def per_call_payload(phone, amount):
+    password, timestamp = PerCallPassword.generate_password()
+    return {
+        "BusinessShortCode": PerCallPassword.Business_short_code,
+        "Password": password,
+        "Timestamp": timestamp,
+        "TransactionType": "CustomerPayBillOnline",
+        "Amount": int(amount),
+        "PartyA": phone,
+        "PartyB": PerCallPassword.Business_short_code,
+        "PhoneNumber": phone,
+        "CallBackURL": default_builder.callback_url,
+        "AccountReference": "Your Mpesa-Test",
+        "TransactionDesc": "Payment for your Company"
+    }
+
+
+class Command(BaseCommand):
+    help = ("Measures building and serialising STK Push payloads with the per-call password "
+            "against the cached StkPayloadBuilder, on one thread and under concurrent load.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=200000)
+        parser.add_argument("--threads", type=int, default=8)
+
+    def handle(self, *args, **options):
+        iterations, threads = options["iterations"], options["threads"]
+        self.stdout.write(f"JSON encoder: {'orjson' if payloads.orjson else 'json'}")
+        cases = (
+            ("per-call build", lambda: per_call_payload("254700000000", 1)),
+            ("builder build", lambda: default_builder.stk_push("254700000000", 1)),
+            ("per-call build+json.dumps", lambda: json.dumps(per_call_payload("254700000000", 1)).encode()),
+            ("builder build+dumps", lambda: payloads.dumps(default_builder.stk_push("254700000000", 1))),
+        )
+        for name, call in cases:
+            for count in (1, threads):
+                self.run(name, call, iterations, count)
+
+    def run(self, name, call, iterations, thread_count):
+        per_thread = iterations // thread_count
+
+        def loop():
+            for _ in range(per_thread):
+                call()
+
+        workers = [threading.Thread(target=loop) for _ in range(thread_count)]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+        total = per_thread * thread_count
+        self.stdout.write(
+            f"{name:<28} {thread_count:2} threads  {total / elapsed:10,.0f} payloads/s  "
+            f"{elapsed / total * 1e6:6.2f} µs each"
+        )
+
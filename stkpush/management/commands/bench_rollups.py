@@ -0,0 +1,86 @@
+import os
+import statistics
+import tempfile
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import TruncDay, TruncHour
+from django.utils import timezone
+
+from stkpush import rollups
+from stkpush.models import RollupPeriod, Transaction
+
+from .bench_schema import seed_transactions
+
+SUCCESS = Q(status=Transaction.Status.SUCCESS)
+
+
+def scan_totals(trunc, since):
+    """
+    The totals computed straight from the Transaction table, as before the rollups.
+    """
+    return list(
+        Transaction.objects.filter(transaction_date__gte=since).order_by()
+        .values(start=trunc("transaction_date"))
+        .annotate(pushes=Count("id", filter=Q(checkout_request_id__isnull=False)),
+                  succeeded=Count("id", filter=SUCCESS),
+                  failed=Count("id", filter=Q(status=Transaction.Status.FAILED)),
+                  amount=Sum("amount", filter=SUCCESS))
+        .order_by("start")
+    )
+
+
+def scan_top_phones(since):
+    return list(
+        Transaction.objects.filter(SUCCESS, transaction_date__gte=since)
+        .values("phone_number").annotate(payments=Count("id"), amount=Sum("amount"))
+        .order_by("-amount", "phone_number")[:10]
+    )
+
+
+class Command(BaseCommand):
+    help = ("Compares dashboard queries computed from the Transaction table with the same "
+            "queries on the rollups, on a throwaway database seeded with synthetic transactions.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=500_000)
+        parser.add_argument("--repeat", type=int, default=5, help="Runs of each query; the median is reported.")
+
+    def handle(self, *args, **options):
+        connection.settings_dict.setdefault("TEST", {})["NAME"] = os.path.join(tempfile.mkdtemp(), "bench.sqlite3")
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            elapsed = seed_transactions(options["rows"])
+            self.stdout.write(f"Seeded {options['rows']} rows in {elapsed:.1f}s")
+            started = time.perf_counter()
+            written = rollups.rebuild()
+            self.stdout.write(f"rebuild_rollups: {written} rows in {time.perf_counter() - started:.1f}s")
+
+            now = timezone.now()
+            week, quarter = now - timedelta(days=7), now - timedelta(days=90)
+            cases = (
+                ("hourly, last 7 days", lambda: scan_totals(TruncHour, week),
+                 lambda: rollups.summary(RollupPeriod.HOUR, rollups.bucket_start(week, RollupPeriod.HOUR))),
+                ("daily, last 90 days", lambda: scan_totals(TruncDay, quarter),
+                 lambda: rollups.summary(RollupPeriod.DAY, rollups.bucket_start(quarter, RollupPeriod.DAY))),
+                ("top 10 phones, 90 days", lambda: scan_top_phones(quarter),
+                 lambda: rollups.top_phones(quarter)),
+            )
+            self.stdout.write(f"{'query':<24}{'table scan ms':>15}{'rollups ms':>12}{'speedup':>9}")
+            for name, scan, rollup in cases:
+                scan_ms = self.time(scan, options["repeat"])
+                rollup_ms = self.time(rollup, options["repeat"])
+                self.stdout.write(f"{name:<24}{scan_ms:>15.1f}{rollup_ms:>12.2f}{scan_ms / rollup_ms:>8.0f}x")
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def time(self, query, repeat):
+        samples = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            query()
+            samples.append((time.perf_counter() - started) * 1000)
+        return statistics.median(samples)
@@ -0,0 +1,147 @@
+import os
+import random
+import statistics
+import tempfile
+import time
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from stkpush.models import ResultDescription, Transaction
+
+DESCRIPTIONS = [
+    "The service request is processed successfully.",
+    "Request cancelled by user",
+    "DS timeout user cannot be reached",
+    "The balance is insufficient for the transaction.",
+]
+
+
+def seed_transactions(rows, chunk_size=10_000):
+    """
+    Bulk-inserts `rows` synthetic transactions spread over the last 90 days.
+
+    Returns:
+        float: Seconds taken.
+    """
+    started = time.perf_counter()
+    descriptions = [ResultDescription.id_for(text) for text in DESCRIPTIONS]
+    statuses = [Transaction.Status.SUCCESS] * 6 + [Transaction.Status.FAILED] * 3 + [Transaction.Status.PENDING]
+    now = timezone.now()
+    rng = random.Random(42)
+
+    # transaction_date is auto_now_add; switch that off so rows spread over 90 days
+    date_field = Transaction._meta.get_field("transaction_date")
+    date_field.auto_now_add = False
+    step = timedelta(days=90) / max(rows, 1)
+    try:
+        for start in range(0, rows, chunk_size):
+            chunk = []
+            for i in range(start, min(start + chunk_size, rows)):
+                status = rng.choice(statuses)
+                chunk.append(Transaction(
+                    reference=uuid.UUID(int=rng.getrandbits(128)),
+                    checkout_request_id=f"ws_CO_{i:012d}",
+                    phone_number=f"2547{rng.randrange(10 ** 5):08d}",
+                    amount=Decimal(rng.randrange(1, 5000)),
+                    status=status,
+                    result_code=0 if status == Transaction.Status.SUCCESS else None,
+                    result_description_id=rng.choice(descriptions),
+                    mpesa_receipt_number=f"Q{i:09d}" if status == Transaction.Status.SUCCESS else None,
+                    transaction_date=now - timedelta(days=90) + step * i,
+                ))
+            Transaction.objects.bulk_create(chunk)
+    finally:
+        date_field.auto_now_add = True
+    return time.perf_counter() - started
+
+
+class Command(BaseCommand):
+    help = ("Seeds a throwaway database with Transaction rows and compares query plans and "
+            "timings of the reconciliation queries without and with the schema's indexes.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=1_000_000)
+        parser.add_argument("--chunk-size", type=int, default=10_000)
+        parser.add_argument("--repeat", type=int, default=5, help="Runs per query; the median is reported.")
+
+    def handle(self, *args, **options):
+        db_file = os.path.join(tempfile.mkdtemp(), "bench.sqlite3")
+        connection.settings_dict.setdefault("TEST", {})["NAME"] = db_file
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            elapsed = seed_transactions(options["rows"], options["chunk_size"])
+            self.stdout.write(f"Seeded {options['rows']} rows in {elapsed:.1f}s")
+            queries = self.queries()
+
+            self.drop_indexes()
+            self.stdout.write("\n== Without indexes ==")
+            self.run(queries, options["repeat"])
+
+            self.create_indexes()
+            self.stdout.write("\n== With indexes ==")
+            self.run(queries, options["repeat"])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def queries(self):
+        now = timezone.now()
+        week_ago = now - timedelta(days=7)
+        sample = Transaction.objects.filter(mpesa_receipt_number__isnull=False).order_by("-id").first()
+        return {
+            "stale pending (oldest 1000)": Transaction.objects.filter(
+                status=Transaction.Status.PENDING, transaction_date__lt=now - timedelta(minutes=10),
+            ).order_by("transaction_date").values_list("id", flat=True)[:1000],
+            "failed last 7 days (count)": Transaction.objects.filter(
+                status=Transaction.Status.FAILED, transaction_date__gte=week_ago,
+            ).values("id"),
+            "by receipt number": Transaction.objects.filter(mpesa_receipt_number=sample.mpesa_receipt_number),
+            "by phone, last 7 days": Transaction.objects.filter(
+                phone_number=sample.phone_number, transaction_date__gte=week_ago,
+            ),
+            "date range export (1 day)": Transaction.objects.filter(
+                transaction_date__gte=week_ago, transaction_date__lt=week_ago + timedelta(days=1),
+            ).values_list("id", "amount"),
+        }
+
+    def run(self, queries, repeat):
+        for name, queryset in queries.items():
+            samples = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                len(queryset.all())
+                samples.append(time.perf_counter() - started)
+            plan = " | ".join(line.strip() for line in queryset.explain().splitlines())
+            self.stdout.write(f"{name:<28} {statistics.median(samples) * 1000:9.2f} ms  {plan}")
+
+    def receipt_constraint(self):
+        return next(c for c in Transaction._meta.constraints if c.name == "unique_receipt_number")
+
+    def drop_indexes(self):
+        # On SQLite dropping the constraint rebuilds the table from the model's Meta, so it
+        # goes first and is hidden from Meta while the table is rebuilt
+        meta = Transaction._meta
+        constraint = self.receipt_constraint()
+        constraints = meta.constraints
+        meta.constraints = [c for c in constraints if c is not constraint]
+        try:
+            with connection.schema_editor() as editor:
+                editor.remove_constraint(Transaction, constraint)
+        finally:
+            meta.constraints = constraints
+
+        with connection.schema_editor() as editor:
+            for index in meta.indexes:
+                editor.remove_index(Transaction, index)
+
+    def create_indexes(self):
+        with connection.schema_editor() as editor:
+            for index in Transaction._meta.indexes:
+                editor.add_index(Transaction, index)
+            editor.add_constraint(Transaction, self.receipt_constraint())
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
@@ -0,0 +1,87 @@
+import csv
+import os
+import random
+import resource
+import tempfile
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from stkpush.models import Transaction
+from stkpush.statements import export_rows, match_statement, read_statement, render_csv
+
+from .bench_schema import seed_transactions
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Command(BaseCommand):
+    help = ("Measures export and statement matching throughput and peak memory on a throwaway "
+            "database seeded with synthetic transactions.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=1_000_000)
+        parser.add_argument("--chunk-size", type=int, default=5000, help="Rows per database fetch / match query.")
+        parser.add_argument("--error-rate", type=float, default=0.01,
+                            help="Share of statement rows made to mismatch, go missing or be unknown.")
+
+    def handle(self, *args, **options):
+        workdir = tempfile.mkdtemp()
+        connection.settings_dict.setdefault("TEST", {})["NAME"] = os.path.join(workdir, "bench.sqlite3")
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            elapsed = seed_transactions(options["rows"])
+            self.stdout.write(f"Seeded {options['rows']} rows in {elapsed:.1f}s (peak RSS {peak_rss_mb():.0f} MB)")
+
+            export_path = os.path.join(workdir, "export.csv")
+            started = time.perf_counter()
+            with open(export_path, "w", newline="") as output:
+                output.writelines(render_csv(export_rows(chunk_size=options["chunk_size"])))
+            self.report("export", options["rows"], time.perf_counter() - started)
+
+            statement_path = os.path.join(workdir, "statement.csv")
+            lines = self.write_statement(statement_path, options["error_rate"], options["chunk_size"])
+
+            started = time.perf_counter()
+            counts = {}
+            with open(statement_path, newline="") as stream:
+                for row in match_statement(read_statement(stream), chunk_size=options["chunk_size"]):
+                    counts[row["kind"]] = counts.get(row["kind"], 0) + 1
+            self.report("match", lines, time.perf_counter() - started)
+            self.stdout.write("Discrepancies: " + ", ".join(f"{kind}: {n}" for kind, n in sorted(counts.items())))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def report(self, name, rows, elapsed):
+        self.stdout.write(f"{name:<7} {rows:>9} rows in {elapsed:7.2f}s  {rows / elapsed:10.0f} rows/s  "
+                          f"(peak RSS {peak_rss_mb():.0f} MB)")
+
+    def write_statement(self, path, error_rate, chunk_size):
+        """
+        Writes an org-portal style statement of every successful transaction, with
+        a share of rows altered, dropped or unknown. Returns the number of rows.
+        """
+        rng = random.Random(7)
+        lines = 0
+        with open(path, "w", newline="") as output:
+            writer = csv.writer(output)
+            writer.writerow(["Receipt No.", "Completion Time", "Details", "Transaction Status",
+                             "Paid In", "Withdrawn", "Balance", "Other Party Info"])
+            for row in export_rows(status=Transaction.Status.SUCCESS, chunk_size=chunk_size):
+                receipt, amount = row["receipt_number"], row["amount"]
+                roll = rng.random()
+                if roll < error_rate:
+                    continue
+                if roll < error_rate * 2:
+                    amount += Decimal(1)
+                elif roll < error_rate * 3:
+                    receipt = f"X{receipt[1:]}"
+                writer.writerow([receipt, f"{row['transaction_date']:%Y-%m-%d %H:%M:%S}", "Pay Bill Online",
+                                 "Completed", f"{amount:.2f}", "", "", f"{row['phone_number']} - CUSTOMER"])
+                lines += 1
+        return lines
@@ -0,0 +1,183 @@
+import hmac
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+from django.utils import timezone
+
+from stkpush import webhooks
+from stkpush.models import OutboxEvent, Transaction, WebhookDelivery, WebhookEndpoint
+
+SECRET = "bench-secret"
+
+
+class Receiver(ThreadingHTTPServer):
+    """
+    Merchant webhook receiver that checks signatures and the order of each transaction's
+    events, and rejects a share of the requests to exercise retries.
+    """
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, failure_rate):
+        super().__init__(("127.0.0.1", 0), ReceiverHandler)
+        self.failure_rate = failure_rate
+        self.rng = random.Random(1)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.rejected = 0
+        self.bad_signatures = 0
+        self.received = set()
+        self.duplicates = 0
+        self.out_of_order = 0
+        # (path, transaction reference) -> id of the last event received for it
+        self.last = {}
+
+    def accept(self, path, body, signature):
+        with self.lock:
+            self.requests += 1
+            if not hmac.compare_digest(signature, webhooks.signature(SECRET, body)):
+                self.bad_signatures += 1
+                return 401
+            if self.rng.random() < self.failure_rate:
+                self.rejected += 1
+                return 503
+            for event in json.loads(body)["events"]:
+                if (path, event["id"]) in self.received:
+                    self.duplicates += 1
+                    continue
+                self.received.add((path, event["id"]))
+                key = path, event["data"]["reference"]
+                if event["id"] < self.last.get(key, 0):
+                    self.out_of_order += 1
+                self.last[key] = max(event["id"], self.last.get(key, 0))
+        return 204
+
+
+class ReceiverHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so the dispatcher's pooled connections are reused
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        status = self.server.accept(self.path, body, self.headers.get("X-Mpesa-Signature", ""))
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = ("Delivers the outbox events of a throwaway database to a local webhook receiver "
+            "and reports dispatch throughput per batch size, with and without failing requests.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--transactions", type=int, default=5000, help="Transactions per run, two events each.")
+        parser.add_argument("--endpoints", type=int, default=2)
+        parser.add_argument("--threads", type=int, default=4)
+        parser.add_argument("--batch-sizes", default="1,10,100")
+        parser.add_argument("--failure-rate", type=float, default=0.1,
+                            help="Share of requests rejected in the last run.")
+
+    def handle(self, *args, **options):
+        directory = tempfile.mkdtemp()
+        connection.settings_dict.setdefault("TEST", {})["NAME"] = os.path.join(directory, "webhooks.sqlite3")
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        saved = webhooks.WEBHOOKS_ENABLED, webhooks.RETRY_BASE, webhooks.RETRY_MAX
+        # Retry rejected batches quickly so the failure run measures throughput, not backoff
+        webhooks.WEBHOOKS_ENABLED, webhooks.RETRY_BASE, webhooks.RETRY_MAX = True, 0.01, 0.1
+        try:
+            self.run(options)
+        finally:
+            webhooks.WEBHOOKS_ENABLED, webhooks.RETRY_BASE, webhooks.RETRY_MAX = saved
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def run(self, options):
+        batch_sizes = [int(size) for size in options["batch_sizes"].split(",")]
+        runs = [(size, 0.0) for size in batch_sizes] + [(batch_sizes[-1], options["failure_rate"])]
+        events = 2 * options["transactions"] * options["endpoints"]
+        self.stdout.write(f"{options['transactions']} transactions, {options['endpoints']} endpoints, "
+                          f"{events} deliveries per run")
+        self.stdout.write(f"{'batch':>6}{'fail %':>8}{'requests':>10}{'seconds':>9}{'events/s':>10}"
+                          f"{'missing':>9}{'dupes':>7}{'order':>7}")
+        for batch_size, failure_rate in runs:
+            receiver = Receiver(failure_rate)
+            threading.Thread(target=receiver.serve_forever, daemon=True).start()
+            try:
+                self.seed(options, receiver)
+                elapsed = self.dispatch(options, batch_size)
+            finally:
+                receiver.shutdown()
+                receiver.server_close()
+            missing = events - len(receiver.received)
+            self.stdout.write(
+                f"{batch_size:>6}{failure_rate * 100:>8.0f}{receiver.requests:>10}{elapsed:>9.2f}"
+                f"{events / elapsed:>10.0f}{missing:>9}{receiver.duplicates:>7}{receiver.out_of_order:>7}"
+            )
+            if receiver.bad_signatures:
+                self.stderr.write(f"{receiver.bad_signatures} requests had a bad signature")
+
+    def seed(self, options, receiver):
+        WebhookDelivery.objects.all().delete()
+        OutboxEvent.objects.all().delete()
+        WebhookEndpoint.objects.all().delete()
+        url = f"http://127.0.0.1:{receiver.server_address[1]}"
+        WebhookEndpoint.objects.bulk_create([
+            WebhookEndpoint(name=f"merchant-{i}", url=f"{url}/hooks/{i}", secret=SECRET)
+            for i in range(options["endpoints"])
+        ])
+
+        # Each transaction's result is published a chunk after its push, like callbacks arriving later
+        now = timezone.now()
+        pending = [
+            Transaction(reference=uuid.uuid4(), checkout_request_id=f"ws_CO_{i}", phone_number="254700000000",
+                        amount=Decimal(100), transaction_date=now, status=Transaction.Status.PENDING)
+            for i in range(options["transactions"])
+        ]
+        previous = []
+        for start in range(0, len(pending) + 500, 500):
+            chunk = pending[start:start + 500]
+            webhooks.publish(chunk)
+            for transaction in previous:
+                number = int(transaction.checkout_request_id[6:])
+                if number % 3:
+                    transaction.status = Transaction.Status.SUCCESS
+                    transaction.mpesa_receipt_number = f"R{number:09d}"
+                else:
+                    transaction.status = Transaction.Status.FAILED
+            webhooks.publish(previous)
+            previous = chunk
+
+    def dispatch(self, options, batch_size):
+        """
+        Runs the webhook worker's loop until every delivery is made.
+        """
+        def deliver(endpoint):
+            close_old_connections()
+            return webhooks.deliver(endpoint, batch_size)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(options["threads"]) as pool:
+            while True:
+                queued = webhooks.fan_out()
+                endpoints = webhooks.claim_endpoints(options["threads"])
+                delivered = sum(pool.map(deliver, endpoints))
+                if not (queued or delivered or WebhookDelivery.objects.filter(dead_at=None).exists()):
+                    break
+                if not endpoints:
+                    # Every endpoint with pending events is backing off
+                    time.sleep(0.01)
+        return time.perf_counter() - started
@@ -0,0 +1,54 @@
+import io
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from stkpush.bulk import import_rows, read_rows, send_batch
+from stkpush.tenants import UnknownTenant, registry
+
+
+class Command(BaseCommand):
+    help = ("Sends STK Pushes to every (phone, amount, reference) row of a CSV or JSON Lines file. "
+            "Re-run with the same --batch to resume an interrupted campaign.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Input file, or - for stdin.")
+        parser.add_argument("--batch", required=True, help="Campaign name; rows are deduplicated by (batch, reference).")
+        parser.add_argument("--tenant", help="Slug of the tenant to send for; defaults to MPESA_SHORT_CODE.")
+        parser.add_argument("--format", choices=("csv", "jsonl"), help="Defaults to the file extension.")
+        parser.add_argument("--concurrency", type=int, default=10, help="Pushes in flight at once.")
+        parser.add_argument("--rate", type=float, default=10, help="Pushes started per second (Daraja TPS budget).")
+        parser.add_argument("--batch-size", type=int, default=1000, help="Rows per bulk_create.")
+        parser.add_argument("--import-only", action="store_true", help="Queue the rows without sending them.")
+        parser.add_argument("--send-only", action="store_true", help="Skip the import and send what is queued.")
+
+    def handle(self, *args, **options):
+        batch = options["batch"]
+
+        if not options["send_only"]:
+            try:
+                registry.get(options["tenant"])
+            except UnknownTenant as e:
+                raise CommandError(str(e))
+            fmt = options["format"] or ("csv" if options["path"].endswith(".csv") else "jsonl")
+            if options["path"] == "-":
+                stream = io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8")
+            else:
+                try:
+                    stream = open(options["path"], newline="", encoding="utf-8")
+                except OSError as e:
+                    raise CommandError(f"Cannot read {options['path']}: {e}")
+            with stream:
+                valid, errors = import_rows(read_rows(stream, fmt), batch, options["batch_size"], options["tenant"])
+            for line_number, error in errors:
+                self.stderr.write(f"line {line_number}: {error}")
+            self.stdout.write(f"Batch {batch}: {valid} valid rows queued, {len(errors)} rejected")
+
+        if options["import_only"]:
+            return
+
+        def report(progress):
+            summary = ", ".join(f"{status}: {count}" for status, count in sorted(progress.items()))
+            self.stdout.write(f"[{batch}] {summary}")
+
+        send_batch(batch, options["concurrency"], options["rate"], on_progress=report)
@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand
+
+from stkpush.stub import DarajaStubServer
+
+
+class Command(BaseCommand):
+    help = ("Runs a local simulator of the Daraja OAuth, STK Push and STK query endpoints, "
+            "optionally sending callbacks, for development and benchmarks.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8765)
+        parser.add_argument("--latency", type=float, default=0.0, help="Seconds slept on every request.")
+        parser.add_argument("--connect-delay", type=float, default=0.0,
+                            help="Seconds slept on every new connection, to model the TLS handshake.")
+        parser.add_argument("--query-result-codes", default="0",
+                            help="Comma-separated ResultCodes the STK query picks from, e.g. 0,1032,1037.")
+        parser.add_argument("--query-processing-rate", type=float, default=0.0,
+                            help="Share of STK queries answered with 'still being processed'.")
+        parser.add_argument("--error-rate", type=float, default=0.0,
+                            help="Share of all requests failed with --error-status, to inject faults.")
+        parser.add_argument("--error-status", type=int, default=503)
+        parser.add_argument("--callback-delay", type=float,
+                            help="Send a callback this many seconds after each accepted STK Push.")
+        parser.add_argument("--callback-result-codes", default="0",
+                            help="Comma-separated ResultCodes the callbacks pick from.")
+        parser.add_argument("--duplicate-rate", type=float, default=0.0,
+                            help="Share of callbacks delivered twice.")
+        parser.add_argument("--callback-url", help="Send callbacks here instead of the push's CallBackURL.")
+
+    def handle(self, *args, **options):
+        server = DarajaStubServer(
+            (options["host"], options["port"]),
+            latency=options["latency"],
+            connect_delay=options["connect_delay"],
+            query_result_codes=options["query_result_codes"].split(","),
+            query_processing_rate=options["query_processing_rate"],
+            error_rate=options["error_rate"],
+            error_status=options["error_status"],
+            callback_delay=options["callback_delay"],
+            callback_result_codes=options["callback_result_codes"].split(","),
+            duplicate_rate=options["duplicate_rate"],
+            callback_url=options["callback_url"],
+        )
+        self.stdout.write(f"Daraja stub listening on {server.base_url}")
+        self.stdout.write(f"Set MPESA_BASE_URL={server.base_url} and "
+                          f"MPESA_API_URL={server.base_url}/oauth/v1/generate?grant_type=client_credentials")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,45 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from stkpush.archive import ArchiveError
+from stkpush.db import replica_reads
+from stkpush.statements import RENDERERS, export_rows, parse_status, parse_time
+
+
+class Command(BaseCommand):
+    help = "Streams transactions in a date range as CSV or JSON Lines, in constant memory."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--since", help="Only transactions at or after this ISO date/time.")
+        parser.add_argument("--until", help="Only transactions before this ISO date/time.")
+        parser.add_argument("--status", help="Only transactions with this status, e.g. Success.")
+        parser.add_argument("--format", choices=sorted(RENDERERS), default="csv")
+        parser.add_argument("--output", "-o", help="Output file (defaults to stdout).")
+        parser.add_argument("--chunk-size", type=int, default=2000, help="Rows fetched from the database at a time.")
+
+    def handle(self, *args, **options):
+        try:
+            since = parse_time(options["since"]) if options["since"] else None
+            until = parse_time(options["until"]) if options["until"] else None
+            status = parse_status(options["status"]) if options["status"] else None
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        rows = export_rows(since, until, status, options["chunk_size"])
+        if options["output"]:
+            try:
+                output = open(options["output"], "w", newline="", encoding="utf-8")
+            except OSError as e:
+                raise CommandError(f"Cannot write {options['output']}: {e}")
+        else:
+            output = sys.stdout
+
+        try:
+            with replica_reads():
+                output.writelines(RENDERERS[options["format"]](rows))
+        except ArchiveError as e:
+            raise CommandError(str(e))
+        finally:
+            if output is not sys.stdout:
+                output.close()
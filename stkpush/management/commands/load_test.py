@@ -0,0 +1,272 @@
+import json
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+import requests
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from stkpush.credentials import MpesaAccessToken, MpesaC2bCredential
+from stkpush.daraja import BUCKETS, LIMITERS, DarajaClient, DarajaSettings
+from stkpush.stub import DarajaStubServer
+
+from .bench_api import CHECKOUT_ID
+from .bench_daraja import percentile
+
+# Endpoint name of each (method, path) reported
+ENDPOINTS = {
+    ("POST", "/pay/"): "pay",
+    ("POST", "/callback/"): "callback",
+    ("GET", "/check-status/"): "check_status",
+}
+TERMINAL = {"Success", "Failed"}
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """
+    Serves every request in its own thread, like a threaded gunicorn worker with no thread cap.
+    """
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class EndpointStats:
+    """
+    Server-side latency, status and database query count of every request, by endpoint.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = defaultdict(list)
+
+    def record(self, endpoint, elapsed, status, queries):
+        with self.lock:
+            self.samples[endpoint].append((elapsed, status, queries))
+
+    def wrap(self, handler):
+        """
+        Wraps a WSGI handler so that every request is timed and its queries counted.
+        """
+        def app(environ, start_response):
+            endpoint = ENDPOINTS.get((environ.get("REQUEST_METHOD"), environ.get("PATH_INFO")))
+            if endpoint is None:
+                return handler(environ, start_response)
+            queries, status = [0], [0]
+
+            def count(execute, sql, params, many, context):
+                queries[0] += 1
+                return execute(sql, params, many, context)
+
+            def capture(status_line, headers, exc_info=None):
+                status[0] = int(status_line.split()[0])
+                return start_response(status_line, headers, exc_info)
+
+            started = time.perf_counter()
+            with connection.execute_wrapper(count):
+                response = handler(environ, capture)
+            self.record(endpoint, time.perf_counter() - started, status[0], queries[0])
+            return response
+        return app
+
+    def summary(self, duration):
+        results = {}
+        for endpoint, samples in sorted(self.samples.items()):
+            latencies = [elapsed * 1000 for elapsed, _, _ in samples]
+            results[endpoint] = {
+                "requests": len(samples),
+                "rps": len(samples) / duration,
+                "p50_ms": percentile(latencies, 50),
+                "p95_ms": percentile(latencies, 95),
+                "p99_ms": percentile(latencies, 99),
+                "queries": statistics.mean(queries for _, _, queries in samples),
+                "errors": sum(1 for _, status, _ in samples if status >= 400),
+            }
+        return results
+
+
+class Command(BaseCommand):
+    help = ("Load-tests pay, callback and check_status end to end: virtual customers pay and poll "
+            "over HTTP while the Daraja simulator sends the callbacks. Reports throughput, latency "
+            "percentiles and queries per endpoint, and can fail on regressions against a baseline.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=16, help="Concurrent virtual customers.")
+        parser.add_argument("--payments", type=int, default=400, help="Total payments to make.")
+        parser.add_argument("--poll-interval", type=float, default=0.2, help="Seconds between status checks.")
+        parser.add_argument("--poll-timeout", type=float, default=30.0,
+                            help="Give up on a payment that is not final after this many seconds.")
+        parser.add_argument("--latency", type=float, default=0.05, help="Simulated Daraja response time.")
+        parser.add_argument("--callback-delay", type=float, default=0.5,
+                            help="Seconds from an accepted push to its callback (the customer entering the PIN).")
+        parser.add_argument("--result-codes", default="0,0,0,1032",
+                            help="Comma-separated ResultCodes the callbacks pick from.")
+        parser.add_argument("--duplicate-rate", type=float, default=0.1, help="Share of callbacks delivered twice.")
+        parser.add_argument("--error-rate", type=float, default=0.0, help="Share of Daraja calls failed with 503.")
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--keep-limits", action="store_true",
+                            help="Keep the Daraja rate limits and concurrency limit instead of disabling them.")
+        parser.add_argument("--save", help="Write the results as JSON to this file.")
+        parser.add_argument("--baseline", help="Compare with results saved by an earlier --save run.")
+        parser.add_argument("--tolerance", type=float, default=0.25,
+                            help="Allowed relative slowdown against the baseline before failing.")
+
+    def handle(self, *args, **options):
+        random.seed(options["seed"])
+        stats = EndpointStats()
+
+        db_file = os.path.join(tempfile.mkdtemp(), "load.sqlite3")
+        connection.settings_dict.setdefault("TEST", {})["NAME"] = db_file
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        app = make_server("127.0.0.1", 0, stats.wrap(WSGIHandler()),
+                          server_class=ThreadingWSGIServer, handler_class=QuietHandler)
+        app_url = f"http://127.0.0.1:{app.server_address[1]}"
+        threading.Thread(target=app.serve_forever, daemon=True).start()
+
+        daraja = DarajaStubServer(
+            latency=options["latency"],
+            error_rate=options["error_rate"],
+            callback_delay=options["callback_delay"],
+            callback_result_codes=options["result_codes"].split(","),
+            duplicate_rate=options["duplicate_rate"],
+            callback_url=f"{app_url}/callback/",
+        ).start()
+        MpesaC2bCredential.api_URL = f"{daraja.base_url}/oauth/v1/generate?grant_type=client_credentials"
+        DarajaSettings.base_url = daraja.base_url
+        MpesaAccessToken.validated_mpesa_access_token = None
+        if not options["keep_limits"]:
+            for bucket in BUCKETS.values():
+                bucket.rate = 0
+            LIMITERS["stkpush"].limit = LIMITERS["stkpush"].maximum = float(options["users"] * 4)
+
+        try:
+            with override_settings(ALLOWED_HOSTS=["*"], DEBUG=False):
+                started = time.perf_counter()
+                outcomes = self.run(app_url, options)
+                duration = time.perf_counter() - started
+                # Let late and duplicate callbacks land before reporting
+                time.sleep(options["callback_delay"] + 0.5)
+        finally:
+            daraja.shutdown()
+            daraja.server_close()
+            app.shutdown()
+            app.server_close()
+            DarajaClient.reset()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        results = stats.summary(duration)
+        completion = [elapsed * 1000 for outcome, elapsed in outcomes if outcome in TERMINAL]
+        results["payment"] = {
+            "requests": len(outcomes),
+            "rps": len(completion) / duration,
+            "p50_ms": percentile(completion, 50) if completion else 0,
+            "p95_ms": percentile(completion, 95) if completion else 0,
+            "p99_ms": percentile(completion, 99) if completion else 0,
+            "queries": 0,
+            "errors": len(outcomes) - len(completion),
+        }
+        self.report(results, duration, daraja.counters)
+
+        if options["save"]:
+            with open(options["save"], "w") as f:
+                json.dump(results, f, indent=2)
+        if options["baseline"]:
+            self.compare(results, options["baseline"], options["tolerance"])
+
+    def run(self, app_url, options):
+        """
+        Runs the virtual customers and returns (final status, seconds to it) per payment.
+        """
+        numbers = iter(range(options["payments"]))
+        lock = threading.Lock()
+        outcomes = []
+
+        def customer():
+            session = requests.Session()
+            # The pay form is CSRF protected: load it once for the cookie
+            session.get(f"{app_url}/pay/")
+            token = session.cookies.get("csrftoken")
+            while True:
+                with lock:
+                    number = next(numbers, None)
+                if number is None:
+                    return
+                outcome = self.pay(session, app_url, token, number, options)
+                with lock:
+                    outcomes.append(outcome)
+
+        with ThreadPoolExecutor(max_workers=options["users"]) as pool:
+            for future in [pool.submit(customer) for _ in range(options["users"])]:
+                future.result()
+        return outcomes
+
+    def pay(self, session, app_url, token, number, options):
+        started = time.perf_counter()
+        response = session.post(f"{app_url}/pay/", data={
+            "csrfmiddlewaretoken": token, "phone": f"2547{number:08d}", "amount": random.randint(1, 500),
+        })
+        match = CHECKOUT_ID.search(response.content)
+        if response.status_code != 200 or not match or not match.group(1):
+            return "rejected", time.perf_counter() - started
+
+        checkout_request_id = match.group(1).decode()
+        deadline = started + options["poll_timeout"]
+        while time.perf_counter() < deadline:
+            time.sleep(options["poll_interval"])
+            response = session.get(f"{app_url}/check-status/", params={"checkout_request_id": checkout_request_id})
+            status = response.json().get("status") if response.status_code == 200 else None
+            if status in TERMINAL:
+                return status, time.perf_counter() - started
+        return "timeout", time.perf_counter() - started
+
+    def report(self, results, duration, counters):
+        self.stdout.write(f"{duration:.1f} s, Daraja simulator: {counters}")
+        self.stdout.write(f"{'endpoint':<14}{'requests':>9}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}"
+                          f"{'p99 ms':>9}{'queries':>9}{'errors':>8}")
+        for endpoint, row in results.items():
+            self.stdout.write(
+                f"{endpoint:<14}{row['requests']:>9}{row['rps']:>9.1f}{row['p50_ms']:>9.1f}{row['p95_ms']:>9.1f}"
+                f"{row['p99_ms']:>9.1f}{row['queries']:>9.1f}{row['errors']:>8}"
+            )
+        self.stdout.write("(payment: from pay to a final status seen by the poller)")
+
+    def compare(self, results, path, tolerance):
+        """
+        Raises CommandError if any endpoint got slower, slower to serve or chattier than the baseline.
+        """
+        try:
+            with open(path) as f:
+                baseline = json.load(f)
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Cannot read baseline {path}: {e}")
+
+        regressions = []
+        for endpoint, base in baseline.items():
+            row = results.get(endpoint)
+            if row is None:
+                continue
+            if row["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+                regressions.append(f"{endpoint}: p95 {row['p95_ms']:.1f} ms vs {base['p95_ms']:.1f} ms")
+            if row["rps"] < base["rps"] * (1 - tolerance):
+                regressions.append(f"{endpoint}: {row['rps']:.1f} req/s vs {base['rps']:.1f} req/s")
+            if row["queries"] > base["queries"] + 0.5:
+                regressions.append(f"{endpoint}: {row['queries']:.1f} queries vs {base['queries']:.1f}")
+            if row["errors"] > base["errors"]:
+                regressions.append(f"{endpoint}: {row['errors']} errors vs {base['errors']}")
+        if regressions:
+            raise CommandError("Performance regressions against the baseline:\n  " + "\n  ".join(regressions))
+        self.stdout.write(f"No regressions against {path} (tolerance {tolerance:.0%}).")
@@ -0,0 +1,55 @@
+import csv
+import io
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from stkpush.archive import ArchiveError
+from stkpush.statements import match_statement, parse_time, read_statement
+
+REPORT_COLUMNS = ("kind", "line", "receipt", "phone", "amount", "reference", "detail")
+
+
+class Command(BaseCommand):
+    help = ("Matches an M-Pesa organisation statement (CSV) against transactions by receipt number, "
+            "phone and amount, and writes every discrepancy as CSV.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Statement CSV, or - for stdin.")
+        parser.add_argument("--since", help="Start of the statement period (ISO date/time).")
+        parser.add_argument("--until", help="End of the statement period, exclusive (ISO date/time).")
+        parser.add_argument("--report", "-o", help="Discrepancy report file (defaults to stdout).")
+        parser.add_argument("--chunk-size", type=int, default=5000, help="Statement rows matched per query.")
+
+    def handle(self, *args, **options):
+        try:
+            since = parse_time(options["since"]) if options["since"] else None
+            until = parse_time(options["until"]) if options["until"] else None
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        try:
+            if options["path"] == "-":
+                stream = io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8-sig")
+            else:
+                stream = open(options["path"], newline="", encoding="utf-8-sig")
+            report = open(options["report"], "w", newline="", encoding="utf-8") if options["report"] else sys.stdout
+        except OSError as e:
+            raise CommandError(str(e))
+
+        counts = {}
+        with stream:
+            writer = csv.DictWriter(report, REPORT_COLUMNS)
+            writer.writeheader()
+            try:
+                for row in match_statement(read_statement(stream), since, until, options["chunk_size"]):
+                    counts[row["kind"]] = counts.get(row["kind"], 0) + 1
+                    writer.writerow(row)
+            except ArchiveError as e:
+                raise CommandError(str(e))
+            finally:
+                if report is not sys.stdout:
+                    report.close()
+
+        summary = ", ".join(f"{kind}: {n}" for kind, n in sorted(counts.items()))
+        self.stderr.write(f"{sum(counts.values())} discrepancies ({summary or 'statement fully matched'})")
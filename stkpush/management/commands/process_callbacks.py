@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from stkpush.inbox import process_pending
+
+
+class Command(BaseCommand):
+    help = "Applies STK callbacks from the inbox in batches (for MPESA_CALLBACK_INBOX=True)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--poll-interval", type=float, default=0.5, help="Seconds to sleep when the inbox is empty.")
+        parser.add_argument("--once", action="store_true", help="Exit once the inbox is drained.")
+
+    def handle(self, *args, **options):
+        while True:
+            counts = process_pending(options["batch_size"])
+            if counts:
+                self.stdout.write(", ".join(f"{outcome}: {n}" for outcome, n in sorted(counts.items())))
+                continue
+
+            # Inbox drained: retry callbacks that arrived before their transaction
+            process_pending(options["batch_size"], retry_unknown=True)
+            if options["once"]:
+                return
+            time.sleep(options["poll_interval"])
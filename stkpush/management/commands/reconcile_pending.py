@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from stkpush.reconcile import STALE_AFTER, reconcile
+
+
+class Command(BaseCommand):
+    help = ("Resolves transactions whose callback never arrived by querying their status "
+            "with the Daraja STK Push query API.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--older-than", type=int, default=STALE_AFTER,
+                            help="Only query transactions pending for at least this many seconds.")
+        parser.add_argument("--batch-size", type=int, default=500, help="Rows read and updated per batch.")
+        parser.add_argument("--concurrency", type=int, default=10, help="Queries in flight at once.")
+        parser.add_argument("--rate", type=float, default=10, help="Queries started per second (Daraja TPS budget).")
+        parser.add_argument("--limit", type=int, help="Stop after this many transactions per run.")
+        parser.add_argument("--loop", action="store_true", help="Keep running, starting a new run every --interval seconds.")
+        parser.add_argument("--interval", type=float, default=60, help="Seconds between runs with --loop.")
+
+    def handle(self, *args, **options):
+        def report(counts):
+            self.stdout.write(", ".join(f"{outcome}: {n}" for outcome, n in sorted(counts.items())))
+
+        while True:
+            started = time.monotonic()
+            counts = reconcile(
+                older_than=options["older_than"],
+                batch_size=options["batch_size"],
+                concurrency=options["concurrency"],
+                rate=options["rate"],
+                limit=options["limit"],
+                on_batch=report if options["verbosity"] > 1 else None,
+            )
+            summary = ", ".join(f"{outcome}: {n}" for outcome, n in sorted(counts.items()))
+            self.stdout.write(f"Reconciled {sum(counts.values())} transactions in "
+                              f"{time.monotonic() - started:.1f}s ({summary or 'none stale'})")
+            if not options["loop"]:
+                return
+            time.sleep(options["interval"])
+            close_old_connections()
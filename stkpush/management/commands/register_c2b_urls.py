@@ -0,0 +1,31 @@
+import requests
+from django.core.management.base import BaseCommand, CommandError
+
+from stkpush.c2b import C2BError, register_urls
+from stkpush.tenants import UnknownTenant
+
+
+class Command(BaseCommand):
+    help = ("Registers the C2B confirmation and validation URLs of the paybill or till with "
+            "Safaricom, so payments made from the SIM menu are reported to this app.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--tenant", help="Register the URLs of this tenant's shortcode instead of the default one.")
+        parser.add_argument("--response-type", choices=("Completed", "Cancelled"), default="Completed",
+                            help="What Safaricom does with a payment when the validation URL does not answer.")
+        parser.add_argument("--confirmation-url", help="Defaults to MPESA_C2B_CONFIRMATION_URL.")
+        parser.add_argument("--validation-url", help="Defaults to MPESA_C2B_VALIDATION_URL.")
+
+    def handle(self, *args, **options):
+        try:
+            result = register_urls(
+                tenant=options["tenant"],
+                response_type=options["response_type"],
+                confirmation_url=options["confirmation_url"],
+                validation_url=options["validation_url"],
+            )
+        except (C2BError, UnknownTenant) as e:
+            raise CommandError(str(e))
+        except requests.RequestException as e:
+            raise CommandError(f"M-Pesa could not be reached: {e}")
+        self.stdout.write(f"Registered C2B URLs: {result.get('ResponseDescription', result)}")
@@ -0,0 +1,49 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from stkpush.inbox import process
+from stkpush.models import CallbackInbox
+
+
+class Command(BaseCommand):
+    help = ("Re-applies stored STK callbacks from the inbox. Replays are idempotent: "
+            "only transactions that are still Pending are changed.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--checkout-request-id", help="Only callbacks for this transaction.")
+        parser.add_argument("--since", help="Only callbacks received at or after this ISO date/time.")
+        parser.add_argument("--until", help="Only callbacks received before this ISO date/time.")
+        parser.add_argument("--outcome", help="Only callbacks whose last outcome matches, e.g. unknown.")
+        parser.add_argument("--dry-run", action="store_true", help="List the matching callbacks without applying them.")
+
+    def parse_time(self, value):
+        try:
+            parsed = datetime.fromisoformat(value)
+        except ValueError:
+            raise CommandError(f"Invalid date/time: {value}")
+        return timezone.make_aware(parsed) if timezone.is_naive(parsed) else parsed
+
+    def handle(self, *args, **options):
+        entries = CallbackInbox.objects.order_by("id")
+        if options["checkout_request_id"]:
+            entries = entries.filter(checkout_request_id=options["checkout_request_id"])
+        if options["since"]:
+            entries = entries.filter(received_at__gte=self.parse_time(options["since"]))
+        if options["until"]:
+            entries = entries.filter(received_at__lt=self.parse_time(options["until"]))
+        if options["outcome"]:
+            entries = entries.filter(outcome=options["outcome"])
+
+        counts = {}
+        for entry in entries.iterator(chunk_size=500):
+            if options["dry_run"]:
+                self.stdout.write(f"{entry.pk} {entry.received_at:%Y-%m-%d %H:%M:%S} {entry}")
+                continue
+            outcome = process(entry)
+            counts[outcome] = counts.get(outcome, 0) + 1
+
+        if not options["dry_run"]:
+            summary = ", ".join(f"{outcome}: {n}" for outcome, n in sorted(counts.items()))
+            self.stdout.write(f"Replayed {sum(counts.values())} callbacks ({summary or 'none'})")
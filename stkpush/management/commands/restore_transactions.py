@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from stkpush.archive import ArchiveError, restore, restore_one
+from stkpush.models import ArchiveBatch, Transaction
+from stkpush.statements import parse_time
+
+
+class Command(BaseCommand):
+    help = ("Moves archived transactions back into the database: whole days in a date range, "
+            "or single transactions by receipt number, checkout_request_id or reference.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--since", help="First day to restore (ISO date).")
+        parser.add_argument("--until", help="Day after the last one to restore (ISO date).")
+        parser.add_argument("--receipt", action="append", default=[], help="M-Pesa receipt number (repeatable).")
+        parser.add_argument("--checkout-request-id", action="append", default=[], help="Repeatable.")
+        parser.add_argument("--reference", action="append", default=[], help="Repeatable.")
+        parser.add_argument("--all", action="store_true", help="Restore everything that was archived.")
+
+    def handle(self, *args, **options):
+        lookups = (
+            [{"mpesa_receipt_number": value} for value in options["receipt"]]
+            + [{"checkout_request_id": value} for value in options["checkout_request_id"]]
+            + [{"reference": value} for value in options["reference"]]
+        )
+        if not (lookups or options["since"] or options["until"] or options["all"]):
+            raise CommandError("Choose what to restore (--since/--until, --receipt, ...), or pass --all")
+
+        restored = 0
+        try:
+            for lookup in lookups:
+                try:
+                    restore_one(**lookup)
+                except Transaction.DoesNotExist:
+                    raise CommandError(f"Not in the archive: {next(iter(lookup.values()))}")
+                restored += 1
+
+            if options["since"] or options["until"] or options["all"]:
+                batches = ArchiveBatch.objects.all()
+                try:
+                    if options["since"]:
+                        batches = batches.filter(day__gte=timezone.localdate(parse_time(options["since"])))
+                    if options["until"]:
+                        batches = batches.filter(day__lt=timezone.localdate(parse_time(options["until"])))
+                except ValueError as e:
+                    raise CommandError(str(e))
+                restored += restore(batches)
+        except ArchiveError as e:
+            raise CommandError(str(e))
+        self.stdout.write(f"Restored {restored} transactions")
@@ -0,0 +1,70 @@
+import logging
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+
+from stkpush.daraja import DarajaClient
+from stkpush.jobs import claim_jobs, process_job, requeued
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Runs a pool of worker threads that initiate queued STK Pushes."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=4)
+        parser.add_argument("--batch-size", type=int, default=10, help="Jobs claimed per poll, per thread.")
+        parser.add_argument("--poll-interval", type=float, default=1.0, help="Seconds to sleep when the queue is empty.")
+        parser.add_argument("--once", action="store_true", help="Exit once the queue is drained.")
+
+    def handle(self, *args, **options):
+        stop = threading.Event()
+        workers = [
+            threading.Thread(target=self.work, args=(stop, options), name=f"stk-worker-{i}", daemon=True)
+            for i in range(options["threads"])
+        ]
+        for worker in workers:
+            worker.start()
+        self.stdout.write(f"STK worker running with {len(workers)} threads")
+        try:
+            while any(worker.is_alive() for worker in workers):
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            stop.set()
+            for worker in workers:
+                worker.join()
+
+    def work(self, stop, options):
+        try:
+            while not stop.is_set():
+                close_old_connections()
+                if not DarajaClient.available("stkpush"):
+                    if options["once"]:
+                        return
+                    # Leave the queue alone until the circuit half-opens
+                    stop.wait(options["poll_interval"])
+                    continue
+                try:
+                    jobs = claim_jobs(options["batch_size"])
+                except Exception:
+                    # e.g. "database is locked"; keep the thread alive and poll again
+                    logger.exception("Claiming STK Push jobs failed")
+                    stop.wait(options["poll_interval"])
+                    continue
+                for job in jobs:
+                    try:
+                        process_job(job)
+                    except Exception:
+                        # The row stays "Sending"; after MPESA_JOB_CLAIM_TIMEOUT it is settled as
+                        # "Pending" with an unknown outcome, never sent again
+                        logger.exception("STK Push job %s failed", job.reference)
+                if not jobs and options["once"]:
+                    return
+                if not jobs or requeued(jobs):
+                    # Nothing to do, or Daraja is failing: don't claim the same rows straight back
+                    stop.wait(options["poll_interval"])
+        finally:
+            connection.close()
@@ -0,0 +1,65 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+
+from stkpush import webhooks
+
+logger = logging.getLogger(__name__)
+
+# Seconds between deletions of delivered outbox events
+PRUNE_INTERVAL = 600
+
+
+class Command(BaseCommand):
+    help = "Delivers outbox events to the configured webhook endpoints, in batches, until interrupted."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=4, help="Endpoints delivered to in parallel.")
+        parser.add_argument("--batch-size", type=int, default=webhooks.BATCH_SIZE, help="Events sent per request.")
+        parser.add_argument("--poll-interval", type=float, default=1.0, help="Seconds to sleep when there is nothing to send.")
+        parser.add_argument("--once", action="store_true", help="Exit once nothing is left to send right now.")
+
+    def handle(self, *args, **options):
+        stop = threading.Event()
+        self.stdout.write(f"Webhook worker running with {options['threads']} threads")
+        with ThreadPoolExecutor(options["threads"], thread_name_prefix="webhook-worker") as pool:
+            try:
+                self.work(stop, pool, options)
+            except KeyboardInterrupt:
+                stop.set()
+        connection.close()
+
+    def work(self, stop, pool, options):
+        pruned_at = 0
+        while not stop.is_set():
+            close_old_connections()
+            try:
+                queued = webhooks.fan_out()
+                endpoints = webhooks.claim_endpoints(options["threads"])
+                # Each endpoint is delivered to by one thread, so its events stay in order
+                delivered = sum(pool.map(self.deliver, endpoints, [options["batch_size"]] * len(endpoints)))
+                if time.monotonic() - pruned_at > PRUNE_INTERVAL:
+                    webhooks.prune()
+                    pruned_at = time.monotonic()
+            except Exception:
+                # e.g. "database is locked"; keep the worker alive and poll again
+                logger.exception("Webhook delivery round failed")
+                stop.wait(options["poll_interval"])
+                continue
+            if not (queued or delivered):
+                if options["once"]:
+                    return
+                stop.wait(options["poll_interval"])
+
+    def deliver(self, endpoint, batch_size):
+        close_old_connections()
+        try:
+            return webhooks.deliver(endpoint, batch_size)
+        except Exception:
+            # The lease runs out and another round picks the endpoint up again
+            logger.exception("Delivering to webhook %s failed", endpoint.name)
+            return 0
@@ -0,0 +1,430 @@
+import atexit
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+from decouple import config
+
+# Directory shared by all worker processes (e.g. gunicorn workers). Each process
+# writes a snapshot of its samples there and /metrics sums them. Clear it when the
+# service starts. Leave unset for a single process.
+MULTIPROCESS_DIR = config("MPESA_METRICS_DIR", default="")
+
+# Seconds between snapshot writes of a process with new samples
+FLUSH_INTERVAL = config("MPESA_METRICS_FLUSH_INTERVAL", default=5, cast=float)
+
+# Latency buckets in seconds, covering cached lookups up to slow Daraja calls
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Registry:
+    """
+    Holds the process's metrics and renders them in the Prometheus text format.
+
+    With MPESA_METRICS_DIR set, a background thread writes a JSON snapshot of this
+    process's samples to `<dir>/<pid>.json` every FLUSH_INTERVAL seconds, and
+    `collect()` sums the snapshots of all processes. Counters and histograms of
+    exited workers keep counting; gauges only include live processes.
+    """
+
+    def __init__(self, directory=MULTIPROCESS_DIR):
+        self.directory = directory
+        self.metrics = {}
+        self.derived = []
+        self.dirty = False
+        self.flusher_pid = None
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def touch(self):
+        if not self.directory:
+            return
+        self.dirty = True
+        if self.flusher_pid != os.getpid():
+            self.start_flusher()
+
+    def start_flusher(self):
+        with self.lock:
+            if self.flusher_pid == os.getpid():
+                return
+            self.flusher_pid = os.getpid()
+            threading.Thread(target=self.flush_periodically, name="mpesa-metrics", daemon=True).start()
+            atexit.register(self.flush)
+
+    def flush_periodically(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            if self.dirty:
+                self.flush()
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+    def flush(self):
+        """
+        Writes this process's samples to the shared directory.
+        """
+        if not self.directory:
+            return
+        with self.flush_lock:
+            self.dirty = False
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"{os.getpid()}.json")
+            temp = f"{path}.tmp"
+            with open(temp, "w") as f:
+                json.dump({name: [[list(key), value] for key, value in samples.items()]
+                           for name, samples in self.snapshot().items()}, f)
+            os.replace(temp, path)
+
+    def collect(self):
+        """
+        Returns {metric name: {label values: value}} summed over all processes.
+        """
+        if not self.directory:
+            return self.snapshot()
+
+        self.flush()
+        merged = {name: {} for name in self.metrics}
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            try:
+                pid = int(os.path.basename(path).split(".")[0])
+                with open(path) as f:
+                    samples = json.load(f)
+            except (ValueError, OSError):
+                continue
+            alive = process_alive(pid)
+            for name, entries in samples.items():
+                metric = self.metrics.get(name)
+                if metric is None or (metric.kind == "gauge" and not alive):
+                    continue
+                for key, value in entries:
+                    key = tuple(key)
+                    merged[name][key] = metric.merge(merged[name].get(key), value)
+        return merged
+
+    def render(self):
+        """
+        Renders every metric in the Prometheus text exposition format (version 0.0.4).
+        """
+        collected = self.collect()
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.extend(metric.render(collected.get(name, {})))
+        for ratio in self.derived:
+            lines.extend(ratio.render(collected))
+        return "\n".join(lines) + "\n"
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = [f'{name}="{escape(value)}"' for name, value in (*zip(names, values), *extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        self.registry = registry or REGISTRY
+        self.registry.register(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values)
+
+    def value(self, **labels):
+        """
+        This process's current value for the given labels.
+        """
+        with self.lock:
+            return self.values.get(self.key(labels), 0)
+
+    def merge(self, current, value):
+        return (current or 0) + value
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self, samples):
+        lines = self.header()
+        for key, value in sorted(samples.items()):
+            lines.append(f"{self.name}{format_labels(self.labelnames, key)} {format_number(value)}")
+        return lines
+
+
+class Counter(Metric):
+    """
+    Monotonically increasing count, e.g. requests per result code.
+    """
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+        self.registry.touch()
+
+
+class Gauge(Metric):
+    """
+    Value that goes up and down, e.g. requests in flight.
+    """
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+        self.registry.touch()
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+        self.registry.touch()
+
+    @contextmanager
+    def track(self, **labels):
+        """
+        Counts the block as in progress while it runs.
+        """
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values (latencies in seconds) over fixed buckets.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = {"buckets": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+            entry["buckets"][index] += 1
+            entry["sum"] += value
+            entry["count"] += 1
+        self.registry.touch()
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observes the duration of the block.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def snapshot(self):
+        with self.lock:
+            return {key: {**entry, "buckets": list(entry["buckets"])} for key, entry in self.values.items()}
+
+    def value(self, **labels):
+        with self.lock:
+            entry = self.values.get(self.key(labels))
+            return entry["count"] if entry else 0
+
+    def merge(self, current, value):
+        if current is None:
+            return {**value, "buckets": list(value["buckets"])}
+        current["buckets"] = [a + b for a, b in zip(current["buckets"], value["buckets"])]
+        current["sum"] += value["sum"]
+        current["count"] += value["count"]
+        return current
+
+    def render(self, samples):
+        lines = self.header()
+        for key, entry in sorted(samples.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), entry["buckets"]):
+                cumulative += count
+                labels = format_labels(self.labelnames, key, [("le", format_number(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {format_number(entry['sum'])}")
+            lines.append(f"{self.name}_count{labels} {entry['count']}")
+        return lines
+
+
+class HitRatio:
+    """
+    Gauge computed at scrape time: the share of a counter's samples whose `label` is in `hits`.
+    """
+
+    def __init__(self, name, documentation, counter, label, hits, registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.counter = counter
+        self.index = counter.labelnames.index(label)
+        self.hits = set(hits)
+        (registry or REGISTRY).derived.append(self)
+
+    def render(self, collected):
+        samples = collected.get(self.counter.name, {})
+        total = sum(samples.values())
+        hits = sum(value for key, value in samples.items() if key[self.index] in self.hits)
+        ratio = hits / total if total else 0.0
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge",
+                f"{self.name} {format_number(float(ratio))}"]
+
+
+def timed(histogram, **labels):
+    """
+    Decorator observing the duration of every call of a sync or async function.
+    """
+    def decorator(func):
+        if iscoroutinefunction(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                with histogram.time(**labels):
+                    return await func(*args, **kwargs)
+        else:
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with histogram.time(**labels):
+                    return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def instrument_view(name):
+    """
+    Decorator recording latency, in-flight requests and response codes of a view.
+
+    Works for both sync and async views.
+    """
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def wrapper(request, *args, **kwargs):
+                with VIEW_IN_FLIGHT.track(view=name), VIEW_SECONDS.time(view=name):
+                    response = await view(request, *args, **kwargs)
+                VIEW_RESPONSES.inc(view=name, status=response.status_code)
+                return response
+        else:
+            @wraps(view)
+            def wrapper(request, *args, **kwargs):
+                with VIEW_IN_FLIGHT.track(view=name), VIEW_SECONDS.time(view=name):
+                    response = view(request, *args, **kwargs)
+                VIEW_RESPONSES.inc(view=name, status=response.status_code)
+                return response
+        return wrapper
+    return decorator
+
+
+REGISTRY = Registry()
+
+DARAJA_SECONDS = Histogram(
+    "mpesa_daraja_request_seconds", "Latency of Daraja API calls.", ["endpoint"])
+DARAJA_IN_FLIGHT = Gauge(
+    "mpesa_daraja_requests_in_flight", "Daraja API calls in progress.", ["endpoint"])
+DARAJA_RESPONSES = Counter(
+    "mpesa_daraja_responses_total", "Daraja API responses by HTTP status.", ["endpoint", "status"])
+DARAJA_ERRORS = Counter(
+    "mpesa_daraja_errors_total", "Daraja API calls that failed without a response.", ["endpoint", "error"])
+DARAJA_SHED = Counter(
+    "mpesa_daraja_shed_total", "Daraja API calls rejected locally (circuit_open, concurrency_limit).",
+    ["endpoint", "reason"])
+BREAKER_TRIPS = Counter(
+    "mpesa_circuit_breaker_trips_total", "Times a Daraja endpoint's circuit was opened by this process.", ["endpoint"])
+RATE_LIMIT_WAIT = Histogram(
+    "mpesa_rate_limit_wait_seconds", "Time Daraja calls waited for a rate limit token.", ["endpoint"])
+PHONE_THROTTLED = Counter(
+    "mpesa_phone_throttled_total", "Payment requests refused because the phone was sent a push moments ago.")
+IDEMPOTENCY = Counter(
+    "mpesa_idempotency_total", "Payment requests by idempotency outcome (new, replayed, conflict).", ["outcome"])
+CONCURRENCY_LIMIT = Gauge(
+    "mpesa_daraja_concurrency_limit", "Current adaptive limit on outstanding Daraja calls.", ["endpoint"])
+
+TOKEN_SECONDS = Histogram(
+    "mpesa_token_lookup_seconds", "Time taken to obtain an access token.")
+TOKEN_LOOKUPS = Counter(
+    "mpesa_token_lookups_total",
+    "Access token lookups by where the token came from (memo, cache, fetched, stale, failed).", ["source"])
+TOKEN_HIT_RATIO = HitRatio(
+    "mpesa_token_cache_hit_ratio", "Share of token lookups served without calling OAuth.",
+    TOKEN_LOOKUPS, "source", ("memo", "cache"))
+
+STK_PUSH_RESULTS = Counter(
+    "mpesa_stk_push_results_total", "STK Push requests by Safaricom ResponseCode.", ["response_code"])
+CALLBACKS = Counter(
+    "mpesa_callbacks_total", "STK callbacks processed, by outcome and ResultCode.", ["outcome", "result_code"])
+
+C2B_VALIDATIONS = Counter(
+    "mpesa_c2b_validations_total", "C2B validation answers by ResultCode (0 accepts).", ["result"])
+C2B_CONFIRMATIONS = Counter(
+    "mpesa_c2b_confirmations_total", "C2B confirmations stored (including repeated deliveries).")
+C2B_BATCH_SIZE = Histogram(
+    "mpesa_c2b_batch_size", "C2B confirmations written per insert.",
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+
+WEBHOOK_EVENTS = Counter(
+    "mpesa_webhook_events_total", "Outbox events sent to webhook endpoints, by result (delivered, failed, dead).", ["result"])
+WEBHOOK_SECONDS = Histogram(
+    "mpesa_webhook_request_seconds", "Latency of webhook delivery requests.")
+
+STATUS_CACHE_LOOKUPS = Counter(
+    "mpesa_status_cache_lookups_total", "Status cache lookups by result (hit, miss).", ["result"])
+STATUS_CACHE_HIT_RATIO = HitRatio(
+    "mpesa_status_cache_hit_ratio", "Share of status lookups served from the cache.",
+    STATUS_CACHE_LOOKUPS, "result", ("hit",))
+
+VIEW_SECONDS = Histogram(
+    "mpesa_view_seconds", "Latency of the payment views.", ["view"])
+VIEW_IN_FLIGHT = Gauge(
+    "mpesa_view_requests_in_flight", "Payment view requests in progress.", ["view"])
+VIEW_RESPONSES = Counter(
+    "mpesa_view_responses_total", "Payment view responses by HTTP status.", ["view", "status"])
@@ -0,0 +1,45 @@
+import uuid
+
+from django.db import migrations, models
+
+
+def populate_references(apps, schema_editor):
+    Transaction = apps.get_model('stkpush', 'Transaction')
+    for transaction in Transaction.objects.filter(reference__isnull=True).only('pk').iterator():
+        Transaction.objects.filter(pk=transaction.pk).update(reference=uuid.uuid4())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stkpush', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='reference',
+            field=models.UUIDField(editable=False, null=True),
+        ),
+        migrations.RunPython(populate_references, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='transaction',
+            name='reference',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='checkout_request_id',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='locked_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
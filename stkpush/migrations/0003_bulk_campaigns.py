@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stkpush', '0002_async_initiation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='account_reference',
+            field=models.CharField(blank=True, max_length=20, null=True),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='batch',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='transaction',
+            constraint=models.UniqueConstraint(fields=('batch', 'account_reference'), name='unique_batch_reference'),
+        ),
+    ]
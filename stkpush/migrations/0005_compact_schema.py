@@ -0,0 +1,98 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+STATUSES = {'Initiating': 1, 'Sending': 2, 'Pending': 3, 'Success': 4, 'Failed': 5}
+
+
+def compact(apps, schema_editor):
+    Transaction = apps.get_model('stkpush', 'Transaction')
+    ResultDescription = apps.get_model('stkpush', 'ResultDescription')
+
+    for label, value in STATUSES.items():
+        Transaction.objects.filter(status=label).update(status_code=value)
+
+    texts = Transaction.objects.exclude(result_desc__isnull=True).exclude(result_desc='')
+    for text in texts.values_list('result_desc', flat=True).distinct().iterator():
+        description, _ = ResultDescription.objects.get_or_create(text=text[:255])
+        Transaction.objects.filter(result_desc=text).update(result_description=description)
+
+
+def expand(apps, schema_editor):
+    Transaction = apps.get_model('stkpush', 'Transaction')
+    ResultDescription = apps.get_model('stkpush', 'ResultDescription')
+
+    for label, value in STATUSES.items():
+        Transaction.objects.filter(status_code=value).update(status=label)
+
+    for description in ResultDescription.objects.iterator():
+        Transaction.objects.filter(result_description=description).update(result_desc=description.text)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stkpush', '0004_callback_inbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResultDescription',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('text', models.CharField(max_length=255, unique=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='result_description',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='stkpush.resultdescription'),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='status_code',
+            field=models.PositiveSmallIntegerField(default=3),
+        ),
+        migrations.RunPython(compact, expand),
+        migrations.RemoveField(
+            model_name='transaction',
+            name='status',
+        ),
+        migrations.RemoveField(
+            model_name='transaction',
+            name='result_desc',
+        ),
+        migrations.RenameField(
+            model_name='transaction',
+            old_name='status_code',
+            new_name='status',
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='status',
+            field=models.PositiveSmallIntegerField(choices=[(1, 'Initiating'), (2, 'Sending'), (3, 'Pending'), (4, 'Success'), (5, 'Failed')], default=3),
+        ),
+        migrations.AddConstraint(
+            model_name='transaction',
+            constraint=models.UniqueConstraint(fields=('mpesa_receipt_number',), name='unique_receipt_number'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['transaction_date'], name='txn_date'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['status', 'transaction_date'], name='txn_status_date'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(condition=models.Q(('status', 3)), fields=['transaction_date'], name='txn_pending_date'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(condition=models.Q(('status__in', [1, 2])), fields=['id'], name='txn_queue'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['phone_number', 'transaction_date'], name='txn_phone_date'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-17 21:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stkpush', '0006_rate_limit_buckets'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Tenant',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('slug', models.SlugField(unique=True)),
+                ('name', models.CharField(max_length=100)),
+                ('consumer_key', models.CharField(max_length=100)),
+                ('consumer_secret', models.CharField(max_length=100)),
+                ('shortcode', models.CharField(max_length=20)),
+                ('passkey', models.CharField(max_length=255)),
+                ('transaction_type', models.CharField(choices=[('CustomerPayBillOnline', 'Paybill'), ('CustomerBuyGoodsOnline', 'Buy Goods (till)')], default='CustomerPayBillOnline', max_length=32)),
+                ('party_b', models.CharField(blank=True, max_length=20)),
+                ('callback_url', models.URLField(blank=True)),
+                ('stk_rate', models.FloatField(blank=True, null=True)),
+                ('is_active', models.BooleanField(default=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='tenant',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='stkpush.tenant', to_field='slug'),
+        ),
+    ]
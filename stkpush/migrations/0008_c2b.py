@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-17 22:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stkpush', '0007_tenants'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PaybillAccount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.CharField(max_length=50, unique=True)),
+                ('name', models.CharField(blank=True, max_length=100)),
+                ('is_active', models.BooleanField(default=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='C2BPayment',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trans_id', models.CharField(max_length=20, unique=True)),
+                ('transaction_type', models.CharField(blank=True, max_length=32)),
+                ('trans_time', models.DateTimeField(blank=True, null=True)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('business_short_code', models.CharField(max_length=20)),
+                ('bill_ref_number', models.CharField(blank=True, db_index=True, max_length=100)),
+                ('invoice_number', models.CharField(blank=True, max_length=100)),
+                ('org_account_balance', models.CharField(blank=True, max_length=32)),
+                ('third_party_trans_id', models.CharField(blank=True, max_length=100)),
+                ('msisdn', models.CharField(blank=True, max_length=100)),
+                ('first_name', models.CharField(blank=True, max_length=100)),
+                ('payload', models.TextField()),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['received_at'], name='c2b_received')],
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-17 22:27
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stkpush', '0009_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchiveBatch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=255)),
+                ('offset', models.BigIntegerField()),
+                ('day', models.DateField(db_index=True)),
+                ('rows', models.PositiveIntegerField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedKey',
+            fields=[
+                ('key', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('batch', models.ForeignKey(db_constraint=False, db_index=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='stkpush.archivebatch')),
+            ],
+        ),
+    ]
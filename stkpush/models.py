@@ -1,6 +1,20 @@
-from django.db import models
+import threading
+import uuid
+
+from django.db import models, transaction as db_transaction
 
 # Create your models here.
+class TransactionStatus(models.IntegerChoices):
+    """
+    Lifecycle of a transaction, stored as a small integer.
+    """
+    INITIATING = 1, "Initiating"
+    SENDING = 2, "Sending"
+    PENDING = 3, "Pending"
+    SUCCESS = 4, "Success"
+    FAILED = 5, "Failed"
+
+
 class Transaction(models.Model):
     """
     Stores the details of each M-Pesa transaction.
@@ -8,8 +22,12 @@ class Transaction(models.Model):
     This model tracks the lifecycle of an STK Push request, from initiation to the final callback result.
     It is essential for reconciling payments and providing status updates to the user.
     """
+    # Local reference handed to the client before Safaricom has answered (async initiation)
+    reference = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+
     # Unique ID generated by Safaricom for every request. Used to match callbacks to requests.
-    checkout_request_id = models.CharField(max_length=100, unique=True)
+    # Empty while the push is still queued for initiation.
+    checkout_request_id = models.CharField(max_length=100, unique=True, blank=True, null=True)
     
     # ID provided by the merchant (optional, but good for internal tracking)
     merchant_request_id = models.CharField(max_length=100, blank=True, null=True)
@@ -21,19 +39,490 @@ class Transaction(models.Model):
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     
     # The receipt number generated by M-Pesa upon successful payment (e.g., QKH1234567)
+    # Unique, so it doubles as the index for reconciliation lookups
     mpesa_receipt_number = models.CharField(max_length=20, blank=True, null=True)
     
+    # Completion time reported by M-Pesa in the callback metadata (TransactionDate)
+    mpesa_transaction_date = models.DateTimeField(blank=True, null=True)
+    
     # Result code from the callback (0 means success, others indicate failure/cancellation)
     result_code = models.IntegerField(blank=True, null=True)
     
-    # Descriptive message from the callback (e.g., "The service request is processed successfully.")
-    result_desc = models.TextField(blank=True, null=True)
+    # Descriptive message from the callback (e.g., "The service request is processed successfully.").
+    # Only a handful of distinct messages exist, so they are stored once in ResultDescription;
+    # read and write the text through the `result_desc` property.
+    result_description = models.ForeignKey(
+        'ResultDescription', on_delete=models.PROTECT, blank=True, null=True, related_name='+',
+    )
     
     # Timestamp of when the transaction was initiated
     transaction_date = models.DateTimeField(auto_now_add=True)
     
-    # Current status of the transaction: Pending, Success, or Failed
-    status = models.CharField(max_length=20, default="Pending")
+    # Current status of the transaction: Initiating, Sending, Pending, Success, or Failed
+    status = models.PositiveSmallIntegerField(choices=TransactionStatus.choices, default=TransactionStatus.PENDING)
+
+    # Account reference sent to Safaricom; bulk pushes take it from the input file
+    account_reference = models.CharField(max_length=20, blank=True, null=True)
+
+    # Name of the bulk campaign the transaction was created by, if any
+    batch = models.CharField(max_length=64, blank=True, null=True)
+
+    # Paybill or till the push was sent for; empty for the shortcode configured in the
+    # environment. Keyed by slug so workers can look up its credentials without a join.
+    tenant = models.ForeignKey(
+        'Tenant', to_field='slug', on_delete=models.PROTECT, blank=True, null=True, related_name='+',
+    )
+
+    # Queue bookkeeping for asynchronous initiation: number of send attempts and
+    # when a worker last claimed the row
+    attempts = models.PositiveSmallIntegerField(default=0)
+    locked_at = models.DateTimeField(blank=True, null=True)
+
+    Status = TransactionStatus
+    TERMINAL_STATUSES = (TransactionStatus.SUCCESS, TransactionStatus.FAILED)
+
+    class Meta:
+        constraints = [
+            # Lets a crashed bulk import be re-run without duplicating rows
+            models.UniqueConstraint(fields=['batch', 'account_reference'], name='unique_batch_reference'),
+            models.UniqueConstraint(fields=['mpesa_receipt_number'], name='unique_receipt_number'),
+        ]
+        indexes = [
+            # Reconciliation and exports by date range, optionally per status
+            models.Index(fields=['transaction_date'], name='txn_date'),
+            models.Index(fields=['status', 'transaction_date'], name='txn_status_date'),
+            # Stale pending transactions, oldest first; only covers the small open set
+            models.Index(
+                fields=['transaction_date'], name='txn_pending_date',
+                condition=models.Q(status=TransactionStatus.PENDING),
+            ),
+            # Queued pushes for the job queue, in claim order
+            models.Index(
+                fields=['id'], name='txn_queue',
+                condition=models.Q(status__in=[TransactionStatus.INITIATING, TransactionStatus.SENDING]),
+            ),
+            # Per-customer history
+            models.Index(fields=['phone_number', 'transaction_date'], name='txn_phone_date'),
+        ]
+
+    @property
+    def result_desc(self):
+        if self.result_description_id is None:
+            return None
+        if Transaction.result_description.is_cached(self):
+            return self.result_description.text
+        return ResultDescription.text_for(self.result_description_id)
+
+    @result_desc.setter
+    def result_desc(self, text):
+        self.result_description_id = ResultDescription.id_for(text)
+
+    def __str__(self):
+        return f"{self.phone_number} - {self.amount} - {self.get_status_display()}"
+
+
+class ResultDescription(models.Model):
+    """
+    Distinct result messages, shared by all transactions that received them.
+
+    Lookups in both directions are memoised per process, since the set is tiny.
+    """
+    text = models.CharField(max_length=255, unique=True)
+
+    _ids = {}
+    _texts = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def remember(cls, pk, text):
+        def store():
+            with cls._lock:
+                cls._ids[text] = pk
+                cls._texts[pk] = text
+        # Only once committed: a row created in a transaction that rolls back must not stay memoised
+        db_transaction.on_commit(store)
+
+    @classmethod
+    def id_for(cls, text):
+        """
+        Returns the id for a message, creating the row on first use.
+        """
+        if not text:
+            return None
+        text = str(text)[:255]
+        pk = cls._ids.get(text)
+        if pk is None:
+            pk = cls.objects.get_or_create(text=text)[0].pk
+            cls.remember(pk, text)
+        return pk
+
+    @classmethod
+    def text_for(cls, pk):
+        """
+        Returns the message for an id.
+        """
+        text = cls._texts.get(pk)
+        if text is None:
+            text = cls.objects.values_list('text', flat=True).get(pk=pk)
+            cls.remember(pk, text)
+        return text
+
+    def __str__(self):
+        return self.text
+
+
+class CallbackInbox(models.Model):
+    """
+    Raw STK callbacks as received from Safaricom, appended before they are applied.
+
+    Storing the payload first lets the callback view acknowledge immediately, makes
+    duplicate deliveries harmless, and allows callbacks to be replayed later.
+    """
+    # The request body exactly as received
+    payload = models.TextField()
+
+    # Extracted on receipt so entries for one transaction can be found and replayed
+    checkout_request_id = models.CharField(max_length=100, blank=True, null=True, db_index=True)
+
+    received_at = models.DateTimeField(auto_now_add=True)
+
+    # Set once the callback has been applied (or found to be a duplicate)
+    processed_at = models.DateTimeField(blank=True, null=True)
+
+    # Outcome of the last processing attempt, e.g. "applied", "duplicate" or an error
+    outcome = models.CharField(max_length=100, blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['processed_at', 'id'], name='inbox_unprocessed'),
+        ]
+
+    def __str__(self):
+        return f"{self.checkout_request_id} - {self.outcome or 'unprocessed'}"
+
+class TransactionType(models.TextChoices):
+    PAYBILL = "CustomerPayBillOnline", "Paybill"
+    BUY_GOODS = "CustomerBuyGoodsOnline", "Buy Goods (till)"
+
+
+class Tenant(models.Model):
+    """
+    A paybill or till served by this deployment, with its own Daraja app credentials.
+
+    The shortcode configured in the environment keeps working without a row here.
+    Rows are loaded on first use and edits are picked up by running workers within
+    MPESA_TENANT_RELOAD_INTERVAL seconds; see `stkpush.tenants`.
+    """
+    # Names the tenant in payment requests and in its callback URL (/callback/<slug>/)
+    slug = models.SlugField(max_length=50, unique=True)
+
+    name = models.CharField(max_length=100)
+
+    # Daraja app credentials
+    consumer_key = models.CharField(max_length=100)
+    consumer_secret = models.CharField(max_length=100)
+
+    # Paybill number, or the store number of a till
+    shortcode = models.CharField(max_length=20)
+    passkey = models.CharField(max_length=255)
+
+    transaction_type = models.CharField(max_length=32, choices=TransactionType.choices, default=TransactionType.PAYBILL)
+
+    # Till number for Buy Goods; defaults to the shortcode
+    party_b = models.CharField(max_length=20, blank=True)
+
+    # Defaults to MPESA_CALLBACK_URL with the slug appended
+    callback_url = models.URLField(blank=True)
+
+    # STK Pushes per second allowed for this tenant's Daraja app; empty uses MPESA_STK_RATE
+    stk_rate = models.FloatField(blank=True, null=True)
+
+    is_active = models.BooleanField(default=True)
+
+    updated_at = models.DateTimeField(auto_now=True)
+
+    # Credentials the admin accepts but never displays
+    SECRET_FIELDS = ("consumer_secret", "passkey")
+
+    def __str__(self):
+        return f"{self.name} ({self.shortcode})"
+
+
+class PaybillAccount(models.Model):
+    """
+    An account number customers may pay into from the SIM menu (C2B).
+
+    The C2B validation callback checks the BillRefNumber against an in-memory
+    index of the active numbers; see `stkpush.c2b`.
+    """
+    # As given to customers; matched ignoring case and spaces
+    number = models.CharField(max_length=50, unique=True)
+
+    name = models.CharField(max_length=100, blank=True)
+
+    is_active = models.BooleanField(default=True)
+
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.number} - {self.name}" if self.name else self.number
+
+
+class C2BPayment(models.Model):
+    """
+    A payment made directly to the paybill or till, as confirmed by Safaricom.
+
+    Confirmations are inserted in batches; Safaricom's retries of the same payment
+    are dropped by the unique TransID.
+    """
+    # M-Pesa receipt number (TransID)
+    trans_id = models.CharField(max_length=20, unique=True)
+
+    # e.g. "Pay Bill" or "Buy Goods"
+    transaction_type = models.CharField(max_length=32, blank=True)
+
+    # TransTime, in East Africa Time
+    trans_time = models.DateTimeField(blank=True, null=True)
+
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+
+    business_short_code = models.CharField(max_length=20)
+
+    # The account number the customer typed
+    bill_ref_number = models.CharField(max_length=100, blank=True, db_index=True)
+
+    invoice_number = models.CharField(max_length=100, blank=True)
+
+    org_account_balance = models.CharField(max_length=32, blank=True)
+
+    third_party_trans_id = models.CharField(max_length=100, blank=True)
+
+    # The payer's number; Safaricom masks or hashes it on newer API versions
+    msisdn = models.CharField(max_length=100, blank=True)
+
+    first_name = models.CharField(max_length=100, blank=True)
+
+    # The confirmation body exactly as received
+    payload = models.TextField()
+
+    received_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['received_at'], name='c2b_received'),
+        ]
 
     def __str__(self):
-        return f"{self.phone_number} - {self.amount} - {self.status}"
\ No newline at end of file
+        return f"{self.trans_id} - {self.amount} to {self.bill_ref_number}"
+
+
+class RollupPeriod(models.TextChoices):
+    HOUR = "hour", "Hour"
+    DAY = "day", "Day"
+
+
+class TransactionRollup(models.Model):
+    """
+    Totals of the transactions started in one hour or day, per tenant.
+
+    Kept up to date as pushes are accepted and resolved (see `stkpush.rollups`),
+    so dashboards read one row per bucket instead of scanning transactions.
+    `rebuild_rollups` recomputes them from the Transaction table.
+    """
+    period = models.CharField(max_length=4, choices=RollupPeriod.choices)
+
+    # Start of the hour or day, in the project's time zone
+    start = models.DateTimeField()
+
+    # Tenant slug; empty for the shortcode configured in the environment
+    tenant = models.CharField(max_length=50, blank=True, default="")
+
+    # STK Pushes accepted by Safaricom
+    pushes = models.PositiveIntegerField(default=0)
+
+    succeeded = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+
+    # Total paid by the successful transactions
+    amount = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['period', 'start', 'tenant'], name='unique_rollup_bucket'),
+        ]
+
+    @property
+    def success_rate(self):
+        resolved = self.succeeded + self.failed
+        return self.succeeded / resolved if resolved else None
+
+    def __str__(self):
+        return f"{self.get_period_display()} {self.start:%Y-%m-%d %H:%M} {self.tenant or 'default'}"
+
+
+class PhoneRollup(models.Model):
+    """
+    Successful payments and amount paid by one phone number on one day.
+    """
+    day = models.DateField()
+
+    phone_number = models.CharField(max_length=15)
+
+    payments = models.PositiveIntegerField(default=0)
+
+    amount = models.DecimalField(max_digits=16, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'phone_number'], name='unique_phone_day'),
+        ]
+
+    def __str__(self):
+        return f"{self.phone_number} on {self.day}: {self.amount}"
+
+
+class RateLimitBucket(models.Model):
+    """
+    Shared token bucket for outbound Daraja calls, one row per endpoint.
+
+    Tokens are taken with a single conditional UPDATE that refills and decrements
+    in the same statement, so the budget holds across threads, processes and hosts.
+    """
+    key = models.CharField(max_length=64, primary_key=True)
+
+    tokens = models.FloatField()
+
+    # Unix time of the last refill
+    updated = models.FloatField()
+
+    def __str__(self):
+        return f"{self.key}: {self.tokens:.1f}"
+
+
+
+class ArchiveBatch(models.Model):
+    """
+    One batch of transactions moved to the archive: a gzip member of a day file.
+    """
+    # Archive file, relative to MPESA_ARCHIVE_DIR, and byte offset of the member
+    path = models.CharField(max_length=255)
+    offset = models.BigIntegerField()
+
+    # Day (in the project's time zone) all the batch's transactions were started on
+    day = models.DateField(db_index=True)
+
+    # Transactions written to the member
+    rows = models.PositiveIntegerField()
+
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.rows} transactions of {self.day} in {self.path}"
+
+
+class ArchivedKey(models.Model):
+    """
+    Lookup key of an archived transaction and the batch that holds it.
+
+    Each archived transaction has one row per reference, checkout_request_id and
+    receipt number, keyed by a 64-bit hash of the value (see `stkpush.archive.key`)
+    so the index stays small: about 35 bytes per key on SQLite, where a transaction
+    with its indexes takes ten times that. Matches are confirmed against the
+    archived row itself.
+    """
+    key = models.BigIntegerField(primary_key=True)
+
+    # Keys are deleted with the rows they point to, never through the batch, so
+    # the column needs neither an index nor a foreign key constraint
+    batch = models.ForeignKey(
+        ArchiveBatch, on_delete=models.DO_NOTHING, db_index=False, db_constraint=False, related_name='+',
+    )
+
+
+class WebhookEndpoint(models.Model):
+    """
+    Merchant URL that is sent payment status changes from the outbox (see `stkpush.webhooks`).
+
+    The delivery state lives on the row: one worker at a time holds the endpoint's
+    lease and sends its events in order, and after a failed request the endpoint
+    backs off exponentially.
+    """
+    name = models.CharField(max_length=100)
+
+    url = models.URLField()
+
+    # Signs each request body (X-Mpesa-Signature: HMAC-SHA256); empty to send unsigned
+    secret = models.CharField(max_length=255, blank=True)
+
+    # Only send events of this tenant slug; empty for every tenant
+    tenant = models.CharField(max_length=50, blank=True)
+
+    is_active = models.BooleanField(default=True)
+
+    # Consecutive failed requests, and when the next one may be made
+    failures = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(blank=True, null=True)
+    last_error = models.CharField(max_length=255, blank=True)
+    last_delivered_at = models.DateTimeField(blank=True, null=True)
+
+    # Lease of the worker currently delivering to the endpoint
+    locked_until = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.url})"
+
+
+class OutboxEvent(models.Model):
+    """
+    A payment status change, written in the same database transaction as the change.
+    """
+    # "payment.pending", "payment.success" or "payment.failed"
+    type = models.CharField(max_length=32)
+
+    reference = models.UUIDField()
+
+    # Tenant slug; empty for the shortcode configured in the environment
+    tenant = models.CharField(max_length=50, blank=True, default="")
+
+    # JSON description of the transaction, as sent to the endpoints
+    payload = models.TextField()
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    # When the worker queued the event for the endpoints
+    dispatched_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            # Events the worker has yet to queue; only covers the small backlog
+            models.Index(fields=['id'], name='outbox_undispatched', condition=models.Q(dispatched_at__isnull=True)),
+            models.Index(fields=['dispatched_at'], name='outbox_dispatched'),
+        ]
+
+    def __str__(self):
+        return f"{self.type} {self.reference}"
+
+
+class WebhookDelivery(models.Model):
+    """
+    An event still to be sent to an endpoint; deleted once the endpoint accepts it.
+
+    A delivery the endpoint rejected outright, or that failed MPESA_WEBHOOK_MAX_ATTEMPTS
+    times, is dead-lettered: kept, with `dead_at` set, but no longer sent.
+    """
+    # Indexed by unique_delivery, which also orders an endpoint's pending events
+    endpoint = models.ForeignKey(WebhookEndpoint, on_delete=models.CASCADE, related_name='deliveries', db_index=False)
+
+    event = models.ForeignKey(OutboxEvent, on_delete=models.CASCADE, related_name='+')
+
+    # Failed requests that carried the event, and the last error
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.CharField(max_length=255, blank=True)
+
+    # When the event was given up on
+    dead_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['endpoint', 'event'], name='unique_delivery'),
+        ]
@@ -0,0 +1,129 @@
+import asyncio
+import threading
+import time
+from collections import defaultdict
+
+from decouple import config
+from django.core.cache import caches
+
+CACHE_ALIAS = config("MPESA_NOTIFY_CACHE", default="default")
+# How often a waiter checks the cache for changes made by another worker process
+CACHE_CHECK_INTERVAL = config("MPESA_NOTIFY_CHECK_INTERVAL", default=1.0, cast=float)
+CACHE_TTL = 600
+
+
+class StatusNotifier:
+    """
+    Wakes clients waiting on a transaction when its status changes.
+
+    Waiters in the same process are woken immediately through registered callbacks.
+    Every change is also written to the cache, which waiters check every
+    CACHE_CHECK_INTERVAL seconds, so a callback handled by another worker still
+    wakes them without any database reads.
+    """
+
+    def __init__(self):
+        self.subscribers = defaultdict(set)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def cache_key(key):
+        return f"mpesa:status:{key}"
+
+    def subscribe(self, keys, callback):
+        with self.lock:
+            for key in keys:
+                self.subscribers[key].add(callback)
+
+    def unsubscribe(self, keys, callback):
+        with self.lock:
+            for key in keys:
+                callbacks = self.subscribers.get(key)
+                if callbacks is not None:
+                    callbacks.discard(callback)
+                    if not callbacks:
+                        del self.subscribers[key]
+
+    def publish(self, status, *keys):
+        """
+        Records a new status for the transaction identified by `keys` and wakes its waiters.
+        """
+        keys = [str(key) for key in keys if key]
+        caches[CACHE_ALIAS].set_many({self.cache_key(key): status for key in keys}, CACHE_TTL)
+        with self.lock:
+            callbacks = set().union(*(self.subscribers.get(key, ()) for key in keys))
+        for callback in callbacks:
+            callback()
+
+    async def apublish(self, status, *keys):
+        """
+        Async version of `publish`.
+        """
+        keys = [str(key) for key in keys if key]
+        await caches[CACHE_ALIAS].aset_many({self.cache_key(key): status for key in keys}, CACHE_TTL)
+        with self.lock:
+            callbacks = set().union(*(self.subscribers.get(key, ()) for key in keys))
+        for callback in callbacks:
+            callback()
+
+    def changed_elsewhere(self, keys, known_status):
+        values = caches[CACHE_ALIAS].get_many([self.cache_key(key) for key in keys])
+        return any(value != known_status for value in values.values())
+
+    async def achanged_elsewhere(self, keys, known_status):
+        values = await caches[CACHE_ALIAS].aget_many([self.cache_key(key) for key in keys])
+        return any(value != known_status for value in values.values())
+
+    def wait(self, keys, known_status, timeout):
+        """
+        Blocks until the transaction leaves `known_status` or `timeout` seconds pass.
+
+        Returns:
+            bool: True if a change was signalled.
+        """
+        keys = [str(key) for key in keys if key]
+        event = threading.Event()
+        self.subscribe(keys, event.set)
+        try:
+            deadline = time.monotonic() + timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                if event.wait(min(CACHE_CHECK_INTERVAL, remaining)):
+                    return True
+                if self.changed_elsewhere(keys, known_status):
+                    return True
+        finally:
+            self.unsubscribe(keys, event.set)
+
+    async def await_change(self, keys, known_status, timeout):
+        """
+        Async version of `wait` that holds no thread while waiting.
+        """
+        keys = [str(key) for key in keys if key]
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+
+        def wake():
+            loop.call_soon_threadsafe(event.set)
+
+        self.subscribe(keys, wake)
+        try:
+            deadline = loop.time() + timeout
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return False
+                try:
+                    await asyncio.wait_for(event.wait(), min(CACHE_CHECK_INTERVAL, remaining))
+                    return True
+                except asyncio.TimeoutError:
+                    pass
+                if await self.achanged_elsewhere(keys, known_status):
+                    return True
+        finally:
+            self.unsubscribe(keys, wake)
+
+
+notifier = StatusNotifier()
@@ -0,0 +1,111 @@
+"""
+STK Push and STK query payloads.
+
+Everything that does not change between requests (shortcode, passkey, callback
+URL, transaction type) is read once and kept in a template per shortcode. The
+password only changes with the timestamp, which has one-second granularity, so it
+is computed once per second and shared by every thread.
+"""
+import base64
+import json
+import time
+
+from decouple import config
+
+try:
+    import orjson
+except ImportError:  # Optional; the standard library encoder is used without it
+    orjson = None
+
+PAYBILL = "CustomerPayBillOnline"
+BUY_GOODS = "CustomerBuyGoodsOnline"
+
+DEFAULT_ACCOUNT_REFERENCE = "Your Mpesa-Test"
+DEFAULT_DESCRIPTION = "Payment for your Company"
+
+
+def dumps(payload):
+    """
+    Serialises a payload to compact JSON bytes, with orjson when it is installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, separators=(",", ":")).encode()
+
+
+class StkPayloadBuilder:
+    """
+    Builds the payloads for one shortcode.
+
+    For a paybill, `party_b` is the shortcode itself. For a till (Buy Goods), the
+    shortcode is the store number and `party_b` the till number. Instances hold no
+    per-request state and are safe to share between threads.
+    """
+
+    def __init__(self, shortcode, passkey, callback_url, transaction_type=PAYBILL, party_b=None,
+                 description=DEFAULT_DESCRIPTION):
+        self.shortcode = shortcode
+        self.passkey = passkey
+        self.callback_url = callback_url
+        self.secret = (shortcode + passkey).encode()
+        self.template = {
+            "BusinessShortCode": shortcode,
+            "TransactionType": transaction_type,
+            "PartyB": party_b or shortcode,
+            "CallBackURL": callback_url,
+            "TransactionDesc": description,
+        }
+        # (epoch second, timestamp, password), replaced as a whole so readers never see a torn value
+        self.current = (None, None, None)
+
+    def password(self):
+        """
+        Returns the (password, timestamp) pair for the current second.
+
+        The password is base64(Shortcode + Passkey + Timestamp). Two threads crossing
+        into a new second may both compute it; they get the same value.
+        """
+        second = int(time.time())
+        cached_second, timestamp, password = self.current
+        if cached_second != second:
+            timestamp = time.strftime("%Y%m%d%H%M%S", time.localtime(second))
+            password = base64.b64encode(self.secret + timestamp.encode()).decode()
+            self.current = (second, timestamp, password)
+        return password, timestamp
+
+    def stk_push(self, phone, amount, account_reference=None):
+        """
+        Returns the processrequest payload for a single STK Push.
+        """
+        password, timestamp = self.password()
+        return {
+            **self.template,
+            "Password": password,
+            "Timestamp": timestamp,
+            "Amount": int(amount),
+            "PartyA": phone,
+            "PhoneNumber": phone,
+            "AccountReference": account_reference or DEFAULT_ACCOUNT_REFERENCE,
+        }
+
+    def stk_query(self, checkout_request_id):
+        """
+        Returns the stkpushquery payload for a previously sent STK Push.
+        """
+        password, timestamp = self.password()
+        return {
+            "BusinessShortCode": self.shortcode,
+            "Password": password,
+            "Timestamp": timestamp,
+            "CheckoutRequestID": checkout_request_id,
+        }
+
+
+# The deployment's own shortcode, from MPESA_SHORT_CODE and MPESA_PASSKEY
+default_builder = StkPayloadBuilder(
+    config("MPESA_SHORT_CODE"),
+    config("MPESA_PASSKEY"),
+    config("MPESA_CALLBACK_URL"),
+    transaction_type=config("MPESA_TRANSACTION_TYPE", default=PAYBILL),
+    party_b=config("MPESA_PARTY_B", default=None),
+)
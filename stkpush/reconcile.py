@@ -0,0 +1,172 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import requests
+from decouple import config
+from django.db import transaction as db_transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import rollups, webhooks
+from .bulk import RateLimiter
+from .models import ResultDescription, Transaction
+from .notify import notifier
+from .status_cache import status_cache
+from .stk import StkPushError, query_stk_push
+from .tenants import registry
+
+logger = logging.getLogger(__name__)
+
+# Pending transactions older than this many seconds are queried; by then the
+# customer has answered the prompt or it has timed out
+STALE_AFTER = config("MPESA_RECONCILE_STALE_AFTER", default=600, cast=int)
+
+# ResultCode the query reports while the push is still being processed
+PROCESSING_RESULT_CODES = {4999}
+
+NO_RESPONSE = "No response from M-Pesa; the payment request may not have reached the customer"
+
+
+def stale_batches(older_than=STALE_AFTER, batch_size=500, limit=None):
+    """
+    Yields lists of (id, transaction_date, checkout_request_id, tenant_id) for stale pending transactions.
+
+    Rows are read oldest first in keyset-paginated batches on (transaction_date, id),
+    which the partial pending index serves directly, so each batch is one index range
+    scan and memory is bounded by `batch_size` however large the backlog is. Rows
+    updated between batches cannot shift the pages.
+    """
+    cutoff = timezone.now() - timedelta(seconds=older_than)
+    pending = Transaction.objects.filter(
+        status=Transaction.Status.PENDING, transaction_date__lt=cutoff, checkout_request_id__isnull=False,
+    ).order_by("transaction_date", "id")
+
+    last, seen = None, 0
+    while limit is None or seen < limit:
+        page = pending
+        if last is not None:
+            last_id, last_date = last[:2]
+            page = page.filter(Q(transaction_date__gt=last_date) | Q(transaction_date=last_date, id__gt=last_id))
+        size = batch_size if limit is None else min(batch_size, limit - seen)
+        rows = list(page.values_list("id", "transaction_date", "checkout_request_id", "tenant_id")[:size])
+        if not rows:
+            return
+        yield rows
+        seen += len(rows)
+        last = rows[-1]
+
+
+def query(checkout_request_id, tenant_id=None):
+    """
+    Queries the outcome of one transaction, with the credentials of tenant `tenant_id`.
+
+    Returns:
+        tuple: ("success" or "failed", dict of Transaction fields to update), or
+        ("processing" or "error", None) when the transaction should stay pending.
+    """
+    try:
+        data = query_stk_push(checkout_request_id, registry.get(tenant_id))
+    except (StkPushError, requests.RequestException, ValueError) as e:
+        logger.warning("STK query for %s failed: %s", checkout_request_id, e)
+        return "error", None
+    if data is None:
+        return "processing", None
+
+    try:
+        result_code = int(data.get("ResultCode"))
+    except (TypeError, ValueError):
+        logger.warning("STK query for %s returned no ResultCode", checkout_request_id)
+        return "error", None
+    if result_code in PROCESSING_RESULT_CODES:
+        return "processing", None
+
+    status = Transaction.Status.SUCCESS if result_code == 0 else Transaction.Status.FAILED
+    return status.label.lower(), {
+        "status": status,
+        "result_code": result_code,
+        "result_description_id": ResultDescription.id_for(data.get("ResultDesc")),
+    }
+
+
+def apply_results(results):
+    """
+    Writes query outcomes, in one database transaction.
+
+    Only rows that are still "Pending" are changed, so a callback that arrived while
+    the query was in flight wins. Each row gets its own conditional UPDATE so the
+    rows this run resolved are known exactly and counted once in the rollups.
+
+    Returns:
+        int: Number of transactions updated.
+    """
+    with db_transaction.atomic():
+        resolved = [
+            pk for pk, fields in results
+            if Transaction.objects.filter(pk=pk, status=Transaction.Status.PENDING).update(**fields)
+        ]
+        if resolved:
+            transactions = list(Transaction.objects.filter(pk__in=resolved).select_related("result_description"))
+            rollups.resolved(transactions)
+            webhooks.publish(transactions)
+
+    if resolved:
+        for transaction in transactions:
+            status_cache.store(transaction)
+            notifier.publish(transaction.get_status_display(), transaction.checkout_request_id, transaction.reference)
+    return len(resolved)
+
+
+def settle_unanswered(older_than=STALE_AFTER):
+    """
+    Fails pushes sent more than `older_than` seconds ago whose response was lost and
+    that no callback was matched to (see `jobs.settle_abandoned`). Without a
+    CheckoutRequestID they cannot be queried.
+
+    Returns:
+        int: Number of transactions failed.
+    """
+    cutoff = timezone.now() - timedelta(seconds=older_than)
+    unanswered = Transaction.objects.filter(
+        status=Transaction.Status.PENDING, checkout_request_id__isnull=True, locked_at__lt=cutoff,
+    ).values_list("pk", flat=True)
+    fields = {"status": Transaction.Status.FAILED, "result_description_id": ResultDescription.id_for(NO_RESPONSE)}
+    return apply_results([(pk, fields) for pk in unanswered[:1000]])
+
+
+def reconcile(older_than=STALE_AFTER, batch_size=500, concurrency=10, rate=10, limit=None, on_batch=None):
+    """
+    Queries every stale pending transaction and applies the outcomes.
+
+    At most `concurrency` queries are in flight and at most `rate` are started per
+    second, all sharing the cached access token. Each batch's outcomes are written
+    before the next batch is read. `on_batch` receives the running counts after
+    every batch.
+
+    Pushes whose outcome is unknown and cannot be queried are failed first, as "unanswered".
+
+    Returns:
+        dict: Number of transactions per outcome ("success", "failed", "processing", "error", "unanswered").
+    """
+    limiter = RateLimiter(rate)
+    counts = {}
+    unanswered = settle_unanswered(older_than)
+    if unanswered:
+        counts["unanswered"] = unanswered
+
+    def check(row):
+        pk, _, checkout_request_id, tenant_id = row
+        limiter.acquire()
+        return (pk, *query(checkout_request_id, tenant_id))
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for rows in stale_batches(older_than, batch_size, limit):
+            results = []
+            for pk, outcome, fields in pool.map(check, rows):
+                counts[outcome] = counts.get(outcome, 0) + 1
+                if fields is not None:
+                    results.append((pk, fields))
+            apply_results(results)
+            if on_batch:
+                on_batch(dict(counts))
+    return counts
@@ -0,0 +1,253 @@
+"""
+Hourly and daily transaction totals, maintained as transactions change.
+
+Every event is counted in the bucket of the transaction's `transaction_date` (the
+moment the payment was started), so a bucket's numbers are exactly what a GROUP
+BY over the transactions started in it would give; `rebuild` does that GROUP BY
+to recreate them. Counting happens in the same database transaction as the
+status change it follows, with one UPDATE ... SET n = n + 1 per bucket row.
+"""
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction as db_transaction
+from django.db.models import Count, F, Q, Sum, Value
+from django.db.models.functions import Coalesce, Trunc, TruncDate
+from django.utils import timezone
+
+from .models import ArchiveBatch, PhoneRollup, RollupPeriod, Transaction, TransactionRollup
+
+# Counter columns of TransactionRollup
+COUNTERS = ("pushes", "succeeded", "failed", "amount")
+CENTS = Decimal("0.01")
+
+
+def bucket_start(moment, period):
+    """
+    Returns the start of the hour or day containing `moment`, in the current time zone.
+    """
+    local = timezone.localtime(moment)
+    if period == RollupPeriod.HOUR:
+        return local.replace(minute=0, second=0, microsecond=0)
+    return local.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def increment(model, keys, deltas):
+    """
+    Adds `deltas` to the counters of the row identified by `keys`, creating it if needed.
+    """
+    changes = {name: F(name) + value for name, value in deltas.items()}
+    if model.objects.filter(**keys).update(**changes):
+        return
+    try:
+        with db_transaction.atomic():
+            model.objects.create(**keys, **deltas)
+    except IntegrityError:
+        # Another request created the row first
+        model.objects.filter(**keys).update(**changes)
+
+
+def record(deltas, phones=None):
+    with db_transaction.atomic(savepoint=False):
+        for (period, start, tenant), counters in deltas.items():
+            increment(TransactionRollup, {"period": period, "start": start, "tenant": tenant}, counters)
+        for (day, phone_number), counters in (phones or {}).items():
+            increment(PhoneRollup, {"day": day, "phone_number": phone_number}, counters)
+
+
+def pushed(transactions):
+    """
+    Counts STK Pushes accepted by Safaricom.
+    """
+    deltas = defaultdict(lambda: defaultdict(int))
+    for transaction in transactions:
+        for period in RollupPeriod.values:
+            deltas[period, bucket_start(transaction.transaction_date, period), transaction.tenant_id or ""]["pushes"] += 1
+    record(deltas)
+
+
+def resolved(transactions):
+    """
+    Counts transactions that just became successful or failed.
+
+    Pass each transaction once, with its final field values (a success callback
+    may correct the amount and phone number).
+    """
+    deltas = defaultdict(lambda: defaultdict(int))
+    phones = defaultdict(lambda: defaultdict(int))
+    for transaction in transactions:
+        success = transaction.status == Transaction.Status.SUCCESS
+        for period in RollupPeriod.values:
+            counters = deltas[period, bucket_start(transaction.transaction_date, period), transaction.tenant_id or ""]
+            counters["succeeded" if success else "failed"] += 1
+            if success:
+                counters["amount"] += Decimal(str(transaction.amount))
+        if success:
+            counters = phones[timezone.localdate(transaction.transaction_date), transaction.phone_number]
+            counters["payments"] += 1
+            counters["amount"] += Decimal(str(transaction.amount))
+    record(deltas, phones)
+
+
+def day_range(since=None, until=None):
+    """
+    Widens [since, until) to whole days, the smallest range both periods can be rebuilt for.
+    """
+    if since is not None:
+        since = bucket_start(since, RollupPeriod.DAY)
+    if until is not None:
+        start = bucket_start(until, RollupPeriod.DAY)
+        until = start if start == timezone.localtime(until) else start + timedelta(days=1)
+    return since, until
+
+
+def newest_archived_day(since=None, until=None):
+    """
+    Returns the last day in [since, until), widened to whole days, with archived transactions, or None.
+    """
+    since, until = day_range(since, until)
+    batches = ArchiveBatch.objects.all()
+    if since is not None:
+        batches = batches.filter(day__gte=timezone.localdate(since))
+    if until is not None:
+        batches = batches.filter(day__lt=timezone.localdate(until))
+    return batches.order_by("-day").values_list("day", flat=True).first()
+
+
+def rebuild(since=None, until=None, chunk_size=5000):
+    """
+    Recomputes the rollups of the transactions started in [since, until), widened to
+    whole days, or of every transaction.
+
+    Runs in one database transaction, so readers see either the old or the new
+    totals. Concurrent status changes in the range wait for it on SQLite and may
+    be lost on other databases; rebuild quiet ranges, or run it again.
+
+    Returns:
+        int: Number of rollup rows written.
+
+    Raises:
+        ValueError: If the range holds archived transactions, whose totals exist
+            only in the rollups and would be lost.
+    """
+    newest = newest_archived_day(since, until)
+    if newest is not None:
+        raise ValueError(
+            f"Transactions up to {newest} in this range are archived and would be lost from the rollups. "
+            f"Rebuild from {newest + timedelta(days=1)} or restore them first."
+        )
+    since, until = day_range(since, until)
+    transactions = Transaction.objects.all()
+    buckets = TransactionRollup.objects.all()
+    phone_days = PhoneRollup.objects.all()
+    if since is not None:
+        transactions = transactions.filter(transaction_date__gte=since)
+        buckets = buckets.filter(start__gte=since)
+        phone_days = phone_days.filter(day__gte=timezone.localdate(since))
+    if until is not None:
+        transactions = transactions.filter(transaction_date__lt=until)
+        buckets = buckets.filter(start__lt=until)
+        phone_days = phone_days.filter(day__lt=timezone.localdate(until))
+
+    success = Q(status=Transaction.Status.SUCCESS)
+    written = 0
+    with db_transaction.atomic():
+        buckets.delete()
+        phone_days.delete()
+        for period in RollupPeriod.values:
+            rows = (
+                transactions.order_by()
+                .values(bucket=Trunc("transaction_date", period), slug=Coalesce("tenant_id", Value("")))
+                .annotate(
+                    pushes=Count("id", filter=Q(checkout_request_id__isnull=False)),
+                    succeeded=Count("id", filter=success),
+                    failed=Count("id", filter=Q(status=Transaction.Status.FAILED)),
+                    paid=Sum("amount", filter=success, default=0),
+                )
+            )
+            written += bulk_write(TransactionRollup, (
+                TransactionRollup(period=period, start=row["bucket"], tenant=row["slug"], pushes=row["pushes"],
+                                  succeeded=row["succeeded"], failed=row["failed"], amount=row["paid"])
+                for row in rows.iterator(chunk_size=chunk_size)
+                if row["pushes"] or row["succeeded"] or row["failed"]
+            ), chunk_size)
+
+        rows = (
+            transactions.filter(success).order_by()
+            .values("phone_number", day=TruncDate("transaction_date"))
+            .annotate(payments=Count("id"), paid=Sum("amount"))
+        )
+        written += bulk_write(PhoneRollup, (
+            PhoneRollup(day=row["day"], phone_number=row["phone_number"], payments=row["payments"], amount=row["paid"])
+            for row in rows.iterator(chunk_size=chunk_size)
+        ), chunk_size)
+    return written
+
+
+def bulk_write(model, objects, chunk_size):
+    written, chunk = 0, []
+    for obj in objects:
+        chunk.append(obj)
+        if len(chunk) >= chunk_size:
+            model.objects.bulk_create(chunk)
+            written, chunk = written + len(chunk), []
+    if chunk:
+        model.objects.bulk_create(chunk)
+        written += len(chunk)
+    return written
+
+
+def summary(period=RollupPeriod.HOUR, since=None, until=None, tenant=None):
+    """
+    Reads the buckets of `period` starting in [since, until), oldest first, and their totals.
+
+    Tenants are summed together unless `tenant` is given ("" for the default shortcode).
+
+    Returns:
+        tuple: (list of bucket dicts, totals dict)
+    """
+    buckets = TransactionRollup.objects.filter(period=period)
+    if since is not None:
+        buckets = buckets.filter(start__gte=since)
+    if until is not None:
+        buckets = buckets.filter(start__lt=until)
+    if tenant is not None:
+        buckets = buckets.filter(tenant=tenant)
+
+    sums = {name: Sum(name) for name in COUNTERS}
+    rows = [with_rate(row) for row in buckets.order_by("start").values("start").annotate(**sums)]
+    totals = with_rate({name: sum(row[name] for row in rows) for name in COUNTERS})
+    return rows, totals
+
+
+def with_rate(row):
+    resolved_count = row["succeeded"] + row["failed"]
+    row["success_rate"] = round(row["succeeded"] / resolved_count, 4) if resolved_count else None
+    # SQLite sums decimals without their scale
+    row["amount"] = Decimal(row["amount"]).quantize(CENTS)
+    return row
+
+
+def top_phones(since=None, until=None, limit=10):
+    """
+    Returns the phone numbers that paid the most on the days overlapping [since, until).
+
+    Returns:
+        list[dict]: phone_number, payments and amount, largest amount first.
+    """
+    since, until = day_range(since, until)
+    days = PhoneRollup.objects.all()
+    if since is not None:
+        days = days.filter(day__gte=timezone.localdate(since))
+    if until is not None:
+        days = days.filter(day__lt=timezone.localdate(until))
+    phones = list(
+        days.values("phone_number")
+        .annotate(payments=Sum("payments"), amount=Sum("amount"))
+        .order_by("-amount", "phone_number")[:limit]
+    )
+    for phone in phones:
+        phone["amount"] = Decimal(phone["amount"]).quantize(CENTS)
+    return phones
+
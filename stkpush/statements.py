@@ -0,0 +1,341 @@
+import csv
+import heapq
+import json
+import re
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from operator import itemgetter
+
+from django.utils import timezone
+
+from . import archive
+from .models import Transaction
+
+# Exported columns, in order, and the values() lookup each is read from
+EXPORT_COLUMNS = {
+    "reference": "reference",
+    "checkout_request_id": "checkout_request_id",
+    "receipt_number": "mpesa_receipt_number",
+    "phone_number": "phone_number",
+    "amount": "amount",
+    "status": "status",
+    "result_code": "result_code",
+    "result_desc": "result_description__text",
+    "transaction_date": "transaction_date",
+    "mpesa_transaction_date": "mpesa_transaction_date",
+    "account_reference": "account_reference",
+    "batch": "batch",
+}
+
+# Accepted headers for each statement column: the M-Pesa org portal export, or plain names
+STATEMENT_COLUMNS = {
+    "receipt": ("Receipt No.", "Receipt No", "receipt", "receipt_number"),
+    "amount": ("Paid In", "amount"),
+    "phone": ("Other Party Info", "phone", "phone_number"),
+}
+
+
+def parse_time(value):
+    """
+    Parses an ISO date or date/time given on the command line or in a query string.
+
+    Raises:
+        ValueError: If the value is not an ISO date/time.
+    """
+    parsed = datetime.fromisoformat(value)
+    return timezone.make_aware(parsed) if timezone.is_naive(parsed) else parsed
+
+
+def parse_status(label):
+    """
+    Returns the Transaction.Status value for a label such as "Success" (any case).
+
+    Raises:
+        ValueError: If there is no such status.
+    """
+    for value, name in Transaction.Status.choices:
+        if name.lower() == label.lower():
+            return value
+    raise ValueError(f"Unknown status: {label}")
+
+
+def export_rows(since=None, until=None, status=None, chunk_size=2000):
+    """
+    Yields one dict per transaction, archived ones included, in `transaction_date` order.
+
+    Rows are fetched with `iterator(chunk_size)`, a server-side cursor where the
+    database supports one, and archived transactions in the range are merged in
+    from their files a day at a time, so memory stays bounded however many rows
+    match.
+
+    Raises:
+        ArchiveError: If an archive file in the range cannot be read.
+    """
+    transactions = Transaction.objects.order_by("transaction_date", "id")
+    if since:
+        transactions = transactions.filter(transaction_date__gte=since)
+    if until:
+        transactions = transactions.filter(transaction_date__lt=until)
+    if status:
+        transactions = transactions.filter(status=status)
+    archived = (
+        (transaction.pk, *export_values(transaction))
+        for transaction in archive.archived_transactions(since, until)
+        if not status or transaction.status == status
+    )
+
+    columns = list(EXPORT_COLUMNS)
+    labels = dict(Transaction.Status.choices)
+    # Each row leads with the primary key, the tie-break of the ordering
+    order = itemgetter(1 + columns.index("transaction_date"), 0)
+    live = transactions.values_list("id", *EXPORT_COLUMNS.values()).iterator(chunk_size=chunk_size)
+    for _pk, *values in heapq.merge(live, archived, key=order):
+        row = dict(zip(columns, values))
+        row["status"] = labels.get(row["status"], row["status"])
+        yield row
+
+
+def export_values(transaction):
+    """
+    Reads the EXPORT_COLUMNS lookups from a Transaction instance, as values_list() would.
+    """
+    values = []
+    for lookup in EXPORT_COLUMNS.values():
+        value = transaction
+        for name in lookup.split("__"):
+            value = None if value is None else getattr(value, name)
+        values.append(value)
+    return values
+
+
+class Echo:
+    """
+    File-like object whose write() returns the line, for streaming csv.writer output.
+    """
+
+    def write(self, value):
+        return value
+
+
+def format_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def render_csv(rows):
+    """
+    Yields the CSV header and one line per row.
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow(EXPORT_COLUMNS)
+    for row in rows:
+        yield writer.writerow([format_value(value) for value in row.values()])
+
+
+def render_jsonl(rows):
+    """
+    Yields one JSON object per line.
+    """
+    for row in rows:
+        yield json.dumps({key: format_value(value) if value is not None else None for key, value in row.items()}) + "\n"
+
+
+RENDERERS = {"csv": render_csv, "jsonl": render_jsonl}
+
+
+def normalise_phone(value):
+    """
+    Extracts the phone number from a statement's "Other Party Info" (e.g. "254712345678 - JOHN DOE").
+
+    Masked numbers (e.g. "2547******678") are returned as they are.
+    """
+    match = re.match(r"\s*([\d*]{9,12})", value or "")
+    if not match:
+        return None
+    phone = match.group(1)
+    if not phone.startswith("254") and len(phone) >= 9:
+        phone = "254" + phone[-9:]
+    return phone
+
+
+def phones_match(statement_phone, phone):
+    if not statement_phone or not phone:
+        return True
+    if len(statement_phone) != len(phone):
+        return False
+    return all(a == "*" or a == b for a, b in zip(statement_phone, phone))
+
+
+def read_statement(stream):
+    """
+    Yields (line_number, entry) for each row of an M-Pesa statement CSV.
+
+    `entry` is a dict with receipt, amount (Decimal) and phone, or
+    None if the row cannot be read. Rows that are not payments received (no
+    "Paid In" amount) are skipped.
+    """
+    reader = csv.DictReader(stream)
+    headers = {}
+    for column, candidates in STATEMENT_COLUMNS.items():
+        headers[column] = next((name for name in candidates if name in (reader.fieldnames or ())), None)
+
+    for row in reader:
+        receipt = (row.get(headers["receipt"]) or "").strip() if headers["receipt"] else ""
+        raw_amount = (row.get(headers["amount"]) or "").replace(",", "").strip() if headers["amount"] else ""
+        if not raw_amount:
+            continue
+        try:
+            amount = Decimal(raw_amount)
+        except InvalidOperation:
+            yield reader.line_num, None
+            continue
+        if not receipt:
+            yield reader.line_num, None
+            continue
+        yield reader.line_num, {
+            "receipt": receipt,
+            "amount": amount,
+            "phone": normalise_phone(row.get(headers["phone"]) if headers["phone"] else None),
+        }
+
+
+def match_statement(entries, since=None, until=None, chunk_size=5000):
+    """
+    Matches statement entries against transactions and yields every discrepancy.
+
+    The statement is read `chunk_size` rows at a time; each chunk is looked up
+    with one query on the unique receipt index and compared through an in-memory
+    hash index of that chunk. Entries whose receipt is unknown are matched on
+    (phone, amount) against successful transactions that have no receipt yet,
+    e.g. those resolved by the reconciler. Finally, successful transactions in
+    [since, until) that the statement does not contain are reported. Archived
+    transactions are looked up in their batches and take part like the others. A
+    receipt listed again later in the statement is reported as a duplicate and
+    matched only once. Memory is bounded by the chunk size plus the receipts read.
+
+    Yields:
+        dict: kind ("invalid", "duplicate", "not_found", "amount_mismatch",
+        "phone_mismatch", "missing_receipt", "missing_from_statement"), line,
+        receipt, phone, amount, reference and detail.
+
+    Raises:
+        ArchiveError: If an archive file the statement needs cannot be read.
+    """
+    # First statement line of every receipt read
+    seen = {}
+    receiptless = ReceiptlessIndex(since, until)
+
+    chunk = []
+    for line_number, entry in entries:
+        if entry is None:
+            yield mismatch("invalid", line_number, detail="Unreadable row")
+            continue
+        chunk.append((line_number, entry))
+        if len(chunk) >= chunk_size:
+            yield from match_chunk(chunk, seen, receiptless)
+            chunk = []
+    if chunk:
+        yield from match_chunk(chunk, seen, receiptless)
+
+    for transaction in archive.archived_transactions(since, until):
+        receipt = transaction.mpesa_receipt_number
+        if transaction.status == Transaction.Status.SUCCESS and receipt and receipt not in seen:
+            yield mismatch("missing_from_statement", None, receipt, transaction.phone_number, transaction.amount,
+                           transaction.reference)
+
+    successes = Transaction.objects.filter(
+        status=Transaction.Status.SUCCESS, mpesa_receipt_number__isnull=False,
+    ).order_by("transaction_date", "id")
+    if since:
+        successes = successes.filter(transaction_date__gte=since)
+    if until:
+        successes = successes.filter(transaction_date__lt=until)
+    for reference, receipt, phone, amount in successes.values_list(
+        "reference", "mpesa_receipt_number", "phone_number", "amount",
+    ).iterator(chunk_size=chunk_size):
+        if receipt not in seen:
+            yield mismatch("missing_from_statement", None, receipt, phone, amount, reference)
+
+
+def match_chunk(chunk, seen, receiptless):
+    by_receipt = {}
+    for line_number, entry in chunk:
+        first = seen.setdefault(entry["receipt"], line_number)
+        if first != line_number:
+            yield mismatch("duplicate", line_number, entry["receipt"], entry["phone"], entry["amount"],
+                           detail=f"Receipt already on line {first}")
+            continue
+        by_receipt[entry["receipt"]] = (line_number, entry)
+    found = {
+        receipt: (reference, phone, amount)
+        for receipt, reference, phone, amount in Transaction.objects.filter(
+            mpesa_receipt_number__in=by_receipt,
+        ).values_list("mpesa_receipt_number", "reference", "phone_number", "amount")
+    }
+    unknown = [receipt for receipt in by_receipt if receipt not in found]
+    if unknown:
+        for receipt, row in archive.locate_many("mpesa_receipt_number", unknown).items():
+            transaction = archive.to_transaction(row)
+            found[receipt] = (transaction.reference, transaction.phone_number, transaction.amount)
+
+    for receipt, (line_number, entry) in by_receipt.items():
+        if receipt not in found:
+            reference = receiptless.take(entry["phone"], entry["amount"])
+            if reference:
+                yield mismatch("missing_receipt", line_number, receipt, entry["phone"], entry["amount"], reference,
+                               "Matched on phone and amount; the transaction has no receipt number")
+            else:
+                yield mismatch("not_found", line_number, receipt, entry["phone"], entry["amount"])
+            continue
+
+        reference, phone, amount = found[receipt]
+        if amount != entry["amount"]:
+            yield mismatch("amount_mismatch", line_number, receipt, entry["phone"], entry["amount"], reference,
+                           f"Transaction amount is {amount}")
+        elif not phones_match(entry["phone"], phone):
+            yield mismatch("phone_mismatch", line_number, receipt, entry["phone"], entry["amount"], reference,
+                           f"Transaction phone is {phone}")
+
+
+class ReceiptlessIndex:
+    """
+    Hash index of successful transactions without a receipt number, by (phone, amount).
+
+    Loaded on first use; each transaction can be taken once.
+    """
+
+    def __init__(self, since=None, until=None):
+        self.since = since
+        self.until = until
+        self.index = None
+
+    def load(self):
+        transactions = Transaction.objects.filter(
+            status=Transaction.Status.SUCCESS, mpesa_receipt_number__isnull=True,
+        ).order_by("transaction_date", "id")
+        if self.since:
+            transactions = transactions.filter(transaction_date__gte=self.since)
+        if self.until:
+            transactions = transactions.filter(transaction_date__lt=self.until)
+        self.index = {}
+        for transaction in archive.archived_transactions(self.since, self.until):
+            if transaction.status == Transaction.Status.SUCCESS and transaction.mpesa_receipt_number is None:
+                self.index.setdefault((transaction.phone_number, transaction.amount), []).append(transaction.reference)
+        for reference, phone, amount in transactions.values_list("reference", "phone_number", "amount").iterator():
+            self.index.setdefault((phone, amount), []).append(reference)
+
+    def take(self, phone, amount):
+        if self.index is None:
+            self.load()
+        references = self.index.get((phone, amount))
+        return references.pop(0) if references else None
+
+
+def mismatch(kind, line, receipt=None, phone=None, amount=None, reference=None, detail=""):
+    return {
+        "kind": kind, "line": line, "receipt": receipt, "phone": phone,
+        "amount": amount, "reference": reference, "detail": detail,
+    }
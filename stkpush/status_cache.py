@@ -0,0 +1,81 @@
+import hashlib
+import json
+
+from decouple import config
+from django.core.cache import caches
+
+from . import metrics
+from .models import Transaction
+from .stk import status_payload
+
+
+class StatusCache:
+    """
+    Write-through cache of the `check_status` response for each transaction.
+
+    Entries are written whenever a transaction is created or changes status, keyed by
+    both its `checkout_request_id` and its local `reference`, so `check_status` only
+    reads the database on a miss. Open transactions are kept for `pending_ttl`
+    seconds; once a transaction is final its entry expires after `terminal_ttl`.
+    Each entry carries an ETag so unchanged responses can be answered with a 304.
+    """
+    alias = config("MPESA_STATUS_CACHE", default="default")
+    pending_ttl = config("MPESA_STATUS_CACHE_PENDING_TTL", default=3600, cast=int)
+    terminal_ttl = config("MPESA_STATUS_CACHE_TERMINAL_TTL", default=300, cast=int)
+
+    @staticmethod
+    def cache_key(key):
+        return f"mpesa:txn:{key}"
+
+    @staticmethod
+    def entry(transaction):
+        payload = status_payload(transaction)
+        body = json.dumps(payload, sort_keys=True, default=str).encode()
+        return {"payload": payload, "etag": f'"{hashlib.md5(body).hexdigest()}"'}
+
+    def ttl(self, transaction):
+        return self.terminal_ttl if transaction.status in Transaction.TERMINAL_STATUSES else self.pending_ttl
+
+    def keys(self, transaction):
+        return [self.cache_key(key) for key in (transaction.checkout_request_id, transaction.reference) if key]
+
+    def store(self, transaction):
+        """
+        Writes the transaction's current status through to the cache and returns the entry.
+        """
+        entry = self.entry(transaction)
+        caches[self.alias].set_many(dict.fromkeys(self.keys(transaction), entry), self.ttl(transaction))
+        return entry
+
+    async def astore(self, transaction):
+        entry = self.entry(transaction)
+        await caches[self.alias].aset_many(dict.fromkeys(self.keys(transaction), entry), self.ttl(transaction))
+        return entry
+
+    def count(self, hit):
+        metrics.STATUS_CACHE_LOOKUPS.inc(result="hit" if hit else "miss")
+
+    def get(self, key):
+        """
+        Returns the cached entry for a checkout_request_id or reference, or None.
+        """
+        entry = caches[self.alias].get(self.cache_key(key))
+        self.count(entry is not None)
+        return entry
+
+    async def aget(self, key):
+        entry = await caches[self.alias].aget(self.cache_key(key))
+        self.count(entry is not None)
+        return entry
+
+    def stats(self):
+        """
+        Hit and miss counts of this process since it started.
+        """
+        return {
+            "hits": metrics.STATUS_CACHE_LOOKUPS.value(result="hit"),
+            "misses": metrics.STATUS_CACHE_LOOKUPS.value(result="miss"),
+        }
+
+
+status_cache = StatusCache()
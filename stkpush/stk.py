@@ -0,0 +1,236 @@
+import logging
+import math
+import re
+
+import requests
+from asgiref.sync import sync_to_async
+from decouple import config
+from django.db import transaction as db_transaction
+
+from . import metrics, rollups, webhooks
+from .daraja import AsyncDarajaClient, DarajaClient
+from .models import Transaction
+from .payloads import default_builder
+from .tenants import registry
+
+logger = logging.getLogger(__name__)
+
+# errorCode returned (with HTTP 500) by the STK query while the customer has not answered yet
+STK_QUERY_PROCESSING = "500.001.1001"
+
+
+# Validators compiled once at import rather than on every request
+PHONE_PATTERN = re.compile(r'^\d{10,12}$')
+
+# Amounts Daraja accepts for an STK Push: whole shillings, per transaction
+MIN_AMOUNT = 1
+MAX_AMOUNT = config("MPESA_MAX_AMOUNT", default=250000, cast=int)
+
+
+class StkPushError(Exception):
+    """
+    Raised when Safaricom rejected an STK Push or query.
+    """
+
+
+class TokenUnavailable(requests.ConnectionError):
+    """
+    Raised when no access token could be obtained (the OAuth call failed or timed out).
+
+    A transport error rather than a rejection, so queued pushes are retried.
+    """
+
+
+def clean_phone(phone):
+    """
+    Validates a phone number and normalises it to start with 254.
+
+    Raises:
+        ValueError: With a user-facing message if the number is invalid.
+    """
+    if not phone or not PHONE_PATTERN.match(phone):
+        raise ValueError("Invalid phone number. Must be 10-12 digits (e.g., 254712345678).")
+    if not phone.startswith('254'):
+        phone = '254' + phone[-9:]
+    return phone
+
+
+def clean_reference(reference):
+    """
+    Validates an optional account reference.
+
+    Returns:
+        str: The stripped reference, or None if blank.
+
+    Raises:
+        ValueError: With a user-facing message if the reference is too long.
+    """
+    reference = str(reference or "").strip()
+    if len(reference) > 20:
+        raise ValueError("Reference must be at most 20 characters.")
+    return reference or None
+
+
+def clean_payment(phone, amount):
+    """
+    Validates and normalises the phone number and amount of a payment request.
+
+    Runs before any side effect (idempotency claim, phone cooldown, saved row),
+    so an amount Daraja or the amount column would refuse is a 400, not a push
+    that fails half way.
+
+    Returns:
+        tuple: (phone starting with 254, amount as float)
+
+    Raises:
+        ValueError: With a user-facing message if either value is invalid.
+    """
+    phone = clean_phone(phone)
+
+    # Validate amount; float() also takes "nan", "inf" and 1e12
+    try:
+        amount = float(amount)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid amount. Must be a positive number.")
+    if not math.isfinite(amount) or amount <= 0:
+        raise ValueError("Invalid amount. Must be a positive number.")
+    if not amount.is_integer() or not MIN_AMOUNT <= amount <= MAX_AMOUNT:
+        raise ValueError(f"Invalid amount. Must be a whole number of shillings from {MIN_AMOUNT} to {MAX_AMOUNT}.")
+    return phone, amount
+
+
+def build_payload(phone, amount, account_reference=None, builder=default_builder):
+    """
+    Constructs the processrequest payload for a single STK Push.
+    """
+    return builder.stk_push(phone, amount, account_reference)
+
+
+def build_query_payload(checkout_request_id, builder=default_builder):
+    """
+    Constructs the stkpushquery payload for a previously sent STK Push.
+    """
+    return builder.stk_query(checkout_request_id)
+
+
+def send_stk_push(payload, tenant=None):
+    """
+    Sends an STK Push and returns Safaricom's decoded response.
+
+    `tenant` is the `TenantContext` whose credentials and rate limit are used
+    (default: the shortcode configured in the environment).
+
+    Raises:
+        StkPushError: If the push was not accepted.
+        DarajaUnavailable: If the call, or the OAuth call for its token, was shed or throttled.
+        TokenUnavailable: If no access token could be obtained.
+        requests.RequestException: On transport or HTTP errors.
+        ValueError: If the response is not valid JSON.
+    """
+    tenant = tenant or registry.default
+    access_token = tenant.token.get_access_token()
+    if not access_token:
+        raise TokenUnavailable("Failed to obtain access token")
+
+    response = DarajaClient.stk_push(payload, access_token, bucket=tenant.buckets["stkpush"])
+    response.raise_for_status()
+    res_data = response.json()
+    metrics.STK_PUSH_RESULTS.inc(response_code=res_data.get("ResponseCode"))
+
+    if res_data.get("ResponseCode") != "0":
+        err_msg = res_data.get('errorMessage') or res_data.get('message') or "Unknown error"
+        raise StkPushError(err_msg)
+    return res_data
+
+
+async def asend_stk_push(payload, tenant=None):
+    """
+    Async version of `send_stk_push`, raising `httpx.HTTPError` on transport errors,
+    `DarajaUnavailable` when the call is shed or throttled and `TokenUnavailable`
+    when no access token could be obtained.
+    """
+    tenant = tenant or registry.default
+    access_token = await tenant.token.aget_access_token()
+    if not access_token:
+        raise TokenUnavailable("Failed to obtain access token")
+
+    response = await AsyncDarajaClient.stk_push(payload, access_token, bucket=tenant.buckets["stkpush"])
+    response.raise_for_status()
+    res_data = response.json()
+    metrics.STK_PUSH_RESULTS.inc(response_code=res_data.get("ResponseCode"))
+
+    if res_data.get("ResponseCode") != "0":
+        err_msg = res_data.get('errorMessage') or res_data.get('message') or "Unknown error"
+        raise StkPushError(err_msg)
+    return res_data
+
+
+def query_stk_push(checkout_request_id, tenant=None):
+    """
+    Asks Safaricom for the outcome of an STK Push sent for `tenant` (a `TenantContext`).
+
+    Returns:
+        dict: The decoded query response, or None while the transaction is still being processed.
+
+    Raises:
+        StkPushError: If the query was not accepted.
+        TokenUnavailable: If no access token could be obtained.
+        requests.RequestException: On transport or HTTP errors.
+        ValueError: If the response is not valid JSON.
+    """
+    tenant = tenant or registry.default
+    access_token = tenant.token.get_access_token()
+    if not access_token:
+        raise TokenUnavailable("Failed to obtain access token")
+
+    response = DarajaClient.stk_query(
+        build_query_payload(checkout_request_id, tenant.builder), access_token, bucket=tenant.buckets["stkquery"],
+    )
+    if response.status_code == 500:
+        try:
+            error_code = response.json().get("errorCode")
+        except ValueError:
+            error_code = None
+        if error_code == STK_QUERY_PROCESSING:
+            return None
+    response.raise_for_status()
+    res_data = response.json()
+
+    if res_data.get("ResponseCode") != "0":
+        err_msg = res_data.get('errorMessage') or res_data.get('ResponseDescription') or "Unknown error"
+        raise StkPushError(err_msg)
+    return res_data
+
+
+def save_accepted(**fields):
+    """
+    Saves the "Pending" transaction of an STK Push Safaricom accepted, counts the push
+    in the rollups and publishes it to the webhooks.
+
+    Returns:
+        Transaction: The new row.
+    """
+    with db_transaction.atomic():
+        transaction = Transaction.objects.create(status=Transaction.Status.PENDING, **fields)
+        rollups.pushed([transaction])
+        webhooks.publish([transaction])
+    return transaction
+
+
+async def asave_accepted(**fields):
+    """
+    Async version of `save_accepted`.
+    """
+    return await sync_to_async(save_accepted)(**fields)
+
+
+def status_payload(transaction):
+    """
+    The JSON body returned to clients waiting on a transaction.
+    """
+    return {
+        "status": transaction.get_status_display(),
+        "result_code": transaction.result_code,
+        "result_desc": transaction.result_desc,
+        "receipt_number": transaction.mpesa_receipt_number
+    }
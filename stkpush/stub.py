@@ -0,0 +1,274 @@
+import heapq
+import itertools
+import json
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+
+RESULT_DESCRIPTIONS = {
+    "0": "The service request is processed successfully.",
+    "1": "The balance is insufficient for the transaction.",
+    "1032": "Request cancelled by user",
+    "1037": "DS timeout user cannot be reached",
+}
+
+
+class DarajaStubHandler(BaseHTTPRequestHandler):
+    """
+    Minimal stand-in for the Daraja OAuth, STK Push and STK Push query endpoints.
+
+    Speaks HTTP/1.1 with keep-alive, so a pooled client can reuse its connection.
+    `connect_delay` is slept once per new connection to model the TCP+TLS handshake
+    round trips of the real API; `latency` is slept on every request. STK queries
+    answer "still processing" for a `query_processing_rate` share of calls and
+    otherwise report one of `query_result_codes` at random. For fault injection,
+    an `error_rate` share of all requests is answered with `error_status`; both
+    can be changed on the running server. With callbacks enabled, every accepted
+    push is answered by a callback; see `CallbackDispatcher`.
+    """
+    protocol_version = "HTTP/1.1"
+    # Buffer each response into a single write and disable Nagle, otherwise delayed
+    # ACKs add ~40 ms to every request on a reused connection.
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        if self.server.connect_delay:
+            time.sleep(self.server.connect_delay)
+        self.server.count("connections")
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        try:
+            return json.loads(raw or b"{}")
+        except json.JSONDecodeError:
+            return None
+
+    def inject_fault(self):
+        if self.server.error_rate and random.random() < self.server.error_rate:
+            self.server.count("faults")
+            self.send_json(self.server.error_status, {
+                "requestId": uuid.uuid4().hex[:20],
+                "errorCode": f"{self.server.error_status}.003.02",
+                "errorMessage": "System is busy. Please try again in few minutes.",
+            })
+            return True
+        return False
+
+    def do_GET(self):
+        self.server.count("requests")
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.inject_fault():
+            return
+        if self.path.startswith("/oauth/v1/generate"):
+            return self.send_json(200, {"access_token": uuid.uuid4().hex, "expires_in": "3599"})
+        self.send_json(404, {"errorMessage": "Not found"})
+
+    def do_POST(self):
+        self.server.count("requests")
+        payload = self.read_json()
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.inject_fault():
+            return
+        if payload is None:
+            return self.send_json(400, {"errorMessage": "Bad Request - Invalid JSON"})
+        if self.path.startswith("/mpesa/stkpush/v1/processrequest"):
+            merchant_request_id = uuid.uuid4().hex[:20]
+            checkout_request_id = f"ws_CO_{uuid.uuid4().hex}"
+            self.send_json(200, {
+                "MerchantRequestID": merchant_request_id,
+                "CheckoutRequestID": checkout_request_id,
+                "ResponseCode": "0",
+                "ResponseDescription": "Success. Request accepted for processing",
+                "CustomerMessage": "Success. Request accepted for processing",
+            })
+            if self.server.callbacks is not None:
+                self.server.callbacks.schedule(payload, merchant_request_id, checkout_request_id)
+            return
+        if self.path.startswith("/mpesa/stkpushquery/v1/query"):
+            return self.send_query_result(payload)
+        if self.path.startswith("/mpesa/c2b/"):
+            return self.send_json(200, {
+                "OriginatorCoversationID": uuid.uuid4().hex[:20],
+                "ResponseCode": "0",
+                "ResponseDescription": "success",
+            })
+        self.send_json(404, {"errorMessage": "Not found"})
+
+    def send_query_result(self, payload):
+        if random.random() < self.server.query_processing_rate:
+            return self.send_json(500, {
+                "requestId": uuid.uuid4().hex[:20],
+                "errorCode": "500.001.1001",
+                "errorMessage": "The transaction is being processed",
+            })
+        result_code = None
+        if self.server.callbacks is not None:
+            # Agree with the callback for pushes this stub accepted
+            result_code = self.server.callbacks.results.get(payload.get("CheckoutRequestID"))
+        if result_code is None:
+            result_code = random.choice(self.server.query_result_codes)
+        self.send_json(200, {
+            "ResponseCode": "0",
+            "ResponseDescription": "The service request has been accepted successsfully",
+            "MerchantRequestID": uuid.uuid4().hex[:20],
+            "CheckoutRequestID": payload.get("CheckoutRequestID"),
+            "ResultCode": result_code,
+            "ResultDesc": RESULT_DESCRIPTIONS.get(result_code, "The transaction failed."),
+        })
+
+
+class CallbackDispatcher:
+    """
+    Sends STK callbacks like Safaricom does once the customer has answered the prompt.
+
+    Each accepted push gets a callback `delay` seconds later, with a ResultCode picked
+    from `result_codes`, posted to the push's CallBackURL (or `url`, if set). A
+    `duplicate_rate` share of callbacks is delivered a second time, shortly after the
+    first. One scheduler thread keeps the due callbacks in a heap and a small pool
+    posts them, so thousands can be outstanding at once.
+    """
+
+    def __init__(self, count, delay=0.0, result_codes=("0",), duplicate_rate=0.0, url=None, workers=8):
+        self.count = count
+        self.delay = delay
+        self.result_codes = tuple(result_codes)
+        self.duplicate_rate = duplicate_rate
+        self.url = url
+        # ResultCode of every push accepted, so STK queries agree with the callback
+        self.results = {}
+        self.pending = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.local = threading.local()
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="stub-callbacks")
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def schedule(self, payload, merchant_request_id, checkout_request_id):
+        result_code = random.choice(self.result_codes)
+        self.results[checkout_request_id] = result_code
+        body = self.body(payload, merchant_request_id, checkout_request_id, result_code)
+        url = self.url or payload.get("CallBackURL")
+        due = time.monotonic() + self.delay
+        deliveries = [due]
+        if self.duplicate_rate and random.random() < self.duplicate_rate:
+            deliveries.append(due + random.uniform(0, max(self.delay, 0.1)))
+        with self.condition:
+            for when in deliveries:
+                heapq.heappush(self.pending, (when, next(self.sequence), url, body))
+            self.condition.notify()
+
+    @staticmethod
+    def body(payload, merchant_request_id, checkout_request_id, result_code):
+        callback = {
+            "MerchantRequestID": merchant_request_id,
+            "CheckoutRequestID": checkout_request_id,
+            "ResultCode": int(result_code),
+            "ResultDesc": RESULT_DESCRIPTIONS.get(result_code, "The transaction failed."),
+        }
+        if result_code == "0":
+            callback["CallbackMetadata"] = {"Item": [
+                {"Name": "Amount", "Value": payload.get("Amount")},
+                {"Name": "MpesaReceiptNumber", "Value": f"S{uuid.uuid4().hex[:9].upper()}"},
+                {"Name": "TransactionDate", "Value": int(time.strftime("%Y%m%d%H%M%S"))},
+                {"Name": "PhoneNumber", "Value": int(payload.get("PhoneNumber") or 0)},
+            ]}
+        return json.dumps({"Body": {"stkCallback": callback}}).encode()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopped and (not self.pending or self.pending[0][0] > time.monotonic()):
+                    self.condition.wait(self.pending[0][0] - time.monotonic() if self.pending else None)
+                if self.stopped:
+                    return
+                _, _, url, body = heapq.heappop(self.pending)
+            self.pool.submit(self.deliver, url, body)
+
+    def deliver(self, url, body):
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = self.local.session = requests.Session()
+        try:
+            response = session.post(url, data=body, headers={"Content-Type": "application/json"}, timeout=30)
+            self.count("callbacks" if response.status_code == 200 else "callback_errors")
+        except requests.RequestException:
+            self.count("callback_errors")
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+class DarajaStubServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server hosting `DarajaStubHandler`, with simple hit counters.
+
+    Callbacks are only sent when `callback_delay` is given.
+    """
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address=("127.0.0.1", 0), handler=DarajaStubHandler, latency=0.0, connect_delay=0.0,
+                 query_result_codes=("0",), query_processing_rate=0.0, error_rate=0.0, error_status=503,
+                 callback_delay=None, callback_result_codes=("0",), duplicate_rate=0.0, callback_url=None):
+        super().__init__(address, handler)
+        self.latency = latency
+        self.connect_delay = connect_delay
+        self.query_result_codes = tuple(query_result_codes)
+        self.query_processing_rate = query_processing_rate
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.counters = {"connections": 0, "requests": 0, "faults": 0, "callbacks": 0, "callback_errors": 0}
+        self._counter_lock = threading.Lock()
+        self.callbacks = None
+        if callback_delay is not None:
+            self.callbacks = CallbackDispatcher(
+                self.count, callback_delay, callback_result_codes, duplicate_rate, callback_url,
+            )
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, name):
+        with self._counter_lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def start(self):
+        """
+        Serves in a daemon thread and returns the server.
+        """
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def server_close(self):
+        if self.callbacks is not None:
+            self.callbacks.stop()
+        super().server_close()
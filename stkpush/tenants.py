@@ -0,0 +1,147 @@
+"""
+Registry of the paybills and tills served by this deployment.
+
+The shortcode configured in the environment is the default tenant. Further
+tenants are `Tenant` rows, loaded on first use. Each one gets its own payload
+builder, access token (memo and cache key), and rate limits, while all tenants
+share the process's Daraja connection pool, circuit breakers and concurrency limit.
+"""
+import logging
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from decouple import config
+from django.db.models import Count, Max
+
+from .credentials import MpesaAccessToken, MpesaC2bCredential
+from .daraja import BUCKETS
+from .models import Tenant
+from .payloads import StkPayloadBuilder, default_builder
+from .throttle import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# How often a worker checks the tenant table for edits, in seconds
+RELOAD_INTERVAL = config("MPESA_TENANT_RELOAD_INTERVAL", default=5, cast=float)
+
+
+class UnknownTenant(ValueError):
+    """
+    Raised for a tenant slug that does not exist or is deactivated.
+    """
+
+
+class TenantContext:
+    """
+    What is needed to call Daraja for one tenant.
+
+    Attributes:
+        slug: The tenant's slug, or None for the default tenant.
+        builder: The tenant's `StkPayloadBuilder`.
+        token: A `MpesaAccessToken` class for the tenant's Daraja app.
+        buckets: The tenant's rate limits, by endpoint.
+    """
+
+    def __init__(self, slug, builder, token, buckets):
+        self.slug = slug
+        self.builder = builder
+        self.token = token
+        self.buckets = buckets
+
+    @classmethod
+    def from_tenant(cls, tenant):
+        """
+        Builds the context of a `Tenant` row.
+        """
+        credential = type(f"MpesaC2bCredential[{tenant.slug}]", (MpesaC2bCredential,), {
+            "consumer_key": tenant.consumer_key,
+            "consumer_secret": tenant.consumer_secret,
+        })
+        # Daraja limits each app separately, so every tenant gets its own budget
+        buckets = {
+            "oauth": TokenBucket(f"oauth:{tenant.slug}", BUCKETS["oauth"].rate),
+            "stkpush": TokenBucket(
+                f"stkpush:{tenant.slug}",
+                BUCKETS["stkpush"].rate if tenant.stk_rate is None else tenant.stk_rate,
+                BUCKETS["stkpush"].capacity if tenant.stk_rate is None else None,
+            ),
+            "stkquery": TokenBucket(f"stkquery:{tenant.slug}", BUCKETS["stkquery"].rate, BUCKETS["stkquery"].capacity),
+        }
+        builder = StkPayloadBuilder(
+            tenant.shortcode,
+            tenant.passkey,
+            tenant.callback_url or f"{default_builder.callback_url.rstrip('/')}/{tenant.slug}/",
+            transaction_type=tenant.transaction_type,
+            party_b=tenant.party_b,
+        )
+        token = MpesaAccessToken.for_credential(tenant.slug, credential, oauth_bucket=buckets["oauth"])
+        return cls(tenant.slug, builder, token, buckets)
+
+
+class TenantRegistry:
+    """
+    Per-process cache of tenant contexts.
+
+    Contexts are built on first use. At most every RELOAD_INTERVAL seconds, one
+    aggregate query checks whether any tenant was added or edited; if so, every
+    context is dropped and rebuilt on next use, so credential changes take effect
+    without a restart.
+    """
+
+    def __init__(self):
+        self.default = TenantContext(None, default_builder, MpesaAccessToken, BUCKETS)
+        self.contexts = {}
+        self.version = None
+        self.checked_at = float("-inf")
+        self.lock = threading.Lock()
+
+    def get(self, slug=None):
+        """
+        Returns the context of tenant `slug`, or the default tenant's if `slug` is empty.
+
+        Raises:
+            UnknownTenant: If no active tenant has this slug.
+        """
+        if not slug:
+            return self.default
+        self.check_for_changes()
+        context = self.contexts.get(slug)
+        if context is None:
+            tenant = Tenant.objects.filter(slug=slug, is_active=True).first()
+            if tenant is None:
+                raise UnknownTenant(f"Unknown tenant {slug!r}.")
+            with self.lock:
+                context = self.contexts.setdefault(slug, TenantContext.from_tenant(tenant))
+        return context
+
+    async def aget(self, slug=None):
+        """
+        Async version of `get`.
+        """
+        if not slug:
+            return self.default
+        return await sync_to_async(self.get)(slug)
+
+    def check_for_changes(self):
+        now = time.monotonic()
+        if now - self.checked_at < RELOAD_INTERVAL:
+            return
+        self.checked_at = now
+        state = Tenant.objects.aggregate(count=Count("id"), updated_at=Max("updated_at"))
+        version = (state["count"], state["updated_at"])
+        if version != self.version:
+            if self.version is not None:
+                logger.info("Tenants changed, reloading their credentials")
+            self.reload(version)
+
+    def reload(self, version=None):
+        """
+        Drops every cached context; they are rebuilt on next use.
+        """
+        with self.lock:
+            self.contexts = {}
+            self.version = version
+
+
+registry = TenantRegistry()
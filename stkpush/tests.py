@@ -0,0 +1,1197 @@
+import base64
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import requests
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.contrib.sessions.backends.cache import SessionStore
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, OperationalError
+from django.db.models import F
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils import timezone
+
+from . import api, archive, async_views, bulk, c2b, db, idempotency, inbox, jobs, metrics, reconcile, rollups, statements, stk, throttle, views, webhooks
+from .breaker import AdaptiveLimiter, CircuitBreaker, DarajaUnavailable, aguard
+from .credentials import LipanaMpesaPassword, MpesaAccessToken
+from .daraja import BREAKERS, LIMITERS, DarajaClient
+from .management.commands import stk_worker, webhook_worker
+from .models import (
+    ArchiveBatch, C2BPayment, CallbackInbox, OutboxEvent, PaybillAccount, PhoneRollup, RateLimitBucket, RollupPeriod,
+    Tenant, Transaction, TransactionRollup, WebhookDelivery, WebhookEndpoint,
+)
+from .stub import DarajaStubServer
+from .tenants import registry
+
+
+def queued(count=1, **fields):
+    return [jobs.enqueue_stk_push("254712345678", 10, **fields) for _ in range(count)]
+
+
+class ClaimJobsTests(TestCase):
+    def test_claims_queued_rows_once(self):
+        queued(3)
+        first = jobs.claim_jobs(2)
+        second = jobs.claim_jobs(2)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 1)
+        self.assertFalse({job.pk for job in first} & {job.pk for job in second})
+        self.assertEqual(jobs.claim_jobs(2), [])
+        for job in first + second:
+            self.assertEqual(job.status, Transaction.Status.SENDING)
+            self.assertEqual(job.attempts, 1)
+
+    def test_never_resends_rows_of_a_crashed_worker(self):
+        job, = queued()
+        jobs.claim_jobs(1)
+        stale = timezone.now() - timedelta(seconds=jobs.CLAIM_TIMEOUT + 1)
+        Transaction.objects.filter(pk=job.pk).update(locked_at=stale)
+        with self.assertLogs("stkpush.jobs", "WARNING"):
+            self.assertEqual(jobs.claim_jobs(1), [])
+        job.refresh_from_db()
+        self.assertEqual(job.status, Transaction.Status.PENDING)
+        self.assertIsNone(job.checkout_request_id)
+
+    def test_skips_rows_out_of_attempts(self):
+        job, = queued()
+        Transaction.objects.filter(pk=job.pk).update(attempts=jobs.MAX_ATTEMPTS)
+        self.assertEqual(jobs.claim_jobs(1), [])
+
+    def test_finish_is_a_no_op_after_the_claim_was_taken_over(self):
+        job, = queued()
+        claimed, = jobs.claim_jobs(1)
+        Transaction.objects.filter(pk=job.pk).update(locked_at=timezone.now() + timedelta(seconds=1))
+        self.assertFalse(jobs.finish(claimed, status=Transaction.Status.FAILED))
+        self.assertEqual(Transaction.objects.get(pk=job.pk).status, Transaction.Status.SENDING)
+
+
+class ProcessJobTests(TestCase):
+    def process(self, error):
+        job, = queued()
+        claimed, = jobs.claim_jobs(1)
+        with mock.patch.object(jobs, "send_stk_push", side_effect=error), self.assertLogs("stkpush.jobs", "WARNING"):
+            jobs.process_job(claimed)
+        job.refresh_from_db()
+        return job
+
+    def test_requeues_a_push_whose_connection_failed(self):
+        job = self.process(requests.ConnectTimeout("connect timed out"))
+        self.assertEqual(job.status, Transaction.Status.INITIATING)
+        self.assertEqual(jobs.claim_jobs(1)[0].pk, job.pk)
+
+    def test_never_resends_a_push_that_may_have_reached_safaricom(self):
+        for error in (requests.ReadTimeout("read timed out"), ValueError("Expecting value")):
+            job = self.process(error)
+            self.assertEqual(job.status, Transaction.Status.PENDING)
+            self.assertIsNone(job.checkout_request_id)
+        self.assertEqual(jobs.claim_jobs(10), [])
+
+    def test_a_callback_is_matched_to_an_unanswered_push(self):
+        job = self.process(requests.ReadTimeout("read timed out"))
+        inbox.process(inbox.append(stk_callback("ws_A")))
+        job.refresh_from_db()
+        self.assertEqual(job.status, Transaction.Status.SUCCESS)
+        self.assertEqual(job.checkout_request_id, "ws_A")
+
+    def test_unanswered_pushes_are_failed_by_the_reconciler(self):
+        job = self.process(requests.ReadTimeout("read timed out"))
+        self.assertEqual(reconcile.settle_unanswered(), 0)
+        Transaction.objects.update(locked_at=timezone.now() - timedelta(seconds=reconcile.STALE_AFTER + 1))
+        self.assertEqual(reconcile.settle_unanswered(), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, Transaction.Status.FAILED)
+        self.assertEqual(job.result_description.text, reconcile.NO_RESPONSE)
+
+
+class StkWorkerTests(TestCase):
+    options = {"batch_size": 10, "poll_interval": 0, "once": True}
+
+    def test_survives_failed_polls_and_jobs(self):
+        queued(2)
+        real_claim = jobs.claim_jobs
+        calls = []
+
+        def flaky_claim(limit):
+            calls.append(limit)
+            if len(calls) == 1:
+                raise OperationalError("database is locked")
+            return real_claim(limit)
+
+        with mock.patch.object(stk_worker, "claim_jobs", flaky_claim), \
+                mock.patch.object(stk_worker, "process_job", side_effect=[ValueError("odd body"), None]) as process, \
+                self.assertLogs("stkpush.management.commands.stk_worker", "ERROR") as logs:
+            stk_worker.Command().work(threading.Event(), self.options)
+
+        self.assertEqual(process.call_count, 2)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(len(logs.records), 2)
+
+    def test_once_exits_while_the_circuit_is_open(self):
+        queued()
+        with mock.patch.object(stk_worker.DarajaClient, "available", return_value=False):
+            stk_worker.Command().work(threading.Event(), self.options)
+        self.assertEqual(Transaction.objects.get().status, Transaction.Status.INITIATING)
+
+
+class BulkCampaignTests(TestCase):
+    def setUp(self):
+        rows = ((n, {"reference": f"r{n}", "phone": "254712345678", "amount": 10}) for n in range(3))
+        self.assertEqual(bulk.import_rows(rows, "promo"), (3, []))
+
+    def test_the_general_worker_leaves_campaign_rows_alone(self):
+        queued()
+        self.assertEqual([job.batch for job in jobs.claim_jobs(10)], [None])
+        self.assertEqual(len(jobs.claim_jobs(10, batch="promo")), 3)
+
+    def test_a_failing_push_does_not_stop_the_campaign(self):
+        with mock.patch.object(bulk, "process_job", side_effect=[ValueError("odd body"), None, None]) as process, \
+                self.assertLogs("stkpush.bulk", "ERROR"):
+            bulk.send_batch("promo", concurrency=1, rate=1000)
+        self.assertEqual(process.call_count, 3)
+
+def pending(checkout_request_id, **fields):
+    return Transaction.objects.create(**{
+        "checkout_request_id": checkout_request_id, "phone_number": "254712345678", "amount": 10,
+        "status": Transaction.Status.PENDING, **fields,
+    })
+
+
+def stk_callback(checkout_request_id, result_code=0, receipt="QKH0000001", amount=10):
+    body = {"MerchantRequestID": "m", "CheckoutRequestID": checkout_request_id, "ResultCode": result_code,
+            "ResultDesc": "ok" if result_code == 0 else "Request cancelled by user"}
+    if result_code == 0:
+        body["CallbackMetadata"] = {"Item": [
+            {"Name": "Amount", "Value": amount},
+            {"Name": "MpesaReceiptNumber", "Value": receipt},
+            {"Name": "TransactionDate", "Value": 20240115120000},
+            {"Name": "PhoneNumber", "Value": 254712345678},
+        ]}
+    return json.dumps({"Body": {"stkCallback": body}})
+
+
+class CallbackInboxTests(TestCase):
+    def post(self, body):
+        return self.client.post("/callback/", body, content_type="application/json")
+
+    def test_applies_a_callback_once(self):
+        pending("ws_A")
+        self.assertEqual(self.post(stk_callback("ws_A")).json()["ResultCode"], 0)
+        self.assertEqual(self.post(stk_callback("ws_A")).json()["ResultCode"], 0)
+        transaction = Transaction.objects.get(checkout_request_id="ws_A")
+        self.assertEqual(transaction.status, Transaction.Status.SUCCESS)
+        self.assertEqual(transaction.mpesa_receipt_number, "QKH0000001")
+        self.assertEqual(list(CallbackInbox.objects.order_by("id").values_list("outcome", flat=True)),
+                         ["applied", "duplicate"])
+
+    def test_keeps_and_acknowledges_a_callback_that_fails_to_apply(self):
+        pending("ws_A")
+        with self.assertLogs("stkpush.inbox", "ERROR"):
+            response = self.post(stk_callback("ws_A", amount="abc"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["ResultCode"], 0)
+        entry = CallbackInbox.objects.get()
+        self.assertTrue(entry.outcome.startswith("error:"))
+        self.assertEqual(Transaction.objects.get().status, Transaction.Status.PENDING)
+
+    def test_keeps_callbacks_the_database_could_not_take(self):
+        pending("ws_A")
+        with mock.patch.object(inbox, "apply", side_effect=OperationalError("database is locked")), \
+                self.assertLogs("stkpush.views", "ERROR"):
+            response = self.post(stk_callback("ws_A"))
+        self.assertEqual(response.json()["ResultCode"], 0)
+        self.assertEqual(inbox.process_pending(), {"applied": 1})
+
+    def test_callbacks_for_unknown_transactions_wait(self):
+        self.post(stk_callback("ws_A"))
+        entry = CallbackInbox.objects.get()
+        self.assertEqual(entry.outcome, "unknown")
+        self.assertIsNone(entry.processed_at)
+        pending("ws_A")
+        inbox.process_waiting("ws_A")
+        self.assertEqual(Transaction.objects.get().status, Transaction.Status.SUCCESS)
+
+    def test_a_poison_entry_does_not_hold_up_the_batch(self):
+        pending("ws_A")
+        pending("ws_B")
+        pending("ws_C")
+        Transaction.objects.filter(checkout_request_id="ws_A").update(mpesa_receipt_number="QKH0000009")
+        for body in (stk_callback("ws_B", amount="abc"), stk_callback("ws_C", receipt="QKH0000009"),
+                     stk_callback("ws_A", result_code=1032)):
+            inbox.append(body)
+
+        with self.assertLogs("stkpush.inbox", "ERROR"):
+            counts = inbox.process_pending()
+        self.assertEqual(counts.get("applied"), 1)
+        self.assertEqual(sum(n for outcome, n in counts.items() if outcome.startswith("error:")), 2)
+        self.assertEqual(Transaction.objects.get(checkout_request_id="ws_A").status, Transaction.Status.FAILED)
+        self.assertEqual(Transaction.objects.get(checkout_request_id="ws_C").status, Transaction.Status.PENDING)
+        self.assertEqual(inbox.process_pending(), {})
+
+
+    def test_counts_undocumented_result_codes_as_other(self):
+        pending("ws_A")
+        pending("ws_B")
+        before = (metrics.CALLBACKS.value(outcome="applied", result_code="1032"),
+                  metrics.CALLBACKS.value(outcome="applied", result_code="other"))
+        self.post(stk_callback("ws_A", result_code=1032))
+        self.post(stk_callback("ws_B", result_code=123456789))
+        after = (metrics.CALLBACKS.value(outcome="applied", result_code="1032"),
+                 metrics.CALLBACKS.value(outcome="applied", result_code="other"))
+        self.assertEqual(after, (before[0] + 1, before[1] + 1))
+        self.assertNotIn("123456789", {key[1] for key in metrics.CALLBACKS.snapshot()})
+
+
+class RollupConsistencyTests(TestCase):
+    def send(self, amount, outcome):
+        job = jobs.enqueue_stk_push("254712345678", amount)
+        claimed, = jobs.claim_jobs(1)
+        with mock.patch.object(jobs, "send_stk_push", **outcome):
+            jobs.process_job(claimed)
+        job.refresh_from_db()
+        return job
+
+    def snapshot(self):
+        return (
+            list(TransactionRollup.objects.order_by("period", "start", "tenant")
+                 .values_list("period", "start", "tenant", "pushes", "succeeded", "failed", "amount")),
+            list(PhoneRollup.objects.order_by("day", "phone_number").values_list("day", "phone_number", "payments", "amount")),
+        )
+
+    def test_incremental_counts_match_a_rebuild(self):
+        def accepted(checkout_request_id):
+            return {"return_value": {"CheckoutRequestID": checkout_request_id, "MerchantRequestID": "m"}}
+
+        with self.assertLogs("stkpush", "INFO"):
+            self.send(10, accepted("ws_A"))
+            self.send(10, accepted("ws_B"))
+            queried = self.send(10, accepted("ws_C"))
+            self.send(20, {"side_effect": requests.ReadTimeout("read timed out")})
+            self.send(30, {"side_effect": requests.ReadTimeout("read timed out")})
+            self.send(40, {"side_effect": stk.StkPushError("Invalid Access Token")})
+            stk.save_accepted(checkout_request_id="ws_E", merchant_request_id="m", phone_number="254712345678", amount=50)
+
+            inbox.process(inbox.append(stk_callback("ws_A")))
+            inbox.process(inbox.append(stk_callback("ws_B", result_code=1032)))
+            inbox.process(inbox.append(stk_callback("ws_D", receipt="QKH0000004", amount=20)))
+            with mock.patch.object(reconcile, "query_stk_push", return_value={"ResultCode": 0, "ResultDesc": "ok"}):
+                self.assertEqual(reconcile.apply_results([(queried.pk, reconcile.query("ws_C")[1])]), 1)
+            inbox.process(inbox.append(stk_callback("ws_C", receipt="QKH0000003")))
+            Transaction.objects.filter(checkout_request_id__isnull=True, status=Transaction.Status.PENDING).update(
+                locked_at=timezone.now() - timedelta(seconds=reconcile.STALE_AFTER + 1),
+            )
+            self.assertEqual(reconcile.settle_unanswered(), 1)
+
+        incremental = self.snapshot()
+        hourly = [row for row in incremental[0] if row[0] == RollupPeriod.HOUR]
+        self.assertEqual(sum(row[3] for row in hourly), 5)
+        self.assertEqual(sum(row[4] for row in hourly), 3)
+        self.assertEqual(sum(row[5] for row in hourly), 3)
+        rollups.rebuild()
+        self.assertEqual(self.snapshot(), incremental)
+
+
+class MetricsEndpointTests(TestCase):
+    def test_is_closed_without_a_token(self):
+        with self.assertLogs("stkpush.views", "ERROR"):
+            self.assertEqual(self.client.get("/metrics").status_code, 503)
+
+    def test_requires_the_token(self):
+        with mock.patch.object(views, "METRICS_TOKEN", "secret"):
+            self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer wrong").status_code, 401)
+            self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer s\u00e9cret").status_code, 401)
+            response = self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer secret")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"mpesa_callbacks_total", response.content)
+
+def c2b_body(trans_id="QKH0000001", amount="100.00", account="ACC-1"):
+    return json.dumps({
+        "TransactionType": "Pay Bill", "TransID": trans_id, "TransTime": "20240115120000", "TransAmount": amount,
+        "BusinessShortCode": "600000", "BillRefNumber": account, "MSISDN": "254712345678", "FirstName": "Jane",
+    })
+
+
+class C2BViewTests(TestCase):
+    def setUp(self):
+        c2b.account_index.reset()
+        PaybillAccount.objects.create(number="ACC-1")
+
+    def post(self, path, body):
+        return self.client.post(path, body, content_type="application/json")
+
+    def test_validation_checks_the_account_and_amount(self):
+        self.assertEqual(self.post("/c2b/validation/", c2b_body(account="acc-1")).json(), c2b.ACCEPTED)
+        with self.assertLogs("stkpush.views", "INFO"):
+            self.assertEqual(self.post("/c2b/validation/", c2b_body(account="ACC-9")).json()["ResultCode"],
+                             c2b.INVALID_ACCOUNT)
+            for amount in ("NaN", "Infinity", "0", "abc"):
+                self.assertEqual(self.post("/c2b/validation/", c2b_body(amount=amount)).json()["ResultCode"],
+                                 c2b.INVALID_AMOUNT, amount)
+
+    @mock.patch.object(c2b, "BATCH_CONFIRMATIONS", False)
+    def test_confirmation_stores_a_payment_once(self):
+        for _ in range(2):
+            self.assertEqual(self.post("/c2b/confirmation/", c2b_body()).json(), c2b.CONFIRMED)
+        payment = C2BPayment.objects.get()
+        self.assertEqual((payment.trans_id, payment.amount, payment.bill_ref_number),
+                         ("QKH0000001", Decimal("100.00"), "ACC-1"))
+
+    @mock.patch.object(c2b, "BATCH_CONFIRMATIONS", False)
+    def test_confirmation_refuses_amounts_that_are_not_finite_and_positive(self):
+        with self.assertLogs("stkpush.views", "ERROR"):
+            for amount in ("NaN", "Infinity", "-5", "abc"):
+                self.assertEqual(self.post("/c2b/confirmation/", c2b_body(amount=amount)).status_code, 400, amount)
+        self.assertFalse(C2BPayment.objects.exists())
+
+    def test_account_index_refreshes_in_the_background(self):
+        index = c2b.AccountIndex()
+        self.assertIn(" acc-1", index)
+        PaybillAccount.objects.create(number="ACC-2")
+        index.checked_at = float("-inf")
+
+        started = []
+
+        class DeferredThread:
+            def __init__(self, target, **kwargs):
+                self.target = target
+
+            def start(self):
+                started.append(self.target)
+
+        # The refresh runs in the test's thread, once the lookup has been answered
+        with mock.patch.object(c2b.threading, "Thread", DeferredThread), mock.patch.object(c2b, "connection"):
+            self.assertNotIn("ACC-2", index)
+            self.assertNotIn("ACC-2", index)
+            self.assertEqual(len(started), 1)
+            started[0]()
+        self.assertIn("ACC-2", index)
+        self.assertFalse(index.refreshing)
+
+
+class ConfirmationWriterTests(TestCase):
+    def payment(self, trans_id):
+        return c2b.payment_from(json.loads(c2b_body(trans_id)), c2b_body(trans_id))
+
+    def submit_all(self, writer, count):
+        errors = []
+
+        def submit(n):
+            try:
+                writer.submit(self.payment(f"QKH{n:07d}"), timeout=5)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=submit, args=(n,)) for n in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def test_group_commits_concurrent_confirmations(self):
+        writes = []
+        writer = c2b.ConfirmationWriter(batch_size=50, linger=0.02)
+        # The writer thread cannot see this test's transaction; record the batches instead
+        writer.write = lambda payments: (time.sleep(0.01), writes.append(len(payments)))
+        self.assertEqual(self.submit_all(writer, 100), [])
+        self.assertEqual(sum(writes), 100)
+        self.assertLess(len(writes), 20)
+
+    def test_throughput(self):
+        writes = []
+        writer = c2b.ConfirmationWriter(batch_size=500, linger=0.005)
+        # Each write costs as much as a commit to disk; one per payment would take 10s
+        writer.write = lambda payments: (time.sleep(0.01), writes.append(len(payments)))
+        started = time.perf_counter()
+        self.assertEqual(self.submit_all(writer, 1000), [])
+        self.assertLess(time.perf_counter() - started, 5)
+        self.assertEqual(sum(writes), 1000)
+
+    def test_a_bad_payment_only_fails_itself(self):
+        stored = []
+
+        def write(payments):
+            if any(payment.trans_id == "QKH0000002" for payment in payments):
+                raise DatabaseError("value too long")
+            stored.extend(payment.trans_id for payment in payments)
+
+        writer = c2b.ConfirmationWriter()
+        writer.write = write
+        batch = c2b.Batch()
+        batch.payments = [self.payment(f"QKH000000{n}") for n in (1, 2, 3)]
+        with self.assertLogs("stkpush.c2b", "WARNING") as logs:
+            writer.write_batch(batch)
+        self.assertEqual(list(batch.errors), [1])
+        self.assertEqual(stored, ["QKH0000001", "QKH0000003"])
+        self.assertEqual([record.levelname for record in logs.records], ["WARNING", "ERROR"])
+
+    def test_a_forked_process_starts_its_own_writer(self):
+        writer = c2b.ConfirmationWriter()
+        writer.writer_pid = -1
+        writer.open.payments.append(self.payment("QKH0000001"))
+        with mock.patch.object(c2b.threading, "Thread") as thread:
+            writer.start_writer()
+            writer.start_writer()
+        thread.return_value.start.assert_called_once_with()
+        self.assertEqual(writer.writer_pid, os.getpid())
+        self.assertEqual(writer.open.payments, [])
+
+class DarajaFaultTests(TestCase):
+    """
+    Circuit breaker and concurrency limiter behaviour against the Daraja stub.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.stub = DarajaStubServer().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.stub.shutdown()
+        cls.stub.server_close()
+        DarajaClient.reset()
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        self.stub.latency = 0.0
+        self.stub.error_rate = 0.0
+        self.breaker = BREAKERS["stkpush"]
+        for name, value in {"min_calls": 4, "window": 60, "open_seconds": 60, "slow_call": 0.2}.items():
+            self.enterContext(mock.patch.object(self.breaker, name, value))
+        for breaker in BREAKERS.values():
+            breaker.open_until = 0.0
+        LIMITERS["stkpush"].limit = float(AdaptiveLimiter.initial)
+        token = registry.default.token
+        for name in ("validated_mpesa_access_token", "token_expiry", "refresh_at"):
+            self.enterContext(mock.patch.object(token, name, None))
+        self.enterContext(mock.patch.object(token.credential, "api_URL", f"{self.stub.base_url}/oauth/v1/generate"))
+
+    def push(self):
+        return DarajaClient.request(
+            "POST", f"{self.stub.base_url}/mpesa/stkpush/v1/processrequest", endpoint="stkpush",
+            json={}, headers={"Authorization": "Bearer t"},
+        )
+
+    def test_opens_when_too_many_calls_fail(self):
+        self.stub.error_rate = 1.0
+        for _ in range(4):
+            self.assertEqual(self.push().status_code, 503)
+        requests_made = self.stub.counters["requests"]
+        with self.assertRaises(DarajaUnavailable) as raised:
+            self.push()
+        self.assertEqual(self.stub.counters["requests"], requests_made)
+        self.assertGreater(raised.exception.retry_after, 0)
+        self.assertEqual(self.breaker.state(), "open")
+
+    def test_opens_when_too_many_calls_are_slow(self):
+        self.stub.latency = 0.25
+        for _ in range(4):
+            self.assertEqual(self.push().status_code, 200)
+        with self.assertRaises(DarajaUnavailable):
+            self.push()
+
+    def test_stays_closed_below_the_thresholds(self):
+        self.stub.error_rate = 1.0
+        self.push()
+        self.stub.error_rate = 0.0
+        for _ in range(5):
+            self.assertEqual(self.push().status_code, 200)
+        self.assertEqual(self.breaker.state(), "closed")
+
+    def expire(self):
+        cache.set(f"{self.breaker.prefix}:open", time.time() - 1, 600)
+        self.breaker.open_until = 0.0
+
+    def test_half_open_lets_a_single_probe_through(self):
+        self.expire()
+        self.assertEqual(self.breaker.state(), "half-open")
+        self.assertTrue(self.breaker.allow())
+        with self.assertRaises(DarajaUnavailable):
+            self.breaker.allow()
+
+    def test_a_successful_probe_closes_the_circuit(self):
+        self.expire()
+        self.assertEqual(self.push().status_code, 200)
+        self.assertEqual(self.breaker.state(), "closed")
+        self.assertEqual(self.push().status_code, 200)
+
+    def test_a_failed_probe_reopens_the_circuit(self):
+        self.expire()
+        self.stub.error_rate = 1.0
+        self.assertEqual(self.push().status_code, 503)
+        self.assertEqual(self.breaker.state(), "open")
+        with self.assertRaises(DarajaUnavailable):
+            self.push()
+
+    def test_limiter_shrinks_on_failure_and_grows_on_success(self):
+        limiter = AdaptiveLimiter("test")
+        limiter.limit = 8.0
+        limiter.acquire()
+        limiter.release(failed=True, slow=False)
+        self.assertEqual(limiter.limit, 4.0)
+        # At most one decrease per cooldown
+        limiter.acquire()
+        limiter.release(failed=False, slow=True)
+        self.assertEqual(limiter.limit, 4.0)
+        limiter.acquire()
+        limiter.release(failed=False, slow=False)
+        self.assertEqual(limiter.limit, 4.25)
+
+        limiter.limit = 1.0
+        limiter.acquire()
+        with self.assertRaises(DarajaUnavailable):
+            limiter.acquire()
+        limiter.decreased_at = 0.0
+        limiter.release(failed=True, slow=False)
+        self.assertEqual(limiter.limit, AdaptiveLimiter.minimum)
+
+    def post_payment(self):
+        return self.client.post("/pay/", {"phone": "0712345678", "amount": "10"})
+
+    def test_pay_answers_503_while_the_oauth_circuit_is_open(self):
+        BREAKERS["oauth"].trip("test", force=True)
+        requests_made = self.stub.counters["requests"]
+        response = self.post_payment()
+        self.assertEqual(response.status_code, 503)
+        self.assertTrue(response["Retry-After"])
+        self.assertEqual(self.stub.counters["requests"], requests_made)
+
+    def test_pay_answers_503_while_the_stk_push_circuit_is_open(self):
+        token = registry.default.token
+        cache.set(token.cache_key, token.token_entry({"access_token": "t", "expires_in": "3599"}), 3599)
+        self.breaker.trip("test", force=True)
+        response = self.post_payment()
+        self.assertEqual(response.status_code, 503)
+        self.assertTrue(response["Retry-After"])
+
+    def test_job_is_deferred_while_the_oauth_circuit_is_open(self):
+        job, = queued()
+        BREAKERS["oauth"].trip("test", force=True)
+        claimed, = jobs.claim_jobs(1)
+        jobs.process_job(claimed)
+        job.refresh_from_db()
+        self.assertEqual(job.status, Transaction.Status.INITIATING)
+        self.assertEqual(job.attempts, 0)
+        self.assertTrue(jobs.requeued([job]))
+
+    def test_job_is_retried_when_no_token_could_be_fetched(self):
+        job, = queued()
+        self.stub.error_rate = 1.0
+        self.stub.error_status = 400
+        self.addCleanup(setattr, self.stub, "error_status", 503)
+        claimed, = jobs.claim_jobs(1)
+        jobs.process_job(claimed)
+        job.refresh_from_db()
+        self.assertEqual(job.status, Transaction.Status.INITIATING)
+        self.assertEqual(job.attempts, 1)
+
+
+class AsyncPayTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def post(self):
+        request = RequestFactory().post("/pay/", {"phone": "254712345678", "amount": "10"})
+        request.session = SessionStore()
+        request._messages = FallbackStorage(request)
+        return async_to_sync(async_views.pay)(request)
+
+    def test_answers_an_unexpected_error_and_lifts_the_cooldown(self):
+        with mock.patch.object(async_views, "asend_stk_push", side_effect=RuntimeError("odd")), \
+                self.assertLogs("stkpush.async_views", "ERROR"):
+            response = self.post()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(throttle.claim_phone("254712345678"), 0)
+
+    def test_queues_through_the_job_queue(self):
+        with mock.patch.object(async_views, "ASYNC_STK_PUSH", True), \
+                mock.patch.object(jobs, "enqueue_stk_push", wraps=jobs.enqueue_stk_push) as enqueue:
+            self.assertEqual(self.post().status_code, 200)
+        enqueue.assert_called_once()
+        self.assertEqual(Transaction.objects.get().status, Transaction.Status.INITIATING)
+
+    def test_async_guard_trips_the_shared_breaker(self):
+        breaker = CircuitBreaker("async-test")
+        breaker.min_calls = 2
+
+        async def call(status):
+            async with aguard(breaker) as guarded:
+                guarded.status = status
+
+        for _ in range(2):
+            async_to_sync(call)(503)
+        self.assertEqual(breaker.state(), "open")
+        with self.assertRaises(DarajaUnavailable):
+            async_to_sync(call)(200)
+        breaker.open_until = 0.0
+        with self.assertRaises(DarajaUnavailable):
+            breaker.allow()
+
+class SqlitePragmaTests(TestCase):
+    def pragmas(self, name):
+        connection = mock.MagicMock(vendor="sqlite", settings_dict={"NAME": name})
+        db.configure_sqlite(None, connection)
+        cursor = connection.cursor.return_value.__enter__.return_value
+        return [call.args[0].split()[1] for call in cursor.execute.call_args_list]
+
+    def test_leaves_the_journal_mode_of_the_sample_database_alone(self):
+        self.assertEqual(self.pragmas(settings.BASE_DIR / "db.sqlite3"), ["synchronous", "busy_timeout"])
+        self.assertEqual(self.pragmas("/srv/mpesa.sqlite3"), ["journal_mode", "synchronous", "busy_timeout"])
+        with mock.patch.object(db, "SQLITE_JOURNAL_MODE", "WAL"):
+            self.assertIn("journal_mode", self.pragmas(settings.BASE_DIR / "db.sqlite3"))
+
+class AccessTokenTests(TestCase):
+    class Credential:
+        consumer_key = "token-tests"
+        consumer_secret = "secret"
+        api_URL = "http://127.0.0.1:1/oauth"
+
+    def setUp(self):
+        cache.clear()
+        self.token = MpesaAccessToken.for_credential("tests", self.Credential)
+
+    def entry(self, token, refresh_in=3000, expires_in=3599):
+        return {"token": token, "expires_at": time.time() + expires_in, "refresh_at": time.time() + refresh_in}
+
+    def fetched(self, token, delay=0.0):
+        def fetch():
+            time.sleep(delay)
+            entry = self.entry(token)
+            cache.set(self.token.cache_key, entry, 3599)
+            return entry
+        return fetch
+
+    def test_concurrent_lookups_refresh_once(self):
+        results = []
+        with mock.patch.object(self.token, "fetch_access_token", side_effect=self.fetched("t1", delay=0.2)) as fetch:
+            threads = [threading.Thread(target=lambda: results.append(self.token.get_access_token())) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(fetch.call_count, 1)
+        self.assertEqual(results, ["t1"] * 8)
+        self.assertIsNone(cache.get(self.token.lock_key))
+
+    def test_serves_the_current_token_while_another_worker_refreshes(self):
+        cache.set(self.token.cache_key, self.entry("old", refresh_in=-1))
+        cache.add(self.token.lock_key, "another worker")
+        with mock.patch.object(self.token, "fetch_access_token") as fetch:
+            self.assertEqual(self.token.get_access_token(), "old")
+        fetch.assert_not_called()
+
+    def test_a_failed_refresh_serves_the_current_token_until_it_expires(self):
+        cache.set(self.token.cache_key, self.entry("old", refresh_in=-1))
+        with mock.patch.object(self.token, "fetch_access_token", return_value=None), \
+                self.assertLogs("stkpush.credentials", "WARNING"):
+            self.assertEqual(self.token.get_access_token(), "old")
+        self.assertIsNone(cache.get(self.token.lock_key))
+
+        cache.set(self.token.cache_key, self.entry("old", refresh_in=-2, expires_in=-1))
+        with mock.patch.object(self.token, "fetch_access_token", return_value=None):
+            self.assertIsNone(self.token.get_access_token())
+
+    def test_never_releases_another_workers_lock(self):
+        def slow_refresh():
+            # Our lock expired during the refresh and another worker took it
+            cache.set(self.token.lock_key, "another worker")
+            return self.fetched("t1")()
+
+        with mock.patch.object(self.token, "fetch_access_token", side_effect=slow_refresh):
+            self.assertEqual(self.token.get_access_token(), "t1")
+        self.assertEqual(cache.get(self.token.lock_key), "another worker")
+
+class LipanaMpesaPasswordTests(TestCase):
+    def test_keeps_its_attributes_readable_but_not_assignable(self):
+        password, timestamp = LipanaMpesaPassword.generate_password()
+        self.assertEqual((LipanaMpesaPassword.decode_password, LipanaMpesaPassword.lipa_time), (password, timestamp))
+        self.assertEqual(
+            base64.b64decode(password).decode(),
+            LipanaMpesaPassword.Business_short_code + LipanaMpesaPassword.passkey + timestamp,
+        )
+        for name in ("passkey", "lipa_time", "decode_password"):
+            with self.assertRaises(AttributeError):
+                setattr(LipanaMpesaPassword, name, "changed")
+
+
+class TokenBucketTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def elapse(self, key, seconds):
+        RateLimitBucket.objects.filter(key=key).update(updated=F("updated") - seconds)
+
+    def test_allows_a_burst_then_refuses(self):
+        bucket = throttle.TokenBucket("test", rate=1, burst=3)
+        self.assertEqual([bucket.try_acquire() for _ in range(4)], [True, True, True, False])
+
+    def test_refills_at_the_rate_up_to_the_burst(self):
+        bucket = throttle.TokenBucket("test", rate=1, burst=3)
+        while bucket.try_acquire():
+            pass
+        self.elapse("test", 2)
+        self.assertEqual([bucket.try_acquire() for _ in range(3)], [True, True, False])
+        self.elapse("test", 100)
+        self.assertEqual([bucket.try_acquire() for _ in range(4)], [True, True, True, False])
+
+    def test_is_shared_by_every_instance_with_the_same_key(self):
+        first = throttle.TokenBucket("test", rate=1, burst=2)
+        second = throttle.TokenBucket("test", rate=1, burst=2)
+        self.assertTrue(first.try_acquire())
+        self.assertTrue(second.try_acquire())
+        self.assertFalse(first.try_acquire())
+
+    def test_acquire_gives_up_after_waiting(self):
+        bucket = throttle.TokenBucket("test", rate=1)
+        bucket.acquire()
+        with self.assertRaises(throttle.Throttled) as raised:
+            bucket.acquire(wait=0.05)
+        self.assertEqual(raised.exception.retry_after, 1)
+
+    def test_recreates_a_deleted_row(self):
+        bucket = throttle.TokenBucket("test", rate=1, burst=2)
+        self.assertTrue(bucket.try_acquire())
+        RateLimitBucket.objects.all().delete()
+        self.assertEqual([bucket.try_acquire() for _ in range(3)], [True, True, False])
+
+    def test_drain_empties_the_bucket(self):
+        bucket = throttle.TokenBucket("test", rate=1, burst=5)
+        self.assertTrue(bucket.try_acquire())
+        bucket.drain()
+        self.assertFalse(bucket.try_acquire())
+
+    def test_a_rate_of_zero_disables_the_limit(self):
+        bucket = throttle.TokenBucket("test", rate=0)
+        for _ in range(10):
+            bucket.acquire(wait=0)
+        self.assertFalse(RateLimitBucket.objects.exists())
+
+    def test_phone_cooldown(self):
+        self.assertEqual(throttle.claim_phone("254712345678"), 0)
+        wait = throttle.claim_phone("254712345678")
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, throttle.PHONE_COOLDOWN)
+        self.assertEqual(throttle.claim_phone("254700000000"), 0)
+        throttle.release_phone("254712345678")
+        self.assertEqual(throttle.claim_phone("254712345678"), 0)
+
+
+class IdempotencyTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def claim(self, **data):
+        request = RequestFactory().post("/pay/", data)
+        return idempotency.claim(request, "254712345678", 10)
+
+    def test_replays_a_supplied_key(self):
+        self.claim(idempotency_key="k1").complete(message="sent", reference="r1")
+        self.assertEqual(self.claim(idempotency_key="k1").replay, {"message": "sent", "reference": "r1"})
+        self.assertIsNone(self.claim(idempotency_key="k2").replay)
+
+    def test_catches_a_repeat_across_a_window_boundary(self):
+        boundary = (time.time() // idempotency.DERIVED_WINDOW + 1) * idempotency.DERIVED_WINDOW
+        with mock.patch("time.time", return_value=boundary - 1):
+            self.claim().complete(message="sent")
+        with mock.patch("time.time", return_value=boundary + 1):
+            self.assertEqual(self.claim().replay, {"message": "sent"})
+        with mock.patch("time.time", return_value=boundary + idempotency.DERIVED_WINDOW):
+            self.assertIsNone(self.claim().replay)
+
+    def test_a_released_key_can_be_claimed_again(self):
+        self.claim().release()
+        self.assertIsNone(self.claim().replay)
+
+
+class ApiAuthTests(TestCase):
+    def test_refuses_every_request_without_a_configured_token(self):
+        with mock.patch.object(api, "API_TOKEN", ""), self.assertLogs("stkpush.api", "ERROR"):
+            for path in ("/api/v1/payments/", "/api/v1/stats/", "/api/v1/payments/ws_A/"):
+                response = self.client.get(path, HTTP_AUTHORIZATION="Bearer ")
+                self.assertEqual(response.status_code, 503, path)
+
+    def test_requires_the_bearer_token(self):
+        with mock.patch.object(api, "API_TOKEN", "secret"):
+            self.assertEqual(self.client.get("/api/v1/payments/").status_code, 401)
+            self.assertEqual(self.client.get("/api/v1/payments/", HTTP_AUTHORIZATION="Bearer wrong").status_code, 401)
+            response = self.client.get("/api/v1/payments/", HTTP_AUTHORIZATION="Bearer secret")
+        self.assertEqual(response.status_code, 200)
+
+
+    def test_rejects_amounts_daraja_would_refuse_before_any_side_effect(self):
+        cache.clear()
+        with mock.patch.object(api, "API_TOKEN", "secret"):
+            for amount in ("inf", "nan", "-Infinity", 1e12, 250001, 0.5, 10.5, "abc"):
+                response = self.client.post(
+                    "/api/v1/payments/", json.dumps({"phone": "254712345678", "amount": amount}),
+                    content_type="application/json", HTTP_AUTHORIZATION="Bearer secret", HTTP_IDEMPOTENCY_KEY="k1",
+                )
+                self.assertEqual(response.status_code, 400, amount)
+        self.assertFalse(Transaction.objects.exists())
+        self.assertEqual(throttle.claim_phone("254712345678"), 0)
+        self.assertIsNone(idempotency.claim(RequestFactory().post("/pay/", {"idempotency_key": "k1"}),
+                                            "254712345678", 10).replay)
+
+class TenantAdminTests(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "pw"))
+        self.tenant = Tenant.objects.create(slug="acme", name="Acme", consumer_key="key", consumer_secret="s3cret-value",
+                                            shortcode="600000", passkey="pass-key-value")
+
+    def test_never_shows_the_secrets(self):
+        response = self.client.get(f"/admin/stkpush/tenant/{self.tenant.pk}/change/")
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(response, "s3cret-value")
+        self.assertNotContains(response, "pass-key-value")
+
+    def test_blank_secrets_keep_their_value(self):
+        data = {"slug": "acme", "name": "Acme Ltd", "consumer_key": "key", "consumer_secret": "", "shortcode": "600000",
+                "passkey": "new-pass-key", "transaction_type": "CustomerPayBillOnline", "is_active": "on"}
+        response = self.client.post(f"/admin/stkpush/tenant/{self.tenant.pk}/change/", data)
+        self.assertEqual(response.status_code, 302)
+        self.tenant.refresh_from_db()
+        self.assertEqual((self.tenant.name, self.tenant.consumer_secret, self.tenant.passkey),
+                         ("Acme Ltd", "s3cret-value", "new-pass-key"))
+
+
+class PayFormTenantTests(TestCase):
+    def test_the_form_cannot_choose_the_tenant(self):
+        cache.clear()
+        Tenant.objects.create(slug="acme", name="Acme", consumer_key="key", consumer_secret="secret",
+                              shortcode="600000", passkey="passkey")
+        with mock.patch.object(views, "ASYNC_STK_PUSH", True):
+            response = self.client.post("/pay/", {"phone": "254712345678", "amount": "10", "tenant": "acme"})
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(Transaction.objects.get().tenant_id)
+        self.assertNotContains(self.client.get("/pay/?tenant=acme"), 'name="tenant"')
+
+class ArchiveLookupTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        directory = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(override_settings(ARCHIVE_DIR=directory))
+        pending("ws_A")
+        Transaction.objects.update(status=Transaction.Status.SUCCESS)
+        archive.archive(before=timezone.now() + timedelta(seconds=1))
+
+    def test_finds_archived_transactions(self):
+        response = self.client.get("/check-status/", {"checkout_request_id": "ws_A"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Transaction.objects.count(), 0)
+
+    def test_answers_503_when_the_archive_file_is_missing(self):
+        batch = ArchiveBatch.objects.get()
+        os.remove(os.path.join(settings.ARCHIVE_DIR, batch.path))
+        with self.assertLogs("stkpush.views", "ERROR") as logs, mock.patch.object(api, "API_TOKEN", "secret"):
+            responses = [
+                self.client.get("/check-status/", {"checkout_request_id": "ws_A"}),
+                self.client.get("/wait-status/", {"checkout_request_id": "ws_A"}),
+                self.client.get("/api/v1/payments/ws_A/", HTTP_AUTHORIZATION="Bearer secret"),
+            ]
+        self.assertEqual([response.status_code for response in responses], [503, 503, 503])
+        self.assertIn(batch.path, logs.output[0])
+
+
+class ArchivedHistoryTests(TestCase):
+    def setUp(self):
+        directory = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(override_settings(ARCHIVE_DIR=directory))
+        self.old = pending("ws_A", mpesa_receipt_number="QKH0000001")
+        self.new = pending("ws_B", mpesa_receipt_number="QKH0000002")
+        Transaction.objects.update(status=Transaction.Status.SUCCESS)
+        self.cutoff = timezone.now() - timedelta(days=5)
+        Transaction.objects.filter(pk=self.old.pk).update(transaction_date=self.cutoff - timedelta(days=1))
+        archive.archive(before=self.cutoff)
+
+    def test_rebuild_refuses_archived_days(self):
+        rollups.rebuild(since=self.cutoff + timedelta(days=1))
+        with self.assertRaisesMessage(ValueError, "archived"):
+            rollups.rebuild()
+        with self.assertRaises(CommandError):
+            call_command("rebuild_rollups", stdout=io.StringIO())
+
+    def test_matches_archived_receipts(self):
+        entries = [
+            (2, {"receipt": "QKH0000001", "amount": Decimal("10"), "phone": "254712345678"}),
+            (3, {"receipt": "QKH0000002", "amount": Decimal("12"), "phone": "254712345678"}),
+        ]
+        report = list(statements.match_statement(entries))
+        self.assertEqual([(row["kind"], row["receipt"]) for row in report], [("amount_mismatch", "QKH0000002")])
+
+        report = list(statements.match_statement(entries[1:]))
+        self.assertIn(("missing_from_statement", "QKH0000001"), [(row["kind"], row["receipt"]) for row in report])
+
+    def test_keeps_rows_changed_while_their_batch_is_written(self):
+        row = pending("ws_C")
+        Transaction.objects.filter(pk=row.pk).update(status=Transaction.Status.SUCCESS)
+        write_batch = archive.write_batch
+
+        def receipt_arrives(rows, run):
+            written = write_batch(rows, run)
+            Transaction.objects.filter(pk=row.pk, mpesa_receipt_number=None).update(mpesa_receipt_number="QKH0000003")
+            return written
+
+        with mock.patch.object(archive, "write_batch", receipt_arrives):
+            self.assertEqual(archive.archive(before=timezone.now() + timedelta(seconds=1)), 2)
+        self.assertFalse(Transaction.objects.exists())
+        self.assertEqual(archive.find(checkout_request_id="ws_C").mpesa_receipt_number, "QKH0000003")
+        self.assertEqual(archive.find(mpesa_receipt_number="QKH0000003").pk, row.pk)
+
+    def test_exports_archived_rows_in_order(self):
+        rows = list(statements.export_rows())
+        self.assertEqual([row["receipt_number"] for row in rows], ["QKH0000001", "QKH0000002"])
+        self.assertEqual(rows[0]["status"], "Success")
+        self.assertEqual(rows[0]["amount"], Decimal("10.00"))
+        self.assertEqual([row["receipt_number"] for row in statements.export_rows(since=self.cutoff)], ["QKH0000002"])
+
+
+class StatementTests(TestCase):
+    def setUp(self):
+        for receipt, amount in (("QKH0000001", 10), ("QKH0000002", 10), ("QKH0000003", 10), (None, 15),
+                                ("QKH0000005", 20)):
+            pending(f"ws_{amount}_{receipt}", mpesa_receipt_number=receipt, amount=amount)
+        pending("ws_pending")
+        Transaction.objects.exclude(checkout_request_id="ws_pending").update(status=Transaction.Status.SUCCESS)
+
+    def test_reads_portal_exports(self):
+        stream = io.StringIO(
+            "Receipt No.,Completion Time,Details,Transaction Status,Paid In,Withdrawn,Other Party Info\n"
+            'QKH0000001,2025-01-15 12:00:00,Pay,Completed,"1,000.00",,254712345678 - JOHN DOE\n'
+            "QKH0000002,2025-01-15 12:01:00,Withdraw,Completed,,500.00,\n"
+            "QKH0000003,2025-01-15 12:02:00,Pay,Completed,abc,,0712345678 - JANE DOE\n"
+            ",2025-01-15 12:03:00,Pay,Completed,10.00,,2547******678 - JANE DOE\n"
+        )
+        self.assertEqual(list(statements.read_statement(stream)), [
+            (2, {"receipt": "QKH0000001", "amount": Decimal("1000.00"), "phone": "254712345678"}),
+            (4, None),
+            (5, None),
+        ])
+        stream = io.StringIO("receipt,amount,phone\nQKH0000001,10,0712345678\n")
+        self.assertEqual(list(statements.read_statement(stream)), [
+            (2, {"receipt": "QKH0000001", "amount": Decimal("10"), "phone": "254712345678"}),
+        ])
+
+    def test_reports_every_kind_of_discrepancy(self):
+        def entry(receipt, amount, phone="254712345678"):
+            return {"receipt": receipt, "amount": Decimal(amount), "phone": phone}
+
+        entries = [
+            (2, entry("QKH0000001", 10)),
+            (3, entry("QKH0000002", 12)),
+            (4, None),
+            (5, entry("QKH0000003", 10, "254799999999")),
+            (6, entry("QKH0000001", 10)),
+            (7, entry("QKH0000009", 15)),
+            (8, entry("QKH0000008", 99)),
+            (9, entry("QKH0000008", 99)),
+            (10, entry("QKH0000003", 10, "2547******678")),
+        ]
+        report = list(statements.match_statement(entries, chunk_size=2))
+        self.assertEqual(sorted((row["kind"], row["line"], row["receipt"]) for row in report), [
+            ("amount_mismatch", 3, "QKH0000002"),
+            ("duplicate", 6, "QKH0000001"),
+            ("duplicate", 9, "QKH0000008"),
+            ("duplicate", 10, "QKH0000003"),
+            ("invalid", 4, None),
+            ("missing_from_statement", None, "QKH0000005"),
+            ("missing_receipt", 7, "QKH0000009"),
+            ("not_found", 8, "QKH0000008"),
+            ("phone_mismatch", 5, "QKH0000003"),
+        ])
+        duplicate = next(row for row in report if row["line"] == 6)
+        self.assertEqual(duplicate["detail"], "Receipt already on line 2")
+        missing_receipt = next(row for row in report if row["kind"] == "missing_receipt")
+        self.assertEqual(missing_receipt["reference"], Transaction.objects.get(amount=15).reference)
+
+    def test_exports_rows_in_order(self):
+        rows = list(statements.export_rows())
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(list(rows[0]), list(statements.EXPORT_COLUMNS))
+        self.assertEqual([row["receipt_number"] for row in rows[:2]], ["QKH0000001", "QKH0000002"])
+        self.assertEqual(rows[-1]["status"], "Pending")
+
+        successes = list(statements.export_rows(status=Transaction.Status.SUCCESS, chunk_size=2))
+        self.assertEqual(len(successes), 5)
+        self.assertEqual({row["status"] for row in successes}, {"Success"})
+        self.assertEqual(list(statements.export_rows(since=timezone.now() + timedelta(seconds=1))), [])
+
+
+class WebhookReceiver(ThreadingHTTPServer):
+    """
+    Records the event ids of each request; answers `reject` for requests carrying an id in `poison`.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), WebhookReceiverHandler)
+        self.status = 204
+        self.poison = set()
+        self.reject = 400
+        self.requests = []
+
+
+class WebhookReceiverHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        ids = [event["id"] for event in body["events"]]
+        self.server.requests.append(ids)
+        status = self.server.reject if self.server.poison.intersection(ids) else self.server.status
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WebhookTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.receiver = WebhookReceiver()
+        threading.Thread(target=cls.receiver.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.receiver.shutdown()
+        cls.receiver.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.receiver.status = 204
+        self.receiver.poison = set()
+        self.receiver.reject = 400
+        self.receiver.requests = []
+        url = f"http://127.0.0.1:{self.receiver.server_address[1]}/hooks"
+        self.endpoint = WebhookEndpoint.objects.create(name="merchant", url=url)
+
+    def events(self, count):
+        events = [
+            OutboxEvent.objects.create(type="payment.success", reference=uuid.uuid4(), payload="{}")
+            for _ in range(count)
+        ]
+        webhooks.fan_out()
+        return [event.pk for event in events]
+
+    def deliver(self, batch_size=10):
+        claimed = webhooks.claim_endpoints(10)
+        return webhooks.deliver(claimed[0], batch_size) if claimed else 0
+
+    def test_an_endpoint_is_leased_to_one_worker_at_a_time(self):
+        self.events(1)
+        self.assertEqual(webhooks.claim_endpoints(10), [self.endpoint])
+        self.assertEqual(webhooks.claim_endpoints(10), [])
+        WebhookEndpoint.objects.update(locked_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(webhooks.claim_endpoints(10), [self.endpoint])
+
+    def test_skips_endpoints_backing_off_or_with_nothing_to_send(self):
+        self.assertEqual(webhooks.claim_endpoints(10), [])
+        self.events(1)
+        WebhookEndpoint.objects.update(next_attempt_at=timezone.now() + timedelta(seconds=60))
+        self.assertEqual(webhooks.claim_endpoints(10), [])
+
+    def test_delivers_in_order_and_releases_the_lease(self):
+        ids = self.events(5)
+        self.assertEqual(self.deliver(batch_size=2), 5)
+        self.assertEqual(self.receiver.requests, [ids[:2], ids[2:4], ids[4:]])
+        self.assertFalse(WebhookDelivery.objects.exists())
+        self.assertIsNone(WebhookEndpoint.objects.get().locked_until)
+
+    def test_stops_when_the_lease_is_lost(self):
+        self.events(3)
+        endpoint, = webhooks.claim_endpoints(10)
+        WebhookEndpoint.objects.update(locked_until=timezone.now() + timedelta(seconds=5))
+        with self.assertLogs("stkpush.webhooks", "WARNING"):
+            self.assertEqual(webhooks.deliver(endpoint, 1), 1)
+        self.assertEqual(WebhookDelivery.objects.count(), 2)
+
+    def test_a_failed_batch_backs_off_and_dead_letters_after_max_attempts(self):
+        self.events(2)
+        self.receiver.status = 503
+        with mock.patch.object(webhooks, "MAX_ATTEMPTS", 2), self.assertLogs("stkpush.webhooks", "WARNING"):
+            self.assertEqual(self.deliver(), 0)
+            endpoint = WebhookEndpoint.objects.get()
+            self.assertEqual(endpoint.failures, 1)
+            self.assertGreater(endpoint.next_attempt_at, timezone.now())
+            self.assertFalse(WebhookDelivery.objects.exclude(dead_at=None).exists())
+
+            WebhookEndpoint.objects.update(next_attempt_at=None)
+            self.deliver()
+        self.assertEqual(list(WebhookDelivery.objects.values_list("attempts", "last_error")), [(2, "HTTP 503")] * 2)
+        self.assertEqual(WebhookDelivery.objects.filter(dead_at=None).count(), 0)
+        self.assertEqual(webhooks.claim_endpoints(10), [])
+
+    def test_a_rejected_event_does_not_block_the_endpoint(self):
+        ids = self.events(4)
+        self.receiver.poison = {ids[1]}
+        with self.assertLogs("stkpush.webhooks", "WARNING"):
+            self.assertEqual(self.deliver(), 1)
+        self.assertEqual(self.receiver.requests, [ids, [ids[0]], [ids[1]]])
+        dead = WebhookDelivery.objects.get(dead_at__isnull=False)
+        self.assertEqual((dead.event_id, dead.last_error), (ids[1], "HTTP 400"))
+
+        WebhookEndpoint.objects.update(next_attempt_at=None)
+        self.assertEqual(self.deliver(), 2)
+        self.assertEqual(self.receiver.requests[-1], ids[2:])
+
+    def test_only_bad_request_answers_are_rejections(self):
+        ids = self.events(1)
+        self.receiver.poison = set(ids)
+        for status in (401, 403, 404, 408, 429):
+            self.receiver.reject = status
+            WebhookEndpoint.objects.update(next_attempt_at=None)
+            with self.assertLogs("stkpush.webhooks", "WARNING"):
+                self.deliver()
+            self.assertIsNone(WebhookDelivery.objects.get().dead_at, status)
+        self.receiver.reject = 422
+        WebhookEndpoint.objects.update(next_attempt_at=None)
+        with self.assertLogs("stkpush.webhooks", "WARNING"):
+            self.deliver()
+        self.assertIsNotNone(WebhookDelivery.objects.get().dead_at)
+
+    def test_worker_survives_a_locked_database_and_failed_deliveries(self):
+        self.events(1)
+        # The test transaction is invisible to other threads; deliver in this one
+        pool = mock.Mock(map=map)
+        options = {"threads": 1, "batch_size": 10, "poll_interval": 0, "once": True}
+        with mock.patch.object(webhooks, "fan_out", side_effect=[OperationalError("database is locked"), 0, 0, 0]), \
+                mock.patch.object(webhooks, "deliver", side_effect=[OperationalError("database is locked"), 1]), \
+                self.assertLogs("stkpush.management.commands.webhook_worker", "ERROR") as logs:
+            webhook_worker.Command().work(threading.Event(), pool, options)
+            WebhookEndpoint.objects.update(locked_until=None)
+            webhook_worker.Command().work(threading.Event(), pool, options)
+            self.assertEqual(webhooks.deliver.call_count, 2)
+        self.assertEqual(len(logs.records), 2)
+
+
+class WaitStatusTests(TestCase):
+    def test_rejects_timeouts_that_are_not_positive_and_finite(self):
+        pending("ws_A")
+        for timeout in ("nan", "inf", "-5", "0", "soon"):
+            response = self.client.get("/wait-status/", {"checkout_request_id": "ws_A", "timeout": timeout})
+            self.assertEqual(response.status_code, 400, timeout)
+
+    def test_answers_a_changed_status_at_once(self):
+        pending("ws_A")
+        response = self.client.get("/wait-status/", {"checkout_request_id": "ws_A", "status": "Initiating",
+                                                      "timeout": "0.5"})
+        self.assertEqual(response.json()["status"], "Pending")
+
+    def test_pay_page_long_polls_only_under_the_async_views(self):
+        self.assertContains(self.client.get("/pay/"), "const longPoll = false;")
+        with mock.patch.object(views, "ASGI_VIEWS", True):
+            self.assertContains(self.client.get("/pay/"), "const longPoll = true;")
@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import random
+import time
+
+from decouple import config
+from django.core.cache import caches
+from django.db.models import F, Value
+from django.db.models.functions import Greatest, Least
+from django.db.models.lookups import GreaterThanOrEqual
+
+from . import metrics
+from .breaker import DarajaUnavailable
+from .models import RateLimitBucket
+
+logger = logging.getLogger(__name__)
+
+# Longest a call waits for a token before it is rejected; 0 rejects straight away
+MAX_WAIT = config("MPESA_RATE_LIMIT_MAX_WAIT", default=2.0, cast=float)
+# Seconds before another STK Push may be sent to the same phone number; 0 disables
+PHONE_COOLDOWN = config("MPESA_PHONE_COOLDOWN", default=30, cast=int)
+PHONE_CACHE = config("MPESA_PHONE_COOLDOWN_CACHE", default="default")
+
+
+class Throttled(DarajaUnavailable):
+    """
+    Raised when a call is over its rate budget, ours or Safaricom's.
+    """
+    user_message = "Too many payment requests right now. Please try again in a few seconds."
+
+
+class TokenBucket:
+    """
+    Token bucket allowing `rate` calls per second with bursts of `burst`, shared through the database.
+
+    The refill is computed inside the UPDATE that takes the token, so there is no
+    read-modify-write race and no lock to hold. A `rate` of 0 disables the limit.
+    """
+
+    def __init__(self, key, rate, burst=None):
+        self.key = key
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1, rate))
+
+    def claim(self, now):
+        available = Least(
+            Value(self.capacity),
+            F("tokens") + Greatest(Value(now) - F("updated"), Value(0.0)) * Value(self.rate),
+        )
+        return RateLimitBucket.objects.filter(GreaterThanOrEqual(available, 1), key=self.key), {
+            "tokens": available - 1, "updated": Value(now),
+        }
+
+    def try_acquire(self):
+        """
+        Takes a token if one is available.
+
+        Returns:
+            bool: Whether the call may go ahead.
+        """
+        now = time.time()
+        queryset, fields = self.claim(now)
+        if queryset.update(**fields):
+            return True
+        # Empty, or the row is missing (first use, a flushed table, a rolled-back creation)
+        _, created = RateLimitBucket.objects.get_or_create(
+            key=self.key, defaults={"tokens": self.capacity - 1, "updated": now},
+        )
+        return created
+
+    def acquire(self, wait=MAX_WAIT):
+        """
+        Takes a token, waiting up to `wait` seconds for one.
+
+        Raises:
+            Throttled: If no token became available in time.
+        """
+        if not self.rate:
+            return
+        deadline = time.monotonic() + wait
+        with metrics.RATE_LIMIT_WAIT.time(endpoint=self.key):
+            while not self.try_acquire():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise self.rejected()
+                time.sleep(min(remaining, self.backoff()))
+
+    async def aacquire(self, wait=MAX_WAIT):
+        """
+        Async version of `acquire`.
+        """
+        if not self.rate:
+            return
+        deadline = time.monotonic() + wait
+        with metrics.RATE_LIMIT_WAIT.time(endpoint=self.key):
+            while True:
+                now = time.time()
+                queryset, fields = self.claim(now)
+                if await queryset.aupdate(**fields):
+                    return
+                _, created = await RateLimitBucket.objects.aget_or_create(
+                    key=self.key, defaults={"tokens": self.capacity - 1, "updated": now},
+                )
+                if created:
+                    return
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise self.rejected()
+                await asyncio.sleep(min(remaining, self.backoff()))
+
+    def backoff(self):
+        # About one refill interval, jittered so waiting workers do not retry in lockstep
+        return random.uniform(0.5, 1.5) / self.rate
+
+    def rejected(self):
+        metrics.DARAJA_SHED.inc(endpoint=self.key, reason="rate_limit")
+        return Throttled(f"M-Pesa {self.key} rate limit reached", retry_after=1 / self.rate)
+
+    def drain(self):
+        """
+        Empties the bucket, e.g. after Safaricom itself answered 429.
+        """
+        RateLimitBucket.objects.filter(key=self.key).update(tokens=0, updated=time.time())
+
+
+def claim_phone(phone):
+    """
+    Reserves `phone` for one STK Push per PHONE_COOLDOWN seconds.
+
+    Returns:
+        float: 0 if the push may be sent, otherwise the seconds left until it may.
+    """
+    if not PHONE_COOLDOWN:
+        return 0
+    cache = caches[PHONE_CACHE]
+    until = time.time() + PHONE_COOLDOWN
+    if cache.add(f"mpesa:phone:{phone}", until, PHONE_COOLDOWN):
+        return 0
+    metrics.PHONE_THROTTLED.inc()
+    return max(1.0, (cache.get(f"mpesa:phone:{phone}") or until) - time.time())
+
+
+async def aclaim_phone(phone):
+    """
+    Async version of `claim_phone`.
+    """
+    if not PHONE_COOLDOWN:
+        return 0
+    cache = caches[PHONE_CACHE]
+    until = time.time() + PHONE_COOLDOWN
+    if await cache.aadd(f"mpesa:phone:{phone}", until, PHONE_COOLDOWN):
+        return 0
+    metrics.PHONE_THROTTLED.inc()
+    return max(1.0, (await cache.aget(f"mpesa:phone:{phone}") or until) - time.time())
+
+
+def release_phone(phone):
+    """
+    Lifts the cooldown after a push that was never sent, so the customer can retry at once.
+    """
+    caches[PHONE_CACHE].delete(f"mpesa:phone:{phone}")
+
+
+async def arelease_phone(phone):
+    await caches[PHONE_CACHE].adelete(f"mpesa:phone:{phone}")
@@ -1,8 +1,14 @@
 from django.urls import path
-from stkpush import views
+from stkpush import api, views
 
 app_name = 'stkpush'
 
+# Under ASGI, serve the payment endpoints with the native async views
+if views.ASGI_VIEWS:
+    from stkpush import async_views as payment_views
+else:
+    payment_views = views
+
 urlpatterns = [
     # Home page
     path('', views.home, name='home'),
@@ -11,14 +17,39 @@ urlpatterns = [
     path('token/', views.token, name='token'),
     
     # Page to demonstrate STK Push payment
-    path('pay/', views.pay, name='pay'),
+    path('pay/', payment_views.pay, name='pay'),
     
     # Alias for the payment page
     path('stk/', views.stk, name='stk'),
     
     # Callback URL - This is the endpoint Safaricom hits with transaction results
-    path('callback/', views.callback, name='callback'),
+    path('callback/', payment_views.callback, name='callback'),
+
+    # Callback URL of each tenant (paybill or till) registered in the Tenant table
+    path('callback/<slug:tenant>/', payment_views.callback, name='tenant_callback'),
     
+    # C2B URLs registered with Safaricom (register_c2b_urls) for payments made from the SIM menu
+    path('c2b/validation/', views.c2b_validation, name='c2b_validation'),
+    path('c2b/confirmation/', views.c2b_confirmation, name='c2b_confirmation'),
+
     # API endpoint for the frontend to poll transaction status
-    path('check-status/', views.check_status, name='check_status'),
+    path('check-status/', payment_views.check_status, name='check_status'),
+    
+    # Long-poll endpoint that answers when the transaction status changes
+    path('wait-status/', payment_views.wait_status, name='wait_status'),
+
+    # Streaming CSV/JSONL export of transactions for finance (staff only)
+    path('export/transactions/', views.export_transactions, name='export_transactions'),
+
+    # JSON API for the mobile backend: POST to initiate, GET to list (keyset paginated)
+    path('api/v1/payments/', api.payments, name='api_payments'),
+
+    # JSON API totals per hour or day, from the rollup tables
+    path('api/v1/stats/', api.stats, name='api_stats'),
+
+    # JSON API status of one payment, by checkout_request_id or reference
+    path('api/v1/payments/<str:key>/', api.payment_status, name='api_payment_status'),
+
+    # Prometheus scrape endpoint
+    path('metrics', views.metrics_endpoint, name='metrics'),
 ]
@@ -1,23 +1,45 @@
-from django.http import JsonResponse
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
 import requests
 import json
 from .credentials import MpesaAccessToken, LipanaMpesaPassword
+from .payloads import default_builder
+from .breaker import DarajaUnavailable
+from .daraja import DarajaClient
+from .jobs import ASYNC_STK_PUSH, enqueue_stk_push
+from .notify import notifier
+from .status_cache import status_cache
+from .tenants import UnknownTenant, registry
+from . import archive, c2b, db, idempotency, inbox, log, metrics
+from .stk import build_payload, clean_payment, save_accepted, status_payload
+from .throttle import Throttled, claim_phone, release_phone
+from . import statements
 from django.shortcuts import render
 from django.contrib import messages
-import re
+import hmac
 import logging
+import math
+import uuid
 from decouple import config
 from datetime import datetime
 from .models import Transaction
 from django.views.decorators.csrf import csrf_exempt
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, transaction as db_transaction
 
-# Set up logging
+# Handlers and levels are configured through LOGGING in settings
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-handler = logging.FileHandler("mpesa_debug.log")
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+
+# Serve the payment endpoints with the native async views (see urls.py); the pay
+# page only long-polls then, as a waiting request would hold a WSGI worker thread
+ASGI_VIEWS = config('MPESA_ASGI_VIEWS', default=False, cast=bool)
+
+# Slug of the tenant the public pay form sends pushes for; empty uses the shortcode
+# in the environment. Customers cannot pick another one.
+PAY_TENANT = config('MPESA_PAY_TENANT', default='')
+
+# Bearer token scrapers must send to /metrics, which is closed without one
+METRICS_TOKEN = config('MPESA_METRICS_TOKEN', default='')
 
 def home(request):
     """
@@ -32,6 +54,7 @@ def token(request):
     This view calls the MpesaAccessToken helper to get a valid token
     and renders it on the screen. It helps in verifying credentials.
     """
+    access_token = None
     try:
         access_token = MpesaAccessToken.get_access_token()
         if not access_token:
@@ -41,38 +64,41 @@ def token(request):
                 "error": "No access token returned.",
                 "environment": "Production",
                 "current_time": datetime.now(),
-                "short_code": config('MPESA_SHORT_CODE'),
-                "callback_url": config('MPESA_CALLBACK_URL')
+                "short_code": default_builder.shortcode,
+                "callback_url": default_builder.callback_url
             })
 
         return render(request, 'token.html', {
             "token": access_token,
             "environment": "Production",
             "current_time": datetime.now(),
-            "short_code": config('MPESA_SHORT_CODE'),
-            "callback_url": config('MPESA_CALLBACK_URL')
+            "short_code": default_builder.shortcode,
+            "callback_url": default_builder.callback_url
         })
 
     except Exception as err:
         messages.error(request, f"An error occurred: {err}")
-        logger.error(f"Error in token view: {err}")
+        logger.error("Error in token view: %s", err)
         return render(request, 'token.html', {
             "token": access_token,
             "environment": "Production",
             "current_time": datetime.now(),
-            "short_code": config('MPESA_SHORT_CODE'),
-            "callback_url": config('MPESA_CALLBACK_URL'),
+            "short_code": default_builder.shortcode,
+            "callback_url": default_builder.callback_url,
             "debug_token": access_token
         })
 
 
+@metrics.instrument_view("pay")
 def pay(request):
     """
     Handles the STK Push payment process.
     
     GET: Renders the payment form.
     POST: Processes the form data, initiates an STK Push via Safaricom API, 
-          and handles the immediate response (synchronous).
+          and handles the immediate response (synchronous). With
+          MPESA_ASYNC_STK_PUSH enabled the push is queued for the
+          `stk_worker` command instead and a local reference is returned.
           
     Key steps:
     1. Validates phone number and amount.
@@ -80,6 +106,9 @@ def pay(request):
     3. Constructs the API payload (Shortcode, Timestamp, Password, etc.).
     4. Sends the request to Safaricom's STK Push endpoint.
     5. Stores the initial transaction details in the database.
+
+    Repeated submissions (a refreshed form, a client retry) are answered with the
+    outcome of the first one instead of sending another push; see `idempotency`.
     """
     debug_info = {}
     checkout_request_id = None
@@ -88,69 +117,70 @@ def pay(request):
         phone = request.POST.get('phone')
         amount = request.POST.get('amount')
 
-        # Validate phone
-        if not phone or not re.match(r'^\d{10,12}$', phone):
-            msg = "Invalid phone number. Must be 10-12 digits (e.g., 254712345678)."
+        try:
+            phone, amount = clean_payment(phone, amount)
+            tenant = registry.get(PAY_TENANT)
+        except ValueError as e:
+            msg = str(e)
             messages.error(request, msg)
             logger.warning(msg)
-            return render(request, 'pay.html', {'navbar': 'stk', 'debug': debug_info})
+            return render(request, 'pay.html', pay_context(debug=debug_info))
 
-        # Ensure phone starts with 254
-        if not phone.startswith('254'):
-            phone = '254' + phone[-9:]
-
-        # Validate amount
         try:
-            amount = float(amount)
-            if amount <= 0:
-                raise ValueError()
-        except (ValueError, TypeError):
-            msg = "Invalid amount. Must be a positive number."
-            messages.error(request, msg)
-            logger.warning(msg)
-            return render(request, 'pay.html', {'navbar': 'stk', 'debug': debug_info})
+            claim = idempotency.claim(request, phone, amount, tenant=tenant.slug)
+        except idempotency.InProgress:
+            messages.error(request, IN_PROGRESS_MESSAGE)
+            return render(request, 'pay.html', pay_context(debug=debug_info), status=409)
+        if claim.replay is not None:
+            logger.info("Replaying the outcome of a repeated payment request")
+            messages.success(request, claim.replay.get('message', REPLAYED_MESSAGE))
+            context = pay_context(checkout_request_id=claim.replay.get('checkout_request_id'),
+                                  reference=claim.replay.get('reference'))
+            return replayed(render(request, 'pay.html', context))
 
-        # Get access token
-        access_token = MpesaAccessToken.get_access_token()
-        if not access_token:
-            msg = "Failed to obtain access token"
-            messages.error(request, msg)
-            logger.error(msg)
-            return render(request, 'pay.html', {'navbar': 'stk', 'debug': debug_info})
-
-        # API request
-        api_url = "https://api.safaricom.co.ke/mpesa/stkpush/v1/processrequest"
-        headers = {"Authorization": f"Bearer {access_token}"}
-        password, timestamp = LipanaMpesaPassword.generate_password()
-        
-        # Use callback URL from environment
-        callback_url = config('MPESA_CALLBACK_URL')
-        
-        payload = {
-            "BusinessShortCode": LipanaMpesaPassword.Business_short_code,
-            "Password": password,
-            "Timestamp": timestamp,
-            "TransactionType": "CustomerPayBillOnline",
-            "Amount": int(amount),
-            "PartyA": phone,
-            "PartyB": LipanaMpesaPassword.Business_short_code,
-            "PhoneNumber": phone,
-            "CallBackURL": callback_url,
-            "AccountReference": "Your Mpesa-Test",
-            "TransactionDesc": "Payment for your Company"
-        }
-
-        debug_info['request_payload'] = payload
+        wait = claim_phone(phone)
+        if wait:
+            # A double tap, or a retry while the first prompt is still on its way
+            claim.release()
+            messages.error(request, phone_throttled_message(wait))
+            logger.warning("STK Push to %s refused: one was sent moments ago", phone)
+            return retry_later(render(request, 'pay.html', pay_context(debug=debug_info), status=429), wait)
+
+        if ASYNC_STK_PUSH:
+            # Queue the push for the stk_worker command and answer immediately
+            transaction = enqueue_stk_push(phone, amount, tenant=tenant.slug)
+            msg = "Payment request queued. Check your phone shortly."
+            claim.complete(message=msg, reference=str(transaction.reference))
+            messages.success(request, msg)
+            logger.info("STK Push queued as %s", transaction.reference)
+            return render(request, 'pay.html', pay_context(debug=debug_info, reference=transaction.reference))
 
         try:
-            response = requests.post(api_url, json=payload, headers=headers, timeout=30)
+            # Get access token; an open OAuth circuit raises DarajaUnavailable
+            access_token = tenant.token.get_access_token()
+            if not access_token:
+                msg = "Failed to obtain access token"
+                messages.error(request, msg)
+                logger.error(msg)
+                claim.release()
+                release_phone(phone)
+                return render(request, 'pay.html', pay_context(debug=debug_info))
+
+            # API request
+            payload = build_payload(phone, amount, builder=tenant.builder)
+
+            debug_info['request_payload'] = payload
+
+            response = DarajaClient.stk_push(payload, access_token, bucket=tenant.buckets["stkpush"])
             debug_info['status_code'] = response.status_code
             debug_info['response_text'] = response.text
 
             response.raise_for_status()
             res_data = response.json()
             debug_info['response_json'] = res_data
-            logger.info(f"STK Push response: {res_data}")
+            log.bind(checkout_request_id=res_data.get("CheckoutRequestID"))
+            metrics.STK_PUSH_RESULTS.inc(response_code=res_data.get("ResponseCode"))
+            logger.info("STK Push response: %s", res_data)
 
             if res_data.get("ResponseCode") == "0":
                 msg = "STK Push sent successfully. Check your phone."
@@ -159,18 +189,28 @@ def pay(request):
                 
                 # Save transaction
                 checkout_request_id = res_data.get("CheckoutRequestID")
-                Transaction.objects.create(
+                claim.complete(message=msg, checkout_request_id=checkout_request_id)
+                transaction = save_accepted(
                     checkout_request_id=checkout_request_id,
                     merchant_request_id=res_data.get("MerchantRequestID"),
                     phone_number=phone,
                     amount=amount,
-                    status="Pending"
+                    tenant_id=tenant.slug,
                 )
+                status_cache.store(transaction)
             else:
                 err_msg = res_data.get('errorMessage') or res_data.get('message') or "Unknown error"
                 messages.error(request, f"STK Push failed: {err_msg}")
-                logger.error(f"STK Push failed: {err_msg}")
+                logger.error("STK Push failed: %s", err_msg)
 
+        except DarajaUnavailable as e:
+            # Shed or throttled: answer at once and ask the client to back off
+            messages.error(request, e.user_message)
+            logger.warning("STK Push not sent: %s", e)
+            claim.release()
+            release_phone(phone)
+            status = 429 if isinstance(e, Throttled) else 503
+            return retry_later(render(request, 'pay.html', pay_context(debug=debug_info), status=status), e.retry_after)
         except requests.Timeout:
             msg = "Request timed out"
             messages.error(request, msg)
@@ -192,82 +232,274 @@ def pay(request):
             messages.error(request, msg)
             logger.exception(msg)
 
-        return render(request, 'pay.html', {'navbar': 'stk', 'debug': debug_info, 'checkout_request_id': checkout_request_id})
+        if checkout_request_id is None:
+            # Nothing reached the phone, so let the customer try again straight away
+            claim.release()
+            release_phone(phone)
+        return render(request, 'pay.html', pay_context(debug=debug_info, checkout_request_id=checkout_request_id))
+
+    return render(request, 'pay.html', pay_context())
+
+IN_PROGRESS_MESSAGE = "This payment request is already being processed. Check your phone."
+REPLAYED_MESSAGE = "This payment request was already received. Check your phone."
+
 
-    return render(request, 'pay.html', {'navbar': 'stk'})
+def pay_context(**context):
+    """
+    Template context for the payment page, with a fresh idempotency key for the next submission.
+    """
+    return {'navbar': 'stk', 'idempotency_key': uuid.uuid4().hex, 'long_poll': ASGI_VIEWS, **context}
+
+
+def replayed(response):
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def phone_throttled_message(wait):
+    return (f"A payment request was just sent to this number. Check your phone, "
+            f"or try again in {math.ceil(wait)} seconds.")
+
+
+def retry_later(response, seconds):
+    """
+    Sets Retry-After on a 429/503 response.
+    """
+    response['Retry-After'] = str(math.ceil(seconds or 1))
+    return response
 
 def stk(request):
     """
     Alias view for the pay page.
     """
-    return render(request, 'pay.html', {'navbar': 'stk'})
+    return render(request, 'pay.html', pay_context())
 
 @csrf_exempt
-def callback(request):
+@metrics.instrument_view("callback")
+def callback(request, tenant=None):
     """
     Process the asynchronous callback from Safaricom.
     
     This endpoint is hit by Safaricom's servers after the user interacts (enters PIN or cancels) 
-    with the STK push on their phone.
+    with the STK push on their phone. Pushes sent for a tenant call back on
+    /callback/<tenant>/; callbacks for unknown tenants are refused before storing.
     
-    It updates the transaction status in the database based on the ResultCode.
+    The raw payload is appended to the callback inbox and acknowledged. Unless
+    MPESA_CALLBACK_INBOX is set (leaving it to `process_callbacks`), the entry is
+    then applied straight away with a conditional update of the pending transaction.
     """
     if request.method == "POST":
+        if tenant:
+            try:
+                registry.get(tenant)
+            except UnknownTenant:
+                logger.warning("Callback for unknown tenant %s", tenant)
+                return JsonResponse({"ResultCode": 1, "ResultDesc": "Unknown tenant"}, status=404)
+            log.bind(tenant=tenant)
         try:
-            data = json.loads(request.body)
-            logger.info(f"Callback received: {data}")
-            
-            stk_callback = data.get('Body', {}).get('stkCallback', {})
-            checkout_request_id = stk_callback.get('CheckoutRequestID')
-            result_code = stk_callback.get('ResultCode')
-            result_desc = stk_callback.get('ResultDesc')
-            
-            if checkout_request_id:
-                try:
-                    transaction = Transaction.objects.get(checkout_request_id=checkout_request_id)
-                    transaction.result_code = result_code
-                    transaction.result_desc = result_desc
-                    
-                    if result_code == 0:
-                        transaction.status = "Success"
-                        # Extract receipt number if available
-                        items = stk_callback.get('CallbackMetadata', {}).get('Item', [])
-                        for item in items:
-                            if item.get('Name') == 'MpesaReceiptNumber':
-                                transaction.mpesa_receipt_number = item.get('Value')
-                                break
-                    else:
-                        transaction.status = "Failed"
-                    
-                    transaction.save()
-                    logger.info(f"Transaction {checkout_request_id} updated to {transaction.status}")
-                except Transaction.DoesNotExist:
-                    logger.error(f"Transaction with CheckoutRequestID {checkout_request_id} not found")
-            
-            return JsonResponse({"ResultCode": 0, "ResultDesc": "Success"})
+            # Store the raw callback first, committed on its own so that nothing going
+            # wrong while applying it can lose it; duplicates and replays are harmless
+            entry = inbox.append(request.body)
         except json.JSONDecodeError:
             logger.error("Failed to parse callback JSON")
             return JsonResponse({"ResultCode": 1, "ResultDesc": "Invalid JSON"}, status=400)
+
+        log.bind(checkout_request_id=entry.checkout_request_id)
+        if not inbox.QUEUED_CALLBACKS:
+            try:
+                with db_transaction.atomic():
+                    inbox.process(entry)
+            except Exception:
+                # Stored, so acknowledge it anyway; `process_callbacks` applies it later
+                logger.exception("Failed to apply callback %s, left in the inbox", entry.pk)
+        logger.info("Callback received for %s", entry.checkout_request_id)
+        return JsonResponse({"ResultCode": 0, "ResultDesc": "Success"})
     return JsonResponse({"ResultCode": 1, "ResultDesc": "Invalid request"}, status=400)
 
+@csrf_exempt
+@metrics.instrument_view("c2b_validation")
+def c2b_validation(request):
+    """
+    C2B validation URL: Safaricom asks whether to complete a paybill/till payment.
+
+    Answered from memory (see `c2b.validate`) so it stays within Safaricom's
+    deadline even while the database is busy.
+    """
+    if request.method != "POST":
+        return JsonResponse({"ResultCode": 1, "ResultDesc": "Invalid request"}, status=400)
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        logger.error("Failed to parse C2B validation JSON")
+        return JsonResponse(c2b.rejected(c2b.OTHER_ERROR))
+    if not isinstance(data, dict):
+        return JsonResponse(c2b.rejected(c2b.OTHER_ERROR))
+    result = c2b.validate(data)
+    if result is not c2b.ACCEPTED:
+        logger.info("C2B payment to account %s rejected with %s", data.get("BillRefNumber"), result["ResultCode"])
+    return JsonResponse(result)
+
+@csrf_exempt
+@metrics.instrument_view("c2b_confirmation")
+def c2b_confirmation(request):
+    """
+    C2B confirmation URL: Safaricom reports a completed paybill/till payment.
+
+    The payment is stored through the group-committing writer and acknowledged
+    once committed. Repeated deliveries are acknowledged without a second row.
+    """
+    if request.method != "POST":
+        return JsonResponse({"ResultCode": 1, "ResultDesc": "Invalid request"}, status=400)
+    try:
+        c2b.confirm(request.body)
+    except ValueError as e:
+        # Includes json.JSONDecodeError
+        logger.error("Invalid C2B confirmation: %s", e)
+        return JsonResponse({"ResultCode": 1, "ResultDesc": "Invalid confirmation"}, status=400)
+    except (TimeoutError, DatabaseError) as e:
+        logger.error("C2B confirmation not stored: %s", e)
+        return JsonResponse({"ResultCode": 1, "ResultDesc": "Temporarily unavailable"}, status=503)
+    return JsonResponse(c2b.CONFIRMED)
+
+@metrics.instrument_view("check_status")
+@db.reads_from_replica
 def check_status(request):
     """
     API endpoint to check the status of a transaction.
     
     Used by the frontend to poll for updates on a specific transaction
-    (e.g., waiting for the user to enter their PIN).
+    (e.g., waiting for the user to enter their PIN). Accepts either the
+    `checkout_request_id` from Safaricom or the local `reference` returned
+    when the push was queued asynchronously.
     """
     checkout_request_id = request.GET.get('checkout_request_id')
-    if not checkout_request_id:
+    reference = request.GET.get('reference')
+    if not checkout_request_id and not reference:
         return JsonResponse({"error": "Missing checkout_request_id"}, status=400)
     
+    # The status cache is written through by pay/callback; read the DB only on a miss
+    entry = status_cache.get(checkout_request_id or reference)
+    if entry is None:
+        try:
+            if checkout_request_id:
+                transaction = archive.get(Transaction.objects, checkout_request_id=checkout_request_id)
+            else:
+                transaction = archive.get(Transaction.objects, reference=reference)
+        except (Transaction.DoesNotExist, ValidationError):
+            return JsonResponse({"error": "Transaction not found"}, status=404)
+        except archive.ArchiveError as e:
+            return archive_unavailable(e)
+        entry = status_cache.store(transaction)
+    return status_response(request, entry)
+
+def archive_unavailable(error):
+    """
+    Answers a status lookup for an archived transaction whose archive file cannot be read.
+    """
+    logger.error("Cannot read an archived transaction: %s", error)
+    return JsonResponse({"error": "The transaction archive is unavailable"}, status=503)
+
+def status_response(request, entry):
+    """
+    Builds the check_status response for a status cache entry, honouring If-None-Match.
+    """
+    if request.headers.get('If-None-Match') == entry['etag']:
+        response = HttpResponseNotModified()
+    else:
+        response = JsonResponse(entry['payload'])
+    response['ETag'] = entry['etag']
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+# Upper bound for one long-poll request, kept below common proxy timeouts
+WAIT_STATUS_MAX_TIMEOUT = 30
+
+def wait_timeout(request):
+    """
+    Returns the `timeout` query parameter capped at WAIT_STATUS_MAX_TIMEOUT, or None
+    unless it is a positive finite number (nan would make the wait loop forever).
+    """
     try:
-        transaction = Transaction.objects.get(checkout_request_id=checkout_request_id)
-        return JsonResponse({
-            "status": transaction.status,
-            "result_code": transaction.result_code,
-            "result_desc": transaction.result_desc,
-            "receipt_number": transaction.mpesa_receipt_number
-        })
-    except Transaction.DoesNotExist:
+        timeout = float(request.GET.get('timeout', 25))
+    except ValueError:
+        return None
+    if not math.isfinite(timeout) or timeout <= 0:
+        return None
+    return min(timeout, WAIT_STATUS_MAX_TIMEOUT)
+
+@metrics.instrument_view("wait_status")
+def wait_status(request):
+    """
+    Long-poll version of `check_status`.
+
+    Answers as soon as the transaction's status differs from the `status` the
+    client last saw (or is final), otherwise holds the request open until the
+    callback wakes it or `timeout` seconds pass. A waiting client costs one idle
+    connection and at most two database reads instead of a query every 2 seconds.
+    """
+    checkout_request_id = request.GET.get('checkout_request_id')
+    reference = request.GET.get('reference')
+    if not checkout_request_id and not reference:
+        return JsonResponse({"error": "Missing checkout_request_id"}, status=400)
+    timeout = wait_timeout(request)
+    if timeout is None:
+        return JsonResponse({"error": "Invalid timeout"}, status=400)
+
+    lookup = {'checkout_request_id': checkout_request_id} if checkout_request_id else {'reference': reference}
+    try:
+        transaction = archive.get(Transaction.objects, **lookup)
+    except (Transaction.DoesNotExist, ValidationError):
         return JsonResponse({"error": "Transaction not found"}, status=404)
+    except archive.ArchiveError as e:
+        return archive_unavailable(e)
+
+    # Clients pass the status label they last saw
+    known_status = request.GET.get('status') or transaction.get_status_display()
+    if transaction.get_status_display() == known_status and transaction.status not in Transaction.TERMINAL_STATUSES:
+        keys = (transaction.checkout_request_id, transaction.reference)
+        if notifier.wait(keys, known_status, timeout):
+            transaction.refresh_from_db()
+    return JsonResponse(status_payload(transaction))
+
+@staff_member_required
+@db.reads_from_replica
+def export_transactions(request):
+    """
+    Streams transactions as CSV or JSON Lines for reconciliation (staff only).
+
+    Query parameters: `since` and `until` (ISO dates, `until` exclusive), `status`
+    (a status label such as Success) and `format` (csv or jsonl). Rows are read
+    from a database cursor and written as they are produced, so exports of any
+    size use constant memory.
+    """
+    fmt = request.GET.get('format', 'csv')
+    if fmt not in statements.RENDERERS:
+        return JsonResponse({"error": "Invalid format"}, status=400)
+    try:
+        since = statements.parse_time(request.GET['since']) if request.GET.get('since') else None
+        until = statements.parse_time(request.GET['until']) if request.GET.get('until') else None
+        status = statements.parse_status(request.GET['status']) if request.GET.get('status') else None
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    rows = statements.export_rows(since, until, status)
+    content_type = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    response = StreamingHttpResponse(statements.RENDERERS[fmt](rows), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="transactions.{fmt}"'
+    return response
+
+def metrics_endpoint(request):
+    """
+    Exposes latency histograms, counters and gauges in the Prometheus text format.
+
+    Values are summed over all worker processes when MPESA_METRICS_DIR is set.
+    Scrapers must send MPESA_METRICS_TOKEN as a bearer token; without it set the
+    endpoint is closed (503), like the API.
+    """
+    if not METRICS_TOKEN:
+        logger.error("Refused a metrics request: MPESA_METRICS_TOKEN is not set")
+        return HttpResponse(status=503)
+    # As bytes: compare_digest refuses str with non-ASCII characters
+    if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), f'Bearer {METRICS_TOKEN}'.encode()):
+        return HttpResponse(status=401)
+    return HttpResponse(metrics.REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,315 @@
+"""
+Outbound webhooks for payment status changes, through a transactional outbox.
+
+Every status change writes an `OutboxEvent` in the database transaction that
+makes it, so there is an event exactly when the change was committed. The
+`webhook_worker` command then:
+
+1. queues new events for the matching active endpoints, as `WebhookDelivery` rows;
+2. takes a short lease on each endpoint with pending deliveries and POSTs them,
+   oldest first and up to MPESA_WEBHOOK_BATCH_SIZE per request, over a pooled
+   keep-alive session.
+
+Deliveries are deleted once the endpoint answers 2xx. On any other outcome the
+batch stays pending and the endpoint backs off exponentially; nothing newer is
+sent to it meanwhile, so an endpoint receives each transaction's events in order.
+Delivery is at least once: receivers should ignore event ids they have seen.
+
+So that one event cannot hold up an endpoint forever, a delivery is
+dead-lettered (kept, but no longer sent) once it has failed MAX_ATTEMPTS times,
+or at once if the endpoint rejects it with a 4xx other than 408 or 429. A batch
+rejected that way is resent one event at a time to find the events at fault.
+"""
+import hashlib
+import hmac
+import json
+import logging
+import random
+import threading
+import time
+from datetime import timedelta
+
+import requests
+from decouple import config
+from django.db import transaction as db_transaction
+from django.db.models import Exists, F, OuterRef, Q
+from django.utils import timezone
+from requests.adapters import HTTPAdapter
+
+from . import metrics
+from .models import OutboxEvent, Transaction, WebhookDelivery, WebhookEndpoint
+
+logger = logging.getLogger(__name__)
+
+# Write outbox events for status changes; off unless an endpoint is going to consume them
+WEBHOOKS_ENABLED = config("MPESA_WEBHOOKS", default=False, cast=bool)
+# Events sent per request to an endpoint
+BATCH_SIZE = config("MPESA_WEBHOOK_BATCH_SIZE", default=100, cast=int)
+# (connect, read) timeout of a request, in seconds
+TIMEOUT = (3.05, config("MPESA_WEBHOOK_TIMEOUT", default=10, cast=float))
+# Backoff after the n-th consecutive failure: RETRY_BASE * 2 ** (n - 1), capped at RETRY_MAX (seconds)
+RETRY_BASE = config("MPESA_WEBHOOK_RETRY_BASE", default=1.0, cast=float)
+RETRY_MAX = config("MPESA_WEBHOOK_RETRY_MAX", default=600.0, cast=float)
+# Failed requests after which an event is dead-lettered (about 3.5 hours with the default backoff)
+MAX_ATTEMPTS = config("MPESA_WEBHOOK_MAX_ATTEMPTS", default=30, cast=int)
+# A worker that has not renewed its lease on an endpoint after this many seconds loses it
+LEASE = config("MPESA_WEBHOOK_LEASE", default=60, cast=int)
+# Connections kept open per endpoint host
+POOL_MAXSIZE = config("MPESA_WEBHOOK_POOL_MAXSIZE", default=10, cast=int)
+# Delivered events are deleted after this many days
+RETENTION_DAYS = config("MPESA_WEBHOOK_RETENTION_DAYS", default=7, cast=int)
+# Statuses by which an endpoint refuses the events themselves. Any other answer,
+# 401, 403 and 404 included (a rotated secret, a moved URL), is an endpoint failure
+# that is retried.
+REJECTED_STATUSES = (400, 422)
+
+EVENT_TYPES = {
+    Transaction.Status.PENDING: "payment.pending",
+    Transaction.Status.SUCCESS: "payment.success",
+    Transaction.Status.FAILED: "payment.failed",
+}
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def session():
+    """
+    Returns the process-wide session, whose pooled connections are shared by all worker threads.
+
+    Requests are not retried here: a failed batch is retried by the worker, after a backoff.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                adapter = HTTPAdapter(pool_connections=10, pool_maxsize=POOL_MAXSIZE, max_retries=0)
+                new_session = requests.Session()
+                new_session.mount("https://", adapter)
+                new_session.mount("http://", adapter)
+                new_session.headers.update({"Content-Type": "application/json", "Connection": "keep-alive"})
+                _session = new_session
+    return _session
+
+
+def event_data(transaction):
+    """
+    The description of a transaction sent in its events.
+    """
+    return {
+        "reference": str(transaction.reference),
+        "checkout_request_id": transaction.checkout_request_id,
+        "status": transaction.get_status_display(),
+        "result_code": transaction.result_code,
+        "result_desc": transaction.result_desc,
+        "receipt_number": transaction.mpesa_receipt_number,
+        "amount": str(transaction.amount),
+        "phone_number": transaction.phone_number,
+        "account_reference": transaction.account_reference,
+        "tenant": transaction.tenant_id,
+        "transaction_date": transaction.transaction_date.isoformat(),
+        "mpesa_transaction_date": transaction.mpesa_transaction_date and transaction.mpesa_transaction_date.isoformat(),
+    }
+
+
+def publish(transactions):
+    """
+    Writes an outbox event for the current status of each transaction.
+
+    Call it inside the database transaction that changed them, with their final
+    field values, so the events commit or roll back with the change.
+    """
+    if not WEBHOOKS_ENABLED:
+        return
+    OutboxEvent.objects.bulk_create([
+        OutboxEvent(
+            type=EVENT_TYPES[transaction.status], reference=transaction.reference, tenant=transaction.tenant_id or "",
+            payload=json.dumps(event_data(transaction), separators=(",", ":")),
+        )
+        for transaction in transactions
+    ])
+
+
+def fan_out(limit=1000):
+    """
+    Queues up to `limit` new events for every active endpoint they are meant for.
+
+    Endpoints added later only receive the events queued after them. Concurrent
+    calls may pick the same events; the deliveries they create are deduplicated.
+
+    Returns:
+        int: Number of events queued.
+    """
+    events = list(OutboxEvent.objects.filter(dispatched_at=None).order_by("id").values_list("id", "tenant")[:limit])
+    if not events:
+        return 0
+    endpoints = list(WebhookEndpoint.objects.filter(is_active=True).values_list("id", "tenant"))
+    with db_transaction.atomic():
+        WebhookDelivery.objects.bulk_create(
+            [
+                WebhookDelivery(endpoint_id=endpoint_id, event_id=event_id)
+                for event_id, tenant in events
+                for endpoint_id, endpoint_tenant in endpoints
+                if not endpoint_tenant or endpoint_tenant == tenant
+            ],
+            batch_size=1000,
+            ignore_conflicts=True,
+        )
+        OutboxEvent.objects.filter(pk__in=[event_id for event_id, _ in events]).update(dispatched_at=timezone.now())
+    return len(events)
+
+
+def claim_endpoints(limit):
+    """
+    Leases up to `limit` active endpoints that have pending deliveries and are not backing off.
+
+    Like `jobs.claim_jobs`, each lease is a conditional UPDATE on the previous
+    `locked_until`, so only one worker delivers to an endpoint at a time.
+
+    Returns:
+        list[WebhookEndpoint]: The endpoints this worker now holds, with `locked_until` set to its lease.
+    """
+    now = timezone.now()
+    candidates = (
+        WebhookEndpoint.objects.filter(is_active=True)
+        .filter(Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now))
+        .filter(Q(locked_until__isnull=True) | Q(locked_until__lt=now))
+        .filter(Exists(WebhookDelivery.objects.filter(endpoint=OuterRef("pk"), dead_at=None)))
+        .order_by("next_attempt_at", "id")
+        .values_list("id", "locked_until")[:limit]
+    )
+
+    claimed = []
+    lease = now + timedelta(seconds=LEASE)
+    for pk, locked_until in candidates:
+        if WebhookEndpoint.objects.filter(pk=pk, locked_until=locked_until).update(locked_until=lease):
+            claimed.append(pk)
+    return list(WebhookEndpoint.objects.filter(pk__in=claimed).order_by("id"))
+
+
+def request_body(deliveries):
+    # The payloads are already JSON; splice them in rather than decoding and re-encoding them
+    return "".join((
+        '{"events":[',
+        ",".join(
+            f'{{"id":{delivery.event_id},"type":"{delivery.event.type}",'
+            f'"created_at":"{delivery.event.created_at.isoformat()}","data":{delivery.event.payload}}}'
+            for delivery in deliveries
+        ),
+        "]}",
+    )).encode()
+
+
+def signature(secret, body):
+    return hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+def backoff(failures):
+    """
+    Seconds to wait after the `failures`-th consecutive failure, with up to 10% jitter.
+    """
+    delay = min(RETRY_MAX, RETRY_BASE * 2 ** (failures - 1))
+    return delay * random.uniform(0.9, 1.0)
+
+
+def send(endpoint, deliveries):
+    """
+    POSTs a batch of deliveries to an endpoint.
+
+    Returns:
+        tuple: (error, rejected): `error` is empty if the endpoint accepted the batch,
+            otherwise what went wrong; `rejected` is True if it refused the events
+            (one of REJECTED_STATUSES).
+    """
+    body = request_body(deliveries)
+    headers = {"X-Mpesa-Signature": signature(endpoint.secret, body)} if endpoint.secret else {}
+    started = time.perf_counter()
+    try:
+        response = session().post(endpoint.url, data=body, headers=headers, timeout=TIMEOUT)
+    except requests.RequestException as e:
+        return str(e)[:255] or type(e).__name__, False
+    finally:
+        metrics.WEBHOOK_SECONDS.observe(time.perf_counter() - started)
+    if 200 <= response.status_code < 300:
+        return "", False
+    return f"HTTP {response.status_code}", response.status_code in REJECTED_STATUSES
+
+
+def deliver(endpoint, batch_size=BATCH_SIZE):
+    """
+    Sends a leased endpoint its pending events in batches, oldest first, until
+    none are left, a request fails or the lease is lost, then releases the lease.
+
+    A failed request counts an attempt against each of its events and dead-letters
+    those out of attempts. An event the endpoint rejects on its own is dead-lettered
+    at once; a rejected batch of several events is resent one event at a time.
+
+    Returns:
+        int: Number of events delivered.
+    """
+    lease = endpoint.locked_until
+    delivered = 0
+    while True:
+        deliveries = list(
+            WebhookDelivery.objects.filter(endpoint=endpoint, dead_at=None)
+            .select_related("event").order_by("event_id")[:batch_size]
+        )
+        if not deliveries:
+            break
+        error, rejected = send(endpoint, deliveries)
+        now = timezone.now()
+        if error:
+            metrics.WEBHOOK_EVENTS.inc(len(deliveries), result="failed")
+            if rejected and len(deliveries) > 1:
+                # Only some of the events may be at fault; the others should still get through
+                batch_size = 1
+                continue
+            failures = endpoint.failures + 1
+            dead = 0
+            with db_transaction.atomic():
+                held = WebhookEndpoint.objects.filter(pk=endpoint.pk, locked_until=lease).update(
+                    failures=failures, last_error=error, locked_until=None,
+                    next_attempt_at=now + timedelta(seconds=backoff(failures)),
+                )
+                if held:
+                    failed = WebhookDelivery.objects.filter(pk__in=[delivery.pk for delivery in deliveries])
+                    failed.update(attempts=F("attempts") + 1, last_error=error)
+                    if not rejected:
+                        failed = failed.filter(attempts__gte=MAX_ATTEMPTS)
+                    dead = failed.update(dead_at=now)
+            logger.warning("Webhook %s failed (%s in a row): %s", endpoint.name, failures, error)
+            if dead:
+                metrics.WEBHOOK_EVENTS.inc(dead, result="dead")
+                logger.error("Webhook %s: dead-lettered %s events (%s)", endpoint.name, dead, error)
+            return delivered
+
+        metrics.WEBHOOK_EVENTS.inc(len(deliveries), result="delivered")
+        renewed = now + timedelta(seconds=LEASE)
+        with db_transaction.atomic():
+            WebhookDelivery.objects.filter(pk__in=[delivery.pk for delivery in deliveries]).delete()
+            held = WebhookEndpoint.objects.filter(pk=endpoint.pk, locked_until=lease).update(
+                failures=0, last_error="", next_attempt_at=None, last_delivered_at=now, locked_until=renewed,
+            )
+        delivered += len(deliveries)
+        endpoint.failures = 0
+        if not held:
+            logger.warning("Lease on webhook %s expired during delivery", endpoint.name)
+            return delivered
+        lease = renewed
+
+    WebhookEndpoint.objects.filter(pk=endpoint.pk, locked_until=lease).update(locked_until=None)
+    return delivered
+
+
+def prune(older_than=timedelta(days=RETENTION_DAYS)):
+    """
+    Deletes the events queued more than `older_than` ago that no endpoint is still waiting for.
+
+    Returns:
+        int: Number of events deleted.
+    """
+    cutoff = timezone.now() - older_than
+    pending = WebhookDelivery.objects.filter(event=OuterRef("pk"))
+    stale = OutboxEvent.objects.filter(dispatched_at__lt=cutoff).filter(~Exists(pending))
+    _, deleted = stale.delete()
+    return deleted.get(OutboxEvent._meta.label, 0)